@@ -1,11 +1,11 @@
 from tastypie.resources import ModelResource, Resource, ALL, ALL_WITH_RELATIONS
 from tastypie import fields
-from tastypie.paginator import Paginator
 
 from django.core.exceptions import PermissionDenied
 from django.db.models import Q, Count
 
 from apps.agency.models import Agency
+from apps.core.pagination import KeysetResourcePaginator
 from apps.government.models import Government
 from apps.government.api import GovernmentResource
 from apps.contacts.api import ContactResource
@@ -55,16 +55,6 @@ class AgencyValidation(Validation):
             return 'An agency with that name and government already exists, please select a different government or use a different name.'
         return {}
 
-class AgencyPaginator(Paginator):
-
-    def get_next(self, limit, offset, count):
-        # See http://django-tastypie.readthedocs.org/en/latest/paginator.html
-        count = 2 ** 64
-        return super(AgencyPaginator, self).get_next(limit, offset, count)
-
-    def get_count(self):
-        return None
-
 def agency_is_valid(bundle, request=None):
     if not bundle.data:
         return 'No data submitted'
@@ -115,7 +105,7 @@ class AgencyResource(ModelResource):
         #authentication = AgencyAuthentication()
         validation = AgencyValidation()
         always_return_data = True
-        paginator_class = AgencyPaginator
+        paginator_class = KeysetResourcePaginator
         filtering = {
             'id': ALL,
             'name' : ALL,
@@ -125,18 +115,11 @@ class AgencyResource(ModelResource):
             'pub_contact_cnt': ALL
         }
 
-    def alter_list_data_to_serialize(self, request, data):
-        result = super(AgencyResource, self).alter_list_data_to_serialize(request, data)
-        data['meta']['total_count'] = self.current_data_len
-        return result
-
-
     def get_object_list(self, request):
         result = super(AgencyResource, self).get_object_list(request)
         return result
 
     def build_filters(self, filters=None):
-        self.current_data_len = 100
         if filters is None:
             filters = {}
 
@@ -185,7 +168,6 @@ class AgencyResource(ModelResource):
         #staff/supers can edit anything so no need to filter
         if show_can_edit and not request.user.is_staff and not request.user.is_superuser:
             filtered = filtered.filter(creator=request.user)
-        self.current_data_len = filtered.count()
         return filtered
         
     def dehydrate(self, bundle):
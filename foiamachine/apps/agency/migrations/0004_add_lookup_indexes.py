@@ -0,0 +1,23 @@
+# Generated migration for lookup indexes
+# This migration indexes deprecated, which every manager filters on, and the live agency names
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agency', '0003_add_medicaid_fields'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='agency',
+            name='deprecated',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='agency',
+            index=models.Index(condition=models.Q(deprecated__isnull=True, hidden=False), fields=['name'], name='agency_live_name_idx'),
+        ),
+    ]
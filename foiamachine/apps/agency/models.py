@@ -46,6 +46,11 @@ class Agency(BaseData):
 
     class Meta:
         verbose_name_plural = 'Agencies'
+        indexes = [
+            #AgencyManager's filter, the agency pickers sort what's left by name
+            models.Index(fields=['name'], condition=models.Q(deprecated__isnull=True, hidden=False),
+                         name='agency_live_name_idx'),
+        ]
 
     def __str__(self):
         return self.name
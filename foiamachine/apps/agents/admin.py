@@ -3,7 +3,8 @@ Agent admin configuration
 """
 
 from django.contrib import admin
-from .models import AgentTask, AgentSuggestion, AgentWorkflow
+from .models import AgentCall, AgentTask, AgentSuggestion, AgentUsage, AgentWorkflow
+from .usage import percentile
 
 
 @admin.register(AgentTask)
@@ -12,12 +13,12 @@ class AgentTaskAdmin(admin.ModelAdmin):
     
     list_display = [
         'id', 'task_type', 'status', 'user', 'foia_request',
-        'created_at', 'tokens_used'
+        'created_at', 'tokens_used', 'cache_hit', 'latency_ms', 'cost'
     ]
-    list_filter = ['task_type', 'status', 'agent_model']
+    list_filter = ['task_type', 'status', 'agent_model', 'cache_hit']
     search_fields = ['user__email', 'foia_request__title']
     date_hierarchy = 'created_at'
-    readonly_fields = ['created_at', 'updated_at', 'started_at', 'completed_at']
+    readonly_fields = ['created_at', 'updated_at', 'started_at', 'completed_at', 'idempotency_key']
     
     fieldsets = (
         ('Task Information', {
@@ -27,10 +28,13 @@ class AgentTaskAdmin(admin.ModelAdmin):
             'fields': ('input_data', 'output_data')
         }),
         ('Processing', {
-            'fields': ('started_at', 'completed_at', 'error_message')
+            'fields': ('started_at', 'completed_at', 'error_message', 'idempotency_key')
         }),
         ('Agent Metadata', {
-            'fields': ('agent_model', 'tokens_used')
+            'fields': ('agent_model', 'tokens_used', 'cache_hit', 'tokens_saved')
+        }),
+        ('Usage', {
+            'fields': ('prompt_tokens', 'completion_tokens', 'latency_ms', 'queue_ms', 'retries', 'cost')
         }),
         ('Timestamps', {
             'fields': ('created_at', 'updated_at'),
@@ -84,3 +88,54 @@ class AgentWorkflowAdmin(admin.ModelAdmin):
             'classes': ('collapse',)
         }),
     )
+
+
+@admin.register(AgentCall)
+class AgentCallAdmin(admin.ModelAdmin):
+    """Admin interface for Agent Call model, written by the engine only"""
+    
+    list_display = [
+        'created_at', 'task_type', 'model', 'outcome', 'user',
+        'latency_ms', 'queue_ms', 'prompt_tokens', 'completion_tokens', 'retries', 'cost'
+    ]
+    list_filter = ['outcome', 'task_type', 'model']
+    search_fields = ['user__email']
+    date_hierarchy = 'created_at'
+    raw_id_fields = ['task', 'user']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(AgentUsage)
+class AgentUsageAdmin(admin.ModelAdmin):
+    """Admin interface for the daily Agent Usage rollups"""
+    
+    list_display = [
+        'day', 'task_type', 'model', 'user', 'calls', 'errors', 'cached',
+        'prompt_tokens', 'completion_tokens', 'cost', 'latency_p50', 'latency_p95', 'queue_mean'
+    ]
+    list_filter = ['task_type', 'model']
+    search_fields = ['user__email']
+    date_hierarchy = 'day'
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    @admin.display(description='p50 ms')
+    def latency_p50(self, obj):
+        return percentile(obj.latency_histogram, 0.5)
+    
+    @admin.display(description='p95 ms')
+    def latency_p95(self, obj):
+        return percentile(obj.latency_histogram, 0.95)
+    
+    @admin.display(description='Queue ms')
+    def queue_mean(self, obj):
+        return round(obj.queue_ms_total / obj.calls) if obj.calls else None
@@ -9,6 +9,9 @@ app_name = 'agents_api'
 
 urlpatterns = [
     path('draft-request/', views.draft_request_with_agent, name='draft_request'),
+    path('draft-request/stream/', views.draft_request_stream, name='draft_request_stream'),
     path('analyze-response/<int:request_id>/', views.analyze_response_with_agent, name='analyze_response'),
     path('generate-followup/<int:request_id>/', views.generate_followup_with_agent, name='generate_followup'),
+    path('tasks/<int:task_id>/', views.task_status, name='task_status'),
+    path('usage/', views.usage_report, name='usage'),
 ]
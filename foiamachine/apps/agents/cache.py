@@ -0,0 +1,165 @@
+"""
+Content-addressed cache of LLM completions
+
+Entries are keyed on a hash of the backend, model, temperature, token limit,
+system prompt and prompt, so an identical call is answered without tokens.
+They live in a local SQLite file shared by every process on the host, with
+a small in-memory LRU in front. Entries expire after a TTL and the least
+recently used ones are evicted beyond max_entries.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from .llm import LLMRequest, agent_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 7 * 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 10000
+MEMORY_ENTRIES = 512
+# expired and surplus rows are swept every this many writes
+EVICT_EVERY = 100
+
+
+def backend_namespace(backend) -> str:
+    """Completions from different backends or endpoints never share entries"""
+    return f"{backend.__class__.__name__}:{getattr(backend, 'api_base', '')}"
+
+
+def cache_key(request: LLMRequest, namespace: str = '') -> str:
+    data = json.dumps([
+        namespace, request.model, request.temperature, request.max_tokens,
+        request.system_prompt or '', request.prompt
+    ], separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class LLMCache:
+
+    def __init__(self, path: str, ttl: int = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_entries = min(MEMORY_ENTRIES, max_entries)
+        self.writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS llm_cache ('
+                'key TEXT PRIMARY KEY, content TEXT NOT NULL, tokens_used INTEGER NOT NULL, '
+                'created REAL NOT NULL, last_used REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used)')
+
+    def connection(self) -> sqlite3.Connection:
+        """One connection per thread, the engine reads and writes from its workers"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+    def remember(self, key: str, entry: Dict[str, Any]):
+        with self.lock:
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """{'content', 'tokens_used'} or None when missing or expired"""
+        now = self.clock()
+        conn = self.connection()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and entry['created'] + self.ttl > now:
+                self.memory.move_to_end(key)
+            else:
+                entry = None
+                self.memory.pop(key, None)
+        if entry is not None:
+            # the file's recency decides what other processes evict
+            with conn:
+                conn.execute('UPDATE llm_cache SET last_used = ? WHERE key = ?', (now, key))
+            return entry
+        row = conn.execute('SELECT content, tokens_used, created FROM llm_cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        with conn:
+            if row[2] + self.ttl <= now:
+                conn.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                return None
+            conn.execute('UPDATE llm_cache SET last_used = ? WHERE key = ?', (now, key))
+        entry = {'content': row[0], 'tokens_used': row[1], 'created': row[2]}
+        self.remember(key, entry)
+        return entry
+
+    def set(self, key: str, content: str, tokens_used: int):
+        now = self.clock()
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO llm_cache (key, content, tokens_used, created, last_used) '
+                'VALUES (?, ?, ?, ?, ?)', (key, content, tokens_used, now, now)
+            )
+        self.remember(key, {'content': content, 'tokens_used': tokens_used, 'created': now})
+        with self.lock:
+            self.writes += 1
+            sweep = self.writes % EVICT_EVERY == 0
+        if sweep:
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries and the least recently used beyond max_entries"""
+        conn = self.connection()
+        with conn:
+            conn.execute('DELETE FROM llm_cache WHERE created <= ?', (self.clock() - self.ttl,))
+            conn.execute(
+                'DELETE FROM llm_cache WHERE key IN '
+                '(SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (self.max_entries,)
+            )
+
+    def clear(self):
+        with self.connection() as conn:
+            conn.execute('DELETE FROM llm_cache')
+        with self.lock:
+            self.memory.clear()
+
+    def __len__(self):
+        return self.connection().execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Optional[LLMCache]:
+    """The process-wide cache at AGENT_CONFIG['CACHE_PATH'], None when caching is off"""
+    global _cache
+    path = agent_setting('CACHE_PATH')
+    if not path:
+        return None
+    with _cache_lock:
+        if _cache is None or _cache.path != path:
+            _cache = LLMCache(
+                path,
+                ttl=agent_setting('CACHE_TTL', DEFAULT_TTL),
+                max_entries=agent_setting('CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)
+            )
+        return _cache
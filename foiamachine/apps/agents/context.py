@@ -0,0 +1,200 @@
+"""
+Precomputed legal and contact context for agent prompts
+
+An agency's bundle holds its FOIA contact details, Medicaid fields, legal
+notes, its government's holidays and the ids of the statutes that apply;
+a statute's bundle holds its deadline, residency rule, fee structure and
+exemptions. They are built once, stored as ContextBundle rows and kept in
+memory, so putting the law in front of the model costs no queries per
+prompt. Saving an agency, government, statute, holiday or fee/exemption
+drops the bundles it is part of, and they are rebuilt on next use.
+"""
+
+import datetime
+import json
+import logging
+from typing import Any, Dict, List, Optional
+
+import workdays
+
+from .models import ContextBundle
+
+logger = logging.getLogger(__name__)
+
+# characters of an exemption's description kept in a bundle
+DESCRIPTION_CHARS = 300
+
+RESPONSE_DAYS_TEXT = {
+    -1: 'promptly',
+    -2: 'within a reasonable time',
+    -3: 'no time limit',
+}
+
+
+def parse_json_text(value: Optional[str]):
+    """Statute.fee_structure and .exemptions hold JSON, or plain text in older rows"""
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value.strip()
+
+
+def holiday_dates(government) -> List[str]:
+    dates = []
+    for holiday in government.get_holiday_dates:
+        if isinstance(holiday, datetime.datetime):
+            holiday = holiday.date()
+        dates.append(holiday.isoformat())
+    return sorted(dates)
+
+
+def build_agency(agency) -> Dict[str, Any]:
+    government = agency.government
+    return {
+        'name': agency.name,
+        'medicaid_agency_name': agency.medicaid_agency_name,
+        'government': government.name,
+        'level': government.get_level_display(),
+        'is_territory': agency.is_territory,
+        'requires_residency': agency.requires_residency,
+        'response_days': agency.statutory_response_days,
+        'contact': {
+            'officer': agency.foia_officer_name,
+            'email': agency.foia_officer_email,
+            'phone': agency.foia_officer_phone,
+            'fax': agency.foia_officer_fax,
+            'address': agency.foia_mailing_address,
+            'website': agency.foia_website,
+            'submission_methods': agency.submission_methods,
+        },
+        'cms_region': agency.cms_region,
+        'cms_region_contact': agency.cms_region_contact,
+        'legal_notes': agency.legal_notes,
+        'holidays': holiday_dates(government),
+        # ordered when read, a statute's deadline can change without this bundle being rebuilt
+        'statute_ids': [statute.pk for statute in government.statutes.all()],
+    }
+
+
+def build_statute(statute) -> Dict[str, Any]:
+    from foiamachine.apps.government.models import FeeExemptionOther
+    kinds = dict(FeeExemptionOther.statute_relation_types)
+    return {
+        'short_title': statute.short_title,
+        'designator': statute.designator,
+        'days_till_due': statute.get_days_till_due,
+        'response_time_days': statute.response_time_days,
+        'response_time_type': statute.response_time_type,
+        'residency_required': statute.residency_required,
+        'fee_structure': parse_json_text(statute.fee_structure),
+        'exemptions': parse_json_text(statute.exemptions),
+        'fees_exemptions': [{
+            'type': kinds.get(item.typee, item.typee),
+            'name': item.name,
+            'description': (item.description or '')[:DESCRIPTION_CHARS],
+            'source': item.source,
+        } for item in statute.fees_exemptions.all()],
+    }
+
+
+def build_agencies(ids) -> Dict[int, Dict[str, Any]]:
+    from foiamachine.apps.agency.models import Agency
+    agencies = Agency.objects.all_them().filter(pk__in=ids).select_related('government')\
+        .prefetch_related('government__statutes', 'government__holidays')
+    return dict((agency.pk, build_agency(agency)) for agency in agencies)
+
+
+def build_statutes(ids) -> Dict[int, Dict[str, Any]]:
+    from foiamachine.apps.government.models import Statute
+    statutes = Statute.objects.filter(pk__in=ids).prefetch_related('fees_exemptions')
+    return dict((statute.pk, build_statute(statute)) for statute in statutes)
+
+
+BUILDERS = {
+    'agency': build_agencies,
+    'statute': build_statutes,
+}
+
+
+def agency_context(agency_id) -> Optional[Dict[str, Any]]:
+    """The agency's bundle with its statutes' bundles under 'statutes', None for an unknown agency"""
+    agency = ContextBundle.objects.get_bundles('agency', [agency_id]).get(agency_id)
+    if agency is None:
+        return None
+    statutes = ContextBundle.objects.get_bundles('statute', agency['statute_ids'])
+    # in Government.get_statutes order, Request.get_due_date goes by the first
+    ordered = sorted((statutes[pk] for pk in agency['statute_ids'] if pk in statutes),
+                     key=lambda statute: -(statute['days_till_due'] if statute['days_till_due'] is not None else -1))
+    return dict(agency, statutes=ordered)
+
+
+def response_days(context: Dict[str, Any]) -> Optional[int]:
+    """Working days the agency has to answer: its own rule, else the first statute's"""
+    days = context.get('response_days')
+    if days is not None and days >= 0:
+        return days
+    for statute in context['statutes']:
+        if statute['days_till_due'] is not None:
+            return statute['days_till_due']
+    return None
+
+
+def due_date(context: Dict[str, Any], sent: datetime.date) -> Optional[datetime.date]:
+    """When a request sent on `sent` is due, skipping weekends and the government's holidays"""
+    days = response_days(context)
+    if days is None:
+        return None
+    holidays = [datetime.date.fromisoformat(day) for day in context['holidays']]
+    return workdays.workday(sent, days, holidays)
+
+
+def deadline_text(context: Dict[str, Any]) -> str:
+    days = response_days(context)
+    if days is not None:
+        return f"{days} working days"
+    return RESPONSE_DAYS_TEXT.get(context.get('response_days'), 'not set by statute')
+
+
+def render_context(context: Dict[str, Any], sent: datetime.date = None) -> str:
+    """The bundle as a compact block of text for a prompt"""
+    lines = [f"Agency: {context['name']} ({context['government']}, {context['level']})"]
+    if context['medicaid_agency_name']:
+        lines.append(f"Medicaid agency: {context['medicaid_agency_name']}")
+    lines.append(f"Response deadline: {deadline_text(context)}")
+    if sent is not None:
+        due = due_date(context, sent)
+        if due is not None:
+            lines.append(f"Due date for a request sent {sent.isoformat()}: {due.isoformat()}")
+    if context['requires_residency'] or any(s['residency_required'] for s in context['statutes']):
+        lines.append('State residency is required to make a request')
+    contact = ', '.join(f"{key}: {value}" for key, value in context['contact'].items() if value)
+    if contact:
+        lines.append(f"FOIA contact: {contact}")
+    if context['is_territory'] and context['cms_region']:
+        lines.append(f"CMS region: {context['cms_region']} {context['cms_region_contact'] or ''}".rstrip())
+    if context['legal_notes']:
+        lines.append(f"Legal notes: {context['legal_notes']}")
+    for statute in context['statutes']:
+        title = f"{statute['short_title']} ({statute['designator']})" if statute['designator'] \
+            else statute['short_title']
+        lines.append(f"Statute: {title}")
+        for field in ('fee_structure', 'exemptions'):
+            if statute[field]:
+                value = statute[field] if isinstance(statute[field], str) else json.dumps(statute[field])
+                lines.append(f"  {field.replace('_', ' ').capitalize()}: {value}")
+        for item in statute['fees_exemptions']:
+            description = f" - {item['description']}" if item['description'] else ''
+            lines.append(f"  {item['type']}: {item['name']}{description}")
+    return '\n'.join(lines)
+
+
+def agency_prompt_context(agency_id, sent: datetime.date = None) -> str:
+    """render_context for an agency id, empty when there is no such agency"""
+    try:
+        agency_id = int(agency_id)
+    except (TypeError, ValueError):
+        return ''
+    context = agency_context(agency_id)
+    return render_context(context, sent) if context is not None else ''
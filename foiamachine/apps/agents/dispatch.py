@@ -0,0 +1,192 @@
+"""
+Queued agent work - views enqueue, the worker dispatches
+
+Endpoints create a pending AgentTask and return its id straight away;
+process_agent_task claims the row and runs the agent method for its
+task_type with input_data. Claiming flips pending to processing under a
+row lock, so a duplicate delivery of the same message finds the task taken
+and spends no tokens, and a POST repeated with the same idempotency key
+gets back the task it already created.
+"""
+
+import hashlib
+import logging
+from datetime import timedelta
+from typing import Any, Dict, Optional, Tuple
+
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
+
+from .engine import AgentEngine
+from .llm import agent_setting
+from .models import AgentTask
+from .services import DocumentSummaryAgent, FollowUpAgent, RequestDraftAgent, ResponseAnalysisAgent
+
+logger = logging.getLogger(__name__)
+
+# a task processing for longer than this belonged to a worker that died
+PROCESSING_TIMEOUT = timedelta(minutes=15)
+
+FINISHED = ('completed', 'failed')
+
+
+def draft_request(agent, task):
+    data = task.input_data
+    return agent.draft_request_job(data['description'], data['agency_name'], data.get('agency_type', 'federal'),
+                                   agency_id=data.get('agency_id'))
+
+
+def analyze_response(agent, task):
+    data = task.input_data
+    return agent.analyze_response_job(data['response_text'], data.get('original_request', ''),
+                                      foia_request=task.foia_request)
+
+
+def generate_followup(agent, task):
+    data = task.input_data
+    return agent.generate_followup_job(data.get('context', {}), data.get('reason', 'no_response'),
+                                       foia_request=task.foia_request)
+
+
+def apply_analysis(task):
+    """Keep the request's summary in step with its latest analysis"""
+    if task.foia_request is not None:
+        task.foia_request.response_summary = task.output_data['summary']
+        task.foia_request.requires_followup = task.output_data['requires_followup']
+        task.foia_request.save(update_fields=['response_summary', 'requires_followup'])
+
+
+# task_type: (agent, job builder, run after the task completed)
+HANDLERS = {
+    'draft_request': (RequestDraftAgent, draft_request, None),
+    'analyze_response': (ResponseAnalysisAgent, analyze_response, apply_analysis),
+    'generate_followup': (FollowUpAgent, generate_followup, None),
+    'summarize_document': (DocumentSummaryAgent, None, None),
+}
+
+
+def scoped_key(user, key: Optional[str]) -> Optional[str]:
+    """Idempotency keys are per user, hashed so any client string fits the column"""
+    if not key:
+        return None
+    return hashlib.sha256(f"{user.pk}:{key}".encode('utf-8')).hexdigest()
+
+
+def enqueue_task(user, task_type: str, input_data: Dict[str, Any], foia_request=None,
+                 idempotency_key: str = None) -> Tuple[AgentTask, bool]:
+    """
+    Create a pending task and queue it once the transaction commits
+
+    Returns (task, created); when idempotency_key was used before the
+    existing task is returned and nothing is queued.
+    """
+    if task_type not in HANDLERS:
+        raise ValueError(f"Unknown task type: {task_type}")
+    key = scoped_key(user, idempotency_key)
+    if key is not None:
+        existing = AgentTask.objects.filter(idempotency_key=key).first()
+        if existing is not None:
+            return existing, False
+    try:
+        with transaction.atomic():
+            task = AgentTask.objects.create(
+                task_type=task_type,
+                user=user,
+                foia_request=foia_request,
+                input_data=input_data,
+                agent_model=agent_setting('MODEL', 'gpt-4-turbo-preview'),
+                status='pending',
+                idempotency_key=key
+            )
+    except IntegrityError:
+        if key is None:
+            raise
+        # a concurrent request with the same key got there first
+        return AgentTask.objects.get(idempotency_key=key), False
+
+    from .tasks import process_agent_task
+    transaction.on_commit(lambda: process_agent_task.delay(task.id))
+    return task, True
+
+
+def claim_task(task_id: int) -> Optional[AgentTask]:
+    """
+    Move the task to processing and return it, or None when it is finished
+    or another worker has it. The lock is only held for the claim, never
+    while the LLM is called.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        task = AgentTask.objects.select_for_update().filter(id=task_id).first()
+        if task is None or task.status in FINISHED:
+            return None
+        if task.status == 'processing':
+            if task.started_at and task.started_at > now - PROCESSING_TIMEOUT:
+                return None
+            logger.warning(f"Reclaiming agent task {task_id}, processing since {task.started_at}")
+        task.status = 'processing'
+        task.started_at = now
+        task.save(update_fields=['status', 'started_at', 'updated_at'])
+    return task
+
+
+def fail(task: AgentTask, message: str) -> AgentTask:
+    task.status = 'failed'
+    task.error_message = message
+    task.completed_at = timezone.now()
+    task.save(update_fields=['status', 'error_message', 'completed_at', 'updated_at'])
+    logger.error(f"Agent task {task.id} failed: {message}")
+    return task
+
+
+def run_task(task: AgentTask) -> AgentTask:
+    """Run a claimed task through its agent, the outcome is saved on the task"""
+    if task.task_type not in HANDLERS:
+        return fail(task, f"Unknown task type: {task.task_type}")
+    agent_class, build_job, after = HANDLERS[task.task_type]
+    agent = agent_class(task.user, model=task.agent_model)
+    if build_job is None:
+        data = task.input_data
+        if data.get('attachment_ids') and not data.get('documents'):
+            run = lambda: agent.summarize_attachments(data['attachment_ids'], data.get('document_type', 'response'),
+                                                      foia_request=task.foia_request, task=task)
+        else:
+            run = lambda: agent.summarize_documents(data.get('documents', []), data.get('document_type', 'response'),
+                                                    foia_request=task.foia_request, task=task)
+    else:
+        try:
+            job = build_job(agent, task)
+        except KeyError as e:
+            return fail(task, f"Missing input for {task.task_type}: {e}")
+        # the claimed row stands in for the one the builder made
+        job.task = task
+        run = lambda: AgentEngine(backend=agent.backend).run_one(job)
+    try:
+        run()
+    except Exception:
+        # already recorded on the task
+        return task
+    if after is not None:
+        after(task)
+    return task
+
+
+def stalled_tasks():
+    """
+    Ids of tasks whose message was lost: still pending, or processing on a
+    worker that died, after PROCESSING_TIMEOUT
+    """
+    cutoff = timezone.now() - PROCESSING_TIMEOUT
+    return list(AgentTask.objects.filter(
+        models.Q(status='pending', created_at__lt=cutoff) |
+        models.Q(status='processing', started_at__lt=cutoff)
+    ).values_list('id', flat=True))
+
+
+def process(task_id: int) -> Optional[AgentTask]:
+    """Claim and run a task, None when there was nothing to do"""
+    task = claim_task(task_id)
+    if task is None:
+        logger.info(f"Agent task {task_id} is finished or claimed elsewhere, skipping")
+        return None
+    return run_task(task)
@@ -0,0 +1,352 @@
+"""
+Agent execution engine - runs many agent jobs at once
+
+Jobs are grouped into batches the backend can complete in one call and
+fanned out over a bounded thread pool. Threads only talk to the LLM; the
+AgentTask rows are created with one bulk_create and their results written
+back with bulk_update every few completions instead of three saves a job.
+A TokenBudget, when configured, holds calls back to the token rate, and
+prompts already answered are served from the LLM cache without a call.
+A single job can also be streamed, relaying the completion as it arrives.
+Every prompt's wait, latency, tokens and cost are noted for usage.py and
+written as AgentCalls alongside the tasks.
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterator, List
+
+from django.utils import timezone
+
+from .cache import backend_namespace, cache_key, get_cache
+from .llm import LLMRequest, agent_setting, estimate_tokens, get_backend, get_budget
+from .models import AgentTask
+from .usage import UsageRecorder, split_tokens
+
+logger = logging.getLogger(__name__)
+
+RESULT_FIELDS = ['status', 'output_data', 'tokens_used', 'cache_hit', 'tokens_saved', 'error_message',
+                 'prompt_tokens', 'completion_tokens', 'latency_ms', 'queue_ms', 'retries', 'cost',
+                 'completed_at', 'updated_at']
+
+
+def elapsed_ms(start: float, end: float = None) -> int:
+    return int(round(((time.monotonic() if end is None else end) - start) * 1000))
+
+
+class AgentJob:
+    """
+    One agent call: the task to record it on, the prompt and how to turn
+    the completion into the task's output
+    """
+
+    def __init__(self, task: AgentTask, request: LLMRequest,
+                 build_output: Callable[[str], Dict[str, Any]]):
+        self.task = task
+        self.request = request
+        self.build_output = build_output
+        self.output = None
+        self.error = None
+
+    @property
+    def succeeded(self):
+        return self.error is None and self.output is not None
+
+
+class StatusWriter:
+    """Collects finished tasks and writes them flush_every at a time"""
+
+    def __init__(self, flush_every: int = 50):
+        self.flush_every = flush_every
+        self.pending = []
+
+    def add(self, task: AgentTask):
+        self.pending.append(task)
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            AgentTask.objects.bulk_update(self.pending, RESULT_FIELDS)
+            self.pending = []
+
+
+class AgentEngine:
+    """
+    Run AgentJobs over at most `workers` concurrent LLM calls
+    """
+
+    def __init__(self, backend=None, workers: int = None, budget=None, cache=None, flush_every: int = 50):
+        self.backend = backend or get_backend()
+        self.workers = workers or agent_setting('WORKERS', 4)
+        self.budget = budget if budget is not None else get_budget()
+        self.cache = cache if cache is not None else get_cache()
+        self.flush_every = flush_every
+        self.usage = UsageRecorder()
+
+    def batches(self, requests: List[LLMRequest]) -> List[List[int]]:
+        """Indexes of requests grouped into calls the backend can answer at once"""
+        size = max(1, getattr(self.backend, 'batch_size', 1))
+        groups = {}
+        for i, request in enumerate(requests):
+            groups.setdefault(request.batch_key, []).append(i)
+        return [group[i:i + size] for group in groups.values() for i in range(0, len(group), size)]
+
+    def cached(self, request: LLMRequest, hit: Dict[str, Any], queued: float) -> Dict[str, Any]:
+        queue_ms = elapsed_ms(queued)
+        self.usage.record(request, 'cached', queue_ms=queue_ms, tokens_saved=hit['tokens_used'])
+        return {'content': hit['content'], 'tokens_used': 0, 'cached': True, 'tokens_saved': hit['tokens_used'],
+                'prompt_tokens': 0, 'completion_tokens': 0, 'latency_ms': 0, 'queue_ms': queue_ms}
+
+    def answered(self, request: LLMRequest, result: Dict[str, Any], queued: float, sent: float,
+                 done: float, batch_size: int = 1) -> Dict[str, Any]:
+        """result with its usage, which is noted"""
+        prompt_tokens, completion_tokens = split_tokens(request, result)
+        latency_ms, queue_ms = elapsed_ms(sent, done), elapsed_ms(queued, sent)
+        spent = self.usage.record(request, 'ok', latency_ms, queue_ms, prompt_tokens, completion_tokens,
+                                  retries=result.get('retries', 0), batch_size=batch_size)
+        return dict(result, cached=False, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                    latency_ms=latency_ms, queue_ms=queue_ms, retries=result.get('retries', 0), cost=spent)
+
+    def call(self, requests: List[LLMRequest]) -> List[Dict[str, Any]]:
+        """Runs in a worker thread, no database access here"""
+        entered = time.monotonic()
+        queued = [entered if request.queued_at is None else request.queued_at for request in requests]
+        results = [None] * len(requests)
+        keys = [None] * len(requests)
+        if self.cache is not None:
+            namespace = backend_namespace(self.backend)
+            for i, request in enumerate(requests):
+                keys[i] = cache_key(request, namespace)
+                hit = self.cache.get(keys[i])
+                if hit is not None:
+                    results[i] = self.cached(request, hit, queued[i])
+        misses = [i for i, result in enumerate(results) if result is None]
+        if not misses:
+            return results
+
+        estimated = sum(requests[i].estimated_tokens() for i in misses)
+        if self.budget is not None:
+            self.budget.acquire(estimated)
+        sent = time.monotonic()
+        fresh = []
+        try:
+            fresh = self.backend.complete_batch([requests[i] for i in misses])
+        except Exception as e:
+            done = time.monotonic()
+            for i in misses:
+                self.usage.record(requests[i], 'error', elapsed_ms(sent, done), elapsed_ms(queued[i], sent),
+                                  retries=getattr(e, 'retries', 0), batch_size=len(misses))
+            raise
+        finally:
+            if self.budget is not None:
+                self.budget.settle(estimated, sum(result.get('tokens_used', 0) for result in fresh))
+        done = time.monotonic()
+        for i, result in zip(misses, fresh):
+            results[i] = self.answered(requests[i], result, queued[i], sent, done, len(misses))
+            if self.cache is not None:
+                self.cache.set(keys[i], result['content'], result.get('tokens_used', 0))
+        if len(fresh) < len(misses):
+            # prompts the backend left unanswered fail on their own, the rest keep their results
+            error = ValueError(f"Backend returned {len(fresh)} results for {len(misses)} prompts")
+            for i in misses[len(fresh):]:
+                self.usage.record(requests[i], 'error', elapsed_ms(sent, done), elapsed_ms(queued[i], sent),
+                                  batch_size=len(misses))
+                results[i] = error
+        return results
+
+    def stream_call(self, request: LLMRequest, result: Dict[str, Any]) -> Iterator[str]:
+        """
+        Yield the completion of request piece by piece, result is filled
+        with what call() would have returned once it is exhausted. Cached
+        completions and backends that can't stream come in one piece.
+        """
+        queued = time.monotonic() if request.queued_at is None else request.queued_at
+        key = None
+        if self.cache is not None:
+            key = cache_key(request, backend_namespace(self.backend))
+            hit = self.cache.get(key)
+            if hit is not None:
+                result.update(self.cached(request, hit, queued))
+                yield hit['content']
+                return
+        if not hasattr(self.backend, 'stream'):
+            result.update(self.call([request])[0])
+            yield result['content']
+            return
+
+        estimated = request.estimated_tokens()
+        if self.budget is not None:
+            self.budget.acquire(estimated)
+        sent = time.monotonic()
+        parts, usage = [], {'tokens_used': 0}
+        try:
+            for chunk in self.backend.stream(request):
+                usage.update((name, chunk[name]) for name in ('tokens_used', 'prompt_tokens', 'completion_tokens',
+                                                             'retries') if name in chunk)
+                if chunk.get('content'):
+                    parts.append(chunk['content'])
+                    yield chunk['content']
+        except Exception as e:
+            self.usage.record(request, 'error', elapsed_ms(sent), elapsed_ms(queued, sent),
+                              retries=getattr(e, 'retries', usage.get('retries', 0)))
+            raise
+        finally:
+            if self.budget is not None:
+                self.budget.settle(estimated, usage['tokens_used'])
+        content = ''.join(parts)
+        # not every server reports usage on a stream
+        if not usage['tokens_used']:
+            usage = dict(usage, tokens_used=estimate_tokens(request.system_prompt, request.prompt, content),
+                         prompt_tokens=None, completion_tokens=None)
+        result.update(self.answered(request, dict(usage, content=content), queued, sent, time.monotonic()))
+        if self.cache is not None:
+            self.cache.set(key, content, usage['tokens_used'])
+
+    def start(self, jobs: List[AgentJob]):
+        """
+        Create the tasks of jobs that don't have a row yet, already
+        processing. Tasks that were queued count the time since then as
+        waiting for their call.
+        """
+        now = timezone.now()
+        clock = time.monotonic()
+        new, existing = [], []
+        for job in jobs:
+            if job.request is not None:
+                job.request.task = job.task
+                waited = (now - job.task.created_at).total_seconds() if job.task.created_at else 0
+                job.request.queued_at = clock - max(waited, 0)
+            job.task.status = 'processing'
+            job.task.started_at = now
+            job.task.updated_at = now
+            (new if job.task.pk is None else existing).append(job.task)
+        if new:
+            AgentTask.objects.bulk_create(new)
+        if existing:
+            AgentTask.objects.bulk_update(existing, ['status', 'started_at', 'updated_at'])
+
+    def finish(self, job: AgentJob, result: Dict[str, Any] = None, error: Exception = None):
+        task = job.task
+        task.completed_at = timezone.now()
+        task.updated_at = task.completed_at
+        if error is None:
+            try:
+                job.output = job.build_output(result['content'])
+                task.output_data = job.output
+                task.tokens_used = result.get('tokens_used', 0)
+                task.cache_hit = result.get('cached')
+                task.tokens_saved = result.get('tokens_saved', 0)
+                task.prompt_tokens = result.get('prompt_tokens', 0)
+                task.completion_tokens = result.get('completion_tokens', 0)
+                task.latency_ms = result.get('latency_ms')
+                task.queue_ms = result.get('queue_ms')
+                task.retries = result.get('retries', 0)
+                task.cost = result.get('cost', 0)
+                task.status = 'completed'
+                return
+            except Exception as e:
+                error = e
+        job.error = error
+        task.retries = getattr(error, 'retries', 0)
+        task.status = 'failed'
+        task.error_message = str(error)
+        logger.error(f"Agent task {task.task_type} failed: {error}")
+
+    def stream(self, requests: List[LLMRequest]):
+        """
+        Yield (indexes, results) for every batch of requests as it finishes,
+        results is the exception instead when the call failed
+        """
+        batches = self.batches(requests)
+        if not batches:
+            return
+        clock = time.monotonic()
+        for request in requests:
+            if request.queued_at is None:
+                request.queued_at = clock
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(batches)))) as pool:
+            futures = {pool.submit(self.call, [requests[i] for i in batch]): batch for batch in batches}
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except Exception as e:
+                    yield futures[future], e
+
+    def complete(self, requests: List[LLMRequest]) -> List[Any]:
+        """Results for requests in order, an exception in place of each one that failed"""
+        results = [None] * len(requests)
+        for batch, batch_results in self.stream(requests):
+            for n, i in enumerate(batch):
+                results[i] = batch_results if isinstance(batch_results, Exception) else batch_results[n]
+        self.usage.flush()
+        return results
+
+    def run(self, jobs: List[AgentJob]) -> List[AgentJob]:
+        """Run every job, returns them with output or error set"""
+        jobs = list(jobs)
+        if not jobs:
+            return jobs
+        self.start(jobs)
+        writer = StatusWriter(self.flush_every)
+        for batch, results in self.stream([job.request for job in jobs]):
+            for n, i in enumerate(batch):
+                result = results if isinstance(results, Exception) else results[n]
+                if isinstance(result, Exception):
+                    self.finish(jobs[i], error=result)
+                else:
+                    self.finish(jobs[i], result=result)
+                writer.add(jobs[i].task)
+        writer.flush()
+        self.usage.flush()
+        return jobs
+
+    def run_one(self, job: AgentJob) -> Dict[str, Any]:
+        """Run a single job in this thread, raising its error"""
+        self.start([job])
+        try:
+            result = self.call([job.request])[0]
+            if isinstance(result, Exception):
+                raise result
+        except Exception as e:
+            self.finish(job, error=e)
+        else:
+            self.finish(job, result=result)
+        AgentTask.objects.bulk_update([job.task], RESULT_FIELDS)
+        self.usage.flush()
+        if job.error is not None:
+            raise job.error
+        return job.output
+
+    def stream_one(self, job: AgentJob) -> Iterator[str]:
+        """
+        Start a single job and return an iterator over its completion. The
+        task is finished when the completion is; if the consumer stops
+        reading, the rest is still read so the paid-for text is kept.
+        """
+        self.start([job])
+        return self._relay(job)
+
+    def _relay(self, job: AgentJob) -> Iterator[str]:
+        result = {}
+        closed = False
+        try:
+            for piece in self.stream_call(job.request, result):
+                if not closed:
+                    try:
+                        yield piece
+                    except GeneratorExit:
+                        closed = True
+        except Exception as e:
+            self.finish(job, error=e)
+        else:
+            self.finish(job, result=result)
+        AgentTask.objects.bulk_update([job.task], RESULT_FIELDS)
+        self.usage.flush()
+        if job.error is not None and not closed:
+            raise job.error
+
+
+def run_jobs(jobs: List[AgentJob], **kwargs) -> List[AgentJob]:
+    return AgentEngine(**kwargs).run(jobs)
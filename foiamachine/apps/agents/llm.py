@@ -0,0 +1,280 @@
+"""
+LLM backends and token-rate budgeting shared by every agent
+"""
+
+import json
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+import requests
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_API_BASE = 'https://api.openai.com/v1'
+
+# rate limited or briefly unavailable, worth another try
+RETRY_STATUSES = (429, 502, 503, 504)
+# longest Retry-After we honor, in seconds
+MAX_RETRY_WAIT = 30
+
+
+def agent_setting(name: str, default=None):
+    return getattr(settings, 'AGENT_CONFIG', {}).get(name, default)
+
+
+def estimate_tokens(*texts: Optional[str]) -> int:
+    """Rough prompt size, about four characters per token"""
+    return sum(len(text) for text in texts if text) // 4 + 1
+
+
+class LLMRequest:
+    """One prompt to complete"""
+
+    def __init__(self, prompt: str, system_prompt: str = None, model: str = None,
+                 temperature: float = None, max_tokens: int = None):
+        self.prompt = prompt
+        self.system_prompt = system_prompt
+        self.model = model or agent_setting('MODEL', 'gpt-4-turbo-preview')
+        self.temperature = agent_setting('TEMPERATURE', 0.7) if temperature is None else temperature
+        self.max_tokens = max_tokens or agent_setting('MAX_TOKENS', 2000)
+        # set by the engine for usage accounting: the AgentTask the call is
+        # made for, saved or not, and when the request started waiting
+        self.task = None
+        self.queued_at = None
+
+    @property
+    def batch_key(self):
+        """Requests with the same key can share one batched call"""
+        return (self.model, self.system_prompt, self.temperature, self.max_tokens)
+
+    def estimated_tokens(self) -> int:
+        return estimate_tokens(self.system_prompt, self.prompt) + self.max_tokens
+
+
+class PlaceholderBackend:
+    """
+    What _call_llm has always returned when no API is configured. It can't
+    stream, the engine sends its completion in one piece.
+    """
+    batch_size = 1
+
+    def complete(self, request: LLMRequest) -> Dict[str, Any]:
+        return {
+            'content': f"[AI Generated Response - Production will use {request.model}]",
+            'tokens_used': 100
+        }
+
+    def complete_batch(self, batch: List[LLMRequest]) -> List[Dict[str, Any]]:
+        return [self.complete(request) for request in batch]
+
+
+class OpenAIBackend:
+    """
+    OpenAI-compatible HTTP API. Single prompts go to /chat/completions.
+    With batch_size > 1, prompts sharing a model and system prompt go to
+    /completions as one list of prompts, for servers that accept that.
+    stream() relays a chat completion as it is generated. Rate limits,
+    gateway errors and dropped connections are retried `retries` times
+    with exponential backoff; results say how many retries it took.
+    """
+
+    def __init__(self, api_base: str = None, api_key: str = None, batch_size: int = None,
+                 timeout: float = None, retries: int = None, backoff: float = None):
+        self.api_base = (api_base or agent_setting('API_BASE', DEFAULT_API_BASE)).rstrip('/')
+        self.api_key = api_key if api_key is not None else agent_setting('OPENAI_API_KEY', '')
+        self.batch_size = batch_size or agent_setting('BATCH_SIZE', 1)
+        self.timeout = timeout or agent_setting('TIMEOUT', 60)
+        self.retries = agent_setting('RETRIES', 0) if retries is None else retries
+        self.backoff = agent_setting('RETRY_BACKOFF', 1.0) if backoff is None else backoff
+        self.session = requests.Session()
+
+    def _wait(self, response, attempt: int) -> float:
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), MAX_RETRY_WAIT)
+            except ValueError:
+                pass
+        return self.backoff * 2 ** attempt
+
+    def _send(self, path: str, payload: Dict[str, Any], stream: bool = False):
+        """The response and how many retries it took, raising once they run out"""
+        retries = 0
+        while True:
+            response = None
+            try:
+                response = self.session.post(
+                    f"{self.api_base}{path}",
+                    json=payload,
+                    headers={'Authorization': f"Bearer {self.api_key}"},
+                    timeout=self.timeout,
+                    stream=stream
+                )
+                if response.status_code not in RETRY_STATUSES or retries >= self.retries:
+                    response.raise_for_status()
+                    return response, retries
+                response.close()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if retries >= self.retries:
+                    e.retries = retries
+                    raise
+            except requests.HTTPError as e:
+                e.retries = retries
+                raise
+            wait = self._wait(response, retries)
+            retries += 1
+            logger.warning(f"LLM call to {path} failed, retry {retries} in {wait:.1f}s")
+            time.sleep(wait)
+
+    def _post(self, path: str, payload: Dict[str, Any]):
+        response, retries = self._send(path, payload)
+        return response.json(), retries
+
+    def _chat_payload(self, request: LLMRequest) -> Dict[str, Any]:
+        messages = []
+        if request.system_prompt:
+            messages.append({'role': 'system', 'content': request.system_prompt})
+        messages.append({'role': 'user', 'content': request.prompt})
+        return {
+            'model': request.model,
+            'messages': messages,
+            'temperature': request.temperature,
+            'max_tokens': request.max_tokens,
+        }
+
+    def complete(self, request: LLMRequest) -> Dict[str, Any]:
+        data, retries = self._post('/chat/completions', self._chat_payload(request))
+        usage = data.get('usage', {})
+        return {
+            'content': data['choices'][0]['message']['content'],
+            'tokens_used': usage.get('total_tokens', 0),
+            'prompt_tokens': usage.get('prompt_tokens'),
+            'completion_tokens': usage.get('completion_tokens'),
+            'retries': retries
+        }
+
+    def stream(self, request: LLMRequest) -> Iterator[Dict[str, Any]]:
+        """
+        Yield {'content': text} pieces as the server sends them over
+        server-sent events; the usage report, when the server sends one,
+        comes as {'tokens_used': n, 'prompt_tokens': n, 'completion_tokens': n}.
+        Only the request is retried, never a stream that has started.
+        """
+        payload = dict(self._chat_payload(request), stream=True, stream_options={'include_usage': True})
+        response, retries = self._send('/chat/completions', payload, stream=True)
+        if retries:
+            yield {'retries': retries}
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                chunk = json.loads(data)
+                usage = chunk.get('usage')
+                if usage:
+                    yield {'tokens_used': usage.get('total_tokens', 0), 'prompt_tokens': usage.get('prompt_tokens'),
+                           'completion_tokens': usage.get('completion_tokens')}
+                for choice in chunk.get('choices') or []:
+                    content = (choice.get('delta') or {}).get('content')
+                    if content:
+                        yield {'content': content}
+
+    def complete_batch(self, batch: List[LLMRequest]) -> List[Dict[str, Any]]:
+        if len(batch) == 1:
+            return [self.complete(batch[0])]
+        first = batch[0]
+        prefix = f"{first.system_prompt}\n\n" if first.system_prompt else ''
+        data, retries = self._post('/completions', {
+            'model': first.model,
+            'prompt': [prefix + request.prompt for request in batch],
+            'temperature': first.temperature,
+            'max_tokens': first.max_tokens,
+        })
+        contents = [None] * len(batch)
+        for choice in data['choices']:
+            contents[choice['index']] = choice['text']
+        # usage is reported for the whole call, prompt tokens are split by
+        # prompt size and completion tokens by completion size
+        usage = data.get('usage', {})
+        total = usage.get('total_tokens', 0)
+        sizes = [estimate_tokens(request.prompt) for request in batch]
+        if usage.get('prompt_tokens') is None or usage.get('completion_tokens') is None:
+            return [
+                {'content': content, 'tokens_used': total * size // sum(sizes), 'retries': retries}
+                for content, size in zip(contents, sizes)
+            ]
+        lengths = [estimate_tokens(content) for content in contents]
+        results = []
+        for content, size, length in zip(contents, sizes, lengths):
+            prompt_tokens = usage['prompt_tokens'] * size // sum(sizes)
+            completion_tokens = usage['completion_tokens'] * length // sum(lengths)
+            results.append({'content': content, 'tokens_used': prompt_tokens + completion_tokens,
+                            'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                            'retries': retries})
+        return results
+
+
+def get_backend():
+    """The configured backend, the placeholder when there is no API key or base"""
+    if agent_setting('OPENAI_API_KEY') or agent_setting('API_BASE'):
+        return OpenAIBackend()
+    return PlaceholderBackend()
+
+
+class TokenBudget:
+    """
+    Token bucket refilled at tokens_per_minute. acquire() blocks until the
+    estimate fits, settle() returns what a call didn't use. Thread safe.
+    """
+
+    def __init__(self, tokens_per_minute: int, clock=time.monotonic, sleep=time.sleep):
+        self.rate = tokens_per_minute / 60.0
+        self.capacity = tokens_per_minute
+        self.available = float(tokens_per_minute)
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens: int):
+        # a single call bigger than the whole budget waits for a full bucket
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.available >= tokens:
+                    self.available -= tokens
+                    return
+                wait = (tokens - self.available) / self.rate
+            self.sleep(wait)
+
+    def settle(self, estimated: int, used: int):
+        with self.lock:
+            self._refill()
+            self.available = min(self.capacity, self.available + min(estimated, self.capacity) - used)
+
+
+_budget = None
+_budget_lock = threading.Lock()
+
+
+def get_budget() -> Optional[TokenBudget]:
+    """The process-wide budget from AGENT_CONFIG['TOKENS_PER_MINUTE'], None when unlimited"""
+    global _budget
+    rate = agent_setting('TOKENS_PER_MINUTE')
+    if not rate:
+        return None
+    with _budget_lock:
+        if _budget is None or _budget.capacity != rate:
+            _budget = TokenBudget(rate)
+        return _budget
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from foiamachine.apps.agency.models import Agency
+from foiamachine.apps.agents.models import ContextBundle
+from foiamachine.apps.government.models import Statute
+
+BATCH = 200
+
+
+class Command(BaseCommand):
+    help = 'Precompute the agency and statute context bundles agent prompts use'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Drop the stored bundles first instead of only building missing ones')
+
+    def handle(self, *args, **options):
+        for kind, queryset in (('agency', Agency.objects.all_them()), ('statute', Statute.objects.all())):
+            ids = list(queryset.order_by('id').values_list('id', flat=True))
+            if options['rebuild']:
+                ContextBundle.objects.invalidate(kind, ids)
+            for start in range(0, len(ids), BATCH):
+                ContextBundle.objects.get_bundles(kind, ids[start:start + BATCH])
+            self.stdout.write(f"{len(ids)} {kind} bundles ready")
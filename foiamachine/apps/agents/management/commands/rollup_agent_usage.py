@@ -0,0 +1,20 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from foiamachine.apps.agents.usage import rollup
+
+
+class Command(BaseCommand):
+    help = 'Roll agent calls up into daily usage by user, task type and model'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=2,
+                            help='Days to rebuild, counting back from today')
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+        for back in range(options['days'] - 1, -1, -1):
+            day = today - datetime.timedelta(days=back)
+            self.stdout.write(f"{day.isoformat()}: {rollup(day)} usage rows")
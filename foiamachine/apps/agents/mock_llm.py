@@ -0,0 +1,142 @@
+"""
+A local stand-in for an OpenAI-compatible API, for tests and development
+
+    with MockLLMServer() as server:
+        backend = OpenAIBackend(api_base=server.url, api_key='test')
+
+Answers /chat/completions and /completions (with a list of prompts) with
+a deterministic echo of the prompt and word-count token usage, and
+records every call so tests can check batching and concurrency. Chat
+completions asked for with "stream" come as server-sent events, a word
+per event.
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def reply_for(prompt: str) -> str:
+    return 'mock: ' + ' '.join(prompt.split())[:60]
+
+
+def count_tokens(*texts: str) -> int:
+    return sum(len(text.split()) for text in texts if text)
+
+
+def usage_for(prompts, replies):
+    prompt_tokens, completion_tokens = count_tokens(*prompts), count_tokens(*replies)
+    return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens}
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, payload, reply: str, usage):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        for i, word in enumerate(reply.split(' ')):
+            delta = {'content': word if i == 0 else ' ' + word}
+            self.send_event({'model': payload.get('model'), 'choices': [{'index': 0, 'delta': delta}]})
+            if self.server.stream_delay:
+                time.sleep(self.server.stream_delay)
+        if (payload.get('stream_options') or {}).get('include_usage'):
+            self.send_event({'model': payload.get('model'), 'choices': [], 'usage': usage})
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def send_event(self, data):
+        self.wfile.write(f"data: {json.dumps(data)}\n\n".encode('utf-8'))
+        self.wfile.flush()
+
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        path = self.path.rstrip('/')
+        server.enter(path, payload)
+        try:
+            if server.delay:
+                time.sleep(server.delay)
+            if server.fail_next:
+                server.fail_next -= 1
+                return self.send_json(server.fail_status, {'error': {'message': 'mock failure'}})
+            if path.endswith('/chat/completions'):
+                prompt = payload['messages'][-1]['content']
+                reply = reply_for(prompt)
+                usage = usage_for([message['content'] for message in payload['messages']], [reply])
+                if payload.get('stream'):
+                    return self.send_stream(payload, reply, usage)
+                return self.send_json(200, {
+                    'model': payload.get('model'),
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply}}],
+                    'usage': usage,
+                })
+            if path.endswith('/completions'):
+                prompts = payload['prompt'] if isinstance(payload['prompt'], list) else [payload['prompt']]
+                replies = [reply_for(prompt) for prompt in prompts]
+                return self.send_json(200, {
+                    'model': payload.get('model'),
+                    'choices': [{'index': i, 'text': reply} for i, reply in enumerate(replies)],
+                    'usage': usage_for(prompts, replies),
+                })
+            self.send_json(404, {'error': {'message': 'unknown endpoint'}})
+        finally:
+            server.leave()
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, delay: float = 0, stream_delay: float = 0):
+        super().__init__((host, port), MockLLMHandler)
+        self.delay = delay
+        self.stream_delay = stream_delay
+        self.fail_next = 0
+        # what the next fail_next calls answer with
+        self.fail_status = 500
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/v1"
+
+    def enter(self, path: str, payload):
+        with self.lock:
+            self.calls.append((path, payload))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
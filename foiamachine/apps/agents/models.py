@@ -2,9 +2,21 @@
 Agent models - Tracks AI agent interactions and tasks
 """
 
+import threading
+import time
+
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.conf import settings
+from foiamachine.apps.agency.models import Agency
 from foiamachine.apps.core.models import TimeStampedModel
+from foiamachine.apps.government.models import FeeExemptionOther, Government, Holiday, Statute
+from foiamachine.apps.mail.models import response_received
+
+BUNDLES_VERSION_KEY = 'agent_context_bundles_version'
+# without a shared cache other processes only notice changes this late
+BUNDLE_MEMORY_SECONDS = 300
 
 
 class AgentTask(TimeStampedModel):
@@ -30,6 +42,15 @@ class AgentTask(TimeStampedModel):
     task_type = models.CharField(max_length=30, choices=TASK_TYPE_CHOICES)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     
+    # Queued tasks: a client's retry with the same key gets the same task
+    idempotency_key = models.CharField(
+        max_length=64,
+        unique=True,
+        null=True,
+        blank=True,
+        help_text="Hash of the user and the key the client sent"
+    )
+    
     # User who initiated the task
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -65,6 +86,29 @@ class AgentTask(TimeStampedModel):
     agent_model = models.CharField(max_length=100, default='gpt-4-turbo-preview')
     tokens_used = models.IntegerField(default=0)
     
+    # LLM cache: None when the cache wasn't consulted
+    cache_hit = models.BooleanField(null=True, blank=True)
+    tokens_saved = models.IntegerField(
+        default=0,
+        help_text="Tokens a cached completion would have cost"
+    )
+    
+    # Usage accounting, summed over the task's LLM calls
+    prompt_tokens = models.IntegerField(default=0)
+    completion_tokens = models.IntegerField(default=0)
+    latency_ms = models.IntegerField(
+        null=True,
+        blank=True,
+        help_text="Time spent waiting on the LLM"
+    )
+    queue_ms = models.IntegerField(
+        null=True,
+        blank=True,
+        help_text="Time from being queued to the first LLM call"
+    )
+    retries = models.IntegerField(default=0)
+    cost = models.DecimalField(max_digits=12, decimal_places=6, default=0)
+    
     class Meta:
         ordering = ['-created_at']
         verbose_name = 'Agent Task'
@@ -144,3 +188,258 @@ class AgentWorkflow(TimeStampedModel):
     
     def __str__(self):
         return self.name
+
+
+class AgentCall(TimeStampedModel):
+    """
+    One prompt sent to the LLM or answered from the cache, see usage.py
+    """
+    OUTCOME_CHOICES = [
+        ('ok', 'Completed'),
+        ('cached', 'Cached'),
+        ('error', 'Error'),
+    ]
+    
+    task = models.ForeignKey(
+        AgentTask,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='calls'
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='agent_calls'
+    )
+    task_type = models.CharField(max_length=30, blank=True)
+    model = models.CharField(max_length=100)
+    outcome = models.CharField(max_length=10, choices=OUTCOME_CHOICES)
+    
+    latency_ms = models.IntegerField(default=0)
+    queue_ms = models.IntegerField(default=0)
+    prompt_tokens = models.IntegerField(default=0)
+    completion_tokens = models.IntegerField(default=0)
+    tokens_saved = models.IntegerField(default=0)
+    retries = models.IntegerField(default=0)
+    cost = models.DecimalField(max_digits=12, decimal_places=6, default=0)
+    # prompts sent in the same HTTP call
+    batch_size = models.IntegerField(default=1)
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [models.Index(fields=['created_at'])]
+    
+    def __str__(self):
+        return f"{self.model} {self.get_outcome_display()} {self.latency_ms}ms"
+
+
+class AgentUsage(models.Model):
+    """
+    AgentCalls rolled up by day, user, task type and model. Latencies are
+    kept as a histogram over usage.LATENCY_BUCKETS so percentiles can be
+    read across any set of rows.
+    """
+    day = models.DateField()
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='agent_usage'
+    )
+    task_type = models.CharField(max_length=30, blank=True)
+    model = models.CharField(max_length=100)
+    
+    calls = models.IntegerField(default=0)
+    errors = models.IntegerField(default=0)
+    cached = models.IntegerField(default=0)
+    retries = models.IntegerField(default=0)
+    prompt_tokens = models.BigIntegerField(default=0)
+    completion_tokens = models.BigIntegerField(default=0)
+    tokens_saved = models.BigIntegerField(default=0)
+    cost = models.DecimalField(max_digits=14, decimal_places=6, default=0)
+    latency_ms_total = models.BigIntegerField(default=0)
+    queue_ms_total = models.BigIntegerField(default=0)
+    latency_histogram = models.JSONField(default=list)
+    
+    class Meta:
+        ordering = ['-day', 'task_type']
+        unique_together = [('day', 'user', 'task_type', 'model')]
+        verbose_name = 'Agent Usage'
+        verbose_name_plural = 'Agent Usage'
+    
+    def __str__(self):
+        return f"{self.day} {self.task_type or 'other'} {self.model}"
+
+
+class ContextBundleManager(models.Manager):
+    """
+    Bundles remembered per process, any change bumps a version in the
+    shared cache so every process drops its copies
+    """
+    _bundles = {}
+    _version = None
+    _loaded = 0
+    _lock = threading.Lock()
+    
+    def _memory(self):
+        version = cache.get(BUNDLES_VERSION_KEY)
+        now = time.monotonic()
+        with self._lock:
+            if version != ContextBundleManager._version or now - ContextBundleManager._loaded > BUNDLE_MEMORY_SECONDS:
+                ContextBundleManager._bundles = {}
+                ContextBundleManager._version = version
+                ContextBundleManager._loaded = now
+            return ContextBundleManager._bundles
+    
+    def get_bundles(self, kind, ids):
+        """
+        {id: bundle} for the ids that exist; stored bundles are read with
+        one query and missing ones built and stored
+        """
+        from .context import BUILDERS
+        memory = self._memory()
+        found = dict(((kind, pk), memory[(kind, pk)]) for pk in ids if (kind, pk) in memory)
+        missing = set(ids) - set(pk for k, pk in found)
+        if missing:
+            stored = dict(self.filter(kind=kind, object_id__in=missing).values_list('object_id', 'data'))
+            built = BUILDERS[kind](missing - set(stored))
+            self.bulk_create([ContextBundle(kind=kind, object_id=pk, data=data) for pk, data in built.items()],
+                             ignore_conflicts=True)
+            for pk, data in list(stored.items()) + list(built.items()):
+                found[(kind, pk)] = memory[(kind, pk)] = data
+        return dict((pk, found[(kind, pk)]) for pk in ids if (kind, pk) in found)
+    
+    def invalidate(self, kind, ids):
+        """Drop stored bundles, they are rebuilt when next asked for"""
+        ids = list(ids)
+        if not ids:
+            return
+        self.filter(kind=kind, object_id__in=ids).delete()
+        try:
+            cache.incr(BUNDLES_VERSION_KEY)
+        except ValueError:
+            cache.set(BUNDLES_VERSION_KEY, 1, None)
+        with self._lock:
+            ContextBundleManager._bundles = {}
+
+
+class ContextBundle(TimeStampedModel):
+    """
+    Precomputed prompt context for an agency or a statute, see context.py
+    """
+    KIND_CHOICES = [
+        ('agency', 'Agency'),
+        ('statute', 'Statute'),
+    ]
+    
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.IntegerField()
+    data = models.JSONField()
+    
+    objects = ContextBundleManager()
+    
+    class Meta:
+        unique_together = [('kind', 'object_id')]
+    
+    def __str__(self):
+        return f"{self.get_kind_display()} {self.object_id}"
+
+
+class PendingAnalysis(models.Model):
+    """
+    A request whose responses are waiting out the debounce before they
+    are analyzed, see triggers.py. Kept in the database so bursts split
+    across processes coalesce whatever cache is configured.
+    """
+    request_id = models.IntegerField(unique=True)
+    first = models.DateTimeField()
+    due = models.DateTimeField()
+    
+    def __str__(self):
+        return f"request {self.request_id} due {self.due}"
+
+
+def agencies_of(governments):
+    return Agency.objects.all_them().filter(government__in=list(governments)).values_list('id', flat=True)
+
+
+def related_ids(through, instance, column):
+    """Ids on the other side of a many to many, read from its through table"""
+    return list(through.objects.filter(**{instance._meta.model_name: instance.pk}).values_list(column, flat=True))
+
+
+def agency_changed(sender, instance, **kwargs):
+    ContextBundle.objects.invalidate('agency', [instance.pk])
+
+
+def government_changed(sender, instance, **kwargs):
+    ContextBundle.objects.invalidate('agency', agencies_of([instance.pk]))
+
+
+def holiday_changed(sender, instance, **kwargs):
+    # on delete this runs before, while its governments can still be found
+    governments = related_ids(Government.holidays.through, instance, 'government_id')
+    ContextBundle.objects.invalidate('agency', agencies_of(governments))
+
+
+def statute_changed(sender, instance, **kwargs):
+    ContextBundle.objects.invalidate('statute', [instance.pk])
+
+
+def exemption_changed(sender, instance, **kwargs):
+    statutes = related_ids(Statute.fees_exemptions.through, instance, 'statute_id')
+    ContextBundle.objects.invalidate('statute', statutes)
+
+
+def government_relations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """A government's statutes or holidays, changed from either side"""
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        governments = [instance.pk]
+    elif action == 'pre_clear':
+        governments = related_ids(sender, instance, 'government_id')
+    else:
+        governments = pk_set
+    ContextBundle.objects.invalidate('agency', agencies_of(governments))
+
+
+def statute_exemptions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        statutes = [instance.pk]
+    elif action == 'pre_clear':
+        statutes = related_ids(sender, instance, 'statute_id')
+    else:
+        statutes = pk_set
+    ContextBundle.objects.invalidate('statute', statutes)
+
+
+for signal, name in ((post_save, 'save'), (post_delete, 'delete')):
+    signal.connect(agency_changed, sender=Agency, dispatch_uid=f'agent_bundles_agency_{name}')
+    signal.connect(government_changed, sender=Government, dispatch_uid=f'agent_bundles_government_{name}')
+    signal.connect(statute_changed, sender=Statute, dispatch_uid=f'agent_bundles_statute_{name}')
+# a holiday only matters through its governments, which a new one doesn't have yet
+pre_delete.connect(holiday_changed, sender=Holiday, dispatch_uid='agent_bundles_holiday_delete')
+post_save.connect(holiday_changed, sender=Holiday, dispatch_uid='agent_bundles_holiday_save')
+post_save.connect(exemption_changed, sender=FeeExemptionOther, dispatch_uid='agent_bundles_exemption_save')
+pre_delete.connect(exemption_changed, sender=FeeExemptionOther, dispatch_uid='agent_bundles_exemption_delete')
+m2m_changed.connect(government_relations_changed, sender=Government.statutes.through,
+                    dispatch_uid='agent_bundles_government_statutes')
+m2m_changed.connect(government_relations_changed, sender=Government.holidays.through,
+                    dispatch_uid='agent_bundles_government_holidays')
+m2m_changed.connect(statute_exemptions_changed, sender=Statute.fees_exemptions.through,
+                    dispatch_uid='agent_bundles_statute_exemptions')
+
+
+def response_stored(sender, request_id, **kwargs):
+    from .triggers import schedule_analysis
+    schedule_analysis(request_id)
+
+
+response_received.connect(response_stored, dispatch_uid='agent_analysis_response_received')
@@ -2,10 +2,15 @@
 AI Agent service layer - Core logic for agent operations
 """
 
+import datetime
 import logging
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Iterator, List, Optional
 from django.conf import settings
+from .context import agency_prompt_context
+from .engine import RESULT_FIELDS, AgentEngine, AgentJob
+from .llm import LLMRequest, get_backend
 from .models import AgentTask
+from .summarize import FINAL_PROMPT, SummaryPipeline
 
 logger = logging.getLogger(__name__)
 
@@ -18,11 +23,12 @@ class BaseAgent:
         self.model = model or settings.AGENT_CONFIG.get('MODEL', 'gpt-4-turbo-preview')
         self.temperature = settings.AGENT_CONFIG.get('TEMPERATURE', 0.7)
         self.api_key = settings.AGENT_CONFIG.get('OPENAI_API_KEY')
+        self.backend = get_backend()
     
     def create_task(self, task_type: str, input_data: Dict[str, Any], 
-                    foia_request=None) -> AgentTask:
-        """Create an agent task record"""
-        return AgentTask.objects.create(
+                    foia_request=None, save: bool = True) -> AgentTask:
+        """Create an agent task record, or just build it with save=False"""
+        task = AgentTask(
             task_type=task_type,
             user=self.user,
             foia_request=foia_request,
@@ -30,65 +36,94 @@ class BaseAgent:
             agent_model=self.model,
             status='pending'
         )
+        if save:
+            task.save()
+        return task
+    
+    def make_job(self, task_type: str, input_data: Dict[str, Any], prompt: str,
+                 system_prompt: str, build_output, foia_request=None) -> AgentJob:
+        """An unsaved task and its prompt, for the execution engine"""
+        task = self.create_task(task_type, input_data, foia_request, save=False)
+        request = LLMRequest(prompt, system_prompt, model=self.model, temperature=self.temperature)
+        return AgentJob(task, request, build_output)
+    
+    def run_job(self, job: AgentJob) -> Dict[str, Any]:
+        """Run one job now: the task is written when it starts and when it ends"""
+        return AgentEngine(backend=self.backend).run_one(job)
+    
+    def legal_context(self, agency_id, sent=None) -> str:
+        """
+        The agency's precomputed deadlines, exemptions and contacts as a
+        prompt section, empty without an agency
+        """
+        context = agency_prompt_context(agency_id, sent)
+        if not context:
+            return ''
+        return f"""
+            Agency facts (use these deadlines, fees and exemptions, do not invent others):
+            {context}
+            """
+    
+    def stream_job(self, job: AgentJob) -> Iterator[str]:
+        """Start one job now and relay its completion as it arrives"""
+        return AgentEngine(backend=self.backend).stream_one(job)
     
-    def _call_llm(self, prompt: str, system_prompt: str = None) -> Dict[str, Any]:
+    def _call_llm(self, prompt: str, system_prompt: str = None, task_type: str = '') -> Dict[str, Any]:
         """
-        Call the LLM API
-        Returns: Dict with 'content' and 'tokens_used'
+        Call the LLM API, the call is accounted to this agent's user
+        Returns: Dict with 'content', 'tokens_used' and the call's usage
         """
-        # This is a placeholder - actual implementation would call OpenAI API
-        # For now, we'll return a mock response
         logger.info(f"LLM call with model {self.model}")
-        
-        # In production, this would use OpenAI's API:
-        # from openai import OpenAI
-        # client = OpenAI(api_key=self.api_key)
-        # response = client.chat.completions.create(...)
-        
-        return {
-            'content': f"[AI Generated Response - Production will use {self.model}]",
-            'tokens_used': 100
-        }
+        request = LLMRequest(prompt, system_prompt, model=self.model, temperature=self.temperature)
+        request.task = self.create_task(task_type, {}, save=False)
+        engine = AgentEngine(backend=self.backend)
+        try:
+            return engine.call([request])[0]
+        finally:
+            engine.usage.flush()
 
 
 class RequestDraftAgent(BaseAgent):
     """Agent specialized in drafting FOIA requests"""
     
-    def draft_request(self, description: str, agency_name: str, 
-                     agency_type: str) -> Dict[str, Any]:
-        """
-        Draft a FOIA request based on user's description
-        
-        Args:
-            description: User's description of what they want to request
-            agency_name: Name of the target agency
-            agency_type: Type of agency (federal, state, local)
-        
-        Returns:
-            Dict containing drafted request text and metadata
-        """
-        task = self.create_task('draft_request', {
-            'description': description,
-            'agency_name': agency_name,
-            'agency_type': agency_type
-        })
-        
-        try:
-            task.status = 'processing'
-            task.save()
-            
-            system_prompt = """You are a FOIA request drafting expert. 
+    system_prompt = """You are a FOIA request drafting expert. 
             Draft professional, legally sound FOIA requests that are:
             - Clear and specific
             - Properly formatted with legal language
             - Scope-appropriate to avoid overly broad rejections
             - Include proper fee waiver language if applicable"""
-            
-            prompt = f"""Draft a FOIA request for the following:
+    
+    examples = 2
+    example_chars = 1500
+    
+    def similar_examples(self, description: str) -> str:
+        """
+        Earlier requests like this one that got records, from the similar
+        request index, as a prompt section; empty when none are indexed
+        """
+        from foiamachine.apps.requests.similar import SUCCESSFUL, similar_requests, visible_requests
+        
+        matches = similar_requests(description, user=self.user, k=self.examples, statuses=SUCCESSFUL)
+        requests = visible_requests(matches, self.user)
+        letters = [requests[match['id']].free_edit_body[:self.example_chars]
+                   for match in matches
+                   if match['id'] in requests and requests[match['id']].status in SUCCESSFUL]
+        if not letters:
+            return ''
+        joined = '\n            ---\n'.join(letters)
+        return f"""
+            Earlier requests like this one that were fulfilled, for wording and scope:
+            {joined}
+            """
+    
+    def draft_request_job(self, description: str, agency_name: str,
+                          agency_type: str, agency_id: int = None) -> AgentJob:
+        """The drafting call as a job for the execution engine"""
+        prompt = f"""Draft a FOIA request for the following:
             
             Agency: {agency_name} ({agency_type})
             Request Description: {description}
-            
+            {self.legal_context(agency_id)}{self.similar_examples(description)}
             Include:
             1. Proper legal opening
             2. Clear description of requested records
@@ -98,65 +133,58 @@ class RequestDraftAgent(BaseAgent):
             6. Professional closing
             
             Format the request as a complete, ready-to-send letter."""
-            
-            result = self._call_llm(prompt, system_prompt)
-            
-            output = {
-                'request_text': result['content'],
+        
+        def build_output(content):
+            return {
+                'request_text': content,
                 'suggestions': [
                     'Review the scope to ensure it\'s not too broad',
                     'Add specific date ranges if possible',
                     'Consider requesting electronic format'
                 ]
             }
-            
-            task.output_data = output
-            task.tokens_used = result['tokens_used']
-            task.status = 'completed'
-            task.save()
-            
-            return output
-            
-        except Exception as e:
-            task.status = 'failed'
-            task.error_message = str(e)
-            task.save()
-            logger.error(f"Request draft failed: {e}")
-            raise
-
-
-class ResponseAnalysisAgent(BaseAgent):
-    """Agent specialized in analyzing agency responses"""
+        
+        return self.make_job('draft_request', {
+            'description': description,
+            'agency_name': agency_name,
+            'agency_type': agency_type,
+            'agency_id': agency_id
+        }, prompt, self.system_prompt, build_output)
     
-    def analyze_response(self, response_text: str, 
-                        original_request: str) -> Dict[str, Any]:
+    def draft_request(self, description: str, agency_name: str, 
+                     agency_type: str) -> Dict[str, Any]:
         """
-        Analyze an agency's response to a FOIA request
+        Draft a FOIA request based on user's description
         
         Args:
-            response_text: The agency's response text
-            original_request: The original FOIA request text
+            description: User's description of what they want to request
+            agency_name: Name of the target agency
+            agency_type: Type of agency (federal, state, local)
         
         Returns:
-            Dict containing analysis and recommendations
+            Dict containing drafted request text and metadata
         """
-        task = self.create_task('analyze_response', {
-            'response_text': response_text,
-            'original_request': original_request
-        })
-        
         try:
-            task.status = 'processing'
-            task.save()
-            
-            system_prompt = """You are a FOIA response analysis expert.
+            return self.run_job(self.draft_request_job(description, agency_name, agency_type))
+        except Exception as e:
+            logger.error(f"Request draft failed: {e}")
+            raise
+
+
+class ResponseAnalysisAgent(BaseAgent):
+    """Agent specialized in analyzing agency responses"""
+    
+    system_prompt = """You are a FOIA response analysis expert.
             Analyze agency responses for:
             - Level of compliance with the request
             - Exemptions claimed and their validity
             - Next steps or follow-up actions needed
             - Appeal opportunities"""
-            
-            prompt = f"""Analyze this FOIA response:
+    
+    def analyze_response_job(self, response_text: str, original_request: str,
+                             foia_request=None) -> AgentJob:
+        """The analysis call as a job for the execution engine"""
+        prompt = f"""Analyze this FOIA response:
             
             Original Request: {original_request[:500]}...
             
@@ -168,90 +196,94 @@ class ResponseAnalysisAgent(BaseAgent):
             3. Assessment of response adequacy
             4. Recommended next steps (accept, follow-up, or appeal)
             5. Key dates or deadlines mentioned"""
-            
-            result = self._call_llm(prompt, system_prompt)
-            
-            output = {
-                'summary': result['content'],
+        
+        def build_output(content):
+            return {
+                'summary': content,
                 'compliance_level': 'partial',  # Would be extracted from analysis
                 'requires_followup': True,
                 'recommended_action': 'follow_up',
                 'key_points': []
             }
-            
-            task.output_data = output
-            task.tokens_used = result['tokens_used']
-            task.status = 'completed'
-            task.save()
-            
-            return output
-            
-        except Exception as e:
-            task.status = 'failed'
-            task.error_message = str(e)
-            task.save()
-            logger.error(f"Response analysis failed: {e}")
-            raise
-
-
-class FollowUpAgent(BaseAgent):
-    """Agent specialized in generating follow-up communications"""
+        
+        return self.make_job('analyze_response', {
+            'response_text': response_text,
+            'original_request': original_request
+        }, prompt, self.system_prompt, build_output, foia_request=foia_request)
     
-    def generate_followup(self, request_context: Dict[str, Any],
-                         followup_reason: str) -> Dict[str, Any]:
+    def analyze_response(self, response_text: str, 
+                        original_request: str) -> Dict[str, Any]:
         """
-        Generate a follow-up communication
+        Analyze an agency's response to a FOIA request
         
         Args:
-            request_context: Context about the original request
-            followup_reason: Reason for follow-up (e.g., 'no_response', 'incomplete')
+            response_text: The agency's response text
+            original_request: The original FOIA request text
         
         Returns:
-            Dict containing follow-up text and metadata
+            Dict containing analysis and recommendations
         """
-        task = self.create_task('generate_followup', {
-            'context': request_context,
-            'reason': followup_reason
-        })
-        
         try:
-            task.status = 'processing'
-            task.save()
-            
-            system_prompt = """You are a FOIA follow-up communication expert.
+            return self.run_job(self.analyze_response_job(response_text, original_request))
+        except Exception as e:
+            logger.error(f"Response analysis failed: {e}")
+            raise
+
+
+class FollowUpAgent(BaseAgent):
+    """Agent specialized in generating follow-up communications"""
+    
+    system_prompt = """You are a FOIA follow-up communication expert.
             Generate professional follow-up messages that are:
             - Polite but firm
             - Reference relevant deadlines and laws
             - Clear about what action is needed
             - Professional in tone"""
-            
-            prompt = f"""Generate a follow-up communication for:
+    
+    def generate_followup_job(self, request_context: Dict[str, Any], followup_reason: str,
+                              foia_request=None) -> AgentJob:
+        """
+        The follow-up call as a job for the execution engine; with an
+        agency_id and submitted_date in the context the prompt gets the
+        agency's deadline and the request's due date
+        """
+        submitted = request_context.get('submitted_date')
+        sent = datetime.date.fromisoformat(str(submitted)[:10]) if submitted else None
+        prompt = f"""Generate a follow-up communication for:
             
             Reason: {followup_reason}
             Original Request: {request_context.get('title', 'N/A')}
             Days Since Submission: {request_context.get('days_elapsed', 0)}
-            
+            {self.legal_context(request_context.get('agency_id'), sent)}
             Create a professional follow-up that addresses the situation."""
-            
-            result = self._call_llm(prompt, system_prompt)
-            
-            output = {
-                'followup_text': result['content'],
+        
+        def build_output(content):
+            return {
+                'followup_text': content,
                 'suggested_subject': f"Follow-up: {request_context.get('title', 'FOIA Request')}",
                 'urgency': 'medium'
             }
-            
-            task.output_data = output
-            task.tokens_used = result['tokens_used']
-            task.status = 'completed'
-            task.save()
-            
-            return output
-            
+        
+        return self.make_job('generate_followup', {
+            'context': request_context,
+            'reason': followup_reason
+        }, prompt, self.system_prompt, build_output, foia_request=foia_request)
+    
+    def generate_followup(self, request_context: Dict[str, Any],
+                         followup_reason: str) -> Dict[str, Any]:
+        """
+        Generate a follow-up communication
+        
+        Args:
+            request_context: Context about the original request
+            followup_reason: Reason for follow-up (e.g., 'no_response', 'incomplete')
+        
+        Returns:
+            Dict containing follow-up text and metadata
+        """
+        try:
+            return self.run_job(self.generate_followup_job(request_context, followup_reason))
         except Exception as e:
-            task.status = 'failed'
-            task.error_message = str(e)
-            task.save()
             logger.error(f"Follow-up generation failed: {e}")
             raise
 
@@ -259,6 +291,110 @@ class FollowUpAgent(BaseAgent):
 class DocumentSummaryAgent(BaseAgent):
     """Agent specialized in summarizing documents"""
     
+    system_prompt = """You are a document summarization expert.
+            Create concise, accurate summaries that capture:
+            - Main points and key information
+            - Important dates and deadlines
+            - Actions required
+            - Critical details"""
+    
+    def summarize_document_job(self, document_content: str,
+                               document_type: str = 'response') -> AgentJob:
+        """
+        The summary call as a job for the execution engine. A document
+        longer than one chunk is first condensed through SummaryPipeline
+        here, so the job's prompt covers all of it
+        """
+        
+        def build_output(content):
+            return {
+                'summary': content,
+                'key_points': [],
+                'word_count': len(document_content.split())
+            }
+        
+        job = self.make_job('summarize_document', {
+            'document_type': document_type,
+            'content_length': len(document_content)
+        }, '', self.system_prompt, build_output)
+        pipeline = SummaryPipeline(AgentEngine(backend=self.backend), document_type, model=self.model,
+                                   temperature=self.temperature, task=job.task)
+        text, chunks, levels = pipeline.condense([document_content or ''], self.system_prompt)
+        job.request.prompt = FINAL_PROMPT.format(document_type=document_type, text=text)
+        return job
+    
+    def summarize_documents(self, documents: List[str], document_type: str = 'response',
+                            foia_request=None, task: AgentTask = None) -> Dict[str, Any]:
+        """
+        Summarize one or more documents of any length, e.g. every attachment
+        of a production, with map-reduce over token-bounded chunks
+        
+        Args:
+            documents: The text of each document
+            document_type: Type of document (request, response, etc.)
+            task: An existing task to record the summary on, e.g. one queued
+                with the documents as its input
+        
+        Returns:
+            Dict containing the summary, key points and how it was built
+        """
+        if task is None:
+            task = self.create_task('summarize_document', {
+                'document_type': document_type,
+                'documents': len(documents),
+                'content_length': sum(len(document) for document in documents)
+            }, foia_request=foia_request, save=False)
+        engine = AgentEngine(backend=self.backend)
+        job = AgentJob(task, None, None)
+        engine.start([job])
+        pipeline = SummaryPipeline(engine, document_type, model=self.model, temperature=self.temperature, task=task)
+        try:
+            result = pipeline.run(documents, self.system_prompt)
+        except Exception as e:
+            engine.finish(job, error=e)
+            AgentTask.objects.bulk_update([task], RESULT_FIELDS)
+            logger.error(f"Document summarization failed: {e}")
+            raise
+        
+        output = {
+            'summary': result['summary'],
+            'key_points': [],
+            'word_count': sum(len(document.split()) for document in documents),
+            'chunks': result['chunks'],
+            'calls': pipeline.calls,
+            'calls_cached': pipeline.cached,
+            'levels': result['levels'],
+            'chunk_hashes': result['chunk_hashes']
+        }
+        job.build_output = lambda content: output
+        engine.finish(job, result={
+            'content': result['summary'],
+            'tokens_used': pipeline.tokens_used,
+            'cached': pipeline.cached == pipeline.calls if engine.cache is not None else None,
+            'tokens_saved': pipeline.tokens_saved,
+            'prompt_tokens': pipeline.prompt_tokens,
+            'completion_tokens': pipeline.completion_tokens,
+            'latency_ms': pipeline.latency_ms,
+            'queue_ms': max(int((task.started_at - task.created_at).total_seconds() * 1000), 0),
+            'retries': pipeline.retries,
+            'cost': pipeline.cost
+        })
+        AgentTask.objects.bulk_update([task], RESULT_FIELDS)
+        return output
+    
+    def summarize_attachments(self, attachment_ids: List[int], document_type: str = 'response',
+                              foia_request=None, task: AgentTask = None) -> Dict[str, Any]:
+        """
+        Summarize the extracted text of attachments, extracting any not read
+        yet; files without text (unsupported, scans without OCR) are skipped
+        """
+        from foiamachine.apps.mail.extraction import attachment_texts
+        texts = attachment_texts(attachment_ids)
+        documents = [texts[pk].text for pk in attachment_ids if pk in texts and texts[pk].status == 'ok']
+        if len(documents) < len(attachment_ids):
+            logger.info(f"Summarizing {len(documents)} of {len(attachment_ids)} attachments, the rest have no text")
+        return self.summarize_documents(documents, document_type, foia_request=foia_request, task=task)
+    
     def summarize_document(self, document_content: str,
                           document_type: str = 'response') -> Dict[str, Any]:
         """
@@ -271,50 +407,4 @@ class DocumentSummaryAgent(BaseAgent):
         Returns:
             Dict containing summary and key points
         """
-        task = self.create_task('summarize_document', {
-            'document_type': document_type,
-            'content_length': len(document_content)
-        })
-        
-        try:
-            task.status = 'processing'
-            task.save()
-            
-            system_prompt = """You are a document summarization expert.
-            Create concise, accurate summaries that capture:
-            - Main points and key information
-            - Important dates and deadlines
-            - Actions required
-            - Critical details"""
-            
-            prompt = f"""Summarize this {document_type} document:
-            
-            {document_content[:2000]}...
-            
-            Provide:
-            1. Brief overview (2-3 sentences)
-            2. Key points (bullet list)
-            3. Important dates or deadlines
-            4. Action items"""
-            
-            result = self._call_llm(prompt, system_prompt)
-            
-            output = {
-                'summary': result['content'],
-                'key_points': [],
-                'word_count': len(document_content.split())
-            }
-            
-            task.output_data = output
-            task.tokens_used = result['tokens_used']
-            task.status = 'completed'
-            task.save()
-            
-            return output
-            
-        except Exception as e:
-            task.status = 'failed'
-            task.error_message = str(e)
-            task.save()
-            logger.error(f"Document summarization failed: {e}")
-            raise
+        return self.summarize_documents([document_content], document_type)
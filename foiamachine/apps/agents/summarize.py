@@ -0,0 +1,186 @@
+"""
+Map-reduce summarization of documents too long for one prompt
+
+Every document is split on its own into token-bounded chunks. Chunks are
+summarized in parallel (map), then the partial summaries are combined a
+few at a time, level by level, until one is left (reduce). Prompts only
+depend on the chunk text, so through the LLM cache a chunk is summarized
+once: adding an attachment to a production only costs its new chunks and
+the reduce steps above them.
+"""
+
+import hashlib
+import re
+import time
+from decimal import Decimal
+from typing import Any, Dict, List
+
+from .llm import LLMRequest, estimate_tokens
+
+CHUNK_TOKENS = 1500
+# partial summaries combined per reduce call
+REDUCE_FANIN = 6
+
+MAP_PROMPT = """Summarize this excerpt from a {document_type} document.
+            Keep names, dates, deadlines, amounts, exemptions cited and
+            any actions required.
+
+            {text}"""
+
+REDUCE_PROMPT = """These are summaries of consecutive parts of a {document_type} document.
+            Combine them into one summary, keeping names, dates, deadlines,
+            exemptions cited and actions required.
+
+            {text}"""
+
+FINAL_PROMPT = """Summarize this {document_type} document:
+
+            {text}
+
+            Provide:
+            1. Brief overview (2-3 sentences)
+            2. Key points (bullet list)
+            3. Important dates or deadlines
+            4. Action items"""
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def split_long(text: str, max_tokens: int) -> List[str]:
+    """A paragraph over the limit, split between sentences, or words as a last resort"""
+    pieces = re.split(r'(?<=[.!?])\s+', text)
+    if len(pieces) == 1:
+        pieces = text.split()
+    chunks, current = [], ''
+    for piece in pieces:
+        candidate = f"{current} {piece}" if current else piece
+        if current and estimate_tokens(candidate) > max_tokens:
+            chunks.append(current)
+            candidate = piece
+        current = candidate
+    if current:
+        chunks.append(current)
+    # a single word longer than the limit is cut by characters
+    return [c[i:i + max_tokens * 4] for c in chunks for i in range(0, len(c), max_tokens * 4)]
+
+
+def split_chunks(text: str, max_tokens: int = CHUNK_TOKENS) -> List[str]:
+    """
+    Consecutive paragraphs packed into chunks of at most max_tokens. The
+    same text always gives the same chunks, which is what makes them cacheable.
+    """
+    chunks, current = [], ''
+    for paragraph in re.split(r'\n\s*\n', text or ''):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if estimate_tokens(paragraph) > max_tokens:
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.extend(split_long(paragraph, max_tokens))
+            continue
+        candidate = f"{current}\n\n{paragraph}" if current else paragraph
+        if current and estimate_tokens(candidate) > max_tokens:
+            chunks.append(current)
+            candidate = paragraph
+        current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class SummaryPipeline:
+    """
+    Summarize documents with an AgentEngine, keeping count of what it cost
+    """
+
+    def __init__(self, engine, document_type: str = 'response', model: str = None,
+                 temperature: float = None, chunk_tokens: int = CHUNK_TOKENS, fanin: int = REDUCE_FANIN,
+                 task=None):
+        self.engine = engine
+        self.task = task
+        self.document_type = document_type
+        self.model = model
+        self.temperature = temperature
+        self.chunk_tokens = chunk_tokens
+        self.fanin = fanin
+        self.tokens_used = 0
+        self.tokens_saved = 0
+        self.calls = 0
+        self.cached = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.retries = 0
+        self.cost = Decimal(0)
+        # time spent in engine calls, the levels run one after another
+        self.latency_ms = 0
+
+    def request(self, template: str, text: str, system_prompt: str) -> LLMRequest:
+        request = LLMRequest(template.format(document_type=self.document_type, text=text), system_prompt,
+                             model=self.model, temperature=self.temperature)
+        request.task = self.task
+        return request
+
+    def complete(self, requests: List[LLMRequest]) -> List[str]:
+        contents = []
+        started = time.monotonic()
+        results = self.engine.complete(requests)
+        self.latency_ms += int(round((time.monotonic() - started) * 1000))
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+            self.calls += 1
+            self.cached += 1 if result.get('cached') else 0
+            self.tokens_used += result.get('tokens_used', 0)
+            self.tokens_saved += result.get('tokens_saved', 0)
+            self.prompt_tokens += result.get('prompt_tokens', 0)
+            self.completion_tokens += result.get('completion_tokens', 0)
+            self.retries += result.get('retries', 0)
+            self.cost += result.get('cost', 0)
+            contents.append(result['content'])
+        return contents
+
+    def groups(self, summaries: List[str]) -> List[List[str]]:
+        """Consecutive summaries, at most fanin and chunk_tokens a group"""
+        groups, current = [], []
+        for summary in summaries:
+            # two at least, or long summaries would never reduce
+            if len(current) >= self.fanin or (len(current) >= 2 and
+                    estimate_tokens('\n\n'.join(current + [summary])) > self.chunk_tokens):
+                groups.append(current)
+                current = []
+            current.append(summary)
+        if current:
+            groups.append(current)
+        return groups
+
+    def condense(self, documents: List[str], system_prompt: str):
+        """
+        The text for the final prompt: the documents themselves when they
+        fit in one chunk, otherwise their chunks summarized (map) and the
+        summaries combined (reduce) until one group is left. Returns the
+        text, the chunks and how many levels of calls that took.
+        """
+        chunks = [chunk for document in documents for chunk in split_chunks(document, self.chunk_tokens)]
+        if len(chunks) <= 1:
+            return (chunks[0] if chunks else ''), chunks, 0
+
+        summaries = self.complete([self.request(MAP_PROMPT, chunk, system_prompt) for chunk in chunks])
+        levels = 1
+        groups = self.groups(summaries)
+        while len(groups) > 1:
+            summaries = self.complete([
+                self.request(REDUCE_PROMPT, '\n\n'.join(group), system_prompt) for group in groups
+            ])
+            levels += 1
+            groups = self.groups(summaries)
+        return '\n\n'.join(groups[0]), chunks, levels
+
+    def run(self, documents: List[str], system_prompt: str) -> Dict[str, Any]:
+        text, chunks, levels = self.condense(documents, system_prompt)
+        summary = self.complete([self.request(FINAL_PROMPT, text, system_prompt)])[0]
+        return {'summary': summary, 'chunks': len(chunks), 'levels': levels + 1 if levels else 0,
+                'chunk_hashes': [content_hash(chunk) for chunk in chunks]}
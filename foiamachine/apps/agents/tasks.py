@@ -8,45 +8,52 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-@shared_task
+# acked after it runs, so a task whose worker died is delivered again
+@shared_task(acks_late=True)
 def process_agent_task(task_id):
     """
-    Process an agent task asynchronously
+    Process a queued agent task
+
+    Safe to deliver more than once: only the delivery that claims the
+    pending task calls the agent, the others return without spending tokens.
     """
-    from .models import AgentTask
-    from .services import (
-        RequestDraftAgent, ResponseAnalysisAgent,
-        FollowUpAgent, DocumentSummaryAgent
-    )
+    from .dispatch import process
     
-    try:
-        task = AgentTask.objects.get(id=task_id)
-        
-        # Get the appropriate agent based on task type
-        agents = {
-            'draft_request': RequestDraftAgent,
-            'analyze_response': ResponseAnalysisAgent,
-            'generate_followup': FollowUpAgent,
-            'summarize_document': DocumentSummaryAgent,
-        }
-        
-        agent_class = agents.get(task.task_type)
-        if not agent_class:
-            task.status = 'failed'
-            task.error_message = f"Unknown task type: {task.task_type}"
-            task.save()
-            return
-        
-        agent = agent_class(task.user)
-        
-        # Execute the task based on type
-        # This would call the appropriate agent method with task.input_data
-        
-        logger.info(f"Agent task {task_id} completed successfully")
-        
-    except Exception as e:
-        logger.error(f"Agent task {task_id} failed: {e}")
-        raise
+    task = process(task_id)
+    if task is not None:
+        logger.info(f"Agent task {task_id} {task.status}")
+
+
+@shared_task
+def requeue_stalled_agent_tasks():
+    """
+    Queue again the tasks a lost message or a dead worker left behind
+    """
+    from .dispatch import stalled_tasks
+    
+    stalled = stalled_tasks()
+    for task_id in stalled:
+        process_agent_task.delay(task_id)
+    if stalled:
+        logger.warning(f"Requeued {len(stalled)} stalled agent tasks")
+
+
+@shared_task
+def rollup_agent_usage():
+    """
+    Fold today's and yesterday's agent calls into the usage rollups, the
+    day before is final once this has run after midnight
+    """
+    from django.utils import timezone
+    from datetime import timedelta
+    from .usage import prune, rollup
+    
+    today = timezone.localdate()
+    for day in (today - timedelta(days=1), today):
+        rollup(day)
+    pruned = prune()
+    if pruned:
+        logger.info(f"Pruned {pruned} agent calls already rolled up")
 
 
 @shared_task
@@ -56,77 +63,77 @@ def auto_followup_overdue_requests():
     """
     from django.utils import timezone
     from datetime import timedelta
-    from .models import FOIARequest
+    from .engine import AgentEngine
+    from .models import AgentSuggestion, FOIARequest
     from .services import FollowUpAgent
     
     # Find requests that are overdue (more than 20 business days old)
-    cutoff_date = timezone.now() - timedelta(days=20)
+    now = timezone.now()
+    cutoff_date = now - timedelta(days=20)
     overdue_requests = FOIARequest.objects.filter(
         status='submitted',
         submitted_date__lt=cutoff_date,
         response_received=False,
-        is_deleted=False
-    )
+        is_deleted=False,
+        user__enable_agent_assistance=True
+    ).select_related('user', 'agency')
     
+    jobs = []
     for request in overdue_requests:
-        if request.user.enable_agent_assistance:
-            # Generate follow-up suggestion
-            agent = FollowUpAgent(request.user)
-            context = {
-                'title': request.title,
-                'agency': request.agency.name,
-                'days_elapsed': (timezone.now() - request.submitted_date).days
-            }
-            
-            try:
-                result = agent.generate_followup(context, 'no_response')
-                # Create a suggestion for the user
-                from .models import AgentSuggestion
-                AgentSuggestion.objects.create(
-                    user=request.user,
-                    foia_request=request,
-                    suggestion_type='followup',
-                    title='Suggested Follow-up for Overdue Request',
-                    description=f'Your request has been pending for {context["days_elapsed"]} days.',
-                    suggested_text=result['followup_text']
-                )
-                logger.info(f"Created follow-up suggestion for request {request.id}")
-            except Exception as e:
-                logger.error(f"Failed to create follow-up for request {request.id}: {e}")
+        context = {
+            'title': request.title,
+            'agency': request.agency.name,
+            'agency_id': request.agency_id,
+            'submitted_date': request.submitted_date.date().isoformat(),
+            'days_elapsed': (now - request.submitted_date).days
+        }
+        job = FollowUpAgent(request.user).generate_followup_job(context, 'no_response', foia_request=request)
+        job.context = context
+        jobs.append(job)
+    
+    # every follow-up is generated at once, then the suggestions are written together
+    suggestions = [
+        AgentSuggestion(
+            user=job.task.user,
+            foia_request=job.task.foia_request,
+            suggestion_type='followup',
+            title='Suggested Follow-up for Overdue Request',
+            description=f'Your request has been pending for {job.context["days_elapsed"]} days.',
+            suggested_text=job.output['followup_text']
+        )
+        for job in AgentEngine().run(jobs) if job.succeeded
+    ]
+    AgentSuggestion.objects.bulk_create(suggestions)
+    failed = len(jobs) - len(suggestions)
+    logger.info(f"Created {len(suggestions)} follow-up suggestions, {failed} failed")
 
 
 @shared_task
-def analyze_new_responses():
+def analyze_request_responses(request_id):
     """
-    Automatically analyze new responses that haven't been processed
+    Analyze a request's latest response once its messages have stopped
+    coming for a while, see triggers.py
     """
-    from .models import FOIARequest
-    from .services import ResponseAnalysisAgent
+    from .triggers import analyze_latest_response, settle
     
-    # Find requests with responses that haven't been analyzed
-    unanalyzed = FOIARequest.objects.filter(
-        response_received=True,
-        response_summary='',
-        is_deleted=False
-    )
+    wait = settle(request_id)
+    if wait > 0:
+        analyze_request_responses.apply_async((request_id,), countdown=wait)
+        return
+    task = analyze_latest_response(request_id)
+    if task is not None:
+        logger.info(f"Queued analysis task {task.id} for request {request_id}")
+
+
+@shared_task
+def analyze_new_responses():
+    """
+    Safety sweep for responses whose trigger was lost: requests with
+    messages received since the last sweep get an analysis scheduled.
+    Responses are normally analyzed when mail stores them.
+    """
+    from .triggers import sweep
     
-    for request in unanalyzed:
-        if request.user.enable_agent_assistance:
-            # Get the response text from communications
-            latest_comm = request.communications.filter(
-                direction='incoming'
-            ).first()
-            
-            if latest_comm:
-                agent = ResponseAnalysisAgent(request.user)
-                try:
-                    result = agent.analyze_response(
-                        latest_comm.content,
-                        request.request_body
-                    )
-                    request.response_summary = result['summary']
-                    request.requires_followup = result['requires_followup']
-                    request.save()
-                    logger.info(f"Analyzed response for request {request.id}")
-                except Exception as e:
-                    logger.error(f"Failed to analyze response for request {request.id}: {e}")
+    scheduled = sweep()
+    if scheduled:
+        logger.warning(f"Sweep scheduled analysis for {scheduled} requests")
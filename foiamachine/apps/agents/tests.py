@@ -0,0 +1,535 @@
+import datetime
+import json
+import shutil
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from foiamachine.apps.agency.models import Agency
+from foiamachine.apps.government.models import FeeExemptionOther, Government, Statute
+from foiamachine.apps.mail.models import MailBox, MailMessage
+from foiamachine.apps.requests.models import Request
+
+from .cache import LLMCache
+from .context import agency_context, agency_prompt_context
+from .dispatch import PROCESSING_TIMEOUT, claim_task, enqueue_task, process, stalled_tasks
+from .engine import AgentEngine
+from .llm import OpenAIBackend, TokenBudget, estimate_tokens
+from .mock_llm import MockLLMServer
+from .models import AgentCall, AgentTask, AgentUsage, ContextBundle, PendingAnalysis
+from .services import DocumentSummaryAgent, RequestDraftAgent
+from .summarize import CHUNK_TOKENS, split_chunks
+from .triggers import WATERMARK_KEY, schedule_analysis, settle, sweep
+from .usage import LATENCY_BUCKETS, bucket, merge, percentile, rollup
+
+
+@override_settings(AGENT_CONFIG={'CACHE_PATH': ''})
+class AgentEngineTesting(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='john', email='john@example.com',
+                                                         password='secret')
+        self.server = MockLLMServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def jobs(self, count):
+        agent = RequestDraftAgent(self.user)
+        return [agent.draft_request_job(f"records number {i}", 'Agency', 'state') for i in range(count)]
+
+    def test_jobs_run_concurrently_within_the_pool(self):
+        self.server.delay = 0.1
+        backend = OpenAIBackend(api_base=self.server.url, api_key='test', batch_size=1)
+        jobs = AgentEngine(backend=backend, workers=3).run(self.jobs(6))
+        self.assertTrue(all(job.succeeded for job in jobs))
+        self.assertEqual(len(self.server.calls), 6)
+        self.assertTrue(1 < self.server.max_active <= 3)
+        tasks = AgentTask.objects.filter(user=self.user)
+        self.assertEqual([task.status for task in tasks], ['completed'] * 6)
+        self.assertTrue(all(task.tokens_used > 0 for task in tasks))
+        self.assertIn('records number', jobs[0].output['request_text'])
+
+    def test_prompts_are_batched(self):
+        backend = OpenAIBackend(api_base=self.server.url, api_key='test', batch_size=3)
+        jobs = AgentEngine(backend=backend, workers=2).run(self.jobs(5))
+        self.assertEqual([path for path, payload in self.server.calls], ['/v1/completions'] * 2)
+        self.assertEqual(sorted(len(payload['prompt']) for path, payload in self.server.calls), [2, 3])
+        for i, job in enumerate(jobs):
+            self.assertIn(f"records number {i}", job.output['request_text'])
+
+    def test_failures_are_recorded_per_job(self):
+        self.server.fail_next = 1
+        backend = OpenAIBackend(api_base=self.server.url, api_key='test', batch_size=1)
+        jobs = AgentEngine(backend=backend, workers=1).run(self.jobs(2))
+        self.assertEqual(sorted(job.succeeded for job in jobs), [False, True])
+        failed = AgentTask.objects.get(status='failed')
+        self.assertIn('500', failed.error_message)
+        self.assertIsNotNone(failed.completed_at)
+
+    def test_missing_results_fail_their_jobs(self):
+        class ShortBackend(OpenAIBackend):
+            def complete_batch(self, requests):
+                return super(ShortBackend, self).complete_batch(requests)[:-1]
+
+        backend = ShortBackend(api_base=self.server.url, api_key='test', batch_size=3)
+        jobs = AgentEngine(backend=backend, workers=1).run(self.jobs(3))
+        self.assertEqual([job.succeeded for job in jobs], [True, True, False])
+        failed = AgentTask.objects.get(status='failed')
+        self.assertIn('2 results for 3 prompts', failed.error_message)
+
+    def test_token_budget_waits_for_refill(self):
+        now = [0.0]
+        slept = []
+
+        def sleep(seconds):
+            slept.append(seconds)
+            now[0] += seconds
+
+        budget = TokenBudget(600, clock=lambda: now[0], sleep=sleep)
+        budget.acquire(600)
+        self.assertEqual(slept, [])
+        budget.acquire(100)
+        self.assertEqual(slept, [10.0])
+        # unused tokens come back
+        budget.settle(100, 40)
+        self.assertEqual(budget.available, 60)
+
+
+@override_settings(AGENT_CONFIG={'CACHE_PATH': ''})
+class LLMCacheTesting(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='john', email='john@example.com',
+                                                         password='secret')
+        self.server = MockLLMServer().start()
+        self.directory = tempfile.mkdtemp()
+        self.now = [1000.0]
+        self.cache = LLMCache(f"{self.directory}/cache.sqlite3", ttl=60, max_entries=2, clock=lambda: self.now[0])
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def engine(self, cache=None):
+        backend = OpenAIBackend(api_base=self.server.url, api_key='test', batch_size=1)
+        return AgentEngine(backend=backend, workers=2, cache=cache or self.cache)
+
+    def jobs(self, count):
+        agent = RequestDraftAgent(self.user)
+        return [agent.draft_request_job(f"records number {i}", 'Agency', 'state') for i in range(count)]
+
+    def test_repeated_prompts_cost_no_tokens(self):
+        first = self.engine().run(self.jobs(2))
+        self.assertEqual(len(self.server.calls), 2)
+        self.assertEqual([job.task.cache_hit for job in first], [False, False])
+
+        # a fresh cache object on the same file, like another process
+        cache = LLMCache(self.cache.path, ttl=60, max_entries=2, clock=lambda: self.now[0])
+        second = self.engine(cache).run(self.jobs(2))
+        self.assertEqual(len(self.server.calls), 2)
+        self.assertEqual([job.output for job in second], [job.output for job in first])
+        for job, earlier in zip(second, first):
+            task = AgentTask.objects.get(pk=job.task.pk)
+            self.assertEqual((task.cache_hit, task.tokens_used), (True, 0))
+            self.assertEqual(task.tokens_saved, earlier.task.tokens_used)
+
+    def test_entries_expire_and_least_recently_used_are_evicted(self):
+        self.cache.set('a', 'A', 1)
+        self.now[0] += 61
+        self.assertIsNone(self.cache.get('a'))
+
+        for key in ('a', 'b', 'c'):
+            self.cache.set(key, key.upper(), 1)
+            self.now[0] += 1
+        self.cache.get('a')
+        self.cache.evict()
+        self.assertEqual(len(self.cache), 2)
+        self.cache.memory.clear()
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a')['content'], 'A')
+
+
+class DocumentSummaryTesting(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='john', email='john@example.com',
+                                                         password='secret')
+        self.server = MockLLMServer().start()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def document(self, name, paragraphs=30):
+        return '\n\n'.join(f"{name} paragraph {i}. " + 'Records were located and released. ' * 12
+                             for i in range(paragraphs))
+
+    def map_calls(self):
+        return [payload for path, payload in self.server.calls
+                if 'excerpt' in payload['messages'][-1]['content']]
+
+    def test_chunks_are_bounded_and_stable(self):
+        text = self.document('memo') + '\n\n' + 'word ' * 4000
+        chunks = split_chunks(text)
+        self.assertTrue(len(chunks) > 2)
+        self.assertTrue(all(estimate_tokens(chunk) <= CHUNK_TOKENS for chunk in chunks))
+        self.assertEqual(chunks, split_chunks(text))
+
+    def test_new_attachment_only_summarizes_new_chunks(self):
+        config = {'CACHE_PATH': f"{self.directory}/cache.sqlite3", 'API_BASE': self.server.url,
+                  'OPENAI_API_KEY': 'test'}
+        documents = [self.document('letter'), self.document('invoice')]
+        with self.settings(AGENT_CONFIG=config):
+            agent = DocumentSummaryAgent(self.user)
+            first = agent.summarize_documents(documents)
+            self.assertEqual(len(self.map_calls()), first['chunks'])
+            self.assertTrue(first['levels'] >= 2)
+
+            self.server.calls = []
+            extra = self.document('emails', paragraphs=10)
+            second = agent.summarize_documents(documents + [extra])
+        self.assertEqual(len(self.map_calls()), len(split_chunks(extra)))
+        self.assertEqual(second['chunks'], first['chunks'] + len(split_chunks(extra)))
+        task = AgentTask.objects.filter(task_type='summarize_document').order_by('-id')[0]
+        self.assertEqual(task.status, 'completed')
+        self.assertTrue(task.tokens_saved > 0)
+
+
+    def test_job_prompt_covers_long_documents(self):
+        config = {'API_BASE': self.server.url, 'OPENAI_API_KEY': 'test'}
+        document = self.document('letter')
+        with self.settings(AGENT_CONFIG=config):
+            job = DocumentSummaryAgent(self.user).summarize_document_job(document)
+        chunks = split_chunks(document)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(len(self.map_calls()), len(chunks))
+        self.assertNotIn(chunks[0], job.request.prompt)
+        self.assertIn('mock:', job.request.prompt)
+
+
+class DispatchTesting(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='john', email='john@example.com',
+                                                         password='secret')
+        self.server = MockLLMServer().start()
+        self.config = {'CACHE_PATH': '', 'API_BASE': self.server.url, 'OPENAI_API_KEY': 'test'}
+        self.input = {'description': 'budget memos', 'agency_name': 'Agency', 'agency_type': 'state'}
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_repeated_key_and_duplicate_delivery_spend_tokens_once(self):
+        task, created = enqueue_task(self.user, 'draft_request', self.input, idempotency_key='abc')
+        again, created_again = enqueue_task(self.user, 'draft_request', self.input, idempotency_key='abc')
+        self.assertTrue(created)
+        self.assertFalse(created_again)
+        self.assertEqual(task.pk, again.pk)
+        with self.settings(AGENT_CONFIG=self.config):
+            self.assertEqual(process(task.pk).status, 'completed')
+            self.assertIsNone(process(task.pk))
+        self.assertEqual(len(self.server.calls), 1)
+        task = AgentTask.objects.get(pk=task.pk)
+        self.assertTrue(task.output_data['request_text'].startswith('mock:'))
+
+    def test_processing_tasks_are_only_reclaimed_after_the_timeout(self):
+        task, created = enqueue_task(self.user, 'draft_request', self.input)
+        self.assertIsNotNone(claim_task(task.pk))
+        self.assertIsNone(claim_task(task.pk))
+        self.assertEqual(stalled_tasks(), [])
+
+        AgentTask.objects.filter(pk=task.pk).update(started_at=timezone.now() - PROCESSING_TIMEOUT * 2)
+        self.assertEqual(stalled_tasks(), [task.pk])
+        self.assertIsNotNone(claim_task(task.pk))
+
+    def test_bad_input_fails_the_task(self):
+        task, created = enqueue_task(self.user, 'draft_request', {'description': 'budget memos'})
+        with self.settings(AGENT_CONFIG=self.config):
+            task = process(task.pk)
+        self.assertEqual(task.status, 'failed')
+        self.assertIn('agency_name', task.error_message)
+        self.assertEqual(self.server.calls, [])
+
+    def test_endpoints_queue_and_report(self):
+        self.client.login(username='john', password='secret')
+        response = self.client.post(reverse('api:agents_api:draft_request'), json.dumps(self.input),
+                                    content_type='application/json', HTTP_IDEMPOTENCY_KEY='k1')
+        self.assertEqual(response.status_code, 202)
+        data = json.loads(response.content)
+        self.assertEqual(data['status'], 'pending')
+        self.assertEqual(self.server.calls, [])
+        response = self.client.post(reverse('api:agents_api:draft_request'), json.dumps(self.input),
+                                    content_type='application/json', HTTP_IDEMPOTENCY_KEY='k1')
+        self.assertEqual(json.loads(response.content)['task_id'], data['task_id'])
+
+        with self.settings(AGENT_CONFIG=self.config):
+            process(data['task_id'])
+        status = json.loads(self.client.get(data['status_url'], {'wait': 1}).content)
+        self.assertEqual(status['status'], 'completed')
+        self.assertIn('request_text', status['output'])
+
+
+class StreamingTesting(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='john', email='john@example.com',
+                                                         password='secret')
+        self.server = MockLLMServer().start()
+        self.input = {'description': 'budget memos', 'agency_name': 'Agency', 'agency_type': 'state'}
+
+    def tearDown(self):
+        self.server.stop()
+
+    def events(self, response):
+        body = b''.join(response.streaming_content).decode('utf-8')
+        return [(event.split('\n')[0][len('event: '):], json.loads(event.split('\n')[1][len('data: '):]))
+                for event in body.strip().split('\n\n')]
+
+    def stream(self):
+        self.client.login(username='john', password='secret')
+        response = self.client.post(reverse('api:agents_api:draft_request_stream'), json.dumps(self.input),
+                                    content_type='application/json')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        return self.events(response)
+
+    def test_tokens_are_relayed_and_the_draft_is_stored(self):
+        config = {'CACHE_PATH': '', 'API_BASE': self.server.url, 'OPENAI_API_KEY': 'test'}
+        with self.settings(AGENT_CONFIG=config):
+            events = self.stream()
+        tokens = [data['text'] for event, data in events if event == 'token']
+        self.assertTrue(len(tokens) > 1)
+        self.assertEqual([event for event, data in events][0], 'task')
+        self.assertEqual(events[-1][0], 'done')
+        task = AgentTask.objects.get(pk=events[0][1]['task_id'])
+        self.assertEqual(task.status, 'completed')
+        self.assertEqual(task.output_data['request_text'], ''.join(tokens))
+        self.assertTrue(task.tokens_used > 0)
+        self.assertTrue(self.server.calls[0][1]['stream'])
+
+    def test_backends_that_cant_stream_send_one_piece(self):
+        with self.settings(AGENT_CONFIG={'CACHE_PATH': ''}):
+            events = self.stream()
+        self.assertEqual([event for event, data in events], ['task', 'token', 'done'])
+        self.assertEqual(events[1][1]['text'], events[2][1]['output']['request_text'])
+
+    def test_the_draft_is_kept_when_the_client_goes_away(self):
+        backend = OpenAIBackend(api_base=self.server.url, api_key='test')
+        with self.settings(AGENT_CONFIG={'CACHE_PATH': ''}):
+            job = RequestDraftAgent(self.user).draft_request_job('budget memos', 'Agency', 'state')
+            pieces = AgentEngine(backend=backend).stream_one(job)
+            next(pieces)
+            pieces.close()
+        task = AgentTask.objects.get(pk=job.task.pk)
+        self.assertEqual(task.status, 'completed')
+        self.assertTrue(task.output_data['request_text'].startswith('mock:'))
+
+
+class ContextBundleTesting(TestCase):
+
+    def setUp(self):
+        self.government = Government.objects.create(name='Illinois', level='1')
+        self.statute = Statute.objects.create(short_title='Illinois FOIA', designator='5 ILCS 140',
+                                              days_till_due=5, exemptions='["7(1)(c) personal privacy"]')
+        self.government.statutes.add(self.statute)
+        self.agency = Agency.objects.create(name='Department of Healthcare and Family Services',
+                                            government=self.government, foia_officer_email='foia@example.gov',
+                                            medicaid_agency_name='HFS')
+
+    def test_prompts_cost_no_queries_once_built(self):
+        text = agency_prompt_context(self.agency.pk)
+        self.assertIn('5 working days', text)
+        self.assertIn('personal privacy', text)
+        self.assertIn('foia@example.gov', text)
+        self.assertEqual(ContextBundle.objects.count(), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(agency_prompt_context(self.agency.pk), text)
+
+    def test_changes_refresh_the_bundles(self):
+        agency_context(self.agency.pk)
+        exemption = FeeExemptionOther.objects.create(name='Trade secrets', typee='E')
+        self.statute.fees_exemptions.add(exemption)
+        self.assertIn('Exemption: Trade secrets', agency_prompt_context(self.agency.pk))
+
+        self.statute.days_till_due = 10
+        self.statute.save()
+        self.agency.legal_notes = 'Requests must be in writing'
+        self.agency.save()
+        text = agency_prompt_context(self.agency.pk)
+        self.assertIn('10 working days', text)
+        self.assertIn('Requests must be in writing', text)
+
+        other = Statute.objects.create(short_title='Medicaid records act', days_till_due=20)
+        self.government.statutes.add(other)
+        self.assertIn('Medicaid records act', agency_prompt_context(self.agency.pk))
+        self.assertIn('20 working days', agency_prompt_context(self.agency.pk))
+
+        # only the statute bundle is rebuilt, the agency's still reads the longest deadline first
+        self.statute.days_till_due = 30
+        self.statute.save()
+        self.assertIn('30 working days', agency_prompt_context(self.agency.pk))
+
+    def test_contact_imports_refresh_the_bundles(self):
+        from foiamachine.apps.contacts.importer import ContactImporter, ContactRecord
+        self.assertNotIn('Only by mail', agency_prompt_context(self.agency.pk))
+        ContactImporter().run([ContactRecord(self.government, self.agency.name,
+                                             agency_fields={'legal_notes': 'Only by mail'})])
+        self.assertIn('Only by mail', agency_prompt_context(self.agency.pk))
+
+    def test_due_date_skips_weekends(self):
+        # sent on a Friday, five working days later is the next Friday
+        text = agency_prompt_context(self.agency.pk, datetime.date(2024, 3, 1))
+        self.assertIn('2024-03-08', text)
+
+
+@override_settings(AGENT_CONFIG={'CACHE_PATH': ''})
+class UsageTesting(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='john', email='john@example.com',
+                                                         password='secret')
+        self.server = MockLLMServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def run_jobs(self, count, **kwargs):
+        backend = OpenAIBackend(api_base=self.server.url, api_key='test', batch_size=1, backoff=0, **kwargs)
+        agent = RequestDraftAgent(self.user)
+        jobs = [agent.draft_request_job(f"records number {i}", 'Agency', 'state') for i in range(count)]
+        return AgentEngine(backend=backend, workers=2).run(jobs)
+
+    def test_calls_are_recorded_and_rolled_up(self):
+        self.server.fail_next = 1
+        jobs = self.run_jobs(3)
+        calls = AgentCall.objects.filter(user=self.user)
+        self.assertEqual(sorted(call.outcome for call in calls), ['error', 'ok', 'ok'])
+        for job in jobs:
+            if not job.succeeded:
+                continue
+            task = AgentTask.objects.get(pk=job.task.pk)
+            self.assertEqual(task.prompt_tokens + task.completion_tokens, task.tokens_used)
+            self.assertTrue(task.completion_tokens > 0)
+            self.assertTrue(task.cost > 0)
+            self.assertIsNotNone(task.latency_ms)
+            call = task.calls.get()
+            self.assertEqual((call.task_type, call.cost), ('draft_request', task.cost))
+
+        self.assertEqual(rollup(timezone.localdate()), 1)
+        usage = AgentUsage.objects.get()
+        self.assertEqual((usage.calls, usage.errors, usage.cached), (3, 1, 0))
+        self.assertEqual(sum(usage.latency_histogram), 3)
+        # rolling up again replaces the day's rows
+        self.run_jobs(1)
+        rollup(timezone.localdate())
+        self.assertEqual(AgentUsage.objects.get().calls, 4)
+
+    def test_rate_limits_are_retried(self):
+        self.server.fail_next = 1
+        self.server.fail_status = 429
+        jobs = self.run_jobs(1, retries=2)
+        self.assertTrue(jobs[0].succeeded)
+        self.assertEqual(AgentTask.objects.get(pk=jobs[0].task.pk).retries, 1)
+        self.assertEqual(AgentCall.objects.get().retries, 1)
+
+    def test_percentiles_merge_across_rollups(self):
+        fast = [0] * (len(LATENCY_BUCKETS) + 1)
+        slow = list(fast)
+        fast[bucket(80)] = 90
+        slow[bucket(4000)] = 10
+        merged = merge([fast, slow])
+        self.assertEqual(percentile(merged, 0.5), 100)
+        self.assertEqual(percentile(merged, 0.95), 5000)
+        self.assertIsNone(percentile(merge([]), 0.5))
+
+    def test_report_is_staff_only(self):
+        self.run_jobs(2)
+        rollup(timezone.localdate())
+        self.client.login(username='john', password='secret')
+        url = reverse('api:agents_api:usage')
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.user.is_staff = True
+        self.user.save()
+        data = json.loads(self.client.get(url, {'group': 'task_type', 'days': 1}).content)
+        self.assertEqual(data['totals']['calls'], 2)
+        self.assertIsNotNone(data['totals']['latency_ms_p95'])
+        self.assertEqual([group['task_type'] for group in data['groups']], ['draft_request'])
+        self.assertEqual(self.client.get(url, {'group': 'agency'}).status_code, 400)
+
+
+@override_settings(AGENT_CONFIG={'ANALYSIS_DEBOUNCE': 60, 'ANALYSIS_MAX_DELAY': 600})
+class ResponseTriggerTesting(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(username='john', email='john@example.com',
+                                                         password='secret')
+        self.request = Request.objects.create(author=self.user, title='Budget', free_edit_body='Budget memos')
+        self.root = MailMessage.objects.create(subject='Budget', email_from='john@example.com', direction='S',
+                                               request=self.request)
+
+    def reply(self):
+        message = MailMessage.objects.create(subject='Re: Budget', email_from='foia@example.gov', direction='R',
+                                             body='Records attached')
+        self.root.replies.add(message)
+        return message
+
+    def test_a_burst_of_replies_is_analyzed_once(self):
+        mailbox = MailBox.objects.create(usr=self.user)
+        with self.captureOnCommitCallbacks() as callbacks:
+            for i in range(3):
+                self.assertEqual(mailbox.notify_response(self.reply()), self.request.pk)
+        self.assertEqual(len(callbacks), 1)
+        self.assertTrue(50 < settle(self.request.pk) <= 60)
+
+        with self.settings(AGENT_CONFIG={'ANALYSIS_DEBOUNCE': 0, 'ANALYSIS_MAX_DELAY': 0}):
+            self.assertEqual(settle(self.request.pk), 0)
+            # settled, the next reply schedules anew
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.assertTrue(schedule_analysis(self.request.pk))
+            self.assertEqual(len(callbacks), 1)
+
+    def test_lost_runs_are_scheduled_again(self):
+        with self.captureOnCommitCallbacks():
+            self.assertTrue(schedule_analysis(self.request.pk))
+        # the queued run never came, e.g. the broker dropped it
+        PendingAnalysis.objects.update(first=timezone.now() - datetime.timedelta(hours=1))
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertTrue(schedule_analysis(self.request.pk))
+        self.assertEqual(len(callbacks), 1)
+
+    def test_settled_request_queues_an_analysis(self):
+        from .tasks import analyze_request_responses
+        message = self.reply()
+        with self.captureOnCommitCallbacks():
+            analyze_request_responses(self.request.pk)
+        task = AgentTask.objects.get(task_type='analyze_response')
+        self.assertEqual(task.user, self.user)
+        self.assertEqual(task.input_data['message_id'], message.pk)
+        self.assertEqual(task.input_data['request_id'], self.request.pk)
+        self.assertEqual(task.input_data['original_request'], 'Budget memos')
+        # the same response is not analyzed twice
+        with self.captureOnCommitCallbacks():
+            analyze_request_responses(self.request.pk)
+        self.assertEqual(AgentTask.objects.filter(task_type='analyze_response').count(), 1)
+
+    def test_sweep_only_reads_past_the_watermark(self):
+        message = self.reply()
+        message.dated = timezone.now()
+        message.save()
+        with self.captureOnCommitCallbacks():
+            self.assertEqual(sweep(), 1)
+        self.assertEqual(cache.get(WATERMARK_KEY), message.pk)
+        PendingAnalysis.objects.all().delete()
+        self.assertEqual(sweep(), 0)
+        self.reply()
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertEqual(sweep(), 1)
+        self.assertEqual(len(callbacks), 1)
@@ -0,0 +1,136 @@
+"""
+Response analysis triggered by incoming mail
+
+When MailBox.store_message threads a reply onto a request, mail sends
+response_received and the request's analysis is scheduled ANALYSIS_DEBOUNCE
+seconds out. Messages arriving meanwhile push the run back instead of
+queueing another, up to ANALYSIS_MAX_DELAY after the first, so a burst of
+replies and attachments costs one analysis of the latest message. The
+pending state is a PendingAnalysis row, so bursts split across processes
+coalesce; the idempotency key on the latest message keeps it from being
+analyzed twice either way.
+
+analyze_new_responses sweeps inbound messages past a watermark for any
+request whose trigger was lost, e.g. mail stored while the broker was down.
+"""
+
+import logging
+from datetime import timedelta
+from typing import Optional
+
+from django.core.cache import cache
+from django.db import models, transaction
+from django.utils import timezone
+
+from .dispatch import enqueue_task
+from .llm import agent_setting
+from .models import AgentTask, PendingAnalysis
+
+logger = logging.getLogger(__name__)
+
+WATERMARK_KEY = 'agent_analysis_watermark'
+# where the sweep starts when the watermark was lost
+SWEEP_LOOKBACK = timedelta(days=1)
+
+RECEIVED = 'R'
+DELETED = 'X'
+
+
+def delays():
+    return agent_setting('ANALYSIS_DEBOUNCE', 60), agent_setting('ANALYSIS_MAX_DELAY', 600)
+
+
+def schedule_analysis(request_id: int) -> bool:
+    """
+    Note a new response for the request, True when this queued its
+    analysis and False when it joined one already waiting
+    """
+    debounce, max_delay = delays()
+    now = timezone.now()
+    due = now + timedelta(seconds=debounce)
+    with transaction.atomic():
+        pending, created = PendingAnalysis.objects.select_for_update().get_or_create(
+            request_id=request_id, defaults={'first': now, 'due': due})
+        if not created:
+            # a row older than any run would leave was left by a lost task
+            lost = pending.first < now - timedelta(seconds=max_delay + debounce)
+            pending.due = due
+            if lost:
+                pending.first = now
+            pending.save(update_fields=['first', 'due'])
+            if not lost:
+                return False
+    from .tasks import analyze_request_responses
+    transaction.on_commit(lambda: analyze_request_responses.apply_async((request_id,), countdown=debounce))
+    return True
+
+
+def settle(request_id: int) -> float:
+    """
+    Seconds until the request's responses have been quiet long enough;
+    at 0 the pending state is cleared so the next response schedules anew
+    """
+    debounce, max_delay = delays()
+    with transaction.atomic():
+        pending = PendingAnalysis.objects.select_for_update().filter(request_id=request_id).first()
+        if pending is None:
+            return 0
+        wait = (min(pending.due, pending.first + timedelta(seconds=max_delay)) - timezone.now()).total_seconds()
+        if wait > 0:
+            return wait
+        pending.delete()
+    return 0
+
+
+def inbound_messages(request_ids):
+    """Received messages of the requests, on the request itself or as replies in its thread"""
+    from foiamachine.apps.mail.models import MailMessage
+    return MailMessage.objects.filter(
+        models.Q(request_id__in=request_ids) | models.Q(replies__request_id__in=request_ids),
+        direction=RECEIVED
+    ).distinct()
+
+
+def analyze_latest_response(request_id: int) -> Optional[AgentTask]:
+    """Queue the analysis of the request's latest response, None when there is nothing new"""
+    from foiamachine.apps.requests.models import Request
+    request = Request.objects.filter(pk=request_id).exclude(status=DELETED).select_related('author').first()
+    if request is None:
+        return None
+    message = inbound_messages([request_id]).order_by('-dated', '-id').first()
+    if message is None:
+        return None
+    # the request travels in the input, AgentTask.foia_request is not a Request
+    task, created = enqueue_task(request.author, 'analyze_response', {
+        'response_text': message.body_text or message.body or '',
+        'original_request': request.free_edit_body,
+        'message_id': message.pk,
+        'request_id': request.pk
+    }, idempotency_key=f"response:{message.pk}")
+    return task if created else None
+
+
+def sweep() -> int:
+    """
+    Schedule analysis for requests that got messages past the watermark,
+    returns how many requests were scheduled
+    """
+    from foiamachine.apps.mail.models import MailMessage
+    newest = MailMessage.objects.aggregate(newest=models.Max('id'))['newest']
+    if newest is None:
+        return 0
+    watermark = cache.get(WATERMARK_KEY)
+    received = MailMessage.objects.filter(direction=RECEIVED, id__lte=newest)
+    if watermark is None:
+        received = received.filter(dated__gte=timezone.now() - SWEEP_LOOKBACK)
+    else:
+        received = received.filter(id__gt=watermark)
+    ids = list(received.values_list('id', flat=True))
+    request_ids = set(received.filter(request__isnull=False).values_list('request_id', flat=True))
+    if ids:
+        request_ids.update(MailMessage.objects.filter(replies__id__in=ids, request__isnull=False)
+                           .values_list('request_id', flat=True))
+    for request_id in request_ids:
+        schedule_analysis(request_id)
+    cache.set(WATERMARK_KEY, newest, None)
+    return len(request_ids)
@@ -0,0 +1,247 @@
+"""
+Token, latency and spend accounting for agent LLM calls
+
+The engine notes every prompt it answers: how long it waited for the
+token budget and a worker (queue), how long the LLM took (latency),
+tokens in and out, retries, what it cost and whether it came from the
+cache. Notes are kept in memory while calls run, on worker threads, and
+written as AgentCall rows with one bulk_create. rollup() folds a day's
+calls into AgentUsage rows by user, task type and model, with latencies
+as a histogram so p50/p95 can be read for any slice of days.
+"""
+
+import bisect
+import datetime
+import logging
+import threading
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Optional
+
+from django.db import transaction
+from django.utils import timezone
+
+from .llm import agent_setting, estimate_tokens
+from .models import AgentCall, AgentUsage
+
+logger = logging.getLogger(__name__)
+
+# USD per 1K (prompt, completion) tokens, AGENT_CONFIG['PRICES'] adds to these
+DEFAULT_PRICES = {
+    'gpt-4-turbo-preview': ('0.01', '0.03'),
+    'gpt-4-turbo': ('0.01', '0.03'),
+    'gpt-4': ('0.03', '0.06'),
+    'gpt-4o': ('0.0025', '0.01'),
+    'gpt-4o-mini': ('0.00015', '0.0006'),
+    'gpt-3.5-turbo': ('0.0005', '0.0015'),
+}
+
+# upper bounds of the latency histogram's buckets in ms, the last bucket
+# holds everything slower
+LATENCY_BUCKETS = [50, 100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, 7500,
+                   10000, 15000, 20000, 30000, 45000, 60000, 90000, 120000]
+
+GROUPS = ('day', 'user', 'task_type', 'model')
+
+
+def prices(model: str):
+    table = dict(DEFAULT_PRICES, **agent_setting('PRICES', {}))
+    prompt, completion = table.get(model, (0, 0))
+    return Decimal(str(prompt)), Decimal(str(completion))
+
+
+def cost(model: str, prompt_tokens: int, completion_tokens: int) -> Decimal:
+    """What a call cost, zero for models without a price"""
+    prompt, completion = prices(model)
+    return ((prompt * prompt_tokens + completion * completion_tokens) / 1000).quantize(Decimal('0.000001'))
+
+
+def bucket(latency_ms: int) -> int:
+    return bisect.bisect_left(LATENCY_BUCKETS, latency_ms)
+
+
+def percentile(histogram: List[int], q: float) -> Optional[int]:
+    """The bucket bound at or under which q of the calls finished, None without calls"""
+    total = sum(histogram)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(histogram):
+        seen += count
+        if count and seen >= rank:
+            return LATENCY_BUCKETS[min(i, len(LATENCY_BUCKETS) - 1)]
+    return LATENCY_BUCKETS[-1]
+
+
+def merge(histograms: Iterable[List[int]]) -> List[int]:
+    merged = [0] * (len(LATENCY_BUCKETS) + 1)
+    for histogram in histograms:
+        for i, count in enumerate(histogram):
+            merged[i] += count
+    return merged
+
+
+def split_tokens(request, result: Dict[str, Any]):
+    """
+    (prompt, completion) tokens of a result; servers that only report a
+    total get the prompt's estimated share of it
+    """
+    prompt_tokens, completion_tokens = result.get('prompt_tokens'), result.get('completion_tokens')
+    if prompt_tokens is not None and completion_tokens is not None:
+        return prompt_tokens, completion_tokens
+    total = result.get('tokens_used', 0)
+    prompt_tokens = min(total, estimate_tokens(request.system_prompt, request.prompt))
+    return prompt_tokens, total - prompt_tokens
+
+
+class UsageRecorder:
+    """
+    AgentCalls noted from any thread and written by flush(), which must
+    run where the database can be used
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def record(self, request, outcome: str, latency_ms: int = 0, queue_ms: int = 0, prompt_tokens: int = 0,
+               completion_tokens: int = 0, tokens_saved: int = 0, retries: int = 0, batch_size: int = 1) -> Decimal:
+        """Note one call, returns its cost"""
+        spent = cost(request.model, prompt_tokens, completion_tokens) if outcome != 'cached' else Decimal(0)
+        with self.lock:
+            self.pending.append((request.task, dict(
+                model=request.model,
+                outcome=outcome,
+                latency_ms=latency_ms,
+                queue_ms=queue_ms,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                tokens_saved=tokens_saved,
+                retries=retries,
+                cost=spent,
+                batch_size=batch_size
+            )))
+        return spent
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return
+        calls = []
+        # the task may have been saved since the call was noted
+        for task, fields in pending:
+            if task is not None:
+                fields.update(task_id=task.pk, user_id=task.user_id, task_type=task.task_type)
+            calls.append(AgentCall(**fields))
+        try:
+            AgentCall.objects.bulk_create(calls)
+        except Exception as e:
+            # accounting never fails the work it accounts for
+            logger.error(f"Could not record {len(calls)} agent calls: {e}")
+
+
+def day_range(day: datetime.date):
+    start = timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+    return start, start + datetime.timedelta(days=1)
+
+
+def rollup(day: datetime.date) -> int:
+    """Rebuild the AgentUsage rows of a day from its calls, returns how many there are"""
+    start, end = day_range(day)
+    rows = {}
+    calls = AgentCall.objects.filter(created_at__gte=start, created_at__lt=end).values_list(
+        'user_id', 'task_type', 'model', 'outcome', 'latency_ms', 'queue_ms', 'prompt_tokens',
+        'completion_tokens', 'tokens_saved', 'retries', 'cost')
+    for (user_id, task_type, model, outcome, latency_ms, queue_ms, prompt_tokens, completion_tokens,
+         tokens_saved, retries, spent) in calls.iterator():
+        row = rows.get((user_id, task_type, model))
+        if row is None:
+            row = rows[(user_id, task_type, model)] = AgentUsage(
+                day=day, user_id=user_id, task_type=task_type, model=model,
+                latency_histogram=[0] * (len(LATENCY_BUCKETS) + 1))
+        row.calls += 1
+        row.errors += outcome == 'error'
+        row.cached += outcome == 'cached'
+        row.retries += retries
+        row.prompt_tokens += prompt_tokens
+        row.completion_tokens += completion_tokens
+        row.tokens_saved += tokens_saved
+        row.cost += spent
+        row.queue_ms_total += queue_ms
+        # cache hits would pull the percentiles toward zero
+        if outcome != 'cached':
+            row.latency_ms_total += latency_ms
+            row.latency_histogram[bucket(latency_ms)] += 1
+    with transaction.atomic():
+        AgentUsage.objects.filter(day=day).delete()
+        AgentUsage.objects.bulk_create(rows.values())
+    return len(rows)
+
+
+def prune(days: int = None) -> int:
+    """Delete calls older than CALL_LOG_DAYS, they live on in the rollups"""
+    days = agent_setting('CALL_LOG_DAYS', 30) if days is None else days
+    start = day_range(timezone.localdate() - datetime.timedelta(days=days))[0]
+    deleted, _ = AgentCall.objects.filter(created_at__lt=start).delete()
+    return deleted
+
+
+def hours_of(start: datetime.date, end: datetime.date) -> float:
+    """Hours from the start of one day to the end of another, or to now"""
+    first, last = day_range(start)[0], min(day_range(end)[1], timezone.now())
+    return max((last - first).total_seconds() / 3600, 0)
+
+
+def group_key(row: AgentUsage, group: str):
+    if group == 'day':
+        return row.day.isoformat()
+    if group == 'user':
+        return row.user_id
+    return getattr(row, group)
+
+
+def totals(rows: List[AgentUsage], hours: float) -> Dict[str, Any]:
+    calls = sum(row.calls for row in rows)
+    answered = sum(row.calls - row.cached for row in rows)
+    histogram = merge(row.latency_histogram for row in rows)
+    prompt_tokens = sum(row.prompt_tokens for row in rows)
+    completion_tokens = sum(row.completion_tokens for row in rows)
+    return {
+        'calls': calls,
+        'errors': sum(row.errors for row in rows),
+        'cached': sum(row.cached for row in rows),
+        'cache_rate': round(sum(row.cached for row in rows) / calls, 4) if calls else None,
+        'retries': sum(row.retries for row in rows),
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'tokens_saved': sum(row.tokens_saved for row in rows),
+        'cost': str(sum((row.cost for row in rows), Decimal(0))),
+        'calls_per_hour': round(calls / hours, 2) if hours else None,
+        'tokens_per_hour': round((prompt_tokens + completion_tokens) / hours, 2) if hours else None,
+        'latency_ms_mean': round(sum(row.latency_ms_total for row in rows) / answered) if answered else None,
+        'latency_ms_p50': percentile(histogram, 0.5),
+        'latency_ms_p95': percentile(histogram, 0.95),
+        'queue_ms_mean': round(sum(row.queue_ms_total for row in rows) / calls) if calls else None,
+    }
+
+
+def report(start: datetime.date, end: datetime.date, group: str = None, **filters) -> Dict[str, Any]:
+    """
+    Throughput, latency percentiles and spend from the rollups of the days
+    start to end, overall and by group (one of GROUPS) when given
+    """
+    rows = list(AgentUsage.objects.filter(day__gte=start, day__lte=end, **filters))
+    hours = hours_of(start, end)
+    data = {'start': start.isoformat(), 'end': end.isoformat(), 'totals': totals(rows, hours)}
+    if group is not None:
+        groups = {}
+        for row in rows:
+            groups.setdefault(group_key(row, group), []).append(row)
+        # a day's throughput is over that day, other groups share the range
+        data['groups'] = [
+            dict(totals(members, hours_of(members[0].day, members[0].day) if group == 'day' else hours),
+                 **{group: key})
+            for key, members in sorted(groups.items(), key=lambda item: str(item[0]))
+        ]
+    return data
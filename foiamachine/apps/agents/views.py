@@ -5,14 +5,27 @@ Agent views - User-facing interfaces for agent features
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
 from django.views.decorators.http import require_http_methods
+import datetime
 import json
+import time
 
-from .services import RequestDraftAgent, ResponseAnalysisAgent, FollowUpAgent
+from django.utils import timezone
+
+from .dispatch import FINISHED, enqueue_task
 from .models import AgentTask, AgentSuggestion
+from .services import RequestDraftAgent
+from .usage import GROUPS, report
 from foiamachine.apps.requests.models import FOIARequest
 
+# long-polling holds a worker, so waits are short and re-read the task
+TASK_WAIT_MAX = 25
+TASK_WAIT_INTERVAL = 0.5
+
+USAGE_DAYS_MAX = 90
+
 
 @login_required
 def agent_dashboard(request):
@@ -30,10 +43,24 @@ def agent_dashboard(request):
     })
 
 
+def queued(task, created):
+    """202 with where to poll for the result, 200 for a repeated idempotency key"""
+    return JsonResponse({
+        'success': True,
+        'task_id': task.id,
+        'status': task.status,
+        'status_url': reverse('api:agents_api:task_status', args=[task.id])
+    }, status=202 if created else 200)
+
+
+def idempotency_key(request, data):
+    return request.META.get('HTTP_IDEMPOTENCY_KEY') or data.get('idempotency_key')
+
+
 @login_required
 @require_http_methods(["POST"])
 def draft_request_with_agent(request):
-    """API endpoint to draft a FOIA request using AI agent"""
+    """API endpoint to queue drafting a FOIA request with the AI agent"""
     try:
         data = json.loads(request.body)
         description = data.get('description')
@@ -45,15 +72,12 @@ def draft_request_with_agent(request):
                 'error': 'Description and agency name are required'
             }, status=400)
         
-        # Use the agent to draft the request
-        agent = RequestDraftAgent(request.user)
-        result = agent.draft_request(description, agency_name, agency_type)
-        
-        return JsonResponse({
-            'success': True,
-            'request_text': result['request_text'],
-            'suggestions': result['suggestions']
-        })
+        return queued(*enqueue_task(request.user, 'draft_request', {
+            'description': description,
+            'agency_name': agency_name,
+            'agency_type': agency_type,
+            'agency_id': data.get('agency_id')
+        }, idempotency_key=idempotency_key(request, data)))
         
     except Exception as e:
         return JsonResponse({
@@ -61,10 +85,59 @@ def draft_request_with_agent(request):
         }, status=500)
 
 
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@login_required
+@require_http_methods(["POST"])
+def draft_request_stream(request):
+    """
+    API endpoint drafting a FOIA request as server-sent events: a `task`
+    event with the task id, a `token` event per piece of text as the model
+    writes it, then `done` with the stored output or `error`
+    """
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    description = data.get('description')
+    agency_name = data.get('agency_name')
+    agency_type = data.get('agency_type', 'federal')
+    
+    if not description or not agency_name:
+        return JsonResponse({
+            'error': 'Description and agency name are required'
+        }, status=400)
+    
+    agent = RequestDraftAgent(request.user)
+    job = agent.draft_request_job(description, agency_name, agency_type, agency_id=data.get('agency_id'))
+    pieces = agent.stream_job(job)
+    
+    def events():
+        yield sse('task', {'task_id': job.task.id})
+        try:
+            for piece in pieces:
+                yield sse('token', {'text': piece})
+        except Exception as e:
+            yield sse('error', {'task_id': job.task.id, 'error': str(e)})
+            return
+        yield sse('done', {'task_id': job.task.id, 'output': job.output})
+    
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # keep nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @login_required
 @require_http_methods(["POST"])
 def analyze_response_with_agent(request, request_id):
-    """API endpoint to analyze a response using AI agent"""
+    """
+    API endpoint to queue analyzing a response with the AI agent, the
+    request's summary is updated when the analysis completes
+    """
     try:
         foia_request = get_object_or_404(
             FOIARequest,
@@ -80,23 +153,13 @@ def analyze_response_with_agent(request, request_id):
                 'error': 'Response text is required'
             }, status=400)
         
-        # Use the agent to analyze the response
-        agent = ResponseAnalysisAgent(request.user)
-        result = agent.analyze_response(
-            response_text,
-            foia_request.request_body
-        )
-        
-        # Update the request with analysis
-        foia_request.response_summary = result['summary']
-        foia_request.requires_followup = result['requires_followup']
-        foia_request.save()
-        
-        return JsonResponse({
-            'success': True,
-            'analysis': result
-        })
+        return queued(*enqueue_task(request.user, 'analyze_response', {
+            'response_text': response_text,
+            'original_request': foia_request.request_body
+        }, foia_request=foia_request, idempotency_key=idempotency_key(request, data)))
         
+    except Http404:
+        raise
     except Exception as e:
         return JsonResponse({
             'error': str(e)
@@ -106,7 +169,7 @@ def analyze_response_with_agent(request, request_id):
 @login_required
 @require_http_methods(["POST"])
 def generate_followup_with_agent(request, request_id):
-    """API endpoint to generate a follow-up using AI agent"""
+    """API endpoint to queue generating a follow-up with the AI agent"""
     try:
         foia_request = get_object_or_404(
             FOIARequest,
@@ -121,25 +184,78 @@ def generate_followup_with_agent(request, request_id):
         context = {
             'title': foia_request.title,
             'agency': foia_request.agency.name,
+            'agency_id': foia_request.agency_id,
             'submitted_date': str(foia_request.submitted_date) if foia_request.submitted_date else None,
             'tracking_number': foia_request.tracking_number,
         }
         
-        # Use the agent to generate follow-up
-        agent = FollowUpAgent(request.user)
-        result = agent.generate_followup(context, reason)
-        
-        return JsonResponse({
-            'success': True,
-            'followup': result
-        })
+        return queued(*enqueue_task(request.user, 'generate_followup', {
+            'context': context,
+            'reason': reason
+        }, foia_request=foia_request, idempotency_key=idempotency_key(request, data)))
         
+    except Http404:
+        raise
     except Exception as e:
         return JsonResponse({
             'error': str(e)
         }, status=500)
 
 
+@login_required
+@require_http_methods(["GET"])
+def task_status(request, task_id):
+    """
+    Poll a queued task. With ?wait=<seconds> the response is held until the
+    task finishes or the wait (at most TASK_WAIT_MAX) runs out.
+    """
+    task = get_object_or_404(AgentTask, id=task_id, user=request.user)
+    try:
+        wait = min(max(float(request.GET.get('wait', 0)), 0), TASK_WAIT_MAX)
+    except ValueError:
+        return JsonResponse({'error': 'wait must be a number of seconds'}, status=400)
+    
+    deadline = time.monotonic() + wait
+    while task.status not in FINISHED and time.monotonic() < deadline:
+        time.sleep(min(TASK_WAIT_INTERVAL, max(0, deadline - time.monotonic())))
+        task.refresh_from_db(fields=['status', 'output_data', 'error_message', 'completed_at'])
+    
+    return JsonResponse({
+        'task_id': task.id,
+        'task_type': task.task_type,
+        'status': task.status,
+        'output': task.output_data if task.status == 'completed' else None,
+        'error': task.error_message if task.status == 'failed' else None,
+        'completed_at': task.completed_at.isoformat() if task.completed_at else None
+    })
+
+
+@login_required
+@require_http_methods(["GET"])
+def usage_report(request):
+    """
+    Staff API endpoint with agent throughput, p50/p95 latency and spend
+    over the last ?days (7 by default), grouped by ?group=day, user,
+    task_type or model and narrowed by ?user, ?task_type and ?model.
+    Figures come from the rollups, which lag calls by up to 15 minutes.
+    """
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff only'}, status=403)
+    filters = dict((name, request.GET[name]) for name in ('task_type', 'model') if request.GET.get(name))
+    try:
+        days = min(max(int(request.GET.get('days', 7)), 1), USAGE_DAYS_MAX)
+        if request.GET.get('user'):
+            filters['user_id'] = int(request.GET['user'])
+    except ValueError:
+        return JsonResponse({'error': 'days and user must be numbers'}, status=400)
+    group = request.GET.get('group') or None
+    if group is not None and group not in GROUPS:
+        return JsonResponse({'error': f"group must be one of {', '.join(GROUPS)}"}, status=400)
+    
+    end = timezone.localdate()
+    return JsonResponse(report(end - datetime.timedelta(days=days - 1), end, group, **filters))
+
+
 @login_required
 def task_detail(request, task_id):
     """View details of an agent task"""
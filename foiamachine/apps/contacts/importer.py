@@ -0,0 +1,401 @@
+'''
+Bulk, idempotent loader for agency/contact datasets
+
+Rows are streamed out of csv/xls(x) files into ContactRecords, diffed in memory
+against what is already stored and written back with bulk_create/bulk_update
+a chunk at a time. Running the same file twice creates nothing the second time.
+
+    importer = ContactImporter(dry_run=True)
+    report = importer.run(importer.records(iter_sheet_rows(path, ['Agencies']), federal_record, govt))
+    print('\n'.join(report.as_lines()))
+'''
+from collections import defaultdict
+
+from django.apps import apps
+from django.db import connection, transaction
+from django.db.models import Count, Q
+from django.utils.text import slugify
+
+from apps.agency.models import Agency
+from apps.contacts.models import Contact, Title, Phone, Address, Note
+from apps.core.models import EmailAddress
+from apps.core.utils import chunked
+
+import logging
+import xlrd
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+logger = logging.getLogger('default')
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# Contact m2m relations whose rows belong to a single contact, keyed on content
+CHILD_RELATIONS = (
+    ('titles', Title),
+    ('phone_numbers', Phone),
+    ('addresses', Address),
+    ('notes', Note),
+)
+
+
+def cell_text(value):
+    '''
+    spreadsheet cells come back as floats for anything numeric (phone numbers, zips)
+    '''
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return ('%s' % value).strip()
+
+
+def split_name(name):
+    fname, middle, lname = ('', '', '')
+    parts = name.split()
+    if len(parts) == 1:
+        fname = parts[0]
+    elif len(parts) == 2:
+        fname, lname = parts
+    elif len(parts) > 2:
+        fname, middle, lname = parts[0], parts[1], parts[2]
+    return (fname, middle, lname)
+
+
+def split_tags(value):
+    return [tag.strip() for tag in cell_text(value).split(',') if tag.strip()]
+
+
+def iter_sheet_rows(path, sheet_names):
+    '''
+    yield the data rows (header skipped) of each named sheet as lists of cell values,
+    xlsx files are read with openpyxl's read-only streaming mode when available
+    '''
+    if path.endswith('.xlsx') and openpyxl is not None:
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            for name in sheet_names:
+                rows = workbook[name].iter_rows(values_only=True)
+                next(rows, None)
+                for row in rows:
+                    yield ['' if value is None else value for value in row]
+        finally:
+            workbook.close()
+        return
+    workbook = xlrd.open_workbook(filename=path, on_demand=True)
+    for name in sheet_names:
+        sheet = workbook.sheet_by_name(name)
+        for idx in range(1, sheet.nrows):
+            yield sheet.row_values(idx)
+        workbook.unload_sheet(name)
+
+
+def invalidate_agent_context(agency_ids):
+    '''
+    drop the agents' prompt bundles of agencies written here, bulk writes
+    send none of the signals that would otherwise do it
+    '''
+    try:
+        bundles = apps.get_model('agents', 'ContextBundle')
+    except LookupError:
+        return
+    bundles.objects.invalidate('agency', agency_ids)
+
+
+class ContactRecord(object):
+    '''
+    One normalized row of a contact dataset. A record without any name only
+    creates/updates its agency.
+    '''
+
+    def __init__(self, government, agency_name, first_name='', middle_name='', last_name='',
+                 titles=(), emails=(), phone_numbers=(), addresses=(), notes=(), tags=(),
+                 agency_fields=None):
+        self.government = government
+        self.agency_name = agency_name
+        self.first_name = first_name
+        self.middle_name = middle_name
+        self.last_name = last_name
+        self.titles = [t for t in titles if t]
+        self.emails = [e for e in emails if e]
+        self.phone_numbers = [p for p in phone_numbers if p]
+        self.addresses = [a for a in addresses if a]
+        self.notes = [n for n in notes if n]
+        self.tags = [t for t in tags if t]
+        self.agency_fields = agency_fields or {}
+
+    @property
+    def has_contact(self):
+        return bool(self.first_name or self.middle_name or self.last_name)
+
+    @property
+    def agency_key(self):
+        return (self.agency_name, self.government.pk)
+
+    def contact_key(self, agency_id):
+        return (agency_id, self.first_name, self.middle_name, self.last_name)
+
+
+def federal_record(row, government):
+    '''
+    foia.gov contact sheet: agency, name, title ... email in column 10, tags in 13
+    '''
+    agency_name = cell_text(row[0])
+    fname, middle, lname = split_name(cell_text(row[1]))
+    email = cell_text(row[10]).split('mailto:')[-1]
+    return ContactRecord(government, agency_name, fname, middle, lname,
+                         titles=[cell_text(row[2])], emails=[email],
+                         tags=split_tags(row[13]) if len(row) > 13 else [])
+
+
+def california_record(row, government):
+    '''
+    put agency name and note together as its name, only contacts with emails are loaded
+    '''
+    email = cell_text(row[11]).split('mailto:')
+    if len(email) < 2:
+        return None
+    note = cell_text(row[1])
+    agency_name = cell_text(row[0]) + '/' + note
+    fname, middle, lname = split_name(cell_text(row[2]))
+    address = ' '.join([cell_text(row[idx]) for idx in [4, 5, 6, 7, 8]])
+    return ContactRecord(government, agency_name, fname, middle, lname,
+                         titles=[cell_text(row[3])], emails=[email[1].strip()],
+                         phone_numbers=[cell_text(row[9])], addresses=[address],
+                         notes=[note], tags=split_tags(row[16]) if len(row) > 16 else [])
+
+
+class ImportReport(object):
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.rows = 0
+        self.skipped = 0
+        self.created = defaultdict(int)
+        self.updated = defaultdict(int)
+        self.linked = defaultdict(int)
+        self.errors = []
+
+    def error(self, msg):
+        logger.error(msg)
+        self.errors.append(msg)
+
+    def as_lines(self):
+        lines = ['rows read: %s (skipped %s)' % (self.rows, self.skipped)]
+        for label, counts in (('created', self.created), ('updated', self.updated), ('linked', self.linked)):
+            for name in sorted(counts):
+                lines.append('%s %s: %s' % (name, label, counts[name]))
+        if self.errors:
+            lines.append('errors: %s' % len(self.errors))
+            lines += ['  - %s' % err for err in self.errors[:10]]
+        if self.dry_run:
+            lines.append('DRY RUN - nothing was saved')
+        return lines
+
+
+class ContactImporter(object):
+    '''
+    Applies ContactRecords in chunks. Agencies are keyed on (name, government),
+    contacts on (agency, first, middle, last) and emails on their content; titles,
+    phones, addresses and notes are only added when the contact doesn't have them yet.
+
+    A dry run applies everything inside a transaction that is rolled back, so the
+    report shows exactly what a real run would do.
+    '''
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, dry_run=False):
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.report = ImportReport(dry_run=dry_run)
+        self._agencies = {}
+        self._contacts = {}
+        self._emails = {}
+        self._agency_slugs = None
+        self._loaded_agencies = set()
+        self._agency_tags = defaultdict(set)
+
+    def records(self, rows, parser, *args):
+        '''
+        turn raw rows into records, bad rows are reported and skipped
+        '''
+        for idx, row in enumerate(rows):
+            self.report.rows += 1
+            try:
+                record = parser(row, *args)
+            except Exception as e:
+                self.report.error('row %s could not be parsed: %s' % (idx + 1, e))
+                continue
+            if record is None or not record.agency_name:
+                self.report.skipped += 1
+                continue
+            yield record
+
+    def run(self, records):
+        with transaction.atomic():
+            for batch in chunked(records, self.chunk_size):
+                self._apply(batch)
+            self._finish()
+            if self.dry_run:
+                transaction.set_rollback(True)
+        return self.report
+
+    def _bulk_create(self, model, objs, label=None):
+        if not objs:
+            return objs
+        if connection.features.can_return_rows_from_bulk_insert:
+            model._base_manager.bulk_create(objs, batch_size=self.chunk_size)
+        else:
+            # backend can't hand back primary keys, we need them for the m2m rows
+            for obj in objs:
+                obj.save()
+        self.report.created[label or model._meta.verbose_name_plural] += len(objs)
+        return objs
+
+    def _link(self, through, rows, label):
+        if rows:
+            through.objects.bulk_create(rows, batch_size=self.chunk_size, ignore_conflicts=True)
+            self.report.linked[label] += len(rows)
+
+    def _unique_agency_slug(self, name):
+        # AutoSlugField keeps a preset slug, bulk_create would otherwise hand every
+        # agency of the same name in a chunk the same slug
+        if self._agency_slugs is None:
+            self._agency_slugs = set(Agency._base_manager.values_list('slug', flat=True))
+        max_length = Agency._meta.get_field('slug').max_length
+        base = slugify(name)[:max_length] or 'agency'
+        slug, idx = base, 2
+        while slug in self._agency_slugs:
+            suffix = '-%s' % idx
+            slug = base[:max_length - len(suffix)] + suffix
+            idx += 1
+        self._agency_slugs.add(slug)
+        return slug
+
+    def _apply(self, batch):
+        agencies = self._apply_agencies(batch)
+        contacts = self._apply_contacts(batch, agencies)
+        self._apply_emails(batch, contacts)
+        for relation, model in CHILD_RELATIONS:
+            self._apply_children(batch, contacts, relation, model)
+        for record in batch:
+            if record.tags:
+                self._agency_tags[agencies[record.agency_key].pk].update(record.tags)
+
+    def _apply_agencies(self, batch):
+        keys = set(record.agency_key for record in batch) - set(self._agencies)
+        if keys:
+            names = set(name for name, govt_id in keys)
+            govt_ids = set(govt_id for name, govt_id in keys)
+            for agency in Agency._base_manager.filter(name__in=names, government_id__in=govt_ids):
+                self._agencies.setdefault((agency.name, agency.government_id), agency)
+
+        new_agencies = []
+        dirty = {}
+        dirty_fields = set()
+        for record in batch:
+            agency = self._agencies.get(record.agency_key)
+            if agency is None:
+                agency = Agency(name=record.agency_name, government=record.government,
+                                slug=self._unique_agency_slug(record.agency_name), **record.agency_fields)
+                self._agencies[record.agency_key] = agency
+                new_agencies.append(agency)
+                continue
+            for field, value in record.agency_fields.items():
+                if getattr(agency, field) != value:
+                    setattr(agency, field, value)
+                    dirty_fields.add(field)
+                    if agency.pk is not None:
+                        dirty[agency.pk] = agency
+        self._bulk_create(Agency, new_agencies, 'agencies')
+        if dirty:
+            Agency._base_manager.bulk_update(list(dirty.values()), sorted(dirty_fields), batch_size=self.chunk_size)
+            self.report.updated['agencies'] += len(dirty)
+        invalidate_agent_context(list(dirty) + [agency.pk for agency in new_agencies])
+        return dict((record.agency_key, self._agencies[record.agency_key]) for record in batch)
+
+    def _apply_contacts(self, batch, agencies):
+        through = Agency.contacts.through
+        unloaded = set(agency.pk for agency in agencies.values()) - self._loaded_agencies
+        if unloaded:
+            existing = through.objects.filter(agency_id__in=unloaded).values_list(
+                'agency_id', 'contact_id', 'contact__first_name', 'contact__middle_name', 'contact__last_name')
+            for agency_id, contact_id, fname, middle, lname in existing:
+                self._contacts.setdefault((agency_id, fname, middle, lname), contact_id)
+            self._loaded_agencies |= unloaded
+
+        new_contacts = {}
+        for record in batch:
+            if not record.has_contact:
+                continue
+            key = record.contact_key(agencies[record.agency_key].pk)
+            if key not in self._contacts and key not in new_contacts:
+                new_contacts[key] = Contact(first_name=record.first_name, middle_name=record.middle_name,
+                                            last_name=record.last_name)
+        self._bulk_create(Contact, list(new_contacts.values()), 'contacts')
+        self._link(through, [through(agency_id=key[0], contact_id=contact.pk) for key, contact in new_contacts.items()],
+                   'agency contacts')
+        for key, contact in new_contacts.items():
+            self._contacts[key] = contact.pk
+
+        contacts = {}
+        for record in batch:
+            if record.has_contact:
+                contacts[id(record)] = self._contacts[record.contact_key(agencies[record.agency_key].pk)]
+        return contacts
+
+    def _apply_emails(self, batch, contacts):
+        wanted = set(email for record in batch for email in record.emails) - set(self._emails)
+        if wanted:
+            for content, pk in EmailAddress._base_manager.filter(content__in=wanted).values_list('content', 'id'):
+                self._emails.setdefault(content, pk)
+            missing = [EmailAddress(content=content) for content in wanted if content not in self._emails]
+            for email in self._bulk_create(EmailAddress, missing, 'emails'):
+                self._emails[email.content] = email.pk
+
+        through = Contact.emails.through
+        existing = set(through.objects.filter(contact_id__in=set(contacts.values())).values_list('contact_id', 'emailaddress_id'))
+        links = set()
+        for record in batch:
+            if id(record) in contacts:
+                for email in record.emails:
+                    links.add((contacts[id(record)], self._emails[email]))
+        self._link(through, [through(contact_id=c, emailaddress_id=e) for c, e in links - existing], 'contact emails')
+
+    def _apply_children(self, batch, contacts, relation, model):
+        field = getattr(Contact, relation).field
+        through = field.remote_field.through
+        contact_attname = field.m2m_field_name() + '_id'
+        child_name = field.m2m_reverse_field_name()
+
+        wanted = set()
+        for record in batch:
+            if id(record) in contacts:
+                for content in getattr(record, relation):
+                    wanted.add((contacts[id(record)], content))
+        if not wanted:
+            return
+        existing = set(through.objects.filter(**{contact_attname + '__in': set(c for c, content in wanted)})
+                       .values_list(contact_attname, child_name + '__content'))
+        missing = sorted(wanted - existing)
+        children = self._bulk_create(model, [model(content=content) for contact_id, content in missing], relation)
+        self._link(through, [through(**{contact_attname: contact_id, child_name + '_id': child.pk})
+                             for (contact_id, content), child in zip(missing, children)], 'contact ' + relation)
+
+    def _finish(self):
+        # tags and the cached contact counts Agency.save would normally keep
+        for agency in Agency._base_manager.filter(pk__in=list(self._agency_tags)):
+            agency.tags.add(*self._agency_tags[agency.pk])
+        touched = [agency.pk for agency in self._agencies.values() if agency.pk is not None]
+        counted = []
+        for ids in chunked(touched, self.chunk_size):
+            for agency in Agency._base_manager.filter(pk__in=ids).annotate(
+                    n_pub=Count('contacts', filter=Q(contacts__hidden=False)), n_all=Count('contacts')):
+                if (agency.pub_contact_cnt, agency.editor_contact_cnt) != (agency.n_pub, agency.n_all):
+                    agency.pub_contact_cnt = agency.n_pub
+                    agency.editor_contact_cnt = agency.n_all
+                    counted.append(agency)
+        if counted:
+            Agency._base_manager.bulk_update(counted, ['pub_contact_cnt', 'editor_contact_cnt'], batch_size=self.chunk_size)
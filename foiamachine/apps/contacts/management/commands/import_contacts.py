@@ -0,0 +1,31 @@
+"""
+Management command to bulk load the bundled federal and California contact sheets.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.contacts.utils import update_federal_contacts, update_california_contacts
+
+
+class Command(BaseCommand):
+    help = 'Bulk load (or re-sync) agency contacts from the bundled spreadsheets'
+
+    loaders = {
+        'federal': update_federal_contacts,
+        'california': update_california_contacts,
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(self.loaders.keys()))
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report what would be created or updated without saving anything',
+        )
+
+    def handle(self, *args, **options):
+        loader = self.loaders.get(options['dataset'])
+        if loader is None:
+            raise CommandError('Unknown dataset %s' % options['dataset'])
+        report = loader(dry_run=options['dry_run'])
+        for line in report.as_lines():
+            self.stdout.write(line)
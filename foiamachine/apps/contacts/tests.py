@@ -109,3 +109,42 @@ class ContactTesting(UserTestBase):
         #self.assertEqual(Contact.objects.all().count(), 3)
         #self.assertEqual(EmailAddress.objects.all().count(), 3)
         #self.assertEqual(EmailAddress.objects.all_them().count(), 4)
+
+
+class ContactImporterTesting(UserTestBase):
+
+    def get_records(self, govt):
+        from apps.contacts.importer import ContactRecord
+        return [
+            ContactRecord(govt, 'Department of Bulk Loading', first_name='Jane', last_name='Doe',
+                          titles=['FOIA Officer'], emails=['jane.doe@bulk.gov'],
+                          phone_numbers=['555-555-5555'], tags=['bulk']),
+            ContactRecord(govt, 'Department of Bulk Loading', first_name='John', last_name='Doe',
+                          emails=['jane.doe@bulk.gov']),
+            ContactRecord(govt, 'Department of Bulk Loading'),
+        ]
+
+    def test_import_is_idempotent(self):
+        from apps.contacts.importer import ContactImporter
+        govt = Government.objects.all()[0]
+        report = ContactImporter().run(self.get_records(govt))
+        self.assertEqual(report.created['agencies'], 1)
+        self.assertEqual(report.created['contacts'], 2)
+        agency = Agency.objects.get(name='Department of Bulk Loading', government=govt)
+        self.assertEqual(agency.contacts.count(), 2)
+        self.assertEqual(EmailAddress.objects.filter(content='jane.doe@bulk.gov').count(), 1)
+
+        report = ContactImporter().run(self.get_records(govt))
+        self.assertEqual(sum(report.created.values()), 0)
+        self.assertEqual(Agency.objects.filter(name='Department of Bulk Loading').count(), 1)
+        self.assertEqual(agency.contacts.count(), 2)
+        jane = agency.contacts.get(first_name='Jane')
+        self.assertEqual(jane.titles.count(), 1)
+        self.assertEqual(jane.phone_numbers.count(), 1)
+
+    def test_dry_run_saves_nothing(self):
+        from apps.contacts.importer import ContactImporter
+        govt = Government.objects.all()[0]
+        report = ContactImporter(dry_run=True).run(self.get_records(govt))
+        self.assertEqual(report.created['contacts'], 2)
+        self.assertEqual(Agency.objects.filter(name='Department of Bulk Loading').count(), 0)
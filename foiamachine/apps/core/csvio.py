@@ -0,0 +1,164 @@
+'''
+CSV reading and writing for the importers and exporters.
+
+Files are decoded/encoded once by an io.TextIOWrapper around the binary
+stream and handed straight to the C csv module, so rows are never
+re-encoded one at a time. The reader can sniff the dialect, map header
+columns to types and yield rows in batches.
+'''
+import codecs
+import csv
+import io
+from itertools import chain
+
+from apps.core.utils import chunked
+
+SNIFF_BYTES = 16384
+SNIFF_DELIMITERS = ',;\t|'
+
+
+def open_text(f, encoding='utf-8', mode='r'):
+    '''
+    text stream for a path, a binary file or an already decoded file
+    '''
+    if isinstance(f, str):
+        return io.open(f, mode, encoding=encoding, newline='')
+    if isinstance(f, io.TextIOBase):
+        return f
+    if mode == 'r':
+        if not hasattr(f, 'readable'):
+            # old style file objects and anything else with a read method
+            return codecs.getreader(encoding)(f)
+        return io.TextIOWrapper(f, encoding=encoding, newline='')
+    return io.TextIOWrapper(f, encoding=encoding, newline='', write_through=True)
+
+
+def sniff_dialect(sample, default=csv.excel):
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=SNIFF_DELIMITERS)
+    except csv.Error:
+        return default
+
+
+def int_or_none(value):
+    value = value.strip()
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def bool_or_none(value):
+    value = value.strip().lower()
+    if value in ('true', 't', 'yes', 'y', '1'):
+        return True
+    if value in ('false', 'f', 'no', 'n', '0'):
+        return False
+    return None
+
+
+class CSVReader(object):
+    '''
+    Iterates rows as lists of str. With header=True the first row is used
+    as fieldnames, which columns ({name: callable}) and dicts() key on.
+    dialect=None sniffs the delimiter and quoting from the start of the file.
+    '''
+
+    def __init__(self, f, encoding='utf-8-sig', dialect=None, header=False, columns=None, **fmtparams):
+        self.stream = open_text(f, encoding)
+        lines = self.stream
+        if dialect is None:
+            sample = self.stream.read(SNIFF_BYTES)
+            # finish the partial line so the sample ends on a row boundary
+            sample += self.stream.readline()
+            dialect = sniff_dialect(sample)
+            lines = chain(io.StringIO(sample), self.stream)
+        self.dialect = dialect
+        self.reader = csv.reader(lines, dialect, **fmtparams)
+        self.fieldnames = None
+        if header:
+            self.fieldnames = next(self.reader, [])
+        self.converters = self._converters(columns or {})
+
+    def _converters(self, columns):
+        converters = []
+        for key, func in columns.items():
+            if isinstance(key, int):
+                converters.append((key, key, func))
+            elif self.fieldnames is not None and key in self.fieldnames:
+                converters.append((self.fieldnames.index(key), key, func))
+            else:
+                raise KeyError('Column %s is not in the header' % key)
+        return converters
+
+    @property
+    def line_num(self):
+        return self.reader.line_num
+
+    def __iter__(self):
+        if not self.converters:
+            return iter(self.reader)
+        return self._typed()
+
+    def _typed(self):
+        converters = self.converters
+        for row in self.reader:
+            for idx, name, func in converters:
+                if idx >= len(row):
+                    continue
+                try:
+                    row[idx] = func(row[idx])
+                except (TypeError, ValueError) as e:
+                    raise ValueError('line %s column %s: %s' % (self.line_num, name, e))
+            yield row
+
+    def dicts(self):
+        if self.fieldnames is None:
+            raise ValueError('dicts() needs a header row, pass header=True')
+        fieldnames = self.fieldnames
+        for row in self:
+            if row:
+                yield dict(zip(fieldnames, row))
+
+    def batches(self, size, dicts=False):
+        return chunked(self.dicts() if dicts else iter(self), size)
+
+    def close(self):
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CSVWriter(object):
+    '''
+    csv.writer over an encoding text wrapper, accepts the same targets as
+    CSVReader. Values that aren't str are written with str(), None as ''.
+    '''
+
+    def __init__(self, f, encoding='utf-8', dialect=csv.excel, **fmtparams):
+        self.stream = open_text(f, encoding, mode='w')
+        self.writer = csv.writer(self.stream, dialect, **fmtparams)
+
+    def writerow(self, row):
+        self.writer.writerow(['' if v is None else v for v in row])
+
+    def writerows(self, rows):
+        self.writer.writerows(['' if v is None else v for v in row] for row in rows)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
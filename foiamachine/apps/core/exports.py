@@ -0,0 +1,202 @@
+'''
+Streaming exports. An Export describes a queryset and how to turn a chunk
+of it into rows; writers turn those rows into CSV, JSON Lines or Parquet a
+chunk at a time so memory stays bounded by chunk_size, whether the output
+goes to a file or to a StreamingHttpResponse.
+'''
+import csv
+import io
+import json
+import logging
+from datetime import date, datetime
+
+from django.http import StreamingHttpResponse
+
+from apps.core.utils import chunked
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+logger = logging.getLogger('default')
+
+DEFAULT_CHUNK_SIZE = 2000
+
+
+class Export(object):
+    '''
+    Subclasses set name and columns, a list of (name, type) pairs where type
+    is one of int, str, bool or datetime, and implement get_queryset and rows.
+    rows gets one chunk of model instances at a time so per-chunk lookups can
+    replace per-object queries.
+    '''
+    name = None
+    columns = ()
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+
+    @property
+    def header(self):
+        return [name for name, _ in self.columns]
+
+    def get_queryset(self):
+        raise NotImplementedError
+
+    def rows(self, chunk):
+        raise NotImplementedError
+
+    def iter_chunks(self):
+        # iterator() uses a server-side cursor where the backend has one
+        objs = self.get_queryset().iterator(chunk_size=self.chunk_size)
+        for chunk in chunked(objs, self.chunk_size):
+            yield list(self.rows(chunk))
+
+
+class Drain(io.RawIOBase):
+    '''
+    write-only sink whose contents are handed out and dropped with take(),
+    lets file based writers feed a streaming response
+    '''
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def write(self, data):
+        data = bytes(data)
+        self._parts.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def take(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def as_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+class CSVExportWriter(object):
+    content_type = 'text/csv'
+    extension = 'csv'
+
+    def __init__(self, export):
+        self.export = export
+
+    def stream(self):
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(self.export.header)
+        for rows in self.export.iter_chunks():
+            writer.writerows([[as_text(v) for v in row] for row in rows])
+            yield buf.getvalue().encode('utf-8')
+            buf.seek(0)
+            buf.truncate(0)
+        yield buf.getvalue().encode('utf-8')
+
+
+class JSONLinesExportWriter(object):
+    content_type = 'application/x-ndjson'
+    extension = 'jsonl'
+
+    def __init__(self, export):
+        self.export = export
+
+    def stream(self):
+        header = self.export.header
+        for rows in self.export.iter_chunks():
+            lines = [json.dumps(dict(zip(header, row)), default=as_text) for row in rows]
+            if lines:
+                yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class ParquetExportWriter(object):
+    content_type = 'application/vnd.apache.parquet'
+    extension = 'parquet'
+
+    def __init__(self, export):
+        if not HAS_PYARROW:
+            raise ImportError('pyarrow is required for parquet exports')
+        self.export = export
+
+    @property
+    def schema(self):
+        types = {
+            'int': pyarrow.int64(),
+            'str': pyarrow.string(),
+            'bool': pyarrow.bool_(),
+            'datetime': pyarrow.timestamp('us', tz='UTC'),
+        }
+        return pyarrow.schema([(name, types[kind]) for name, kind in self.export.columns])
+
+    def stream(self):
+        # one row group per chunk
+        sink = Drain()
+        schema = self.schema
+        writer = pyarrow.parquet.ParquetWriter(sink, schema)
+        try:
+            for rows in self.export.iter_chunks():
+                if not rows:
+                    continue
+                columns = list(zip(*rows))
+                writer.write_table(pyarrow.Table.from_arrays(
+                    [pyarrow.array(col, type=field.type) for col, field in zip(columns, schema)],
+                    schema=schema))
+                yield sink.take()
+        finally:
+            writer.close()
+        yield sink.take()
+
+
+WRITERS = {
+    'csv': CSVExportWriter,
+    'jsonl': JSONLinesExportWriter,
+    'parquet': ParquetExportWriter,
+}
+
+
+def get_writer(export, fmt):
+    try:
+        writer_class = WRITERS[fmt]
+    except KeyError:
+        raise ValueError('Unknown export format %s, expected one of %s' % (fmt, ', '.join(sorted(WRITERS))))
+    return writer_class(export)
+
+
+def write_export(export, fmt, path):
+    '''
+    write an export to path, returns the number of bytes written
+    '''
+    written = 0
+    with open(path, 'wb') as out:
+        for data in get_writer(export, fmt).stream():
+            out.write(data)
+            written += len(data)
+    logger.info('exported %s to %s (%s bytes)' % (export.name, path, written))
+    return written
+
+
+def export_response(export, fmt):
+    '''
+    StreamingHttpResponse downloading the export as an attachment
+    '''
+    writer = get_writer(export, fmt)
+    response = StreamingHttpResponse(writer.stream(), content_type=writer.content_type)
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (export.name, writer.extension)
+    return response
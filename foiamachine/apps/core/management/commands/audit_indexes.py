@@ -0,0 +1,119 @@
+from datetime import timedelta
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models, transaction
+from django.utils import timezone
+
+import re
+
+
+def canonical_queries():
+    '''
+    (label, queryset) for the lookups the managers, views, notification
+    commands and mail handling run most, each should be answered from an index
+    '''
+    from apps.agency.models import Agency
+    from apps.core.models import EmailAddress
+    from apps.government.models import Statute
+    from apps.mail.models import MailBox, MailMessage
+    from apps.requests.models import Request, ThreadLookup
+
+    now = timezone.now()
+    return [
+        ('overdue requests', Request.objects.filter(status='S', due_date__lte=now)),
+        ('requests by status', Request.objects.filter(status='F')),
+        ('sunsetting requests', Request.objects.filter(private=True, keep_private=False,
+            scheduled_send_date__lte=now - timedelta(days=30))),
+        ('request by thread lookup', ThreadLookup.objects.filter(token__in=['LOOKUP:audit', 'LOOKUP:other'])),
+        ('my requests', Request.objects.filter(author_id=1).order_by('-date_added', '-id')[:20]),
+        ('latest requests', Request.objects.order_by('-date_added', '-id')[:20]),
+        ('message by message id', MailMessage.objects.filter(message_id='<audit@localhost>')),
+        ('request thread', MailMessage.objects.filter(request_id=1, deprecated__isnull=True).order_by('dated')),
+        ('latest messages', MailMessage.objects.order_by('-dated', '-id')[:20]),
+        ('mailbox by address', MailBox.objects.filter(provisioned_email='audit@localhost')),
+        ('email address', EmailAddress.objects.filter(content='audit@localhost', deprecated__isnull=True)),
+        ('live statutes', Statute.objects.filter(deprecated__isnull=True)),
+        ('live agencies', Agency.objects.filter(deprecated__isnull=True, hidden=False).order_by('name')),
+    ]
+
+
+def full_scans(plan, vendor):
+    '''
+    tables read without an index according to an EXPLAIN plan
+    '''
+    if vendor == 'postgresql':
+        return re.findall(r'Seq Scan on (\w+)', plan)
+    if vendor == 'sqlite':
+        return [m.group(1) for m in re.finditer(r'\bSCAN (?:TABLE )?(\w+)(?!.*\bUSING\b)', plan)]
+    if vendor == 'mysql':
+        #tabular EXPLAIN: id, select_type, table, partitions, type... type ALL is a full table scan
+        rows = [line.split() for line in plan.splitlines()]
+        return [row[2] for row in rows if len(row) > 4 and row[4] == 'ALL']
+    return []
+
+
+def missing_indexes():
+    '''
+    (model, index) for every index declared in a model's Meta or with
+    db_index=True that isn't in the database, e.g. for apps without migrations
+    '''
+    missing = []
+    with connection.cursor() as cursor:
+        tables = set(connection.introspection.table_names(cursor))
+        for model in apps.get_models():
+            table = model._meta.db_table
+            if table not in tables or model._meta.proxy or not model._meta.managed:
+                continue
+            existing = connection.introspection.get_constraints(cursor, table)
+            indexed = set(tuple(info['columns']) for info in existing.values() if info['index'] or info['unique'])
+            for index in model._meta.indexes:
+                if index.name not in existing:
+                    missing.append((model, index))
+            for field in model._meta.local_fields:
+                if field.db_index and not field.unique and (field.column,) not in indexed:
+                    name = connection.schema_editor()._create_index_name(table, [field.column], suffix='_idx')
+                    missing.append((model, models.Index(fields=[field.name], name=name)))
+    return missing
+
+
+class Command(BaseCommand):
+    help = 'EXPLAIN the canonical queries and report full table scans and declared indexes missing from the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--create-missing', action='store_true', help='Create declared indexes the database lacks')
+        parser.add_argument('--report-only', action='store_true', help="Don't fail when problems are found")
+        parser.add_argument('--verbose-plans', action='store_true', help='Print every plan')
+
+    def handle(self, *args, **options):
+        problems = []
+
+        for model, index in missing_indexes():
+            if options['create_missing']:
+                with connection.schema_editor() as editor:
+                    editor.add_index(model, index)
+                self.stdout.write('created %s on %s' % (index.name, model._meta.db_table))
+            else:
+                problems.append('index %s on %s is declared but missing' % (index.name, model._meta.db_table))
+
+        vendor = connection.vendor
+        for label, queryset in canonical_queries():
+            with transaction.atomic():
+                if vendor == 'postgresql':
+                    # tiny tables get sequential scans anyway, this makes the planner
+                    # use any index that applies so a scan means there isn't one
+                    with connection.cursor() as cursor:
+                        cursor.execute('SET LOCAL enable_seqscan = off')
+                plan = queryset.explain()
+            scans = full_scans(plan, vendor)
+            if options['verbose_plans']:
+                self.stdout.write('-- %s\n%s' % (label, plan))
+            if scans:
+                problems.append('%s: full scan of %s' % (label, ', '.join(sorted(set(scans)))))
+            else:
+                self.stdout.write('ok   %s' % label)
+
+        for problem in problems:
+            self.stdout.write('FAIL %s' % problem)
+        if problems and not options['report_only']:
+            raise CommandError('%s index problem(s) found' % len(problems))
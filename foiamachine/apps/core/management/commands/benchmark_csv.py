@@ -0,0 +1,134 @@
+import codecs
+import csv
+import io
+import os
+import random
+import string
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.core.csvio import CSVReader, CSVWriter
+
+
+class LegacyRecoder(object):
+    '''
+    the old UTF8Recoder: decode each line, re-encode it to utf-8
+    '''
+    def __init__(self, f, encoding):
+        self.reader = codecs.getreader(encoding)(f)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.reader).encode('utf-8').decode('utf-8')
+
+
+class LegacyReader(object):
+    '''
+    the old UnicodeReader, converting every cell once more on the way out
+    '''
+    def __init__(self, f, encoding='utf-8'):
+        self.reader = csv.reader(LegacyRecoder(f, encoding))
+
+    def __iter__(self):
+        for row in self.reader:
+            yield [s.encode('utf-8').decode('utf-8') for s in row]
+
+
+class LegacyWriter(object):
+    '''
+    the old UnicodeWriter: queue each row, then decode and re-encode it
+    '''
+    def __init__(self, f, encoding='utf-8'):
+        self.queue = io.StringIO()
+        self.writer = csv.writer(self.queue)
+        self.stream = f
+        self.encoder = codecs.getincrementalencoder(encoding)()
+
+    def writerow(self, row):
+        self.writer.writerow([s.encode('utf-8').decode('utf-8') for s in row])
+        data = self.queue.getvalue()
+        self.stream.write(self.encoder.encode(data))
+        self.queue.seek(0)
+        self.queue.truncate(0)
+
+
+def synthetic_rows(count, seed=1):
+    rnd = random.Random(seed)
+    words = [''.join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(3, 10))) for _ in range(500)]
+    words += [u'caf\xe9', u'se\xf1or', u'na\xefve', u'"quoted"', u'comma, inside']
+    for idx in range(count):
+        yield [str(idx), rnd.choice(words), ' '.join(rnd.choice(words) for _ in range(8)),
+               str(rnd.randint(0, 90)), rnd.choice(('TRUE', 'FALSE'))]
+
+
+def timed(func):
+    start = time.perf_counter()
+    rows = func()
+    return rows, time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = 'Compare row throughput of apps.core.csvio against the old unicode_csv approach'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000, help='Rows in the synthetic file')
+        parser.add_argument('--repeat', type=int, default=200, help='Passes over foia_statutes.csv')
+
+    def report(self, label, legacy, current):
+        (rows, legacy_secs), (_, current_secs) = legacy, current
+        self.stdout.write('%-32s %9d rows  legacy %10.0f rows/s  csvio %10.0f rows/s  x%.1f' % (
+            label, rows, rows / legacy_secs, rows / current_secs, legacy_secs / current_secs))
+
+    def read_legacy(self, path, repeat=1):
+        rows = 0
+        for _ in range(repeat):
+            with open(path, 'rb') as f:
+                rows += sum(1 for _ in LegacyReader(f))
+        return rows
+
+    def read_csvio(self, path, repeat=1):
+        rows = 0
+        for _ in range(repeat):
+            with CSVReader(path, dialect=csv.excel) as reader:
+                rows += sum(len(batch) for batch in reader.batches(1000))
+        return rows
+
+    def write_legacy(self, path, count):
+        with open(path, 'wb') as f:
+            writer = LegacyWriter(f)
+            for row in synthetic_rows(count):
+                writer.writerow(row)
+        return count
+
+    def write_csvio(self, path, count):
+        with CSVWriter(path) as writer:
+            writer.writerows(synthetic_rows(count))
+        return count
+
+    def handle(self, *args, **options):
+        statutes = os.path.join(settings.SITE_ROOT, 'apps', 'government', 'data', 'foia_statutes.csv')
+        repeat = options['repeat']
+        self.report('read foia_statutes.csv x%s' % repeat,
+                    timed(lambda: self.read_legacy(statutes, repeat)),
+                    timed(lambda: self.read_csvio(statutes, repeat)))
+
+        count = options['rows']
+        tmpdir = tempfile.mkdtemp()
+        legacy_path = os.path.join(tmpdir, 'legacy.csv')
+        csvio_path = os.path.join(tmpdir, 'csvio.csv')
+        try:
+            # generating the rows is part of both timings
+            self.report('write synthetic', timed(lambda: self.write_legacy(legacy_path, count)),
+                        timed(lambda: self.write_csvio(csvio_path, count)))
+            self.report('read synthetic', timed(lambda: self.read_legacy(csvio_path)),
+                        timed(lambda: self.read_csvio(csvio_path)))
+        finally:
+            for path in (legacy_path, csvio_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            os.rmdir(tmpdir)
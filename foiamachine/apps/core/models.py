@@ -13,7 +13,8 @@ class BaseData(models.Model):
     TODO we may want to use this approach on more models than those in contacts
     '''
     created = models.DateTimeField(auto_now_add=True)
-    deprecated = models.DateTimeField(null=True)
+    #every manager filters on deprecated__isnull
+    deprecated = models.DateTimeField(null=True, db_index=True)
     yay_votes = models.PositiveSmallIntegerField(default=0)
     nay_votes = models.PositiveSmallIntegerField(default=0)
     tags = TaggableManager()
@@ -45,6 +46,12 @@ class EmailAddress(BaseData):
     content = models.EmailField()
     objects = EmailsManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['content'], condition=models.Q(deprecated__isnull=True),
+                         name='emailaddress_live_content_idx'),
+        ]
+
 
     def __unicode__(self):
         return self.content
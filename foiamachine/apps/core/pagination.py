@@ -0,0 +1,322 @@
+'''
+Keyset (cursor) pagination. A page is found by filtering on the sort keys
+of the last row shown instead of OFFSET, so page 500 costs the same as
+page 1 and rows added meanwhile don't shift pages around. The primary key
+is always the last sort key so every row has a unique position. Nulls sort
+as the smallest value on every backend.
+
+Counts are optional and bounded: approximate_count stops counting at a
+limit so a listing never scans the whole table just to print a total.
+'''
+import base64
+import json
+from datetime import date, datetime
+
+from django.db.models import F, Q
+from django.http import Http404
+from django.utils.http import urlencode
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
+
+DEFAULT_COUNT_LIMIT = 1000
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    def default(value):
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        return str(value)
+    data = json.dumps(values, default=default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        token = str(token)
+        data = base64.urlsafe_b64decode((token + '=' * (-len(token) % 4)).encode('ascii'))
+        values = json.loads(data.decode('utf-8'))
+    except Exception:
+        raise InvalidCursor('Invalid cursor %s' % token)
+    if not isinstance(values, list):
+        raise InvalidCursor('Invalid cursor %s' % token)
+    return values
+
+
+def approximate_count(queryset, limit=DEFAULT_COUNT_LIMIT):
+    '''
+    (count, exact), counting at most limit + 1 rows
+    '''
+    counted = queryset.order_by()[:limit + 1].count()
+    if counted > limit:
+        return limit, False
+    return counted, True
+
+
+def resolve_field(queryset, name):
+    '''
+    the model field (or annotation output field) a sort key refers to,
+    following relations for keys like government__name
+    '''
+    if name in queryset.query.annotations:
+        return queryset.query.annotations[name].output_field
+    model = queryset.model
+    field = None
+    for part in name.split('__'):
+        if model is None:
+            raise InvalidCursor('Cannot sort on %s' % name)
+        field = model._meta.pk if part == 'pk' else model._meta.get_field(part)
+        model = field.related_model if field.is_relation else None
+    if field.is_relation:
+        field = field.target_field
+    return field
+
+
+def key_value(obj, name):
+    if name in ('pk', 'id'):
+        return obj.pk
+    value = obj
+    for part in name.split('__'):
+        value = getattr(value, part, None)
+        if value is None:
+            return None
+    #ordering on a foreign key orders by its primary key
+    return getattr(value, 'pk', value)
+
+
+class KeysetPage(object):
+    '''
+    quacks enough like django's Page for the list templates
+    '''
+
+    def __init__(self, object_list, has_next, has_previous, next_cursor=None, previous_cursor=None,
+                 count=None, count_exact=True):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+        self.next_cursor = next_cursor if has_next else None
+        self.previous_cursor = previous_cursor if has_previous else None
+        self.count = count
+        self.count_exact = count_exact
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+
+class KeysetPaginator(object):
+    '''
+    pages through queryset in ordering, a list of field names as given to
+    order_by. When ordering is None the queryset's own ordering is used.
+    Only plain fields, annotations and relation lookups can be keys.
+    '''
+
+    def __init__(self, queryset, per_page, ordering=None, count_limit=None):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.count_limit = count_limit
+        self.keys = self.parse_ordering(queryset, ordering)
+
+    @staticmethod
+    def parse_ordering(queryset, ordering=None):
+        if ordering is None:
+            ordering = list(queryset.query.order_by) or list(queryset.model._meta.ordering)
+        keys = []
+        for item in ordering:
+            if not isinstance(item, str) or item == '?':
+                raise InvalidCursor('Cannot use %s as a keyset' % item)
+            descending = item.startswith('-')
+            name = item.lstrip('-+')
+            if name == queryset.model._meta.pk.name:
+                name = 'pk'
+            if name == 'pk':
+                keys.append(('pk', descending))
+                break
+            resolve_field(queryset, name)
+            keys.append((name, descending))
+        if not keys or keys[-1][0] != 'pk':
+            keys.append(('pk', keys[0][1] if keys else True))
+        return keys
+
+    def ordered(self, reverse=False):
+        order = []
+        for name, descending in self.keys:
+            if descending != reverse:
+                order.append(F(name).desc(nulls_last=True))
+            else:
+                order.append(F(name).asc(nulls_first=True))
+        return self.queryset.order_by(*order)
+
+    def cursor_for(self, obj):
+        return encode_cursor([key_value(obj, name) for name, _ in self.keys])
+
+    def decode(self, token):
+        values = decode_cursor(token)
+        if len(values) != len(self.keys):
+            raise InvalidCursor('Cursor does not match the ordering')
+        decoded = []
+        for (name, _), value in zip(self.keys, values):
+            try:
+                decoded.append(None if value is None else resolve_field(self.queryset, name).to_python(value))
+            except Exception:
+                raise InvalidCursor('Invalid cursor value %s for %s' % (value, name))
+        return decoded
+
+    def after(self, values, reverse=False):
+        '''
+        rows that sort after values, or before them with reverse=True
+        '''
+        condition = Q(pk__in=[])
+        equal = Q()
+        for (name, descending), value in zip(self.keys, values):
+            greater = descending == reverse
+            if value is None:
+                #nothing is smaller than null
+                beyond = Q(**{name + '__isnull': False}) if greater else Q(pk__in=[])
+                same = Q(**{name + '__isnull': True})
+            else:
+                lookup = '__gt' if greater else '__lt'
+                beyond = Q(**{name + lookup: value})
+                if not greater:
+                    beyond |= Q(**{name + '__isnull': True})
+                same = Q(**{name: value})
+            condition |= equal & beyond
+            equal &= same
+        return condition
+
+    def count(self):
+        if self.count_limit is None:
+            return None, True
+        return approximate_count(self.queryset, self.count_limit)
+
+    def page(self, after=None, before=None):
+        '''
+        the page following the cursor after, or preceding the cursor before
+        '''
+        backwards = before is not None
+        cursor = before if backwards else after
+        qs = self.ordered(reverse=backwards)
+        if cursor is not None:
+            qs = qs.filter(self.after(self.decode(cursor), reverse=backwards))
+        rows = list(qs[:self.per_page + 1])
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+            has_next, has_previous = True, more
+        else:
+            has_next, has_previous = more, cursor is not None
+        count, exact = self.count()
+        return KeysetPage(rows, has_next, has_previous,
+                          next_cursor=self.cursor_for(rows[-1]) if rows else None,
+                          previous_cursor=self.cursor_for(rows[0]) if rows else None,
+                          count=count, count_exact=exact)
+
+
+class KeysetPaginationMixin(object):
+    '''
+    for ListViews: pages by keyset_ordering unless the queryset is already
+    ordered, ?after= and ?before= carry the cursor instead of ?page=
+    '''
+    keyset_ordering = ('-pk',)
+    count_limit = DEFAULT_COUNT_LIMIT
+
+    def paginate_queryset(self, queryset, page_size):
+        if not queryset.ordered:
+            queryset = queryset.order_by(*self.keyset_ordering)
+        try:
+            #the constructor rejects orderings that can't be a keyset
+            paginator = KeysetPaginator(queryset, page_size, count_limit=self.count_limit)
+            page = paginator.page(after=self.request.GET.get('after') or None,
+                                  before=self.request.GET.get('before') or None)
+        except InvalidCursor:
+            raise Http404
+        return (paginator, page, page.object_list, page.has_other_pages())
+
+
+class KeysetResourcePaginator(Paginator):
+    '''
+    tastypie paginator that follows ?after=<cursor> / ?before=<cursor> when
+    given and offset otherwise, without counting the whole list. Next and
+    previous links use cursors, meta.total_count is a count bounded by
+    count_limit and meta.total_count_exact says whether it was cut off.
+    '''
+    count_limit = DEFAULT_COUNT_LIMIT
+
+    def get_count(self):
+        if not hasattr(self.objects, 'query'):
+            self.count_exact = True
+            return len(self.objects)
+        count, self.count_exact = approximate_count(self.objects, self.count_limit)
+        return count
+
+    def cursor_uri(self, limit, **cursor):
+        if self.resource_uri is None:
+            return None
+        if hasattr(self.request_data, 'copy') and hasattr(self.request_data, 'urlencode'):
+            params = self.request_data.copy()
+        else:
+            params = dict(self.request_data)
+        for key in ('offset', 'after', 'before'):
+            params.pop(key, None)
+        params['limit'] = limit
+        params.update(cursor)
+        encoded = params.urlencode() if hasattr(params, 'urlencode') else urlencode(params)
+        return '%s?%s' % (self.resource_uri, encoded)
+
+    def page(self):
+        limit = self.get_limit()
+        try:
+            paginator = KeysetPaginator(self.objects, limit)
+        except (AttributeError, InvalidCursor):
+            #a list, or an ordering that can't be a keyset
+            paginator = None
+        if not limit or paginator is None:
+            return super(KeysetResourcePaginator, self).page()
+
+        after = self.request_data.get('after')
+        before = self.request_data.get('before')
+        offset = self.get_offset()
+        if after or before:
+            try:
+                page = paginator.page(after=after or None, before=before or None)
+            except InvalidCursor as e:
+                raise BadRequest(str(e))
+            objects = page.object_list
+        else:
+            #first page by offset, the links from here on are cursors
+            rows = list(paginator.ordered()[offset:offset + limit + 1])
+            objects = rows[:limit]
+            page = KeysetPage(objects, len(rows) > limit, offset > 0,
+                              next_cursor=paginator.cursor_for(objects[-1]) if objects else None,
+                              previous_cursor=paginator.cursor_for(objects[0]) if objects else None)
+
+        count = self.get_count()
+        meta = {
+            'offset': offset,
+            'limit': limit,
+            'total_count': count,
+            'total_count_exact': self.count_exact,
+            'next_cursor': page.next_cursor,
+            'previous_cursor': page.previous_cursor,
+            'next': self.cursor_uri(limit, after=page.next_cursor) if page.next_cursor else None,
+            'previous': self.cursor_uri(limit, before=page.previous_cursor) if page.previous_cursor else None,
+        }
+        return {self.collection_name: objects, 'meta': meta}
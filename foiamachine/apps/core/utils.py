@@ -0,0 +1,14 @@
+from itertools import islice
+
+
+def chunked(iterable, size):
+    '''
+    yield lists of at most size items from any iterable without
+    materializing it, used by the bulk loaders and exporters
+    '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
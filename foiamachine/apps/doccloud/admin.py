@@ -27,11 +27,15 @@ class DocumentAdmin(admin.ModelAdmin):
 
             if o_file_hdr != n_file_hdr:
                 #looks like the file could be different (not a whole file compar)
-                obj.dc_properties.delete()
+                #queue the new upload before dropping the old one, deleting the properties cascades to obj
+                old_props = obj.dc_properties
                 obj.connect_dc_doc()
                 obj.save()
+                if old_props is not None:
+                    old_props.delete()
         else:
-            obj.dc_properties.update_access(obj.access_level)
             obj.save()
+            if obj.dc_properties is not None:
+                obj.dc_properties.update_access(obj.access_level)
 
 admin.site.register(Document, DocumentAdmin)
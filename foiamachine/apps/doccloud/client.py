@@ -0,0 +1,70 @@
+'''
+Thin layer over the DocumentCloud API client. One client is kept per
+thread and reused, instead of logging in again for every call.
+
+settings.DOCUMENTCLOUD_CLIENT is the dotted path of the client class,
+apps.doccloud.fake.FakeDocumentCloud in tests, and
+settings.DOCUMENTCLOUD_BASE_URI optionally points it at another server.
+'''
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+DEFAULT_CLIENT = 'documentcloud.DocumentCloud'
+
+_local = threading.local()
+
+
+def get_client():
+    client = getattr(_local, 'client', None)
+    if client is None:
+        client_class = import_string(getattr(settings, 'DOCUMENTCLOUD_CLIENT', DEFAULT_CLIENT))
+        kwargs = {}
+        base_uri = getattr(settings, 'DOCUMENTCLOUD_BASE_URI', None)
+        if base_uri:
+            kwargs['base_uri'] = base_uri
+        client = client_class(getattr(settings, 'DOCUMENTCLOUD_USERNAME', ''),
+                              getattr(settings, 'DOCUMENTCLOUD_PASS', ''), **kwargs)
+        _local.client = client
+    return client
+
+
+def reset_client():
+    '''
+    drop this thread's client, e.g. after the credentials changed
+    '''
+    _local.client = None
+
+
+def get_dc_file(dc_id):
+    return get_client().documents.get(dc_id)
+
+
+def put_file(file, title, access_level):
+    '''
+    upload a file, returns (id, canonical url, processing status)
+    '''
+    dc_obj = get_client().documents.upload(pdf=file, title=title,
+        access=access_level, secure=True)
+    return (dc_obj.id, dc_obj.canonical_url, getattr(dc_obj, 'status', 'pending'))
+
+
+def get_status(dc_id):
+    '''
+    pending while DocumentCloud is still processing, then success or error
+    '''
+    return getattr(get_dc_file(dc_id), 'status', 'success')
+
+
+def set_access(dc_id, access_level):
+    '''
+    change the access level, the documents API only saves documents it fetched
+    '''
+    dc_obj = get_dc_file(dc_id)
+    dc_obj.access = access_level
+    dc_obj.put()
+
+
+def rm_file(dc_id):
+    get_dc_file(dc_id).delete()
@@ -0,0 +1,78 @@
+'''
+In-memory stand-in for the DocumentCloud API, set
+DOCUMENTCLOUD_CLIENT = 'apps.doccloud.fake.FakeDocumentCloud' to use it.
+Documents are shared by all client instances, every API call is recorded
+in FakeDocumentCloud.calls so tests can count round trips. Like the real
+client, documents are changed and deleted through the objects that
+documents.get() returns, the client itself has no put or delete.
+'''
+import itertools
+
+
+class FakeDocument(object):
+
+    def __init__(self, client, id, title, access, status):
+        self._client = client
+        self.id = id
+        self.title = title
+        self.access = access
+        self.status = status
+        self.canonical_url = 'https://www.documentcloud.org/documents/%s.html' % id
+
+    def put(self):
+        FakeDocumentCloud.calls.append(('put', self.id))
+
+    save = put
+
+    def delete(self):
+        FakeDocumentCloud.calls.append(('delete', self.id))
+        FakeDocumentCloud.store.pop(self.id)
+
+
+class FakeDocuments(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    def upload(self, pdf, title=None, access='private', secure=False, **kwargs):
+        cls = self.client.__class__
+        cls.calls.append(('upload', title))
+        if cls.upload_failures > 0:
+            cls.upload_failures -= 1
+            raise IOError('fake upload failure')
+        dc_id = '%s-%s' % (next(cls.ids), title.lower().replace(' ', '-') if title else 'document')
+        pdf.read()
+        doc = FakeDocument(self.client, dc_id, title, access, cls.initial_status)
+        cls.store[dc_id] = doc
+        return doc
+
+    def get(self, id):
+        cls = self.client.__class__
+        cls.calls.append(('get', id))
+        return cls.store[id]
+
+
+class FakeDocumentCloud(object):
+    store = {}
+    calls = []
+    ids = itertools.count(1)
+    #how many uploads fail before they start to work again
+    upload_failures = 0
+    #status new uploads report, set to 'pending' to exercise polling
+    initial_status = 'success'
+
+    def __init__(self, username=None, password=None, base_uri=None):
+        self.username = username
+        self.password = password
+        self.documents = FakeDocuments(self)
+
+    @classmethod
+    def reset(cls):
+        cls.store.clear()
+        del cls.calls[:]
+        cls.upload_failures = 0
+        cls.initial_status = 'success'
+
+    @classmethod
+    def calls_to(cls, method):
+        return [call for call in cls.calls if call[0] == method]
@@ -0,0 +1,46 @@
+# Generated migration for the DocumentCloud models
+# This migration creates the tables syncdb used to create for this app
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentCloudProperties',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dc_id', models.CharField(max_length=300)),
+                ('dc_url', models.URLField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Document',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(max_length=255, upload_to=settings.DOCUMENTS_PATH)),
+                ('slug', django_extensions.db.fields.AutoSlugField(blank=True, editable=False, populate_from=('title',))),
+                ('title', models.CharField(max_length=255)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('created_at', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, db_index=True)),
+                ('updated_at', models.DateTimeField(blank=True, db_index=True, editable=False)),
+                ('access_level', models.CharField(choices=[('private', 'Private (only viewable by those with permission to this doc)'), ('public', 'Public (viewable by anyone)'), ('organization', 'Organization (viewable by users in your organization)')], max_length=32)),
+                ('dc_properties', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='doccloud.documentcloudproperties')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'Documents',
+                'ordering': ['created_at'],
+            },
+        ),
+    ]
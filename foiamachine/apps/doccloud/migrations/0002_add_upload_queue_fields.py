@@ -0,0 +1,63 @@
+# Generated migration for the DocumentCloud upload queue
+# This migration adds upload status, retry and access sync fields to DocumentCloudProperties
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doccloud', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='documentcloudproperties',
+            name='dc_id',
+            field=models.CharField(blank=True, default='', max_length=300),
+        ),
+        migrations.AlterField(
+            model_name='documentcloudproperties',
+            name='dc_url',
+            field=models.URLField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='documentcloudproperties',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued for upload'), ('pending', 'Processing on DocumentCloud'), ('success', 'Ready'), ('error', 'Upload failed')], db_index=True, default='success', max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='documentcloudproperties',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued for upload'), ('pending', 'Processing on DocumentCloud'), ('success', 'Ready'), ('error', 'Upload failed')], db_index=True, default='queued', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='documentcloudproperties',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='documentcloudproperties',
+            name='last_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='documentcloudproperties',
+            name='access_synced',
+            field=models.CharField(blank=True, choices=[('private', 'Private (only viewable by those with permission to this doc)'), ('public', 'Public (viewable by anyone)'), ('organization', 'Organization (viewable by users in your organization)')], default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='documentcloudproperties',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        # existing rows were uploaded synchronously, record their current access level
+        migrations.RunSQL(
+            "UPDATE doccloud_documentcloudproperties SET access_synced = ("
+            "SELECT access_level FROM doccloud_document WHERE doccloud_document.dc_properties_id = doccloud_documentcloudproperties.id LIMIT 1)"
+            " WHERE EXISTS (SELECT 1 FROM doccloud_document WHERE doccloud_document.dc_properties_id = doccloud_documentcloudproperties.id)",
+            migrations.RunSQL.noop,
+        ),
+    ]
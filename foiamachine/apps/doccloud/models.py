@@ -1,10 +1,9 @@
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from datetime import datetime
-from documentcloud import DocumentCloud
 from django_extensions.db.fields import AutoSlugField, CreationDateTimeField
 
 
@@ -14,85 +13,50 @@ PRIVACY_LVLS = (
 ('organization', 'Organization (viewable by users in your organization)')
 )
 
-def put_file(file, user):
-    if len(form.files) > 0 and obj.updated_at == None:
-        #file, obj are new
-        obj.user = request.user
-        obj.connect_dc_doc()
-        obj.save()
-    elif len(form.files) > 0 and obj.updated_at != None:
-        #object has been updated, look for file changes
-        n_file = form.files['file']
-        n_file_sz = getsize(n_file)
-        n_file_hdr = n_file.read(512) if n_file_sz >= 512\
-         else n_file.read()
-        o_file = obj.file
-        o_file_sz = getsize(o_file)
-        o_file_hdr = o_file.read(512) if o_file_sz >= 512\
-         else o_file.read()
-
-        if o_file_hdr != n_file_hdr:
-            #looks like the file could be different (not a whole file compar)
-            obj.dc_properties.delete()
-            obj.connect_dc_doc()
-            obj.save()
-    else:
-        obj.dc_properties.update_access(obj.access_level)
-        obj.save()
-
-def get_client():
-    return DocumentCloud(settings.DOCUMENTCLOUD_USERNAME,\
-         settings.DOCUMENTCLOUD_PASS)
-
-def get_dc_file(id):
-    t_client = get_client()
-    return t_client.documents.get(id)
-
-def put_file(file, title, access_level):
-    t_client = get_client()
-    dc_obj = t_client.documents.upload(pdf=file, title=title,\
-     access=access_level, secure=True)
-    return (dc_obj.id, dc_obj.canonical_url)
-
-def rm_file(id):
-    try:
-        get_dc_file(id).delete()
-    except Exception as e: 
-        return False
+DC_STATUSES = (
+('queued', 'Queued for upload'),
+('pending', 'Processing on DocumentCloud'),
+('success', 'Ready'),
+('error', 'Upload failed'),
+)
+
 
 class DocumentCloudProperties(models.Model):
-    dc_id = models.CharField(max_length=300, blank=False, null=False)
-    dc_url = models.URLField(max_length=200, null=False, blank=False)
-
-    def __init__(self, *args, **kwargs):
-        vals = None
-        if "file" in kwargs and "title" in kwargs and "access_level" in kwargs:
-                file = kwargs.pop('file')
-                title = kwargs.pop('title')
-                access_level = kwargs.pop('access_level')
-                vals = put_file(file, title, access_level)
-        super(DocumentCloudProperties, self).__init__(*args, **kwargs)
-        #set values l8r so values aren't overwritten
-        if vals != None:
-            self.dc_id = vals[0]
-            self.dc_url = vals[1]
+    '''
+    DocumentCloud side of a Document. Rows start out queued and are filled
+    in by apps.doccloud.tasks.upload_document, nothing here talks to
+    DocumentCloud directly.
+    '''
+    dc_id = models.CharField(max_length=300, blank=True, default='')
+    dc_url = models.URLField(max_length=200, blank=True, default='')
+    status = models.CharField(max_length=16, choices=DC_STATUSES, default='queued', db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    #access level DocumentCloud currently has, differs from the document's while an update is pending
+    access_synced = models.CharField(max_length=32, choices=PRIVACY_LVLS, blank=True, default='')
+    updated = models.DateTimeField(auto_now=True)
+
+    @property
+    def is_uploaded(self):
+        return self.status in ('pending', 'success') and self.dc_id != ''
 
     def update_access(self, access):
-        if self.dc_id == None and self.dc_url == None:
+        '''
+        access changes are pushed in batches by tasks.sync_access_levels,
+        queued uploads pick up the current access level when they run
+        '''
+        if not self.is_uploaded:
             return False #obj not set yet
-        try: 
-            dc_obj = get_dc_file(self.dc_id)
-            dc_obj.access = access
-            dc_obj.save()
-        except Exception as e:
-            return False #taking suggestions on handling mgmt issues n admin
+        from apps.doccloud.tasks import sync_access_levels
+        transaction.on_commit(sync_access_levels.delay)
+        return True
 
     def delete(self, *args, **kwargs):
-        #no effective way of dealing with errors on DC cloud side
-        #unless we create a custom template for managing documents 
-        rm_file(self.dc_id)
-        #so if rm_file don't complete we orphan the dc cloud doc
+        dc_id = self.dc_id
         super(DocumentCloudProperties, self).delete(*args, **kwargs)
+        if dc_id:
+            from apps.doccloud.tasks import delete_remote_document
+            transaction.on_commit(lambda: delete_remote_document.delay(dc_id))
 
 class Document(models.Model):
     """
@@ -118,21 +82,25 @@ class Document(models.Model):
         return self.title
 
     def get_absolute_url(self):
-        if self.dc_properties != None:
+        if self.dc_properties != None and self.dc_properties.dc_url:
             return self.dc_properties.dc_url
         return self.file.url
 
     def connect_dc_doc(self):
-        dc_props = DocumentCloudProperties(file=self.file, title=self.title,\
-         access_level=self.access_level)
-        dc_props.save()
+        '''
+        queue the file for upload, it's sent once the transaction commits
+        so the worker never looks for rows that aren't there yet
+        '''
+        from apps.doccloud.tasks import upload_document
+        dc_props = DocumentCloudProperties.objects.create()
         self.dc_properties = dc_props
+        transaction.on_commit(lambda: upload_document.delay(dc_props.pk))
 
     def delete(self, *args, **kwargs):
-        self.dc_properties.delete()
-        if self.dc_properties != None:
-            return #document didn't delete, admin view error msgs?
+        dc_props = self.dc_properties
         super(Document, self).delete(*args, **kwargs)
+        if dc_props is not None:
+            dc_props.delete()
 
     def save(self, *args, **kwargs):
         self.updated_at = timezone.now()
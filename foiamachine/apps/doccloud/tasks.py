@@ -0,0 +1,124 @@
+"""
+Background DocumentCloud uploads, status polling and access level updates
+"""
+
+from celery import shared_task
+from django.db.models import F
+import logging
+
+from . import client
+from .models import Document, DocumentCloudProperties
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_RETRIES = 5
+POLL_RETRIES = 40
+POLL_INTERVAL = 30
+
+
+def backoff(attempt):
+    """Seconds to wait before retry number `attempt`: 1, 2, 4, 8 ... minutes"""
+    return 60 * 2 ** min(attempt, 6)
+
+
+@shared_task(bind=True, max_retries=UPLOAD_RETRIES)
+def upload_document(self, properties_id):
+    """
+    Upload the file of the Document attached to a queued DocumentCloudProperties
+    """
+    props = DocumentCloudProperties.objects.filter(id=properties_id, status='queued').first()
+    document = Document.objects.filter(dc_properties_id=properties_id).first()
+    if props is None or document is None:
+        return
+
+    try:
+        document.file.open('rb')
+        try:
+            dc_id, dc_url, status = client.put_file(document.file, document.title, document.access_level)
+        finally:
+            document.file.close()
+    except Exception as e:
+        props.attempts += 1
+        props.last_error = str(e)
+        if self.request.retries >= self.max_retries:
+            props.status = 'error'
+            props.save(update_fields=['attempts', 'last_error', 'status', 'updated'])
+            logger.error(f"DocumentCloud upload of document {document.id} failed for good: {e}")
+            return
+        props.save(update_fields=['attempts', 'last_error', 'updated'])
+        logger.warning(f"DocumentCloud upload of document {document.id} failed, retrying: {e}")
+        raise self.retry(exc=e, countdown=backoff(self.request.retries))
+
+    props.dc_id = str(dc_id)
+    props.dc_url = dc_url
+    props.status = 'success' if status == 'success' else 'pending'
+    props.access_synced = document.access_level
+    props.last_error = ''
+    props.save()
+    if props.status == 'pending':
+        poll_document_status.apply_async((props.id,), countdown=POLL_INTERVAL)
+
+
+@shared_task(bind=True, max_retries=POLL_RETRIES)
+def poll_document_status(self, properties_id):
+    """
+    Wait for DocumentCloud to finish processing an upload
+    """
+    props = DocumentCloudProperties.objects.filter(id=properties_id, status='pending').first()
+    if props is None:
+        return
+    try:
+        status = client.get_status(props.dc_id)
+    except Exception as e:
+        logger.warning(f"Could not get DocumentCloud status for {props.dc_id}: {e}")
+        status = 'pending'
+
+    if status == 'pending':
+        if self.request.retries >= self.max_retries:
+            logger.error(f"DocumentCloud document {props.dc_id} is still processing, giving up polling")
+            return
+        raise self.retry(countdown=POLL_INTERVAL)
+
+    DocumentCloudProperties.objects.filter(id=props.id).update(
+        status='success' if status == 'success' else 'error')
+
+
+@shared_task
+def sync_access_levels():
+    """
+    Push every pending access level change in one pass, only documents
+    whose access changed are fetched and saved, and the results are
+    recorded with a single bulk_update.
+    """
+    documents = Document.objects.select_related('dc_properties')\
+        .filter(dc_properties__status__in=['pending', 'success'])\
+        .exclude(access_level=F('dc_properties__access_synced'))
+
+    synced = []
+    for document in documents.iterator():
+        props = document.dc_properties
+        try:
+            client.set_access(props.dc_id, document.access_level)
+        except Exception as e:
+            logger.warning(f"Could not set access on DocumentCloud document {props.dc_id}: {e}")
+            continue
+        props.access_synced = document.access_level
+        synced.append(props)
+
+    DocumentCloudProperties.objects.bulk_update(synced, ['access_synced'])
+    return len(synced)
+
+
+@shared_task(bind=True, max_retries=UPLOAD_RETRIES)
+def delete_remote_document(self, dc_id):
+    """
+    Remove a document from DocumentCloud after its local row is gone
+    """
+    try:
+        client.rm_file(dc_id)
+    except Exception as e:
+        if self.request.retries >= self.max_retries:
+            # orphaned on DocumentCloud, nothing else we can do from here
+            logger.error(f"Could not delete DocumentCloud document {dc_id}: {e}")
+            return
+        raise self.retry(exc=e, countdown=backoff(self.request.retries))
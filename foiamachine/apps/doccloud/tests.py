@@ -0,0 +1,86 @@
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from apps.doccloud import client
+from apps.doccloud.fake import FakeDocumentCloud
+from apps.doccloud.models import Document, DocumentCloudProperties
+from apps.doccloud.tasks import POLL_INTERVAL, upload_document, poll_document_status, sync_access_levels,\
+    delete_remote_document
+
+
+@override_settings(DOCUMENTCLOUD_CLIENT='apps.doccloud.fake.FakeDocumentCloud')
+class DocumentCloudTesting(TestCase):
+
+    def setUp(self):
+        FakeDocumentCloud.reset()
+        client.reset_client()
+
+    def tearDown(self):
+        client.reset_client()
+
+    def create_document(self, title='A test document', access_level='private'):
+        doc = Document(title=title, access_level=access_level)
+        doc.file.save('test.pdf', ContentFile(b'%PDF-1.4 test'), save=False)
+        doc.connect_dc_doc()
+        doc.save()
+        return doc
+
+    def test_save_does_not_upload(self):
+        doc = self.create_document()
+        self.assertEqual(FakeDocumentCloud.calls, [])
+        self.assertEqual(doc.dc_properties.status, 'queued')
+        self.assertEqual(doc.get_absolute_url(), doc.file.url)
+
+    def test_upload_and_poll(self):
+        FakeDocumentCloud.initial_status = 'pending'
+        doc = self.create_document()
+        #the poll is scheduled through the broker, only check that it was
+        with mock.patch.object(poll_document_status, 'apply_async') as schedule:
+            upload_document.apply(args=[doc.dc_properties_id])
+        props = DocumentCloudProperties.objects.get(id=doc.dc_properties_id)
+        schedule.assert_called_once_with((props.id,), countdown=POLL_INTERVAL)
+        self.assertEqual(props.status, 'pending')
+        self.assertEqual(props.access_synced, 'private')
+        self.assertNotEqual(props.dc_id, '')
+
+        FakeDocumentCloud.store[props.dc_id].status = 'success'
+        poll_document_status.apply(args=[props.id])
+        self.assertEqual(DocumentCloudProperties.objects.get(id=props.id).status, 'success')
+
+    def test_upload_retries(self):
+        FakeDocumentCloud.upload_failures = 2
+        doc = self.create_document()
+        upload_document.apply(args=[doc.dc_properties_id])
+        props = DocumentCloudProperties.objects.get(id=doc.dc_properties_id)
+        self.assertEqual(props.status, 'success')
+        self.assertEqual(props.attempts, 2)
+        self.assertEqual(len(FakeDocumentCloud.calls_to('upload')), 3)
+        #one client for all three attempts
+        self.assertTrue(client.get_client() is client.get_client())
+
+    def test_batched_access_updates(self):
+        docs = [self.create_document(title='doc %s' % i) for i in range(3)]
+        for doc in docs:
+            upload_document.apply(args=[doc.dc_properties_id])
+        del FakeDocumentCloud.calls[:]
+
+        Document.objects.filter(id__in=[d.id for d in docs[:2]]).update(access_level='public')
+        self.assertEqual(sync_access_levels.apply().get(), 2)
+        self.assertEqual(len(FakeDocumentCloud.calls_to('put')), 2)
+        self.assertEqual(len(FakeDocumentCloud.calls_to('get')), 2)
+        dc_id = DocumentCloudProperties.objects.get(id=docs[0].dc_properties_id).dc_id
+        self.assertEqual(FakeDocumentCloud.store[dc_id].access, 'public')
+
+        #nothing left to push
+        self.assertEqual(sync_access_levels.apply().get(), 0)
+
+    def test_remote_delete(self):
+        doc = self.create_document()
+        upload_document.apply(args=[doc.dc_properties_id])
+        dc_id = DocumentCloudProperties.objects.get(id=doc.dc_properties_id).dc_id
+        delete_remote_document.apply(args=[dc_id])
+        self.assertEqual(FakeDocumentCloud.calls_to('delete'), [('delete', dc_id)])
+        self.assertNotIn(dc_id, FakeDocumentCloud.store)
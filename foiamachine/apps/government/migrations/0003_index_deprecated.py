@@ -0,0 +1,54 @@
+# Generated migration for lookup indexes
+# This migration indexes deprecated, which every manager filters on
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('government', '0002_add_statute_enhancements'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='language',
+            name='deprecated',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='adminname',
+            name='deprecated',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='update',
+            name='deprecated',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='feeexemptionother',
+            name='deprecated',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='nation',
+            name='deprecated',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='statute',
+            name='deprecated',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='holiday',
+            name='deprecated',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='government',
+            name='deprecated',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+    ]
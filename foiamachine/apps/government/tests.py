@@ -50,3 +50,21 @@ class GovernmentTesting(UserTestBase):
         self.assertEqual(FeeExemptionOther.objects.all().count(), 15)
 
 
+
+
+class StatuteCSVTesting(UserTestBase):
+
+    def test_load_states_days_till_due(self):
+        #numeric days are kept, "reasonable time period" falls back to the default
+        florida = Government.objects.get(name='Florida')
+        self.assertEqual(florida.statutes.all()[0].days_till_due, -1)
+        self.assertTrue(Statute.objects.filter(days_till_due=5).exists())
+
+    def test_csv_reader(self):
+        from apps.core.csvio import CSVReader, int_or_none
+        import io
+        data = u'name;days\n"Smith; Jones";10\nCaf\xe9;soon\n'.encode('utf-8')
+        reader = CSVReader(io.BytesIO(data), header=True, columns={'days': int_or_none})
+        rows = list(reader.dicts())
+        self.assertEqual(reader.dialect.delimiter, ';')
+        self.assertEqual(rows, [{'name': 'Smith; Jones', 'days': 10}, {'name': u'Caf\xe9', 'days': None}])
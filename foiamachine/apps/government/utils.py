@@ -1,9 +1,10 @@
 from apps.government.models import Language, Nation,\
  Government, Statute, FeeExemptionOther
-from apps.core.unicode_csv import UnicodeReader
+from apps.core.csvio import CSVReader, int_or_none
 from django.conf import settings
 
 import logging
+import csv
 
 logger = logging.getLogger('default')
 
@@ -32,25 +33,22 @@ def load_states():
     language, created = Language.objects.get_or_create(name='English')
     ntn, created = Nation.objects.get_or_create(name='United States of America')
     fname = settings.SITE_ROOT + "/apps/government/data/foia_statutes.csv"
-    print fname
-    reader = list(UnicodeReader(open(fname, 'rb')))
-    idx = 0
-    for row in reader[1:]:
-        loc = row[1]
-        typee = row[2]
-        govt = get_or_create_us_govt(loc, typee)
-        print "%s %s" % (loc, idx)
-        short_title = row[3]
-        text = row[4]
-        days_till_due = row[5]
-        print "%s %s" % (loc, days_till_due)
-        try:
-            st, created = Statute.objects.get_or_create(short_title=short_title, designator='', text=text, days_till_due=days_till_due)
-        except Exception as e:
-            st, created = Statute.objects.get_or_create(short_title=short_title, designator='', text=text)
-            print e
-        govt.statutes.add(st)
-        idx += 1
+    logger.debug(fname)
+    #some states only say "reasonable time period", those keep the default days_till_due
+    with CSVReader(fname, dialect=csv.excel, header=True, columns={5: int_or_none}) as reader:
+        for idx, row in enumerate(reader):
+            loc = row[1]
+            typee = row[2]
+            govt = get_or_create_us_govt(loc, typee)
+            short_title = row[3]
+            text = row[4]
+            days_till_due = row[5]
+            logger.debug("%s %s %s" % (loc, idx, days_till_due))
+            if days_till_due is not None:
+                st, created = Statute.objects.get_or_create(short_title=short_title, designator='', text=text, days_till_due=days_till_due)
+            else:
+                st, created = Statute.objects.get_or_create(short_title=short_title, designator='', text=text)
+            govt.statutes.add(st)
 
 def load_statutes():
     lagnuage, ntn, govt = get_defaults()
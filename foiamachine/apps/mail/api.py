@@ -1,12 +1,15 @@
 #!/usr/bin/python
-from apps.mail.models import MailBox, MailMessage, Attachment
+from apps.mail.models import MESSAGE_PREFETCH, MailBox, MailMessage, Attachment
 from apps.core.models import EmailAddress
+from apps.core.pagination import KeysetResourcePaginator
 from apps.requests.models import Request
 
 from tastypie import fields
 from tastypie.resources import ModelResource, Resource
 from tastypie.authorization import Authorization, DjangoAuthorization
+from tastypie.exceptions import BadRequest
 
+from django.db.models import Prefetch
 from django.utils import timezone
 from datetime import datetime
 from apps.users.models import User
@@ -16,6 +19,10 @@ import logging
 
 logger = logging.getLogger('default')
 
+MESSAGE_FIELDS = ('id', 'email_from', 'reply_to', 'body', 'body_text', 'body_html', 'preview', 'subject', 'request',
+                  'message_id', 'direction', 'created', 'updated', 'slug', 'deprecated', 'dated', 'was_fwded',
+                  'replies', 'attachments', 'to', 'cc', 'bcc')
+
 
 class MessageResource(ModelResource):
     
@@ -24,22 +31,40 @@ class MessageResource(ModelResource):
         allowed_methods = ['get', 'post']
         detail_allowed_methods = ['get', 'post', 'put']
         authorization = Authorization()
-        queryset = MailMessage.objects.all()
+        queryset = MailMessage.objects.order_by('-dated', '-id')
         always_return_data = True 
+        paginator_class = KeysetResourcePaginator
+
+    def requested_fields(self, request):
+        '''
+        the fields asked for with ?fields=a,b,c or None for all of them
+        '''
+        fields = request.GET.get('fields') if request is not None else None
+        if not fields:
+            return None
+        wanted = set(field.strip() for field in fields.split(',') if field.strip())
+        unknown = wanted - set(MESSAGE_FIELDS)
+        if unknown:
+            raise BadRequest("Unknown message fields %s" % ', '.join(sorted(unknown)))
+        return wanted | set(['id'])
 
     def dehydrate(self, bundle):
-        for attr in ['id', 'email_from', 'reply_to', 'body', 'subject', 'request','id', 'message_id', 'direction', 'created', 'updated', 'slug', 'deprecated']:
-            bundle.data[attr] = getattr(bundle.obj, attr)
-        if bundle.data['request']:
-            bundle.data['request'] = bundle.data['request'].id
-
-        bundle.data['replies'] = map(lambda x: x.id, bundle.obj.replies.all())
-        bundle.data['attachments'] = map(lambda x: [x.file.url, x.get_filename], bundle.obj.attachments.all())
-        bundle.data['dated'] = bundle.data['dated'].strftime("%B %d, %Y %I:%M %p")
-        bundle.data['was_fwded'] = bundle.obj.was_fwded
-        for attr in ['bcc', 'cc', 'to']:
-            bundle.data[attr] = map(str, getattr(bundle.obj, attr).all())
-        #import pdb;pdb.set_trace()
+        wanted = self.requested_fields(bundle.request)
+        obj = bundle.obj
+        values = {
+            'request': lambda: obj.request_id,
+            'replies': lambda: [reply.id for reply in obj.replies.all()],
+            'attachments': lambda: [[x.file.url, x.get_filename] for x in obj.attachments.all()],
+            'dated': lambda: obj.dated.strftime("%B %d, %Y %I:%M %p") if obj.dated is not None else None,
+            'to': lambda: [str(address) for address in obj.to.all()],
+            'cc': lambda: [str(address) for address in obj.cc.all()],
+            'bcc': lambda: [str(address) for address in obj.bcc.all()],
+        }
+        data = {'resource_uri': bundle.data.get('resource_uri')}
+        for attr in MESSAGE_FIELDS:
+            if wanted is None or attr in wanted:
+                data[attr] = values[attr]() if attr in values else getattr(obj, attr)
+        bundle.data = data
         return bundle
 
     def obj_update(self, bundle, **kwargs):
@@ -140,10 +165,16 @@ class MessageResource(ModelResource):
         return bundle
 
     def get_object_list(self, request):
-        try:
-            return MailBox.objects.get(usr=request.user).messages
-        except Exception as e:
-            logger.info(e)
-            return []
-
-
+        '''
+        the user's messages, every relation the page shows is loaded with
+        one query for the whole page, replies only as far as their ids
+        '''
+        if not request.user.is_authenticated():
+            #anonymous users have no mailbox, and no messages
+            return MailMessage.objects.none()
+        messages = MailMessage.objects.filter(mailbox_messages__usr=request.user)
+        wanted = self.requested_fields(request)
+        prefetch = [field for field in MESSAGE_PREFETCH if wanted is None or field in wanted]
+        if wanted is None or 'replies' in wanted:
+            prefetch.append(Prefetch('replies', queryset=MailMessage._base_manager.only('id')))
+        return messages.prefetch_related(*prefetch).order_by('-dated', '-id')
@@ -1,25 +1,169 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 
 import boto
 import django
+import hashlib
+import logging
 import mimetypes
 import datetime
 from django.conf import settings
 
+logger = logging.getLogger('default')
+
+HASH_CHUNK_SIZE = 64 * 1024
+
 # Avoid circular references with Request, which needs to store attachments
 # for initial send
 def content_file_name(instance, filename):
     #return '%s/%s/%s' % ('attachments', instance.user.username,filename)
     return '%s/%s/%s/_%s_%s' % (settings.DEFAULT_S3_PATH, 'attachments', instance.user.username,datetime.datetime.now(), filename)
 
+def blob_file_name(instance, filename):
+    #content addressed, the same bytes always end up at the same key
+    return '%s/%s/%s/%s' % (settings.DEFAULT_S3_PATH, 'blobs', instance.sha256[:2], instance.sha256)
+
+def hash_file(content):
+    '''
+    sha256 and size of a file, read in chunks and rewound afterwards
+    '''
+    digest = hashlib.sha256()
+    size = 0
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in iter(lambda: content.read(HASH_CHUNK_SIZE), b''):
+        if not chunk:
+            break
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        digest.update(chunk)
+        size += len(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return digest.hexdigest(), size
+
+def set_private_acl(key_name):
+    if settings.USE_S3:
+        conn = boto.s3.connection.S3Connection(settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY)
+        bucket = conn.create_bucket(settings.AWS_STORAGE_BUCKET_NAME)
+        k = boto.s3.key.Key(bucket)
+        k.key = key_name
+        k.set_acl('private')
+
+
+class AttachmentBlob(models.Model):
+    '''
+    one stored copy of a file, shared by every Attachment with the same
+    content. refcount is the number of Attachments pointing at it, the
+    stored file is removed when it drops to zero
+    '''
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to=blob_file_name, max_length=255)
+    size = models.BigIntegerField(default=0)
+    refcount = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def acquire(cls, content):
+        '''
+        blob for content with its refcount already incremented, the file is
+        only uploaded if nothing with the same hash is stored yet
+        '''
+        digest, size = hash_file(content)
+        with transaction.atomic():
+            blob, created = cls.objects.select_for_update().get_or_create(sha256=digest, defaults={'size': size})
+            if not blob.file:
+                name = blob_file_name(blob, None)
+                if blob.file.storage.exists(name):
+                    blob.file.name = name
+                else:
+                    blob.file.save(name, content, save=False)
+                    set_private_acl(blob.file.name)
+                blob.save()
+            cls.objects.filter(pk=blob.pk).update(refcount=F('refcount') + 1)
+        return blob
+
+    def release(self):
+        with transaction.atomic():
+            blob = AttachmentBlob.objects.select_for_update().filter(pk=self.pk).first()
+            if blob is None:
+                return
+            if blob.refcount > 1:
+                AttachmentBlob.objects.filter(pk=blob.pk).update(refcount=F('refcount') - 1)
+                return
+            name, storage = blob.file.name, blob.file.storage
+            blob.delete()
+        try:
+            storage.delete(name)
+        except Exception as e:
+            logger.exception('could not delete blob %s e=%s' % (name, e))
+
+
+class AttachmentText(models.Model):
+    '''
+    text extracted from a file, keyed by content hash like AttachmentBlob
+    so each distinct file is read once. pages holds a dict per page (or
+    sheet) with its number, the [start, end) offsets of its text and
+    whether it came from OCR. see apps.mail.extraction
+    '''
+    STATUSES = (
+        ('ok', 'Extracted'),
+        ('empty', 'No text'),
+        ('unsupported', 'Unsupported'),
+        ('error', 'Failed'),
+    )
+    sha256 = models.CharField(max_length=64, unique=True)
+    status = models.CharField(max_length=16, choices=STATUSES, default='ok')
+    method = models.CharField(max_length=16, blank=True, default='')
+    text = models.TextField(blank=True, default='')
+    pages = models.JSONField(default=list)
+    ocr_pages = models.PositiveIntegerField(default=0)
+    #the ATTACHMENT_OCR it was extracted with
+    ocr_backend = models.CharField(max_length=255, blank=True, default='')
+    #what extraction could read then, unsupported files and empty text are redone when that changes
+    readers = models.CharField(max_length=255, blank=True, default='')
+    version = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    extracted = models.DateTimeField(auto_now=True, db_index=True)
+
+    def page_text(self, number):
+        for page in self.pages:
+            if page['number'] == number:
+                return self.text[page['start']:page['end']]
+        return None
+
+
+class AttachmentManager(models.Manager):
+
+    def store(self, user, filename, content):
+        '''
+        save an uploaded, received or generated file as an Attachment,
+        identical files are stored once
+        '''
+        blob = AttachmentBlob.acquire(content)
+        atch = self.model(user=user, blob=blob, filename=filename or '')
+        atch.file.name = blob.file.name
+        atch.save()
+        #text is read off the request path, files already read are skipped there
+        from apps.mail.tasks import extract_attachment_text
+        transaction.on_commit(lambda: extract_attachment_text.delay([atch.pk]))
+        return atch
+
+
 class Attachment(models.Model):
     from django.contrib.auth.models import User
     user = models.ForeignKey(User)
+    #file points at the blob's file for deduplicated attachments, rows from before keep their own
     file = models.FileField(upload_to=content_file_name, max_length=255)
+    blob = models.ForeignKey(AttachmentBlob, blank=True, null=True, on_delete=models.PROTECT, related_name='attachments')
+    filename = models.CharField(max_length=255, blank=True, default='')
     created = models.DateTimeField(auto_now_add=True)
+    objects = AttachmentManager()
 
     def get_mimetype(self):
-        format, enc = mimetypes.guess_type(self.get_filename())
+        format, enc = mimetypes.guess_type(self.get_filename)
         return format
 
     def get_messages(self):
@@ -27,6 +171,8 @@ class Attachment(models.Model):
 
     @property
     def get_filename(self):
+        if self.filename:
+            return self.filename
         fname = self.file.name.split('/')[-1]
         if fname.startswith('_'):
             return fname.split('_', 2)[2]
@@ -44,11 +190,25 @@ class Attachment(models.Model):
     def get_key(self):
         return "%s" % (self.file.name)
 
-    def save(self, *args, **kwargs):
-        super(Attachment, self).save(*args, **kwargs)
+    def get_download_url(self, expires_in=300):
+        '''
+        short lived url that downloads under the original filename
+        '''
         if settings.USE_S3:
             conn = boto.s3.connection.S3Connection(settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY)
-            bucket = conn.create_bucket(settings.AWS_STORAGE_BUCKET_NAME)
-            k = boto.s3.key.Key(bucket)
-            k.key = self.get_key
-            k.set_acl('private')
+            key = conn.get_bucket(settings.AWS_STORAGE_BUCKET_NAME, validate=False).get_key(self.get_key, validate=False)
+            disposition = 'attachment; filename="%s"' % self.get_filename.replace('"', '')
+            return key.generate_url(expires_in, response_headers={'response-content-disposition': disposition})
+        return self.file.url
+
+    def save(self, *args, **kwargs):
+        super(Attachment, self).save(*args, **kwargs)
+        if self.blob_id is None:
+            #blobs are made private once, when they're uploaded
+            set_private_acl(self.get_key)
+
+
+@receiver(post_delete, sender=Attachment)
+def release_attachment_blob(sender, instance, **kwargs):
+    if instance.blob_id is not None:
+        AttachmentBlob(pk=instance.blob_id).release()
@@ -0,0 +1,92 @@
+'''
+Message bodies normalized once when they are stored: plain text for
+search, agents and exports, sanitized HTML for display and a short
+preview for lists. MailMessage.save() fills the columns whenever the body
+changes and backfill_message_bodies does it for older rows.
+'''
+from django.conf import settings
+
+import bleach
+import re
+
+try:
+    from html.parser import HTMLParser
+except ImportError:
+    from HTMLParser import HTMLParser
+
+PREVIEW_LENGTH = 200
+
+#tags that end a line of text
+BREAKING_TAGS = set(['br', 'p', 'div', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote'])
+#tags whose content isn't text
+SKIPPED_TAGS = set(['script', 'style', 'head', 'title'])
+
+
+class TextExtractor(HTMLParser):
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.convert_charrefs = True
+        self.fed = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self.skipping += 1
+        elif tag in BREAKING_TAGS:
+            self.fed.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self.skipping = max(0, self.skipping - 1)
+        elif tag in BREAKING_TAGS:
+            self.fed.append('\n')
+
+    def handle_data(self, d):
+        if not self.skipping:
+            self.fed.append(d)
+
+    def get_data(self):
+        return ''.join(self.fed)
+
+
+def html_to_text(body):
+    if not body:
+        return ''
+    extractor = TextExtractor()
+    extractor.feed(body)
+    extractor.close()
+    lines = [' '.join(line.split()) for line in extractor.get_data().splitlines()]
+    #at most one blank line in a row
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+
+def sanitize_html(body):
+    '''
+    what the mail templates used to do on every render: carriage returns
+    become line breaks and bleach strips everything not allowed in settings
+    '''
+    if not body:
+        return ''
+    return bleach.clean(body.replace('\r', '<br/>'),
+                        tags=getattr(settings, 'BLEACH_ALLOWED_TAGS', bleach.ALLOWED_TAGS),
+                        attributes=getattr(settings, 'BLEACH_ALLOWED_ATTRIBUTES', bleach.ALLOWED_ATTRIBUTES),
+                        styles=getattr(settings, 'BLEACH_ALLOWED_STYLES', bleach.ALLOWED_STYLES),
+                        strip=getattr(settings, 'BLEACH_STRIP_TAGS', True),
+                        strip_comments=getattr(settings, 'BLEACH_STRIP_COMMENTS', True))
+
+
+def preview(text, length=PREVIEW_LENGTH):
+    text = ' '.join(text.split())
+    if len(text) <= length:
+        return text
+    cut = text[:length - 1].rsplit(' ', 1)[0] or text[:length - 1]
+    return cut + u'…'
+
+
+def normalize_body(body):
+    '''
+    (plain text, sanitized html, preview) for a message body
+    '''
+    text = html_to_text(body)
+    return text, sanitize_html(body), preview(text)
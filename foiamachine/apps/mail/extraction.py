@@ -0,0 +1,401 @@
+'''
+Text of attachments for agents, the similar request index and exports.
+PDFs are read with pypdf, DOCX and XLSX straight from their XML, and
+pages of scanned PDFs that have no text layer go to the OCR backend named
+by settings.ATTACHMENT_OCR. Extraction runs in a process pool, since it
+is CPU bound, while reading files and saving results stays on the calling
+thread. Results are AttachmentText rows keyed by content hash, so a file
+received twice is read once. Each row keeps the whole text with the
+[start, end) offsets of every page (or sheet) in it.
+'''
+from concurrent.futures import ProcessPoolExecutor
+from importlib import import_module
+from xml.etree import ElementTree
+
+from django.conf import settings
+from django.db.models import Q
+from django.db.models.functions import Substr
+
+from apps.core.utils import chunked
+from apps.mail.attachment import Attachment, AttachmentText, hash_file
+from apps.mail.bodies import html_to_text
+
+import io
+import logging
+import posixpath
+import zipfile
+
+try:
+    import pypdf
+    HAS_PYPDF = True
+except ImportError:
+    HAS_PYPDF = False
+
+try:
+    import pytesseract
+    from pdf2image import convert_from_bytes
+    HAS_TESSERACT = True
+except ImportError:
+    HAS_TESSERACT = False
+
+logger = logging.getLogger('default')
+
+#bump when extraction changes so older rows are redone
+EXTRACTOR_VERSION = 1
+EXTRACT_WORKERS = 2
+#below this many files starting processes costs more than it saves
+EXTRACT_POOL_MIN = 4
+#files read into memory at once
+EXTRACT_BATCH = 16
+MAX_BYTES = 50 * 1024 * 1024
+#pages with less text than this are taken to be scans
+OCR_MIN_CHARS = 20
+PAGE_SEPARATOR = '\n\n'
+
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+SHEET_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+PACKAGE_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+TEXT_EXTENSIONS = ('.txt', '.csv', '.tsv', '.md', '.json', '.xml')
+HTML_EXTENSIONS = ('.html', '.htm')
+
+
+class UnsupportedFile(Exception):
+    pass
+
+
+class TesseractOCR(object):
+    '''
+    OCR with tesseract, one PDF page rendered at a time
+    '''
+    dpi = 300
+
+    def __init__(self, lang='eng'):
+        if not HAS_TESSERACT:
+            raise ImportError('pytesseract and pdf2image are required for OCR')
+        self.lang = lang
+
+    def pdf_page(self, data, number):
+        images = convert_from_bytes(data, dpi=self.dpi, first_page=number, last_page=number)
+        return '\n'.join(pytesseract.image_to_string(image, lang=self.lang) for image in images)
+
+
+def get_ocr(path=None):
+    '''
+    the OCR backend at dotted path, settings.ATTACHMENT_OCR by default;
+    None when there isn't one or it can't be loaded
+    '''
+    path = getattr(settings, 'ATTACHMENT_OCR', '') if path is None else path
+    if not path:
+        return None
+    module, name = path.rsplit('.', 1)
+    try:
+        return getattr(import_module(module), name)()
+    except ImportError as e:
+        logger.error('OCR backend %s unavailable: %s' % (path, e))
+        return None
+
+
+def extraction_readers(ocr_path):
+    '''
+    what extraction can read here, saved with each AttachmentText so files
+    that were unsupported or had no text are only read again once it changes
+    '''
+    readers = [name for name, available in (('pypdf', HAS_PYPDF), ('tesseract', HAS_TESSERACT)) if available]
+    return ','.join(readers + [ocr_path or ''])
+
+
+def pdf_pages(data, ocr=None):
+    if not HAS_PYPDF:
+        raise UnsupportedFile('pypdf is required for PDFs')
+    reader = pypdf.PdfReader(io.BytesIO(data))
+    pages = []
+    for number, page in enumerate(reader.pages, 1):
+        text = page.extract_text() or ''
+        if ocr is not None and len(text.strip()) < OCR_MIN_CHARS:
+            pages.append((ocr.pdf_page(data, number), True))
+        else:
+            pages.append((text, False))
+    return pages
+
+
+def docx_pages(data):
+    '''
+    paragraphs of the document body, split into pages where the file
+    records a page break
+    '''
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        root = ElementTree.fromstring(archive.read('word/document.xml'))
+    pages, lines = [], []
+    for paragraph in root.iter(WORD_NS + 'p'):
+        parts = []
+        for node in paragraph.iter():
+            if node.tag == WORD_NS + 't':
+                parts.append(node.text or '')
+            elif node.tag == WORD_NS + 'tab':
+                parts.append('\t')
+            elif node.tag == WORD_NS + 'lastRenderedPageBreak' or \
+                    (node.tag == WORD_NS + 'br' and node.get(WORD_NS + 'type') == 'page'):
+                if lines or parts:
+                    lines.append(''.join(parts))
+                    pages.append(('\n'.join(lines).strip(), False))
+                    lines, parts = [], []
+            elif node.tag == WORD_NS + 'br':
+                parts.append('\n')
+        lines.append(''.join(parts))
+    pages.append(('\n'.join(lines).strip(), False))
+    return [page for page in pages if page[0]] or [('', False)]
+
+
+def xlsx_pages(data):
+    '''
+    a page per sheet, its name then a line per row with cells tab separated
+    '''
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        names = set(archive.namelist())
+        shared = []
+        if 'xl/sharedStrings.xml' in names:
+            for item in ElementTree.fromstring(archive.read('xl/sharedStrings.xml')).iter(SHEET_NS + 'si'):
+                shared.append(''.join(node.text or '' for node in item.iter(SHEET_NS + 't')))
+        rels = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+        targets = dict((rel.get('Id'), rel.get('Target')) for rel in rels.iter(PACKAGE_REL_NS + 'Relationship'))
+        workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+        pages = []
+        for sheet in workbook.iter(SHEET_NS + 'sheet'):
+            target = targets.get(sheet.get(REL_NS + 'id'), '')
+            path = target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+            if path not in names:
+                continue
+            lines = [sheet.get('name', '')]
+            for row in ElementTree.fromstring(archive.read(path)).iter(SHEET_NS + 'row'):
+                cells = []
+                for cell in row.iter(SHEET_NS + 'c'):
+                    value = cell.find(SHEET_NS + 'v')
+                    if cell.get('t') == 's' and value is not None:
+                        cells.append(shared[int(value.text)])
+                    elif cell.get('t') == 'inlineStr':
+                        cells.append(''.join(node.text or '' for node in cell.iter(SHEET_NS + 't')))
+                    else:
+                        cells.append(value.text if value is not None and value.text else '')
+                if any(cells):
+                    lines.append('\t'.join(cells).rstrip('\t'))
+            pages.append(('\n'.join(lines), False))
+    return pages or [('', False)]
+
+
+def decode(data):
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+
+def file_kind(data, filename):
+    name = (filename or '').lower()
+    if data[:5] == b'%PDF-' or name.endswith('.pdf'):
+        return 'pdf'
+    if data[:2] == b'PK':
+        try:
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                names = set(archive.namelist())
+        except zipfile.BadZipfile:
+            names = set()
+        if 'word/document.xml' in names:
+            return 'docx'
+        if 'xl/workbook.xml' in names:
+            return 'xlsx'
+    if name.endswith(HTML_EXTENSIONS):
+        return 'html'
+    if name.endswith(TEXT_EXTENSIONS):
+        return 'text'
+    return None
+
+
+def join_pages(pages):
+    '''
+    (text, [{'number', 'start', 'end', 'ocr'}]) with pages one after another
+    '''
+    parts, offsets, position = [], [], 0
+    for number, (text, ocr) in enumerate(pages, 1):
+        text = (text or '').strip()
+        if parts:
+            parts.append(PAGE_SEPARATOR)
+            position += len(PAGE_SEPARATOR)
+        parts.append(text)
+        offsets.append({'number': number, 'start': position, 'end': position + len(text), 'ocr': ocr})
+        position += len(text)
+    return ''.join(parts), offsets
+
+
+def extract(data, filename='', ocr_path=None):
+    '''
+    text and pages of a file as a dict of AttachmentText fields. Runs in
+    worker processes, so it only takes picklable arguments and never
+    touches the database
+    '''
+    kind = file_kind(data, filename)
+    try:
+        if kind == 'pdf':
+            pages = pdf_pages(data, get_ocr(ocr_path))
+        elif kind == 'docx':
+            pages = docx_pages(data)
+        elif kind == 'xlsx':
+            pages = xlsx_pages(data)
+        elif kind == 'html':
+            pages = [(html_to_text(decode(data)), False)]
+        elif kind == 'text':
+            pages = [(decode(data), False)]
+        else:
+            raise UnsupportedFile('no extractor for %s' % (filename or 'this file'))
+    except UnsupportedFile as e:
+        return {'status': 'unsupported', 'method': kind or '', 'error': str(e)}
+    except Exception as e:
+        return {'status': 'error', 'method': kind or '', 'error': '%s: %s' % (e.__class__.__name__, e)}
+    text, offsets = join_pages(pages)
+    return {
+        'status': 'ok' if text.strip() else 'empty',
+        'method': kind,
+        'text': text,
+        'pages': offsets,
+        'ocr_pages': sum(1 for page in offsets if page['ocr']),
+    }
+
+
+def extract_job(job):
+    data, filename, ocr_path = job
+    return extract(data, filename, ocr_path)
+
+
+def attachment_hash(atch):
+    '''
+    content hash of an attachment, read from the file for attachments
+    stored before blobs
+    '''
+    if atch.blob_id is not None:
+        return atch.blob.sha256
+    atch.file.open('rb')
+    try:
+        return hash_file(atch.file)[0]
+    finally:
+        atch.file.close()
+
+
+def read_file(atch):
+    atch.file.open('rb')
+    try:
+        return atch.file.read(MAX_BYTES + 1)
+    finally:
+        atch.file.close()
+
+
+def extract_attachments(attachments, workers=EXTRACT_WORKERS, reextract=False):
+    '''
+    extract the text of attachments whose content hasn't been extracted
+    yet (or was by an older EXTRACTOR_VERSION, or failed), returns how
+    many files were read
+    '''
+    ocr_path = getattr(settings, 'ATTACHMENT_OCR', '')
+    readers = extraction_readers(ocr_path)
+    pending = {}
+    for atch in attachments:
+        try:
+            pending.setdefault(attachment_hash(atch), atch)
+        except Exception as e:
+            logger.exception('could not hash attachment %s e=%s' % (atch.pk, e))
+    if not reextract:
+        #errors are tried again, unsupported files and scans once pypdf or OCR are set up
+        done = AttachmentText.objects.filter(sha256__in=list(pending), version__gte=EXTRACTOR_VERSION)\
+            .filter(Q(status='ok') | Q(status__in=['empty', 'unsupported'], readers=readers))
+        for digest in done.values_list('sha256', flat=True):
+            pending.pop(digest, None)
+    if not pending:
+        return 0
+
+    pool = None
+    if workers and len(pending) >= EXTRACT_POOL_MIN:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    extracted = 0
+    try:
+        for batch in chunked(list(pending.items()), EXTRACT_BATCH):
+            jobs, digests, results = [], [], {}
+            for digest, atch in batch:
+                if atch.blob_id is not None and atch.blob.size > MAX_BYTES:
+                    results[digest] = {'status': 'unsupported', 'error': 'larger than %s bytes' % MAX_BYTES}
+                    continue
+                try:
+                    data = read_file(atch)
+                except Exception as e:
+                    #not saved, the read is tried again next time
+                    logger.exception('could not read attachment %s e=%s' % (atch.pk, e))
+                    continue
+                if len(data) > MAX_BYTES:
+                    results[digest] = {'status': 'unsupported', 'error': 'larger than %s bytes' % MAX_BYTES}
+                    continue
+                jobs.append((data, atch.get_filename, ocr_path))
+                digests.append(digest)
+            found = pool.map(extract_job, jobs) if pool is not None else map(extract_job, jobs)
+            results.update(zip(digests, found))
+            AttachmentText.objects.bulk_create(
+                [AttachmentText(sha256=digest, version=EXTRACTOR_VERSION, ocr_backend=ocr_path, readers=readers,
+                                **fields)
+                 for digest, fields in results.items()],
+                update_conflicts=True, unique_fields=['sha256'],
+                update_fields=['status', 'method', 'text', 'pages', 'ocr_pages', 'ocr_backend', 'readers', 'version',
+                               'error', 'extracted'])
+            extracted += len(results)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    logger.info('extracted text of %s attachments' % extracted)
+    return extracted
+
+
+def attachment_texts(attachment_ids, extract_missing=True):
+    '''
+    {attachment id: AttachmentText} for attachments whose text is known,
+    extracting the missing ones here first unless extract_missing is off
+    '''
+    attachments = list(Attachment.objects.filter(pk__in=list(attachment_ids)).select_related('blob'))
+    if extract_missing:
+        extract_attachments(attachments, workers=0)
+    hashes = {}
+    for atch in attachments:
+        try:
+            hashes[atch.pk] = attachment_hash(atch)
+        except Exception as e:
+            logger.exception('could not hash attachment %s e=%s' % (atch.pk, e))
+    texts = AttachmentText.objects.in_bulk(list(set(hashes.values())), field_name='sha256')
+    return dict((pk, texts[digest]) for pk, digest in hashes.items() if digest in texts)
+
+
+def request_attachment_texts(request_ids, chars):
+    '''
+    {request id: start of the text of the attachments in its thread, at
+    most chars long} with one query for the text
+    '''
+    from apps.mail.models import MailMessage
+    request_ids = list(request_ids)
+    pairs = list(MailMessage.objects.filter(request_id__in=request_ids, attachments__blob__isnull=False)
+                 .values_list('request_id', 'attachments__blob__sha256'))
+    pairs += list(MailMessage.objects.filter(replies__request_id__in=request_ids, attachments__blob__isnull=False)
+                  .values_list('replies__request_id', 'attachments__blob__sha256'))
+    heads = dict(AttachmentText.objects.filter(sha256__in=set(digest for request_id, digest in pairs))
+                 .annotate(head=Substr('text', 1, chars)).values_list('sha256', 'head'))
+    retval = {}
+    for request_id, digest in sorted(set(pairs)):
+        if heads.get(digest):
+            retval.setdefault(request_id, []).append(heads[digest])
+    return dict((request_id, PAGE_SEPARATOR.join(texts)[:chars]) for request_id, texts in retval.items())
+
+
+def requests_with_text_since(since):
+    '''
+    ids of requests with an attachment whose text was extracted since
+    '''
+    from apps.mail.models import MailMessage
+    digests = AttachmentText.objects.filter(extracted__gte=since, status='ok').values('sha256')
+    messages = MailMessage.objects.filter(attachments__blob__sha256__in=digests)
+    ids = set(messages.filter(request__isnull=False).values_list('request_id', flat=True))
+    ids.update(messages.filter(replies__request__isnull=False).values_list('replies__request_id', flat=True))
+    return ids
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.mail.bodies import normalize_body
+from apps.mail.models import MailMessage
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = 'Fill the plain text, sanitized html and preview of messages stored before they were computed on save'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--all', action='store_true', help='Recompute every message, not just missing ones')
+
+    def handle(self, *args, **options):
+        #deprecated messages too, they can be restored
+        messages = MailMessage._base_manager.order_by('id').only('id', 'body')
+        if not options['all']:
+            messages = messages.filter(body_text__isnull=True)
+        last_id = 0
+        total = 0
+        while True:
+            #by id rather than offset, rows leave the filter as they are filled
+            batch = list(messages.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            for message in batch:
+                message.body_text, message.body_html, message.preview = normalize_body(message.body)
+            with transaction.atomic():
+                MailMessage._base_manager.bulk_update(batch, ['body_text', 'body_html', 'preview'])
+            last_id = batch[-1].id
+            total += len(batch)
+            self.stdout.write('normalized %s messages' % total)
+        self.stdout.write('done, %s messages normalized' % total)
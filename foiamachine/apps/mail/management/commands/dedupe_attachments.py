@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from apps.core.utils import chunked
+from apps.mail.attachment import Attachment, AttachmentBlob, hash_file
+
+import logging
+
+logger = logging.getLogger('default')
+
+
+class Command(BaseCommand):
+    help = 'Move attachments saved before content addressing onto shared blobs, deleting duplicate files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='Only report how much would be freed')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        seen = {}
+        moved = duplicates = freed = 0
+        ids = Attachment.objects.filter(blob__isnull=True).order_by('id').values_list('id', flat=True)
+        for chunk in chunked(ids.iterator(), options['chunk_size']):
+            for atch in Attachment.objects.filter(id__in=chunk).order_by('id'):
+                try:
+                    atch.file.open('rb')
+                    try:
+                        digest, size = hash_file(atch.file)
+                    finally:
+                        atch.file.close()
+                except Exception as e:
+                    logger.exception('could not read attachment %s e=%s' % (atch.id, e))
+                    continue
+                duplicate = digest in seen or AttachmentBlob.objects.filter(sha256=digest).exists()
+                seen[digest] = True
+                moved += 1
+                if duplicate:
+                    duplicates += 1
+                    freed += size
+                if not dry_run:
+                    self.move(atch, digest, size)
+
+        self.stdout.write('attachments moved: %s, duplicates removed: %s, bytes freed: %s%s' % (
+            moved, duplicates, freed, ' (dry run)' if dry_run else ''))
+
+    def move(self, atch, digest, size):
+        old_name = atch.file.name
+        with transaction.atomic():
+            blob, created = AttachmentBlob.objects.select_for_update().get_or_create(sha256=digest, defaults={'size': size})
+            if created:
+                #the first copy becomes the blob, nothing is uploaded again
+                blob.file.name = old_name
+                blob.save()
+            AttachmentBlob.objects.filter(pk=blob.pk).update(refcount=F('refcount') + 1)
+            Attachment.objects.filter(pk=atch.pk).update(blob=blob, file=blob.file.name, filename=atch.get_filename)
+        if blob.file.name != old_name:
+            try:
+                atch.file.storage.delete(old_name)
+            except Exception as e:
+                logger.exception('could not delete duplicate %s e=%s' % (old_name, e))
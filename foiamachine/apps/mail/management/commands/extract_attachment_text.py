@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from apps.mail.attachment import Attachment
+from apps.mail.extraction import EXTRACT_WORKERS, extract_attachments
+
+BATCH_SIZE = 200
+
+
+class Command(BaseCommand):
+    help = 'Extract the text of attachments stored before it was extracted on arrival'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--workers', type=int, default=EXTRACT_WORKERS, help='Extraction processes, 0 to extract in this one')
+        parser.add_argument('--reextract', action='store_true', help='Read every file again, not just new ones')
+
+    def handle(self, *args, **options):
+        attachments = Attachment.objects.select_related('blob').order_by('id')
+        last_id = 0
+        total = 0
+        while True:
+            batch = list(attachments.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            total += extract_attachments(batch, workers=options['workers'], reextract=options['reextract'])
+            last_id = batch[-1].id
+            self.stdout.write('extracted %s files' % total)
+        self.stdout.write('done, %s files extracted' % total)
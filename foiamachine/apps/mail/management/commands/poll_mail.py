@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from apps.mail.models import MailBox
+from apps.mail.poller import PARSE_WORKERS, POLL_WORKERS, poll_mailboxes
+
+
+class Command(BaseCommand):
+    help = 'Download new mail for every mailbox (or the given users) from the POP3 server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help='Only poll these users')
+        parser.add_argument('--workers', type=int, default=POLL_WORKERS, help='POP3 connections at a time')
+        parser.add_argument('--parse-workers', type=int, default=PARSE_WORKERS,
+                            help='Processes parsing messages, 0 parses in this process')
+
+    def handle(self, *args, **options):
+        mailboxes = MailBox.objects.select_related('usr')
+        if options['usernames']:
+            mailboxes = mailboxes.filter(usr__username__in=options['usernames'])
+        summary = poll_mailboxes(mailboxes, workers=options['workers'], parse_workers=options['parse_workers'])
+        self.stdout.write('polled %(mailboxes)s mailboxes: %(fetched)s fetched, %(stored)s stored, '
+                          '%(errors)s errors' % summary)
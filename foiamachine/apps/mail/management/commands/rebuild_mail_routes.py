@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from apps.mail.models import MailBox, MailRoute
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the inbound routing table from every mailbox, e.g. after MG_ROUTE or MG_DOMAIN change'
+
+    def handle(self, *args, **options):
+        count = 0
+        for mailbox in MailBox.objects.select_related('usr').order_by('id').iterator():
+            MailRoute.objects.sync(mailbox)
+            count += 1
+        self.stdout.write('synced routes for %s mailboxes' % count)
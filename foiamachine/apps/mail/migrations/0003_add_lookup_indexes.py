@@ -0,0 +1,30 @@
+# Generated migration for mail lookup indexes
+# This migration indexes message ids, request threads and provisioned addresses
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0002_add_attachment_blobs'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mailmessage',
+            index=models.Index(fields=['message_id'], name='mailmessage_message_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mailmessage',
+            index=models.Index(condition=models.Q(deprecated__isnull=True), fields=['request', 'dated'], name='mailmessage_request_dated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mailmessage',
+            index=models.Index(fields=['-dated', '-id'], name='mailmessage_dated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mailbox',
+            index=models.Index(fields=['provisioned_email'], name='mailbox_provisioned_email_idx'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated migration for inbound mail routing
+# This migration adds the MailRoute table and fills it from the existing mailboxes
+
+from collections import defaultdict
+from email.utils import parseaddr
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def normalize_address(address):
+    return parseaddr(address or '')[1].strip().lower()
+
+
+def provisioned_address(username):
+    if hasattr(settings, 'MG_ROUTE'):
+        return "%s@%s.%s" % (username.split("@")[0], settings.MG_ROUTE, settings.MG_DOMAIN)
+    return "%s@%s" % (username.split("@")[0], settings.MG_DOMAIN)
+
+
+def build_routes(apps, schema_editor):
+    MailBox = apps.get_model('mail', 'MailBox')
+    MailRoute = apps.get_model('mail', 'MailRoute')
+    provisioned = {}
+    registered = defaultdict(set)
+    for mailbox_id, username, email in MailBox.objects.order_by('id').values_list('id', 'usr__username', 'usr__email').iterator():
+        provisioned.setdefault(normalize_address(provisioned_address(username)), mailbox_id)
+        if normalize_address(email):
+            registered[normalize_address(email)].add(mailbox_id)
+    rows = [MailRoute(address=address, mailbox_id=mailbox_id, kind='P') for address, mailbox_id in provisioned.items() if address]
+    for address, mailbox_ids in registered.items():
+        if address in provisioned:
+            continue
+        #shared by several users, routes nowhere
+        mailbox_id = mailbox_ids.pop() if len(mailbox_ids) == 1 else None
+        rows.append(MailRoute(address=address, mailbox_id=mailbox_id, kind='R'))
+    MailRoute.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0003_add_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailRoute',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.CharField(max_length=254, unique=True)),
+                ('kind', models.CharField(choices=[('P', 'provisioned'), ('R', 'registered')], max_length=1)),
+                ('mailbox', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='routes', to='mail.mailbox')),
+            ],
+        ),
+        migrations.RunPython(build_routes, migrations.RunPython.noop),
+    ]
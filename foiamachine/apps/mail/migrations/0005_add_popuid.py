@@ -0,0 +1,27 @@
+# Generated migration for incremental POP3 polling
+# This migration adds the PopUid table of message unique ids each mailbox has downloaded
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0004_add_mailroute'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PopUid',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uid', models.CharField(max_length=70)),
+                ('seen', models.DateTimeField(auto_now_add=True)),
+                ('mailbox', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pop_uids', to='mail.mailbox')),
+            ],
+            options={
+                'unique_together': {('mailbox', 'uid')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated migration for normalized message bodies
+# This migration adds the plain text, sanitized html and preview columns,
+# existing rows are filled by the backfill_message_bodies command
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0005_add_popuid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailmessage',
+            name='body_text',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mailmessage',
+            name='body_html',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mailmessage',
+            name='preview',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated migration for extracted attachment text
+# This migration adds AttachmentText, existing attachments are read by the
+# extract_attachment_text command
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0006_add_normalized_bodies'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AttachmentText',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('status', models.CharField(choices=[('ok', 'Extracted'), ('empty', 'No text'), ('unsupported', 'Unsupported'), ('error', 'Failed')], default='ok', max_length=16)),
+                ('method', models.CharField(blank=True, default='', max_length=16)),
+                ('text', models.TextField(blank=True, default='')),
+                ('pages', models.JSONField(default=list)),
+                ('ocr_pages', models.PositiveIntegerField(default=0)),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('extracted', models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated migration for the OCR backend of extracted text
+# This migration records which ATTACHMENT_OCR each AttachmentText was
+# extracted with, so text-less scans are read again when it changes
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0007_add_attachment_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachmenttext',
+            name='ocr_backend',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated migration for the readers of extracted text
+# This migration records what extraction could read when each AttachmentText
+# was saved, so unsupported files and text-less scans are only read again
+# once pypdf or OCR become available
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0008_add_attachment_text_ocr_backend'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachmenttext',
+            name='readers',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
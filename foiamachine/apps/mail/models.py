@@ -1,5 +1,8 @@
+from django.core.cache import cache
 from django.db import models
-from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+from django.db.models import Q, prefetch_related_objects
 from django.conf import settings
 from django_extensions.db.fields import AutoSlugField
 from django.core.files.uploadedfile import InMemoryUploadedFile
@@ -15,7 +18,7 @@ from email.utils import parseaddr, parsedate
 from dateutil.parser import parse
 from attachment import *
 
-from apps.requests.models import Request
+from apps.requests.models import Request, ThreadLookup
 from apps.core.models import EmailAddress
 
 import django
@@ -26,15 +29,19 @@ import email
 import logging
 import boto
 import re
+import time
 
 logger = logging.getLogger('default')
-thread_pattern = re.compile("LOOKUP:[a-zA-Z1234567890]*")
+thread_pattern = re.compile("LOOKUP:[a-zA-Z0-9]+")
 
 MSG_DIRECTIONS = (
     ('S', 'SENT'),
     ('R', "RECEIVED")
 )
 
+#sent with message and request_id once an inbound message is stored and threaded to a request
+response_received = Signal()
+
 class MessageId(models.Model):
     #messageid should never be more than 250, we do 512 just in case
     #http://www.imc.org/ietf-usefor/2000/Jun/0020.html
@@ -44,6 +51,10 @@ class MessageId(models.Model):
     def get_msg_id(self):
         return self.idd
 
+#what displaying a message reads, loaded for a whole list at once
+MESSAGE_PREFETCH = ('to', 'cc', 'bcc', 'attachments')
+
+
 class MailManager(models.Manager):
     def get_query_set(self):
         return super(MailManager, self).get_query_set().filter(deprecated__isnull=True)
@@ -55,6 +66,10 @@ class MailMessage(models.Model):
     cc = models.ManyToManyField(EmailAddress, blank=True, null=True, related_name='message_cc')
     bcc = models.ManyToManyField(EmailAddress, blank=True, null=True, related_name='message_bcc')
     body = models.TextField(blank=True, null=True)
+    #body_text, body_html and preview are derived from body on save, see apps.mail.bodies
+    body_text = models.TextField(blank=True, null=True)
+    body_html = models.TextField(blank=True, null=True)
+    preview = models.CharField(max_length=255, blank=True, default='')
     subject = models.CharField(max_length=1024)
     attachments = models.ManyToManyField(Attachment, blank=True, null=True, related_name='message_attachments')
     request = models.ForeignKey(Request, blank=True, null=True)
@@ -75,6 +90,15 @@ class MailMessage(models.Model):
 
     objects = MailManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['message_id'], name='mailmessage_message_id_idx'),
+            #threads, through MailManager which always excludes deprecated messages
+            models.Index(fields=['request', 'dated'], condition=Q(deprecated__isnull=True),
+                         name='mailmessage_request_dated_idx'),
+            models.Index(fields=['-dated', '-id'], name='mailmessage_dated_idx'),
+        ]
+
     @staticmethod
     def get_notes():
         #message id is set by mailgun / mail server so unsent messages or user notes have no id
@@ -118,28 +142,38 @@ class MailMessage(models.Model):
     def get_cc_emails(self):
         return [cc.content for cc in self.cc.all()]
 
+    def __init__(self, *args, **kwargs):
+        super(MailMessage, self).__init__(*args, **kwargs)
+        #deferred bodies aren't loaded just to remember them
+        self._normalized_body = self.__dict__.get('body')
+
+    def normalize_body(self):
+        from apps.mail.bodies import normalize_body
+        self.body_text, self.body_html, self.preview = normalize_body(self.body)
+        self._normalized_body = self.body
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'body' in update_fields:
+            if self.body_text is None or self.body != self._normalized_body:
+                self.normalize_body()
+                if update_fields is not None:
+                    kwargs['update_fields'] = set(update_fields) | set(['body_text', 'body_html', 'preview'])
+        super(MailMessage, self).save(*args, **kwargs)
+
     @property
     def plain_text_body(self):
-        from HTMLParser import HTMLParser
-
-        class MLStripper(HTMLParser):
-            def __init__(self):
-                self.reset()
-                self.fed = []
-
-            def handle_data(self, d):
-                self.fed.append(d)
-
-            def get_data(self):
-                return ''.join(self.fed)
-
-        s = MLStripper()
-        s.feed(self.body)
-        return s.get_data()
+        if self.body_text is None:
+            from apps.mail.bodies import html_to_text
+            return html_to_text(self.body)
+        return self.body_text
 
     @property
     def get_body(self):
-        return self.body.replace("\r", "<br/>")
+        if self.body_html is None:
+            from apps.mail.bodies import sanitize_html
+            return sanitize_html(self.body)
+        return self.body_html
 
     def send(self, provisioned_address, references=None):
         data = {"from": self.email_from,
@@ -157,7 +191,7 @@ class MailMessage(models.Model):
 
         resp = requests.post(
                 settings.MG_POST_URL,
-                files=MultiDict([("attachment", attachment.file) for attachment in self.attachments.all()]),
+                files=MultiDict([("attachment", (attachment.get_filename, attachment.file)) for attachment in self.attachments.all()]),
                 auth=("api", settings.MAILGUN_KEY),
                 data=data)
         content = json.loads(resp.content)
@@ -178,6 +212,11 @@ class MailBox(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     provisioned_email = models.EmailField(blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['provisioned_email'], name='mailbox_provisioned_email_idx'),
+        ]
+
     def get_orphaned_messages(self):
         return self.messages.filter(request__id=None).order_by('-dated')
 
@@ -186,49 +225,38 @@ class MailBox(models.Model):
         return MailMessage.objects.filter(request__id=request_id).order_by('dated')[0]
 
     def get_threads(self, request_id):
-        #roots = self.messages.filter(request__id=request_id).order_by('dated')
-        roots = MailMessage.objects.filter(request__id=request_id).order_by('dated')
-        logger.debug("getting threads len=%s request_id=%s" % (roots.count(), request_id))
-        if roots.count() <= 0:
+        '''
+        the oldest message on the request followed by its replies, with
+        recipients and attachments prefetched so the thread is read in the
+        same number of queries however long it is
+        '''
+        root = MailMessage.objects.filter(request__id=request_id).order_by('dated').first()
+        if root is None:
             return list()
-        if roots.count() > 0:
-            return [roots[0]] + [mail_msg for mail_msg in roots[0].replies.all().order_by('dated')]
-        if roots[0].dated is not None and roots[0].dated >= datetime(month=3, day=18, year=2013):
-            retval = [reply for reply in roots[0].replies.all()]
-            retval.insert(0, roots[0])
-            return retval
-        return []
+        threads = [root] + list(root.replies.order_by('dated'))
+        logger.debug("getting threads len=%s request_id=%s" % (len(threads), request_id))
+        prefetch_related_objects(threads, *MESSAGE_PREFETCH)
+        return threads
 
     def add_message(self, message):
         self.messages.add(message)
 
     def check_and_save_mail(self):
-        messages = self.check_mail()
-        for message in messages:
-            try:
-                mail_msg, inreply = self.parse_message_poptres(message)
-                self.store_message(mail_msg, inreply)
-            except Exception as e:
-                logger.exception(e)
-        return True
+        from apps.mail.poller import poll_mailboxes
+        return poll_mailboxes([self])
 
     def check_mail(self):
         '''
-        TODO I need to delete messages that have been stored
-        which should be taken care of with a wrapper method
-        that deletes messages after I have stored them
+        messages on the POP3 server this mailbox hasn't downloaded before,
+        without marking them as seen, see apps.mail.poller
         '''
-        M = poplib.POP3(settings.MAILGUN_POP)
-        M.user(self.get_provisioned_email())
-        M.pass_(self.get_password())
-
-        numMessages = len(M.list()[1])
-        retval = list()
-        for i in range(numMessages):
-            msg = M.retr(i+1)[1]
-            mail = email.message_from_string('\n'.join(msg))
-            retval.append(mail)
-        return retval
+        from apps.mail.poller import fetch_new, parse_all
+        known = set(self.pop_uids.values_list('uid', flat=True))
+        server_uids, fetched = fetch_new(self.get_provisioned_email(), self.get_password(), known)
+        return parse_all([raw for uid, raw in fetched])
+
+    def get_password(self):
+        return getattr(settings, 'MAILGUN_POP_PASSWORD', '')
 
     def parse_message_poptres(self, message):
         '''
@@ -363,15 +391,14 @@ class MailBox(models.Model):
             for key in files:
                 f = files[key]
                 logger.info('FILE=%s' % f)
-                atch = Attachment()
-                atch.user = self.usr
-                atch.file.save(f.name, f)
-                atch.save()
+                atch = Attachment.objects.store(self.usr, f.name, f)
                 attachments.append(atch)
         except Exception as e:
             logger.exception('cant parse attachment e=%s' % e)
 
-        mail_msg.attachments = attachments
+        #added rather than set, parse_message_poptres already linked the attachments it found
+        if attachments:
+            mail_msg.attachments.add(*attachments)
         if inreply:
             try:
                 logger.info('this message=%s looking up message in reply to: %s' % (mail_msg.message_id, inreply))
@@ -415,25 +442,53 @@ class MailBox(models.Model):
                 self.lookup_thread(mail_msg)
         else:
             self.lookup_thread(mail_msg)
+        self.notify_response(mail_msg)
         return mail_msg
 
+    def notify_response(self, mail_msg):
+        '''
+        let listeners, like the response analysis agent, know the request
+        a reply landed on; replies hang off the thread's root message so
+        the request is read from there when the reply has none
+        '''
+        if mail_msg.direction != MSG_DIRECTIONS[1][0]:
+            return None
+        request_id = mail_msg.request_id
+        if request_id is None:
+            request_id = mail_msg.replies.filter(request__isnull=False).values_list('request_id', flat=True).first()
+        if request_id is not None:
+            #the message is stored, a listener failing must not lose it
+            for listener, result in response_received.send_robust(sender=MailMessage, message=mail_msg,
+                                                                  request_id=request_id):
+                if isinstance(result, Exception):
+                    logger.error('response_received listener failed request=%s e=%s' % (request_id, result))
+        return request_id
+
     def lookup_thread(self, mail_msg):
-        any_matches = [thread_pattern.findall(mail_msg.body), thread_pattern.findall(mail_msg.subject)]
-        for any_match in any_matches:
-            for match in any_match:
-                logger.debug("FOUND MATCH =%s" % match)
-                for req in Request.objects.filter(thread_lookup=match):
-                    threads = self.get_threads(req.id)
-                    logger.debug("LOOKUP CODE THREAD COUNT =%s" % len(threads))
-                    if len(threads) > 0:#messages have been sent!
-                        thread = threads[0]
-                        thread.replies.add(mail_msg)
-                        mail_msg.add_references(thread.references.all())
-                        mail_msg.was_fwded = True
-                        thread.add_references(mail_msg.references.all())
-                    else:#message was never sent
-                        mail_msg.request = req
-                    mail_msg.save() 
+        #subject and body in one pass, each code once in the order found
+        text = '%s\n%s' % (mail_msg.body or '', mail_msg.subject or '')
+        tokens = []
+        for match in thread_pattern.findall(text):
+            if match not in tokens:
+                tokens.append(match)
+        if not tokens:
+            return mail_msg
+        lookups = ThreadLookup.objects.resolve(tokens)
+        roots = MailMessage.objects.in_bulk([lookup.root_id for lookup in lookups.values() if lookup.root_id])
+        for match in tokens:
+            lookup = lookups.get(match)
+            if lookup is None:
+                continue
+            logger.debug("FOUND MATCH =%s" % match)
+            thread = roots.get(lookup.root_id)
+            if thread is not None:#messages have been sent!
+                thread.replies.add(mail_msg)
+                mail_msg.add_references(thread.references.all())
+                mail_msg.was_fwded = True
+                thread.add_references(mail_msg.references.all())
+            else:#message was never sent
+                mail_msg.request = lookup.request
+            mail_msg.save()
         return mail_msg
 
     def parse_attachments_poptres(self, content_disposition, part):
@@ -466,23 +521,158 @@ class MailBox(models.Model):
             attachment.seek(0, 2)
             f = InMemoryUploadedFile(attachment, "", attachment.name, attachment.content_type, attachment.tell(), None)
 
-            atch = Attachment()
-            atch.user = self.usr
-            atch.file.save(attachment.name, f)
-            atch.save()
+            atch = Attachment.objects.store(self.usr, attachment.name, f)
             return atch
 
     def get_provisioned_email(self):
-        if hasattr(settings, 'MG_ROUTE'):
-            # Fix this beore commit
-            thisaddress = "%s@%s.%s" % (self.usr.username.split("@")[0], settings.MG_ROUTE, settings.MG_DOMAIN)
-        else:
-            thisaddress = "%s@%s" % (self.usr.username.split("@")[0], settings.MG_DOMAIN)
-        logger.info("THIS address=%s" % thisaddress)
-        if self.provisioned_email is None or self.provisioned_email != thisaddress:
+        thisaddress = provisioned_address(self.usr)
+        if self.provisioned_email != thisaddress:
+            #only the column and the routes change, not a full save
+            logger.info("provisioned address for mailbox %s changed to=%s" % (self.pk, thisaddress))
             self.provisioned_email = thisaddress
-            self.save()
+            MailBox.objects.filter(pk=self.pk).update(provisioned_email=thisaddress)
+            MailRoute.objects.sync(self)
         return self.provisioned_email
 
     def get_registered_email(self):
         return self.usr.email
+
+
+def normalize_address(address):
+    return parseaddr(address or '')[1].strip().lower()
+
+
+def provisioned_address(user):
+    if hasattr(settings, 'MG_ROUTE'):
+        return "%s@%s.%s" % (user.username.split("@")[0], settings.MG_ROUTE, settings.MG_DOMAIN)
+    return "%s@%s" % (user.username.split("@")[0], settings.MG_DOMAIN)
+
+
+ROUTE_KINDS = (
+    ('P', 'provisioned'),
+    ('R', 'registered'),
+)
+
+ROUTES_VERSION_KEY = 'mail_routes_version'
+#a process re-reads its routes this often even if no version bump reaches it,
+#the default DummyCache shares nothing between processes
+ROUTE_MEMORY_SECONDS = 300
+#addresses that route nowhere are looked up again after this long
+ROUTE_MISS_SECONDS = 30
+
+
+class MailRouteManager(models.Manager):
+    '''
+    normalized address -> mailbox id, remembered per process for up to
+    ROUTE_MEMORY_SECONDS. Any change bumps a version in the shared cache so
+    every process drops its copy sooner
+    '''
+    _routes = {}
+    _misses = {}
+    _version = None
+    _loaded = 0
+
+    def invalidate(self):
+        try:
+            cache.incr(ROUTES_VERSION_KEY)
+        except ValueError:
+            cache.set(ROUTES_VERSION_KEY, 1, None)
+        MailRouteManager._routes = {}
+        MailRouteManager._misses = {}
+
+    def resolve(self, addresses):
+        '''
+        {address: mailbox id} for the addresses that route to a mailbox,
+        the ones not seen before are looked up with one query
+        '''
+        version = cache.get(ROUTES_VERSION_KEY)
+        now = time.time()
+        if version != MailRouteManager._version or now - MailRouteManager._loaded > ROUTE_MEMORY_SECONDS:
+            MailRouteManager._routes = {}
+            MailRouteManager._misses = {}
+            MailRouteManager._version = version
+            MailRouteManager._loaded = now
+        routes, misses = MailRouteManager._routes, MailRouteManager._misses
+        normalized = dict((address, normalize_address(address)) for address in addresses)
+        missing = set(address for address in normalized.values()
+                      if address and address not in routes and misses.get(address, 0) <= now)
+        if missing:
+            found = dict(self.filter(address__in=missing).values_list('address', 'mailbox_id'))
+            for address in missing:
+                if found.get(address) is not None:
+                    routes[address] = found[address]
+                else:
+                    #mailbox None means nobody gets it, asked again once the miss expires
+                    misses[address] = now + ROUTE_MISS_SECONDS
+        return dict((address, routes[key]) for address, key in normalized.items() if key in routes)
+
+    def sync(self, mailbox):
+        '''
+        bring the rows for one mailbox up to date. The provisioned address
+        always wins, a registered address shared by two users routes nowhere
+        like MailBox.objects.get(usr__email=) did
+        '''
+        provisioned = normalize_address(provisioned_address(mailbox.usr))
+        registered = normalize_address(mailbox.usr.email)
+        keep = set()
+        if provisioned:
+            self.update_or_create(address=provisioned, defaults={'mailbox': mailbox, 'kind': 'P'})
+            keep.add(provisioned)
+        if registered and registered != provisioned:
+            route, created = self.get_or_create(address=registered, defaults={'mailbox': mailbox, 'kind': 'R'})
+            if not created and route.kind == 'R' and route.mailbox_id not in (mailbox.pk, None):
+                route.mailbox = None
+                route.save()
+            keep.add(registered)
+        self.filter(mailbox=mailbox).exclude(address__in=keep).delete()
+        self.invalidate()
+
+
+class MailRoute(models.Model):
+    '''
+    inbound routing table for new_msg
+    '''
+    address = models.CharField(max_length=254, unique=True)
+    mailbox = models.ForeignKey(MailBox, null=True, blank=True, on_delete=models.CASCADE, related_name='routes')
+    kind = models.CharField(max_length=1, choices=ROUTE_KINDS)
+
+    objects = MailRouteManager()
+
+    def __unicode__(self):
+        return self.address
+
+
+class PopUid(models.Model):
+    '''
+    a POP3 unique id already downloaded into a mailbox, so polling only
+    fetches what's new
+    '''
+    mailbox = models.ForeignKey(MailBox, on_delete=models.CASCADE, related_name='pop_uids')
+    #RFC 1939 caps a unique-id at 70 characters
+    uid = models.CharField(max_length=70)
+    seen = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = (('mailbox', 'uid'),)
+
+    def __unicode__(self):
+        return self.uid
+
+
+@receiver(post_save, sender=MailBox)
+def route_mailbox(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        MailRoute.objects.sync(instance)
+
+
+@receiver(post_save, sender=django.contrib.auth.models.User)
+def route_registered_email(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and 'email' not in update_fields):
+        return
+    for mailbox in MailBox.objects.filter(usr=instance).select_related('usr'):
+        MailRoute.objects.sync(mailbox)
+
+
+@receiver(post_delete, sender=MailRoute)
+def drop_mail_route(sender, instance, **kwargs):
+    MailRoute.objects.invalidate()
@@ -0,0 +1,144 @@
+'''
+Incremental POP3 polling. The unique ids (UIDL) of messages a mailbox has
+downloaded are kept in PopUid, so each poll only retrieves what the server
+hasn't shown us before. Mailboxes are polled from a bounded thread pool
+since the time goes to waiting on the network, raw messages are parsed in
+a process pool, and everything touching the database stays on the calling
+thread.
+'''
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+
+from apps.mail.models import MailBox, PopUid
+
+import email
+import logging
+import poplib
+
+logger = logging.getLogger('default')
+
+POLL_WORKERS = 8
+PARSE_WORKERS = 2
+#below this many messages starting processes costs more than it saves
+PARSE_POOL_MIN = 20
+POP_TIMEOUT = 30
+
+
+def pop_server():
+    return (settings.MAILGUN_POP, getattr(settings, 'MAILGUN_POP_PORT', poplib.POP3_PORT))
+
+
+def fetch_new(address, password, known, host=None, port=None):
+    '''
+    (uids on the server, [(uid, raw message)]) for the messages whose uid
+    isn't in known. Doesn't touch the database so it can run in a thread.
+    '''
+    default_host, default_port = pop_server()
+    conn = poplib.POP3(host or default_host, port or default_port, timeout=POP_TIMEOUT)
+    try:
+        conn.user(address)
+        conn.pass_(password)
+        resp, listing, octets = conn.uidl()
+        server_uids = []
+        fetched = []
+        for line in listing:
+            num, uid = line.decode('ascii', 'replace').split(None, 1)
+            server_uids.append(uid)
+            if uid not in known:
+                fetched.append((uid, b'\r\n'.join(conn.retr(int(num))[1])))
+        return server_uids, fetched
+    finally:
+        try:
+            conn.quit()
+        except (poplib.error_proto, OSError):
+            pass
+
+
+def parse_raw(raw):
+    return email.message_from_bytes(raw)
+
+
+def parse_all(raws, workers=PARSE_WORKERS):
+    '''
+    email.message.Message for every raw message, in order
+    '''
+    raws = list(raws)
+    if not workers or len(raws) < PARSE_POOL_MIN:
+        return [parse_raw(raw) for raw in raws]
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(parse_raw, raws, chunksize=max(1, len(raws) // (workers * 4))))
+    except (AssertionError, OSError, RuntimeError) as e:
+        #daemonic processes (celery workers) can't start children, a broken pool raises RuntimeError
+        logger.warning('parse pool unavailable, parsing %s messages serially e=%s' % (len(raws), e))
+        return [parse_raw(raw) for raw in raws]
+
+
+def store(mailbox, message):
+    '''
+    True if message became a new MailMessage in mailbox, duplicates are skipped
+    '''
+    parsed = mailbox.parse_message_poptres(message)
+    if parsed is None:
+        return False
+    mail_msg, inreply = parsed
+    mailbox.store_message(mail_msg, inreply, {})
+    return True
+
+
+def poll_mailboxes(mailboxes=None, workers=POLL_WORKERS, parse_workers=PARSE_WORKERS, host=None, port=None,
+                   password=None):
+    '''
+    download and store new mail for mailboxes (all of them by default),
+    at most workers POP3 connections at a time. A mailbox whose server
+    can't be reached is skipped and tried again next time. Returns a
+    summary dict.
+    '''
+    if mailboxes is None:
+        mailboxes = MailBox.objects.select_related('usr')
+    mailboxes = list(mailboxes)
+    summary = {'mailboxes': len(mailboxes), 'fetched': 0, 'stored': 0, 'errors': 0}
+    if not mailboxes:
+        return summary
+
+    known = defaultdict(set)
+    for mailbox_id, uid in PopUid.objects.filter(mailbox__in=mailboxes).values_list('mailbox_id', 'uid'):
+        known[mailbox_id].add(uid)
+    #provisioned addresses may hit the database, so look them up before the threads start
+    addresses = dict((mailbox.pk, mailbox.get_provisioned_email()) for mailbox in mailboxes)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(mailboxes)))) as pool:
+        futures = dict((pool.submit(fetch_new, addresses[mailbox.pk], password or mailbox.get_password(),
+                                    known[mailbox.pk], host, port), mailbox)
+                       for mailbox in mailboxes)
+        for future in as_completed(futures):
+            mailbox = futures[future]
+            try:
+                server_uids, fetched = future.result()
+            except (poplib.error_proto, OSError) as e:
+                logger.warning('pop3 poll failed mailbox=%s e=%s' % (mailbox.pk, e))
+                summary['errors'] += 1
+                continue
+            results.append((mailbox, server_uids, fetched))
+
+    messages = iter(parse_all([raw for _, _, fetched in results for _, raw in fetched], parse_workers))
+    for mailbox, server_uids, fetched in results:
+        for uid, raw in fetched:
+            message = next(messages)
+            try:
+                if store(mailbox, message):
+                    summary['stored'] += 1
+            except Exception as e:
+                #recorded as seen anyway, a message that can't be parsed won't parse next time either
+                logger.exception('cant store pop3 message mailbox=%s uid=%s e=%s' % (mailbox.pk, uid, e))
+        summary['fetched'] += len(fetched)
+        PopUid.objects.bulk_create([PopUid(mailbox=mailbox, uid=uid) for uid, _ in fetched], ignore_conflicts=True)
+        #forget uids the server no longer has
+        stale = known[mailbox.pk] - set(server_uids)
+        if stale:
+            PopUid.objects.filter(mailbox=mailbox, uid__in=stale).delete()
+    logger.info('pop3 poll %s' % summary)
+    return summary
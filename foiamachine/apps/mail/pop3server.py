@@ -0,0 +1,163 @@
+'''
+A small in-memory POP3 server (RFC 1939: USER/PASS, STAT, LIST, UIDL, RETR,
+DELE, RSET, NOOP, CAPA, QUIT) standing in for Mailgun's in tests and local
+development.
+
+    with FakePOP3Server() as server:
+        server.add_account('john@example.com', 'secret')
+        server.deliver('john@example.com', raw_message)
+        poll_mailboxes(host=server.host, port=server.port, password='secret')
+'''
+import itertools
+import socketserver
+import threading
+
+
+class POP3Handler(socketserver.StreamRequestHandler):
+
+    def send(self, line):
+        self.wfile.write(line.encode('utf-8') + b'\r\n')
+
+    def send_lines(self, status, lines):
+        self.send(status)
+        for line in lines:
+            #byte-stuff lines starting with the terminator
+            self.wfile.write((b'.' + line if line.startswith(b'.') else line) + b'\r\n')
+        self.wfile.write(b'.\r\n')
+
+    def message(self, arg):
+        try:
+            index = int(arg) - 1
+        except (TypeError, ValueError):
+            return None
+        if 0 <= index < len(self.maildrop) and index not in self.deleted:
+            return self.maildrop[index]
+        return None
+
+    def handle(self):
+        server = self.server
+        user = None
+        self.maildrop = None
+        self.deleted = set()
+        self.send('+OK fake pop3 ready')
+        for raw in self.rfile:
+            parts = raw.decode('utf-8', 'replace').strip().split(None, 1)
+            if not parts:
+                continue
+            command, arg = parts[0].upper(), parts[1] if len(parts) > 1 else None
+            if command == 'QUIT':
+                if self.maildrop is not None:
+                    server.expunge(user, [self.maildrop[i][0] for i in self.deleted])
+                self.send('+OK bye')
+                return
+            if command == 'CAPA':
+                self.send_lines('+OK', [b'USER', b'UIDL'])
+            elif command == 'NOOP':
+                self.send('+OK')
+            elif self.maildrop is None:
+                if command == 'USER':
+                    user = arg
+                    self.send('+OK')
+                elif command == 'PASS' and server.authenticate(user, arg):
+                    #the maildrop is fixed for the session, like a real server locks it
+                    self.maildrop = server.messages(user)
+                    self.send('+OK logged in')
+                else:
+                    self.send('-ERR not authenticated')
+            elif command == 'STAT':
+                live = [raw for i, (uid, raw) in enumerate(self.maildrop) if i not in self.deleted]
+                self.send('+OK %s %s' % (len(live), sum(len(raw) for raw in live)))
+            elif command in ('LIST', 'UIDL'):
+                def describe(i, uid, raw):
+                    return '%s %s' % (i + 1, uid if command == 'UIDL' else len(raw))
+                if arg is not None:
+                    found = self.message(arg)
+                    if found is None:
+                        self.send('-ERR no such message')
+                    else:
+                        self.send('+OK ' + describe(int(arg) - 1, *found))
+                else:
+                    self.send_lines('+OK', [describe(i, uid, raw).encode('utf-8')
+                                            for i, (uid, raw) in enumerate(self.maildrop) if i not in self.deleted])
+            elif command == 'RETR':
+                found = self.message(arg)
+                if found is None:
+                    self.send('-ERR no such message')
+                else:
+                    server.retrieved.append((user, found[0]))
+                    self.send_lines('+OK %s octets' % len(found[1]), found[1].splitlines())
+            elif command == 'DELE':
+                if self.message(arg) is None:
+                    self.send('-ERR no such message')
+                else:
+                    self.deleted.add(int(arg) - 1)
+                    self.send('+OK deleted')
+            elif command == 'RSET':
+                self.deleted = set()
+                self.send('+OK')
+            else:
+                self.send('-ERR unknown command')
+
+
+class FakePOP3Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), POP3Handler)
+        self.lock = threading.Lock()
+        self.accounts = {}
+        self.retrieved = []
+        self.uids = itertools.count(1)
+        self.thread = None
+
+    @property
+    def host(self):
+        return self.server_address[0]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def add_account(self, user, password):
+        with self.lock:
+            self.accounts[user] = {'password': password, 'messages': []}
+
+    def deliver(self, user, raw, uid=None):
+        '''
+        add a message to user's maildrop, returns its unique id
+        '''
+        if not isinstance(raw, bytes):
+            raw = raw.encode('utf-8')
+        with self.lock:
+            uid = uid or 'uid-%s' % next(self.uids)
+            self.accounts[user]['messages'].append((uid, raw))
+        return uid
+
+    def authenticate(self, user, password):
+        with self.lock:
+            return user in self.accounts and self.accounts[user]['password'] == password
+
+    def messages(self, user):
+        with self.lock:
+            return list(self.accounts[user]['messages'])
+
+    def expunge(self, user, uids):
+        with self.lock:
+            account = self.accounts[user]
+            account['messages'] = [(uid, raw) for uid, raw in account['messages'] if uid not in uids]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
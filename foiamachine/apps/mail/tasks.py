@@ -0,0 +1,27 @@
+"""
+Background POP3 polling
+"""
+
+from celery import shared_task
+
+
+@shared_task
+def poll_mail():
+    """
+    Download new mail for every mailbox, see apps.mail.poller. The
+    poll_mail command parses in a process pool, this task can't
+    """
+    from .poller import poll_mailboxes
+    #celery's pool processes are daemonic and can't start a parse pool
+    return poll_mailboxes(parse_workers=0)
+
+
+@shared_task
+def extract_attachment_text(attachment_ids):
+    """
+    Extract the text of newly stored attachments, see apps.mail.extraction
+    """
+    from .attachment import Attachment
+    from .extraction import extract_attachments
+    attachments = Attachment.objects.filter(pk__in=attachment_ids).select_related('blob')
+    return extract_attachments(attachments, workers=0)
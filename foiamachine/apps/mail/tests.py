@@ -1,6 +1,7 @@
 import apps
 from django.test import TestCase
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 
 class EMailTest(TestCase):
@@ -50,3 +51,442 @@ class EMailTest(TestCase):
 
         # Finish
         self.assertEqual(1 + 1, 2)
+
+
+class AttachmentStoreTest(TestCase):
+
+    def setUp(self):
+        from django.test.utils import override_settings
+        self.settings_override = override_settings(USE_S3=False)
+        self.settings_override.enable()
+        self.user = User.objects.create_user('john', 'lennon@thebeatles.com', 'secret')
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def test_identical_files_share_a_blob(self):
+        from django.core.files.base import ContentFile
+        from apps.mail.attachment import Attachment, AttachmentBlob
+        first = Attachment.objects.store(self.user, 'letter.pdf', ContentFile(b'%PDF-1.4 same bytes'))
+        second = Attachment.objects.store(self.user, 'copy of letter.pdf', ContentFile(b'%PDF-1.4 same bytes'))
+        other = Attachment.objects.store(self.user, 'other.pdf', ContentFile(b'%PDF-1.4 other bytes'))
+
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertNotEqual(first.blob_id, other.blob_id)
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(second.get_filename, 'copy of letter.pdf')
+        blob = AttachmentBlob.objects.get(id=first.blob_id)
+        self.assertEqual(blob.refcount, 2)
+
+        first.delete()
+        blob = AttachmentBlob.objects.get(id=first.blob_id)
+        self.assertEqual(blob.refcount, 1)
+        self.assertTrue(blob.file.storage.exists(blob.file.name))
+
+        name = blob.file.name
+        second.delete()
+        self.assertFalse(AttachmentBlob.objects.filter(id=first.blob_id).exists())
+        self.assertFalse(blob.file.storage.exists(name))
+        other.delete()
+
+
+class ThreadLookupTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('john', 'lennon@thebeatles.com', 'secret')
+        self.mailbox = apps.mail.models.MailBox.objects.create(usr=self.user)
+
+    def create_request(self, title):
+        return apps.requests.models.Request.objects.create(author=self.user, title=title)
+
+    def test_codes_are_allocated_once(self):
+        from apps.requests.models import ThreadLookup
+        req = self.create_request('first')
+        self.assertTrue(req.thread_lookup.startswith('LOOKUP:'))
+        self.assertEqual(list(req.lookups.values_list('token', flat=True)), [req.thread_lookup])
+
+        #a taken code is replaced, not shared
+        other = self.create_request('second')
+        ThreadLookup.objects.filter(request=other).delete()
+        lookup = ThreadLookup.objects.allocate(other, code=req.thread_lookup)
+        self.assertNotEqual(lookup.token, req.thread_lookup)
+        self.assertEqual(apps.requests.models.Request.objects.get(id=other.id).thread_lookup, lookup.token)
+
+    def test_lookup_thread_matches_all_codes(self):
+        from apps.mail.models import MailMessage
+        unsent = self.create_request('unsent')
+        sent = self.create_request('sent')
+        root = MailMessage.objects.create(email_from='a@example.com', subject='root', body='root', request=sent,
+                                          direction='S', dated=timezone.now())
+
+        reply = MailMessage.objects.create(email_from='b@example.com', subject='Re: %s' % sent.thread_lookup,
+            body='quoting %s and %s and LOOKUP:doesnotexist' % (unsent.thread_lookup, unsent.thread_lookup),
+            direction='R', dated=timezone.now())
+        self.mailbox.lookup_thread(reply)
+        self.assertEqual(MailMessage.objects.get(id=reply.id).request_id, unsent.id)
+        self.assertEqual(list(root.replies.values_list('id', flat=True)), [reply.id])
+
+
+class MailRouteTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('john', 'lennon@thebeatles.com', 'secret')
+        self.mailbox = apps.mail.models.MailBox.objects.create(usr=self.user)
+
+    def test_provisioned_and_registered_addresses_route(self):
+        from apps.mail.models import MailRoute
+        provisioned = self.mailbox.get_provisioned_email()
+        routes = MailRoute.objects.resolve(['John <%s>' % provisioned.upper(), 'lennon@thebeatles.com', 'nobody@example.com'])
+        self.assertEqual(routes, {'John <%s>' % provisioned.upper(): self.mailbox.id,
+                                  'lennon@thebeatles.com': self.mailbox.id})
+
+    def test_shared_registered_address_routes_nowhere(self):
+        from apps.mail.models import MailRoute
+        other = User.objects.create_user('yoko', 'lennon@thebeatles.com', 'secret')
+        mailbox = apps.mail.models.MailBox.objects.create(usr=other)
+        self.assertEqual(MailRoute.objects.resolve(['lennon@thebeatles.com']), {})
+        self.assertEqual(MailRoute.objects.resolve([mailbox.get_provisioned_email()]),
+                         {mailbox.get_provisioned_email(): mailbox.id})
+
+    def test_email_change_invalidates_routes(self):
+        from apps.mail.models import MailRoute
+        self.assertEqual(MailRoute.objects.resolve(['lennon@thebeatles.com']), {'lennon@thebeatles.com': self.mailbox.id})
+        self.user.email = 'john@thebeatles.com'
+        self.user.save()
+        self.assertEqual(MailRoute.objects.resolve(['lennon@thebeatles.com']), {})
+        self.assertEqual(MailRoute.objects.resolve(['john@thebeatles.com']), {'john@thebeatles.com': self.mailbox.id})
+
+    def test_misses_and_routes_expire(self):
+        from unittest import mock
+        from apps.mail import models
+        from apps.mail.models import MailRoute
+        self.assertEqual(MailRoute.objects.resolve(['ringo@thebeatles.com']), {})
+        #rows written without a version bump, as another process with its own cache would
+        MailRoute.objects.create(address='ringo@thebeatles.com', mailbox=self.mailbox, kind='R')
+        self.assertEqual(MailRoute.objects.resolve(['ringo@thebeatles.com']), {})
+        with mock.patch.object(models, 'ROUTE_MISS_SECONDS', 0):
+            MailRoute.objects.invalidate()
+            MailRoute.objects.resolve(['nobody@example.com'])
+            MailRoute.objects.create(address='nobody@example.com', mailbox=self.mailbox, kind='R')
+            self.assertEqual(MailRoute.objects.resolve(['nobody@example.com']),
+                             {'nobody@example.com': self.mailbox.id})
+        self.assertEqual(MailRoute.objects.resolve(['ringo@thebeatles.com']), {'ringo@thebeatles.com': self.mailbox.id})
+        MailRoute.objects.filter(address='ringo@thebeatles.com').update(mailbox=None)
+        self.assertEqual(MailRoute.objects.resolve(['ringo@thebeatles.com']), {'ringo@thebeatles.com': self.mailbox.id})
+        with mock.patch.object(models, 'ROUTE_MEMORY_SECONDS', -1):
+            self.assertEqual(MailRoute.objects.resolve(['ringo@thebeatles.com']), {})
+
+
+class PopPollTest(TestCase):
+
+    def setUp(self):
+        from apps.mail.pop3server import FakePOP3Server
+        self.server = FakePOP3Server().start()
+        self.mailboxes = []
+        for name in ('john', 'yoko', 'ringo'):
+            user = User.objects.create_user(name, '%s@thebeatles.com' % name, 'secret')
+            mailbox = apps.mail.models.MailBox.objects.create(usr=user)
+            self.server.add_account(mailbox.get_provisioned_email(), 'secret')
+            self.mailboxes.append(mailbox)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def deliver(self, mailbox, subject):
+        return self.server.deliver(mailbox.get_provisioned_email(),
+            'From: agency@example.com\r\nTo: %s\r\nSubject: %s\r\nMessage-Id: <%s@example.com>\r\n\r\n%s body\r\n'
+            % (mailbox.get_provisioned_email(), subject, subject, subject))
+
+    def poll(self, **kwargs):
+        from apps.mail.poller import poll_mailboxes
+        return poll_mailboxes(self.mailboxes, host=self.server.host, port=self.server.port, password='secret',
+                              **kwargs)
+
+    def test_only_new_messages_are_downloaded(self):
+        from apps.mail.models import PopUid
+        john, yoko, ringo = self.mailboxes
+        self.deliver(john, 'one')
+        self.deliver(john, 'two')
+        self.deliver(yoko, 'three')
+        summary = self.poll(workers=2, parse_workers=0)
+        self.assertEqual((summary['fetched'], summary['errors']), (3, 0))
+        self.assertEqual(PopUid.objects.filter(mailbox=john).count(), 2)
+
+        self.assertEqual(self.poll(parse_workers=0)['fetched'], 0)
+        self.assertEqual(len(self.server.retrieved), 3)
+
+        uid = self.deliver(ringo, 'four')
+        self.assertEqual(self.poll(parse_workers=0)['fetched'], 1)
+        self.assertEqual(self.server.retrieved[-1], (ringo.get_provisioned_email(), uid))
+
+    def test_unreachable_mailbox_is_retried(self):
+        john = self.mailboxes[0]
+        self.deliver(john, 'one')
+        self.server.accounts[john.get_provisioned_email()]['password'] = 'changed'
+        summary = self.poll(parse_workers=0)
+        self.assertEqual((summary['fetched'], summary['errors']), (0, 1))
+
+        self.server.accounts[john.get_provisioned_email()]['password'] = 'secret'
+        self.assertEqual(self.poll(parse_workers=0)['fetched'], 1)
+
+    def test_parsing_falls_back_to_serial(self):
+        from unittest import mock
+        from apps.mail import poller
+        raws = [('Subject: message %s\r\n\r\nbody\r\n' % i).encode('utf-8') for i in range(poller.PARSE_POOL_MIN)]
+        refused = AssertionError('daemonic processes are not allowed to have children')
+        with mock.patch.object(poller, 'ProcessPoolExecutor', side_effect=refused):
+            parsed = poller.parse_all(raws, workers=2)
+        self.assertEqual([m['Subject'] for m in parsed], ['message %s' % i for i in range(poller.PARSE_POOL_MIN)])
+
+    def test_attachments_survive_storing(self):
+        from apps.mail.models import MailMessage
+        john = self.mailboxes[0]
+        self.server.deliver(john.get_provisioned_email(),
+            'From: agency@example.com\r\nTo: %s\r\nSubject: records\r\nMessage-Id: <records@example.com>\r\n'
+            'MIME-Version: 1.0\r\nContent-Type: multipart/mixed; boundary="part"\r\n\r\n'
+            '--part\r\nContent-Type: text/plain\r\n\r\nrecords attached\r\n'
+            '--part\r\nContent-Type: text/plain\r\nContent-Disposition: attachment; filename="records.txt"\r\n\r\n'
+            'the records\r\n--part--\r\n' % john.get_provisioned_email())
+        with self.settings(USE_S3=False):
+            self.assertEqual(self.poll(parse_workers=0)['stored'], 1)
+            message = MailMessage.objects.get(message_id='<records@example.com>')
+            attachments = list(message.attachments.all())
+            self.assertEqual([atch.get_filename for atch in attachments], ['records.txt'])
+            for atch in attachments:
+                atch.delete()
+
+    def test_process_pool_parses_like_serial(self):
+        from apps.mail.poller import PARSE_POOL_MIN, parse_all
+        raws = [('Subject: message %s\r\n\r\nbody\r\n' % i).encode('utf-8') for i in range(PARSE_POOL_MIN)]
+        self.assertEqual([m['Subject'] for m in parse_all(raws, workers=2)],
+                         [m['Subject'] for m in parse_all(raws, workers=0)])
+
+
+class MessageBodyTest(TestCase):
+
+    def test_body_is_normalized_on_save(self):
+        from apps.mail.models import MailMessage
+        message = MailMessage.objects.create(email_from='agency@example.com', subject='records',
+            body='<p>Dear  requester,</p><p>Attached &amp; enclosed<br>records.</p><script>bad()</script>')
+        self.assertEqual(message.body_text, 'Dear requester,\n\nAttached & enclosed\nrecords.')
+        self.assertNotIn('<script>', message.body_html)
+        self.assertEqual(message.preview, 'Dear requester, Attached & enclosed records.')
+
+        message.body = 'edited'
+        message.save(update_fields=['body'])
+        message = MailMessage.objects.get(id=message.id)
+        self.assertEqual((message.body_text, message.plain_text_body), ('edited', 'edited'))
+
+    def test_allowed_styles_are_kept(self):
+        from apps.mail.bodies import sanitize_html
+        html = sanitize_html('<p style="font-weight: bold; position: fixed;">records</p>')
+        self.assertIn('font-weight: bold;', html)
+        self.assertNotIn('position', html)
+
+    def test_backfill_fills_missing_bodies(self):
+        from django.core.management import call_command
+        from apps.mail.models import MailMessage
+        import io
+        message = MailMessage.objects.create(email_from='agency@example.com', subject='old', body='<b>old</b> body')
+        MailMessage._base_manager.filter(id=message.id).update(body_text=None, body_html=None, preview='')
+        call_command('backfill_message_bodies', batch_size=1, stdout=io.StringIO())
+        message = MailMessage.objects.get(id=message.id)
+        self.assertEqual((message.body_text, message.preview), ('old body', 'old body'))
+
+
+WORD_XML = (
+    '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+    '<w:p><w:r><w:t>Records request</w:t></w:r></w:p>'
+    '<w:p><w:r><w:t xml:space="preserve">Dear </w:t></w:r><w:r><w:t>clerk,</w:t></w:r></w:p>'
+    '<w:p><w:r><w:br w:type="page"/><w:t>Page two</w:t></w:r></w:p>'
+    '</w:body></w:document>'
+)
+
+SHEET_MAIN = 'xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+
+
+def make_zip(files):
+    import io
+    import zipfile
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return data.getvalue()
+
+
+def make_docx():
+    return make_zip({'word/document.xml': WORD_XML})
+
+
+def make_xlsx():
+    return make_zip({
+        'xl/workbook.xml': '<workbook %s xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            '<sheets><sheet name="Budget" sheetId="1" r:id="rId1"/><sheet name="Empty" sheetId="2" r:id="rId2"/>'
+            '</sheets></workbook>' % SHEET_MAIN,
+        'xl/_rels/workbook.xml.rels': '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Target="worksheets/sheet1.xml"/>'
+            '<Relationship Id="rId2" Target="worksheets/sheet2.xml"/></Relationships>',
+        'xl/sharedStrings.xml': '<sst %s><si><t>Item</t></si><si><t>Cost</t></si></sst>' % SHEET_MAIN,
+        'xl/worksheets/sheet1.xml': '<worksheet %s><sheetData>'
+            '<row r="1"><c r="A1" t="s"><v>0</v></c><c r="B1" t="s"><v>1</v></c></row>'
+            '<row r="2"><c r="A2" t="inlineStr"><is><t>Paper</t></is></c><c r="B2"><v>12.5</v></c></row>'
+            '</sheetData></worksheet>' % SHEET_MAIN,
+        'xl/worksheets/sheet2.xml': '<worksheet %s><sheetData/></worksheet>' % SHEET_MAIN,
+    })
+
+
+class AttachmentTextTest(TestCase):
+
+    def setUp(self):
+        from django.test.utils import override_settings
+        self.settings_override = override_settings(USE_S3=False, ATTACHMENT_OCR='')
+        self.settings_override.enable()
+        self.user = User.objects.create_user('john', 'lennon@thebeatles.com', 'secret')
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def test_docx_pages_have_offsets(self):
+        from apps.mail.attachment import AttachmentText
+        from apps.mail.extraction import extract
+        fields = extract(make_docx(), 'letter.docx')
+        self.assertEqual((fields['status'], fields['method']), ('ok', 'docx'))
+        self.assertEqual(fields['text'], 'Records request\nDear clerk,\n\nPage two')
+        text = AttachmentText(**fields)
+        self.assertEqual([page['number'] for page in text.pages], [1, 2])
+        self.assertEqual(text.page_text(1), 'Records request\nDear clerk,')
+        self.assertEqual(text.page_text(2), 'Page two')
+        self.assertIsNone(text.page_text(3))
+
+    def test_xlsx_has_a_page_per_sheet(self):
+        from apps.mail.extraction import extract
+        fields = extract(make_xlsx(), 'budget.xlsx')
+        self.assertEqual(fields['method'], 'xlsx')
+        self.assertEqual(fields['text'], 'Budget\nItem\tCost\nPaper\t12.5\n\nEmpty')
+        self.assertEqual(len(fields['pages']), 2)
+
+    def test_unknown_files_are_unsupported(self):
+        from apps.mail.extraction import extract
+        self.assertEqual(extract(b'\x00\x01binary', 'photo.bin')['status'], 'unsupported')
+        self.assertEqual(extract(b'PK not really a zip', 'broken.docx')['status'], 'unsupported')
+
+    def test_text_is_extracted_once_per_content(self):
+        from django.core.files.base import ContentFile
+        from apps.mail.attachment import Attachment, AttachmentText
+        from apps.mail.extraction import attachment_texts, extract_attachments
+        first = Attachment.objects.store(self.user, 'letter.docx', ContentFile(make_docx()))
+        second = Attachment.objects.store(self.user, 'copy.docx', ContentFile(make_docx()))
+        notes = Attachment.objects.store(self.user, 'notes.txt', ContentFile(b'plain notes'))
+
+        self.assertEqual(extract_attachments([first, second, notes], workers=0), 2)
+        self.assertEqual(extract_attachments([first, second, notes], workers=0), 0)
+        self.assertEqual(AttachmentText.objects.count(), 2)
+        self.assertEqual(extract_attachments([first], workers=0, reextract=True), 1)
+
+        texts = attachment_texts([first.pk, second.pk, notes.pk], extract_missing=False)
+        self.assertEqual(texts[first.pk].pk, texts[second.pk].pk)
+        self.assertEqual(texts[notes.pk].text, 'plain notes')
+        for atch in (first, second, notes):
+            atch.delete()
+
+    def test_failures_and_scans_are_tried_again(self):
+        from unittest import mock
+        from django.core.files.base import ContentFile
+        from apps.mail import extraction
+        from apps.mail.attachment import Attachment, AttachmentText
+        from apps.mail.extraction import extract_attachments
+        photo = Attachment.objects.store(self.user, 'photo.bin', ContentFile(b'\x00\x01binary'))
+        blank = Attachment.objects.store(self.user, 'blank.txt', ContentFile(b'   '))
+        self.assertEqual(extract_attachments([photo, blank], workers=0), 2)
+        self.assertEqual(AttachmentText.objects.get(sha256=photo.blob.sha256).status, 'unsupported')
+        self.assertEqual(AttachmentText.objects.get(sha256=blank.blob.sha256).status, 'empty')
+        #neither is read again until what extraction can read changes
+        self.assertEqual(extract_attachments([photo, blank], workers=0), 0)
+        with mock.patch.object(extraction, 'HAS_PYPDF', not extraction.HAS_PYPDF):
+            self.assertEqual(extract_attachments([photo], workers=0), 1)
+        with self.settings(ATTACHMENT_OCR='apps.mail.extraction.TesseractOCR'):
+            self.assertEqual(extract_attachments([blank], workers=0), 1)
+            self.assertEqual(extract_attachments([blank], workers=0), 0)
+        for atch in (photo, blank):
+            atch.delete()
+
+    def test_process_pool_extracts_like_serial(self):
+        from apps.mail.extraction import EXTRACT_POOL_MIN, extract_job
+        from concurrent.futures import ProcessPoolExecutor
+        jobs = [(make_docx(), 'letter.docx', ''), (make_xlsx(), 'budget.xlsx', '')]
+        jobs += [(('note %s' % i).encode('utf-8'), 'note.txt', '') for i in range(EXTRACT_POOL_MIN)]
+        with ProcessPoolExecutor(max_workers=2) as pool:
+            self.assertEqual(list(pool.map(extract_job, jobs)), [extract_job(job) for job in jobs])
+
+
+class MessageListQueriesTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('john', 'lennon@thebeatles.com', 'secret')
+        self.mailbox = apps.mail.models.MailBox.objects.create(usr=self.user)
+        self.request = apps.requests.models.Request.objects.create(author=self.user, title='thread')
+        self.root = self.add_message('root')
+        self.client.login(username='john', password='secret')
+
+    def add_message(self, subject, parent=None):
+        from apps.core.models import EmailAddress
+        from apps.mail.models import MailMessage
+        message = MailMessage.objects.create(email_from='agency@example.com', subject=subject, body=subject,
+                                             request=self.request, dated=timezone.now())
+        message.to.add(EmailAddress.objects.get_or_create(content='lennon@thebeatles.com')[0])
+        message.cc.add(EmailAddress.objects.get_or_create(content='cc@example.com')[0])
+        self.mailbox.messages.add(message)
+        if parent is not None:
+            parent.replies.add(message)
+        return message
+
+    def count_queries(self, func):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as context:
+            func()
+        return len(context)
+
+    def test_thread_queries_dont_grow_with_thread(self):
+        self.add_message('reply 1', self.root)
+        short = self.count_queries(lambda: [list(m.to.all()) + list(m.attachments.all())
+                                            for m in self.mailbox.get_threads(self.request.id)])
+        for i in range(5):
+            self.add_message('reply %s' % (i + 2), self.root)
+        threads = []
+        long = self.count_queries(lambda: threads.extend([list(m.to.all()) + list(m.attachments.all())
+                                                          for m in self.mailbox.get_threads(self.request.id)]))
+        self.assertEqual(len(threads), 7)
+        self.assertEqual(short, long)
+
+    def test_message_list_queries_dont_grow_with_page(self):
+        self.add_message('reply 1', self.root)
+        short = self.count_queries(lambda: self.client.get('/api/v1/message/?format=json'))
+        for i in range(5):
+            self.add_message('reply %s' % (i + 2), self.root)
+        long = self.count_queries(lambda: self.client.get('/api/v1/message/?format=json'))
+        self.assertEqual(short, long)
+
+    def test_sparse_fields_and_null_dated(self):
+        import json
+        from apps.mail.models import MailMessage
+        MailMessage.objects.filter(id=self.root.id).update(dated=None)
+        self.add_message('reply', self.root)
+        resp = self.client.get('/api/v1/message/?format=json&fields=subject,dated,replies')
+        self.assertEqual(resp.status_code, 200)
+        objects = json.loads(resp.content)['objects']
+        self.assertEqual(set(objects[0].keys()), set(['id', 'subject', 'dated', 'replies', 'resource_uri']))
+        root = [obj for obj in objects if obj['id'] == self.root.id][0]
+        self.assertEqual(root['dated'], None)
+        self.assertEqual(len(root['replies']), 1)
+
+        resp = self.client.get('/api/v1/message/?format=json&fields=nope')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_anonymous_users_see_no_messages(self):
+        import json
+        self.client.logout()
+        resp = self.client.get('/api/v1/message/?format=json')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content)['objects'], [])
@@ -2,7 +2,8 @@ from django.shortcuts import get_object_or_404, render_to_response, redirect
 from django.http import HttpResponse, HttpResponseRedirect, HttpResponseGone, Http404,HttpResponseBadRequest
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import ListView, DetailView, RedirectView
-from apps.mail.models import MailMessage, MailBox, Attachment
+from apps.core.pagination import KeysetPaginationMixin
+from apps.mail.models import MailMessage, MailBox, MailRoute, Attachment
 from apps.requests.models import Request
 from django.utils.decorators import method_decorator
 from django.contrib.auth.decorators import login_required
@@ -40,11 +41,8 @@ def attachment_upload(request):
     form = UploadFileForm(request.POST, request.FILES)
 
     if form.is_valid():
-        atch = Attachment()
-        atch.user = request.user
         f = request.FILES['file']
-        atch.file.save(f.name, f)
-        atch.save()
+        atch = Attachment.objects.store(request.user, f.name, f)
         return render_to_response('mail/file_upload_response.json', {"attachment": atch.id, "url": atch.url, "filename": atch.get_filename}, context_instance = RequestContext(request))
     else:
         return HttpResponseBadRequest('File too large')
@@ -57,17 +55,24 @@ def new_msg(request):
     message, inreply = MailBox.parse_message_http(request.POST)
     messages = message.get_email_addresses()
     logger.debug('INCOMING: emails=%s files=%s' % (messages, request.FILES))
+    routes = MailRoute.objects.resolve(messages)
+    mailboxes = MailBox.objects.select_related('usr').in_bulk(set(routes.values()))
+    delivered = set()
     for email in messages:
+        mb = mailboxes.get(routes.get(email))
+        if mb is None:
+            #generally just indicates we can't find the inbox
+            logger.debug('incoming: no inbox for email=%s' % email)
+            continue
+        if mb.pk in delivered:
+            continue
+        delivered.add(mb.pk)
         try:
-            mb = MailBox.objects.get(provisioned_email=email)\
-                if MailBox.objects.filter(provisioned_email=email).count() > 0\
-                else MailBox.objects.get(usr__email=email)
             logger.debug('INCOMING: found inbox for email=%s mb=%s' % (email, mb.pk))
             mb.messages.add(message)
             mb.store_message(message, inreply, request.FILES)
         except Exception as e:
-            #generally just indicates we can't find the inbox
-            logger.debug('incoming: email=%s exception=%s' % (email, e))
+            logger.exception('incoming: email=%s exception=%s' % (email, e))
     return HttpResponse('OK')
 
 
@@ -93,7 +98,7 @@ def s3_file_view(request, rpk, pk):
     can_view = user.has_perm(Request.get_permission_name('view'), therequest)
     if not can_view:
         return render_to_response('403.html', {}, context_instance=RequestContext(request))
-    return HttpResponseRedirect(attachment.file.url)
+    return HttpResponseRedirect(attachment.get_download_url())
 
 
 @login_required
@@ -166,15 +171,17 @@ class MailRequestListView(ListView):
         return super(MailRequestListView, self).dispatch(*args, **kwargs)
 
 
-class MailBoxMailListView(ListView):
+class MailBoxMailListView(KeysetPaginationMixin, ListView):
     """
     Main view showing the list of all user's requests. Used as an index page.
     """
     context_object_name = 'mail_messages'
     template_name = 'mail/mail_request_list.html'
+    paginate_by = 25
+    keyset_ordering = ('-dated', '-id')
 
     def get_queryset(self):
-        return MailBox.objects.get(usr=self.request.user).messages.all()
+        return MailBox.objects.get(usr=self.request.user).messages.all().order_by(*self.keyset_ordering)
 
     def get_context_data(self, **kwargs):
         context = super(MailBoxMailListView, self).get_context_data(**kwargs)
@@ -0,0 +1,122 @@
+'''
+Status and privacy changes on many requests at once. Edit permission is
+checked for the whole selection in one query and the changes are written
+with a single UPDATE, the public group's view permission is granted or
+revoked with bulk statements instead of Request.save() per request.
+'''
+from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from guardian.models import GroupObjectPermission
+from guardian.shortcuts import get_objects_for_user
+
+from apps.requests.models import Request, request_statuses
+
+from datetime import datetime
+import logging
+import pytz
+
+logger = logging.getLogger('default')
+
+BULK_ACTIONS = ('public', 'private', 'delete', 'status')
+
+#what the request list form posts
+FORM_ACTIONS = {
+    'Make Public': 'public',
+    'Make Private': 'private',
+    'Delete': 'delete',
+    'Update': 'status',
+}
+
+FULFILLED_STATUSES = ('F', 'P')
+
+
+class BulkActionError(Exception):
+    '''
+    raised when nothing was changed, the message is safe to show to the user
+    '''
+    def __init__(self, message, forbidden=None):
+        super(BulkActionError, self).__init__(message)
+        self.forbidden = forbidden or []
+
+
+def editable_request_ids(user, request_ids):
+    '''
+    the subset of request_ids the user can edit, like calling
+    user.has_perm(edit) on every request
+    '''
+    ids = set(int(rid) for rid in request_ids)
+    allowed = get_objects_for_user(user, Request.get_permissions_path('edit'),
+        klass=Request.objects.filter(id__in=ids)).values_list('id', flat=True)
+    return set(allowed), ids
+
+
+def status_code(status):
+    for code, label in request_statuses:
+        if status == code or status == label:
+            return code
+    return None
+
+
+def set_public_view(request_ids, public):
+    '''
+    grant or revoke the public group's view permission on request_ids,
+    returns the number of permission rows written or removed
+    '''
+    group, created = Group.objects.get_or_create(name='public')
+    content_type = ContentType.objects.get_for_model(Request)
+    permission = Permission.objects.get(content_type=content_type, codename=Request.get_permission_name('view'))
+    object_pks = [str(rid) for rid in request_ids]
+    existing = GroupObjectPermission.objects.filter(group=group, permission=permission,
+        content_type=content_type, object_pk__in=object_pks)
+    if not public:
+        count = existing.count()
+        existing.delete()
+        return count
+    have = set(existing.values_list('object_pk', flat=True))
+    rows = [GroupObjectPermission(group=group, permission=permission, content_type=content_type, object_pk=pk)
+            for pk in object_pks if pk not in have]
+    GroupObjectPermission.objects.bulk_create(rows)
+    return len(rows)
+
+
+def apply_bulk_action(user, action, request_ids, status=None):
+    '''
+    make requests public or private, delete them or set their status.
+    The user has to be able to edit every request or nothing changes.
+    Returns a summary dict.
+    '''
+    action = FORM_ACTIONS.get(action, action)
+    if action not in BULK_ACTIONS:
+        raise BulkActionError("Unknown action %s" % action)
+    code = None
+    if action == 'status':
+        code = status_code(status)
+        if code is None:
+            raise BulkActionError("Unknown status %s" % status)
+
+    allowed, ids = editable_request_ids(user, request_ids)
+    forbidden = sorted(ids - allowed)
+    if forbidden:
+        logger.info("%s tried to change requests %s without edit permission" % (user, forbidden))
+        raise BulkActionError("It appears you don't have permission to change these requests.", forbidden)
+
+    now = datetime.now(tz=pytz.utc)
+    requests = Request.objects.filter(id__in=ids)
+    summary = {'action': action, 'requests': len(ids), 'changed': 0}
+    with transaction.atomic():
+        if action in ('public', 'private'):
+            private = action == 'private'
+            #only the ones that actually flip, like the privacy check in Request.save
+            changing = list(requests.exclude(private=private).values_list('id', flat=True))
+            summary['changed'] = Request.objects.filter(id__in=changing).update(private=private, date_updated=now)
+            summary['permissions'] = set_public_view(changing, not private)
+            if changing:
+                logger.info("requests %s privacy changed to=%s" % (changing, private))
+        elif action == 'delete':
+            summary['changed'] = requests.exclude(status='X').update(status='X', date_updated=now)
+        else:
+            date_fulfilled = now if code in FULFILLED_STATUSES else None
+            summary['status'] = code
+            summary['changed'] = requests.update(status=code, date_fulfilled=date_fulfilled, date_updated=now)
+    return summary
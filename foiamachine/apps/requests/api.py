@@ -1,11 +1,13 @@
 from django.db.models import Count, Avg
 from datetime import datetime
+from apps.requests.actions import apply_bulk_action, BulkActionError
 from apps.requests.models import Request, ViewableLink
 from apps.agency.models import Agency
 from apps.contacts.models import Contact
 from apps.users.models import Group
 from apps.users.api import GroupResource
 from apps.agency.api import AgencyResource
+from apps.core.pagination import KeysetResourcePaginator
 from apps.contacts.api import ContactResource
 from apps.users.models import User
 from apps.users.api import TagResource, GroupResource
@@ -26,6 +28,7 @@ from tastypie.http import HttpBadRequest, HttpForbidden
 
 from apps.users.models import UserProfile
 
+from django.conf.urls.defaults import url
 from django.db.models import Q
 
 import logging
@@ -178,6 +181,7 @@ class RequestResource(ModelResource):
         detail_allowed_methods = ['get', 'post', 'put', 'patch']
         authorization = Authorization()
         always_return_data = True
+        paginator_class = KeysetResourcePaginator
         filtering = {
             'id': ALL,
             'status': ALL,
@@ -232,7 +236,7 @@ class RequestResource(ModelResource):
     def get_object_list(self, request):
         #getting lazyload error if we don't take some action to load the user obj
         print request.user.id
-        obj_list = Request.objects.for_user(request.user)
+        obj_list = Request.objects.for_user(request.user).order_by('-date_added', '-id')
         try:
             if request.GET.get("authored", None) and request.GET.get("authored").lower() in ("yes", "true", "t", "1", "True"):
                 return obj_list.filter(author=request.user)
@@ -268,6 +272,32 @@ class RequestResource(ModelResource):
     def hydrate(self, bundle):
         return bundle
 
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/bulk/$" % self._meta.resource_name, self.wrap_view('bulk_action'), name="api_request_bulk"),
+        ]
+
+    def bulk_action(self, request, **kwargs):
+        '''
+        POST {"action": "public"|"private"|"delete"|"status", "request_ids": [...], "status": ...}
+        to change many requests at once. The user has to be able to edit
+        every request or nothing is changed. Returns what was done.
+        '''
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        if not request.user.is_authenticated():
+            return HttpForbidden("You need to be logged in to change requests.")
+        data = self.deserialize(request, request.body, format=request.META.get('CONTENT_TYPE', 'application/json'))
+        if not data.get('action') or not data.get('request_ids'):
+            return HttpBadRequest("action and request_ids are required")
+        try:
+            summary = apply_bulk_action(request.user, data['action'], data['request_ids'], status=data.get('status'))
+        except BulkActionError as e:
+            if e.forbidden:
+                return HttpForbidden(str(e))
+            return HttpBadRequest(str(e))
+        return self.create_response(request, summary)
+
     def obj_update(self, bundle, **kwargs):
         data = bundle.data
         bundle.obj = Request.objects.get(id=bundle.data['id'])
@@ -0,0 +1,277 @@
+'''
+Summary exports for the stats dumps. Counts come from annotations and
+related rows are fetched once per chunk instead of once per object.
+'''
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, Exists, OuterRef, Q, Subquery
+from taggit.models import TaggedItem
+
+from apps.agency.models import Agency
+from apps.contacts.models import Contact
+from apps.core.exports import Export
+from apps.government.models import Government
+from apps.mail.attachment import AttachmentText
+from apps.mail.models import MailBox, MailMessage
+from apps.requests.models import Request, request_statuses
+
+
+STATUS_NAMES = dict(request_statuses)
+
+
+def related_ids(field, ids):
+    '''
+    {object id: [related ids]} for a many to many field over a chunk of ids
+    '''
+    through = field.remote_field.through
+    source = field.m2m_field_name() + '_id'
+    target = field.m2m_reverse_field_name() + '_id'
+    retval = dict((pk, []) for pk in ids)
+    for pk, related_pk in through.objects.filter(**{source + '__in': ids}).order_by(target).values_list(source, target):
+        retval[pk].append(related_pk)
+    return retval
+
+
+def first_active_content(field, ids):
+    '''
+    {contact id: content} of the first non deprecated related row, the bulk
+    version of Contact.get_first_active_*
+    '''
+    through = field.remote_field.through
+    source = field.m2m_field_name()
+    target = field.m2m_reverse_field_name()
+    rows = through.objects.filter(**{
+        source + '_id__in': ids,
+        target + '__deprecated__isnull': True,
+    }).order_by(target + '_id').values_list(source + '_id', target + '__content')
+    retval = {}
+    for pk, content in rows:
+        retval.setdefault(pk, content)
+    return retval
+
+
+class RequestSummaryExport(Export):
+    name = 'requests'
+    columns = (
+        ('id', 'int'),
+        ('agency_id', 'int'),
+        ('status', 'str'),
+        ('created', 'datetime'),
+        ('sent', 'datetime'),
+        ('due_date', 'datetime'),
+        ('fullfilled_date', 'datetime'),
+        ('private', 'bool'),
+        ('num_messages', 'int'),
+        ('contacts', 'str'),
+    )
+
+    def get_queryset(self):
+        # the thread is the oldest message on the request plus its replies, see MailBox.get_threads
+        thread_root = MailMessage.objects.filter(request=OuterRef('pk')).order_by('dated').values('pk')[:1]
+        replies = MailMessage.replies.through.objects.filter(from_mailmessage=OuterRef('thread_root'))\
+            .order_by().values('from_mailmessage').annotate(cnt=Count('pk')).values('cnt')
+        return Request.objects.filter(Exists(MailBox.objects.filter(usr=OuterRef('author'))))\
+            .annotate(thread_root=Subquery(thread_root), num_replies=Subquery(replies))\
+            .order_by('pk')
+
+    def rows(self, chunk):
+        contacts = related_ids(Request._meta.get_field('contacts'), [r.pk for r in chunk])
+        for request in chunk:
+            yield [
+                request.pk,
+                request.agency_id,
+                STATUS_NAMES.get(request.status, request.status),
+                request.date_added,
+                request.scheduled_send_date,
+                request.due_date,
+                request.date_fulfilled,
+                request.private,
+                0 if request.thread_root is None else 1 + (request.num_replies or 0),
+                ','.join(str(pk) for pk in contacts[request.pk]),
+            ]
+
+
+class GovernmentSummaryExport(Export):
+    name = 'governments'
+    columns = (
+        ('id', 'int'),
+        ('name', 'str'),
+        ('slug', 'str'),
+        ('created', 'datetime'),
+        ('agencies', 'int'),
+    )
+
+    def get_queryset(self):
+        visible = Q(agency__deprecated__isnull=True, agency__hidden=False)
+        return Government.objects.annotate(num_agencies=Count('agency', filter=visible)).order_by('pk')
+
+    def rows(self, chunk):
+        for gov in chunk:
+            yield [gov.pk, gov.name, gov.slug, gov.created, gov.num_agencies]
+
+
+class AgencySummaryExport(Export):
+    name = 'agencies'
+    columns = (
+        ('id', 'int'),
+        ('government_id', 'int'),
+        ('name', 'str'),
+        ('slug', 'str'),
+        ('created', 'datetime'),
+        ('contacts', 'int'),
+    )
+
+    def get_queryset(self):
+        # the manager prefetches government and creator, neither is needed here
+        return Agency.objects.prefetch_related(None).annotate(num_contacts=Count('contacts')).order_by('pk')
+
+    def rows(self, chunk):
+        for agency in chunk:
+            yield [agency.pk, agency.government_id, agency.name, agency.slug, agency.created, agency.num_contacts]
+
+
+class ContactSummaryExport(Export):
+    name = 'contacts'
+    columns = (
+        ('id', 'int'),
+        ('agency_id', 'int'),
+        ('first_name', 'str'),
+        ('last_name', 'str'),
+        ('created', 'datetime'),
+        ('address', 'str'),
+        ('phone', 'str'),
+        ('emails', 'str'),
+    )
+
+    def get_queryset(self):
+        # one row per agency/contact pair, like walking agency.contacts for every agency
+        return Agency.contacts.through.objects\
+            .filter(agency__in=Agency.objects.prefetch_related(None).values('pk'))\
+            .select_related('contact').order_by('agency_id', 'contact_id')
+
+    def rows(self, chunk):
+        ids = set(link.contact_id for link in chunk)
+        addresses = first_active_content(Contact._meta.get_field('addresses'), ids)
+        phones = first_active_content(Contact._meta.get_field('phone_numbers'), ids)
+        emails = first_active_content(Contact._meta.get_field('emails'), ids)
+        for link in chunk:
+            contact = link.contact
+            yield [
+                contact.pk,
+                link.agency_id,
+                contact.first_name,
+                contact.last_name,
+                contact.created,
+                addresses.get(contact.pk, ''),
+                phones.get(contact.pk, ''),
+                emails.get(contact.pk, ''),
+            ]
+
+
+class AttachmentTextExport(Export):
+    '''
+    extracted text of every attachment on a request's messages, one row per
+    message and attachment. see apps.mail.extraction
+    '''
+    name = 'attachments'
+    columns = (
+        ('message_id', 'int'),
+        ('attachment_id', 'int'),
+        ('request_id', 'int'),
+        ('filename', 'str'),
+        ('status', 'str'),
+        ('method', 'str'),
+        ('pages', 'int'),
+        ('ocr_pages', 'int'),
+        ('text', 'str'),
+    )
+
+    def get_queryset(self):
+        # replies carry no request of their own, their thread's root does
+        on_request = Q(mailmessage__request__isnull=False) | Q(mailmessage__replies__request__isnull=False)
+        return MailMessage.attachments.through.objects.filter(on_request).distinct()\
+            .select_related('attachment', 'attachment__blob').order_by('mailmessage_id', 'attachment_id')
+
+    def rows(self, chunk):
+        message_ids = set(link.mailmessage_id for link in chunk)
+        requests = dict(MailMessage.objects.filter(pk__in=message_ids, request__isnull=False)
+                        .values_list('pk', 'request_id'))
+        for pk, request_id in MailMessage.replies.through.objects\
+                .filter(from_mailmessage__in=message_ids, to_mailmessage__request__isnull=False)\
+                .values_list('from_mailmessage_id', 'to_mailmessage__request_id'):
+            requests.setdefault(pk, request_id)
+        hashes = set(link.attachment.blob.sha256 for link in chunk if link.attachment.blob_id is not None)
+        texts = AttachmentText.objects.in_bulk(list(hashes), field_name='sha256')
+        for link in chunk:
+            atch = link.attachment
+            text = texts.get(atch.blob.sha256) if atch.blob_id is not None else None
+            yield [
+                link.mailmessage_id,
+                atch.pk,
+                requests.get(link.mailmessage_id),
+                atch.get_filename,
+                text.status if text is not None else '',
+                text.method if text is not None else '',
+                len(text.pages) if text is not None else 0,
+                text.ocr_pages if text is not None else 0,
+                text.text if text is not None else '',
+            ]
+
+
+SUMMARY_EXPORTS = dict((export.name, export) for export in (
+    RequestSummaryExport,
+    GovernmentSummaryExport,
+    AgencySummaryExport,
+    ContactSummaryExport,
+    AttachmentTextExport,
+))
+
+
+class RequestListExport(Export):
+    '''
+    whatever a request list view is showing, downloaded in full instead of
+    rendering every row into one page
+    '''
+    name = 'request_list'
+    columns = (
+        ('id', 'int'),
+        ('title', 'str'),
+        ('status', 'str'),
+        ('agency', 'str'),
+        ('government', 'str'),
+        ('author', 'str'),
+        ('created', 'datetime'),
+        ('updated', 'datetime'),
+        ('due_date', 'datetime'),
+        ('fullfilled_date', 'datetime'),
+        ('private', 'bool'),
+        ('tags', 'str'),
+    )
+
+    def __init__(self, queryset, **kwargs):
+        super(RequestListExport, self).__init__(**kwargs)
+        self.queryset = queryset
+
+    def get_queryset(self):
+        return self.queryset.select_related('agency', 'government', 'author')
+
+    def rows(self, chunk):
+        tags = {}
+        tagged = TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(Request),
+            object_id__in=[r.pk for r in chunk]).order_by('tag__name').values_list('object_id', 'tag__name')
+        for pk, name in tagged:
+            tags.setdefault(pk, []).append(name)
+        for request in chunk:
+            yield [
+                request.pk,
+                request.title,
+                STATUS_NAMES.get(request.status, request.status),
+                request.agency.name if request.agency_id else '',
+                request.government.name if request.government_id else '',
+                request.author.username,
+                request.date_added,
+                request.date_updated,
+                request.due_date,
+                request.date_fulfilled,
+                request.private,
+                ','.join(tags.get(request.pk, [])),
+            ]
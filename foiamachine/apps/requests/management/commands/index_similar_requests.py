@@ -0,0 +1,25 @@
+from apps.requests.similar import HAS_NUMPY, get_index, index_requests
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Add new and changed requests to the similar request index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Index every request from scratch, needed after changing the embedder')
+        parser.add_argument('--compact', action='store_true',
+                            help='Drop rows of requests that changed since and recluster')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if not HAS_NUMPY:
+            raise CommandError('the similar request index needs numpy')
+        index = get_index()
+        if options['rebuild']:
+            index.clear()
+        appended = index_requests(batch_size=options['batch_size'], index=index)
+        self.stdout.write('requests indexed: %s' % appended)
+        if options['compact']:
+            self.stdout.write('superseded rows dropped: %s' % index.compact())
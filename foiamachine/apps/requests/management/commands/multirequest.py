@@ -4,7 +4,7 @@ from django.template.loader import get_template
 from django.template import Context
 from django.template import Template
 from django.core.cache import cache
-from apps.core.unicode_csv import UnicodeReader
+from apps.core.csvio import CSVReader
 from django.conf import settings
 
 from apps.mail.models import MailBox
@@ -22,6 +22,7 @@ import logging
 import requests
 import codecs
 import csv
+import io
 from datetime import datetime
 
 logger = logging.getLogger('default')
@@ -39,29 +40,29 @@ class Command(BaseCommand):
             return -1
         idd = args[0]
         resp = requests.get("https://docs.google.com/spreadsheets/d/%s/pub?output=csv" % idd)
-        reader = list(csv.reader(resp.content.split('\n'), delimiter=','))
-        header = reader[0]
-        for row in reader[1:-1]:
+        #the sheet has quoted multi-line cells, so don't split it on newlines ourselves
+        reader = CSVReader(io.BytesIO(resp.content), dialect=csv.excel, header=True)
+        for row in reader.dicts():
             #get user, contact and agency
-            user = User.objects.get(username=row[header.index('username')])
+            user = User.objects.get(username=row['username'])
             user_profile = UserProfile.objects.get(user=user)
-            govt = get_or_create_us_govt(row[header.index("state")], 'state')
-            agency, acreated = Agency.objects.get_or_create(name=row[header.index("agency")], government=govt)
+            govt = get_or_create_us_govt(row["state"], 'state')
+            agency, acreated = Agency.objects.get_or_create(name=row["agency"], government=govt)
             contact, ccreated = agency.contacts.get_or_create(
-                first_name=row[header.index("contact.first.name")], 
-                middle_name=row[header.index("contact.middle.name")], 
-                last_name=row[header.index("contact.last.name")])
-            if row[header.index("contact.email")] != "":
-                contact.add_email(row[header.index("contact.email")])
-            if row[header.index("contact.phone")] != "":
-                contact.add_phone(row[header.index("contact.phone")])
+                first_name=row["contact.first.name"], 
+                middle_name=row["contact.middle.name"], 
+                last_name=row["contact.last.name"])
+            if row["contact.email"] != "":
+                contact.add_email(row["contact.email"])
+            if row["contact.phone"] != "":
+                contact.add_phone(row["contact.phone"])
 
             #set up group and tags
-            group, created = Group.objects.get_or_create(name=row[header.index("group")])
+            group, created = Group.objects.get_or_create(name=row["group"])
             assign_perm(UserProfile.get_permission_name('edit'), user, group)
             assign_perm(UserProfile.get_permission_name('view'), user, group)
             user.groups.add(group)
-            user_profile.tags.add(row[header.index("tag")])
+            user_profile.tags.add(row["tag"])
 
             #assemble law text
             law_texts = []
@@ -70,7 +71,7 @@ class Command(BaseCommand):
             law_text = ' and '.join(law_texts)
 
             #get the letter template
-            letter_url = row[header.index("letter.url")]
+            letter_url = row["letter.url"]
             letter_template = ''
             if letter_url in letter_responses.keys():
                 letter_template = letter_responses[letter_url]
@@ -92,13 +93,13 @@ class Command(BaseCommand):
             #create the request
             fields_to_use = {
                 'author': user,
-                'title': row[header.index("request.title")],
+                'title': row["request.title"],
                 'free_edit_body': letter,
-                'private': True if row[header.index("request.private")] == "TRUE" else False,
+                'private': True if row["request.private"] == "TRUE" else False,
                 'text': letter#silly distinction leftover from old days but fill it in
             }
             #delete all requests that look like the one i'm about to make so we don't have duplicates floating around
-            Request.objects.filter(author=user, title=row[header.index("request.title")]).delete()
+            Request.objects.filter(author=user, title=row["request.title"]).delete()
             #create the request
             therequest = Request(**fields_to_use)
             therequest.date_added = datetime.now()
@@ -106,14 +107,14 @@ class Command(BaseCommand):
             therequest.contacts = [contact]
             therequest.government = govt
             therequest.agency = agency
-            therequest.tags.add(row[header.index("tag")])
+            therequest.tags.add(row["tag"])
             therequest.save()
             #assing permissions to the request
             assign_perm(Request.get_permission_name('view'), group, therequest)
             assign_perm(Request.get_permission_name('edit'), group, therequest)
 
-            if row[header.index("request.send")] == "TRUE":
+            if row["request.send"] == "TRUE":
                 therequest.send()
-                print "SENT request %s" % row[header.index("request.title")]
+                print "SENT request %s" % row["request.title"]
             else:
-                print "STAGED request %s" % row[header.index("request.title")]
\ No newline at end of file
+                print "STAGED request %s" % row["request.title"]
\ No newline at end of file
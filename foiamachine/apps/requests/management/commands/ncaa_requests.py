@@ -1,7 +1,7 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.contrib.auth.models import User, Group
 from django.core.cache import cache
-from apps.core.unicode_csv import UnicodeReader
+from apps.core.csvio import CSVReader
 from django.conf import settings
 
 from apps.mail.models import MailBox
@@ -18,6 +18,7 @@ from guardian.shortcuts import assign_perm, remove_perm, get_groups_with_perms
 import logging
 import requests
 import codecs
+import csv
 from datetime import datetime
 
 logger = logging.getLogger('default')
@@ -155,7 +156,7 @@ class Command(BaseCommand):
         #    resp = requests.get("https://docs.google.com/spreadsheets/d/1kccaiCCYIHOTEvpUWQiKs51v6K2TNRX7-NN6l1WtzyM/pub?output=csv")
         #    f.write(resp.text)
 
-        reader = list(UnicodeReader(open(fname, 'rb')))
+        reader = list(CSVReader(fname, dialect=csv.excel))
         #create contacts
         header = reader[0]
         for idx, row in enumerate(reader[1:]):
@@ -1,18 +1,20 @@
-from apps.requests.models import Request
+from apps.core.utils import chunked
+from apps.requests.models import Request, ThreadLookup
 
-from django.core.management.base import BaseCommand, CommandError
-from django.core.cache import cache
-from apps.users.models import User
+from django.core.management.base import BaseCommand
 
 
 class Command(BaseCommand):
+    help = 'Give every request without a lookup code one, existing codes are kept'
 
-    def handle(self, *args, **options):
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
 
-        for rr in Request.objects.all():
-            code = "LOOKUP:" + User.objects.make_random_password(length=64)
-            while Request.objects.filter(thread_lookup=code):
-                code = User.objects.make_random_password(length=64)
-            rr.thread_lookup = code
-            rr.save()
-            print 'request id=%s saved' % rr.id
\ No newline at end of file
+    def handle(self, *args, **options):
+        allocated = 0
+        ids = Request.objects.filter(lookups__isnull=True).order_by('id').values_list('id', flat=True)
+        for chunk in chunked(ids.iterator(), options['chunk_size']):
+            for rr in Request.objects.filter(id__in=chunk):
+                ThreadLookup.objects.allocate(rr)
+                allocated += 1
+        self.stdout.write('lookup codes allocated: %s' % allocated)
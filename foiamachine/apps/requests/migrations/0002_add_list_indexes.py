@@ -0,0 +1,34 @@
+# Generated migration for request lookup indexes
+# This migration adds the indexes behind the managers, the notification commands and the list views
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('requests', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(fields=['status', 'due_date'], name='request_status_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(condition=models.Q(keep_private=False, private=True), fields=['scheduled_send_date'], name='request_sunset_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(fields=['thread_lookup'], name='request_thread_lookup_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(fields=['author', '-date_added', '-id'], name='request_author_added_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(fields=['-date_added', '-id'], name='request_added_idx'),
+        ),
+    ]
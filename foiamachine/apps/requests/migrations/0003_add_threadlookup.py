@@ -0,0 +1,45 @@
+# Generated migration for lookup codes
+# This migration adds the ThreadLookup table and fills it from Request.thread_lookup
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+CHUNK_SIZE = 1000
+
+
+def copy_lookup_codes(apps, schema_editor):
+    Request = apps.get_model('requests', 'Request')
+    ThreadLookup = apps.get_model('requests', 'ThreadLookup')
+    seen = set()
+    rows = []
+    codes = Request.objects.filter(thread_lookup__startswith='LOOKUP:').order_by('id').values_list('id', 'thread_lookup')
+    for request_id, code in codes.iterator():
+        #the oldest request keeps a duplicated code, run set_threadlookup for the rest
+        if code in seen:
+            continue
+        seen.add(code)
+        rows.append(ThreadLookup(token=code, request_id=request_id))
+        if len(rows) >= CHUNK_SIZE:
+            ThreadLookup.objects.bulk_create(rows)
+            rows = []
+    ThreadLookup.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('requests', '0002_add_list_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThreadLookup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=80, unique=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('request', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lookups', to='requests.request')),
+            ],
+        ),
+        migrations.RunPython(copy_lookup_codes, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.dispatch import receiver
 from django.core.urlresolvers import reverse
 from django.core.files.base import ContentFile
@@ -7,6 +7,7 @@ from django_extensions.db.fields import AutoSlugField
 from django.db.models.signals import post_save
 from django.db.models import Q
 from django.utils import timezone
+from django.utils.crypto import get_random_string
 
 from apps.agency.models import Agency
 from apps.contacts.models import Contact
@@ -177,6 +178,17 @@ class Request(models.Model):
 
     tags = TaggableManager(blank=True)
 
+    class Meta:
+        # match the filters in the managers, the notification commands and the list views
+        indexes = [
+            models.Index(fields=['status', 'due_date'], name='request_status_due_idx'),
+            models.Index(fields=['scheduled_send_date'], condition=Q(private=True, keep_private=False),
+                         name='request_sunset_idx'),
+            models.Index(fields=['thread_lookup'], name='request_thread_lookup_idx'),
+            models.Index(fields=['author', '-date_added', '-id'], name='request_author_added_idx'),
+            models.Index(fields=['-date_added', '-id'], name='request_added_idx'),
+        ]
+
     @property
     def get_contacts_with_email(self):
         retval = []
@@ -326,13 +338,11 @@ class Request(models.Model):
     @property
     def sent(self):
         #this is the for sure way but scheduled_send_date is set when the object is mailed and we currently have no scheduler
-        from apps.mail.models import MailBox
-        mb = MailBox.objects.get_or_create(usr=self.author)[0]
-        threads = mb.get_threads(self.id)
+        from apps.mail.models import MailBox, MailMessage
+        MailBox.objects.get_or_create(usr=self.author)
         #TODO update this so it checks the sent date, because now people can send emails to an unsent request
-        if len(threads) > 0:
-            return True
-        return False
+        #a thread exists exactly when the request has a message, see MailBox.get_threads
+        return MailMessage.objects.filter(request__id=self.id).exists()
 
     @property
     def get_due_date(self):
@@ -510,10 +520,7 @@ class Request(models.Model):
             if not doc.err:
                 with open(fname, 'rb') as f:
                     to_file = ContentFile(f.read())
-                    attachment = Attachment()
-                    attachment.user = self.author
-                    attachment.file.save('request_%s.pdf' % self.id, to_file)
-                    attachment.save()
+                    attachment = Attachment.objects.store(self.author, 'request_%s.pdf' % self.id, to_file)
                 os.remove(fname)
             else:
                 logger.error("error writing to PDF: %s" % doc.err)
@@ -637,11 +644,11 @@ class Request(models.Model):
                 self.government = None
         else:
             self.status = 'I'
-            code = "LOOKUP:" + User.objects.make_random_password(length=64)
-            while Request.objects.filter(thread_lookup=code):
-                code = User.objects.make_random_password(length=64)
-            self.thread_lookup = code
+            self.thread_lookup = new_lookup_code()
+        created = self.pk is None
         super(Request, self).save(*args, **kw)
+        if created:
+            ThreadLookup.objects.allocate(self)
 
     @staticmethod
     def get_user_in_threshold(user, days=7):
@@ -689,6 +696,72 @@ class Request(models.Model):
         #return set(results)
         return Request.objects.filter(private=True, scheduled_send_date__lte=now, keep_private=False)
 
+LOOKUP_PREFIX = 'LOOKUP:'
+LOOKUP_CHARS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+LOOKUP_ATTEMPTS = 5
+
+
+def new_lookup_code():
+    #62**64 possible codes, a collision is only ever caught by the unique index
+    return LOOKUP_PREFIX + get_random_string(64, LOOKUP_CHARS)
+
+
+class ThreadLookupManager(models.Manager):
+
+    def allocate(self, request, code=None):
+        '''
+        give request a lookup code, keeping request.thread_lookup if it's
+        free. Uniqueness comes from the index, the insert is only retried
+        if it collides
+        '''
+        code = code or request.thread_lookup
+        if not code or not code.startswith(LOOKUP_PREFIX):
+            code = new_lookup_code()
+        for attempt in range(LOOKUP_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    lookup = self.create(token=code, request=request)
+                break
+            except IntegrityError:
+                logger.info('lookup code collision for request %s' % request.pk)
+                code = new_lookup_code()
+        else:
+            raise IntegrityError('could not allocate a lookup code for request %s' % request.pk)
+        if request.thread_lookup != code:
+            Request.objects.filter(pk=request.pk).update(thread_lookup=code)
+            request.thread_lookup = code
+        return lookup
+
+    def resolve(self, tokens):
+        '''
+        {token: ThreadLookup} for the tokens that exist, with the request and
+        the id of its oldest message (the thread root) from one query
+        '''
+        from apps.mail.models import MailMessage
+        tokens = set(tokens)
+        if not tokens:
+            return {}
+        root = MailMessage.objects.filter(request=models.OuterRef('request_id')).order_by('dated').values('pk')[:1]
+        lookups = self.filter(token__in=tokens).select_related('request')\
+            .annotate(root_id=models.Subquery(root))
+        return dict((lookup.token, lookup) for lookup in lookups)
+
+
+class ThreadLookup(models.Model):
+    '''
+    the LOOKUP: codes put in outgoing requests so replies that lost their
+    threading headers can still be matched to a request
+    '''
+    token = models.CharField(max_length=80, unique=True)
+    request = models.ForeignKey(Request, related_name='lookups', on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = ThreadLookupManager()
+
+    def __unicode__(self):
+        return self.token
+
+
 class ViewableLink(models.Model):
     owner = models.ForeignKey(User, null=True)
     request = models.ForeignKey(Request, blank = True, null = True)
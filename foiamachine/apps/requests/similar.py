@@ -0,0 +1,505 @@
+'''
+Similar past requests, for the drafting agent and the request wizard
+
+Request texts (free_edit_body) are embedded into unit vectors kept in a
+memory-mapped float32 matrix on local disk, with a parallel table of
+request id, author, privacy and status so results can be limited to what
+the asking user may see and to outcomes such as fulfilled (F), partially
+fulfilled (P) or denied (D). The start of the text extracted from a
+request's attachments is embedded with it. New and changed requests are
+appended; a changed request's older row is ignored and dropped by compact().
+
+The embedder is pluggable with SIMILAR_REQUESTS_EMBEDDER, a dotted path to
+a class whose instances have a dim and turn a list of texts into an array
+of unit rows. The default is a hashing vectorizer needing no model files;
+SentenceTransformerEmbedder wraps a locally stored sentence-transformers
+model for better matches. Changing embedder means rebuilding the index.
+
+Small indexes are searched exhaustively. Large ones are clustered with
+k-means and a query only scores the rows of the clusters nearest to it,
+which keeps it well under 50 ms at 1M requests with the default 256
+dimensions; an exhaustive scan of 1M rows would take several times that.
+'''
+import fcntl
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+try:
+    import numpy
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+logger = logging.getLogger('default')
+
+DEFAULT_DIM = 256
+#rows scored per matrix-vector product, bounds the temporary memory
+SEARCH_SLICE = 1 << 18
+#outcomes worth showing as examples of letters that worked
+SUCCESSFUL = ('F', 'P')
+#deleted and unfinished requests are never suggested
+SKIPPED_STATUSES = ('X', 'I')
+
+ROW_DTYPE = [('id', '<i8'), ('author', '<i8'), ('status', 'S1'), ('private', 'u1'), ('list', '<i4')]
+
+#clustering kicks in at TRAIN_AT rows, k-means over a sample of them
+TRAIN_AT = 20000
+TRAIN_SAMPLE = 16384
+TRAIN_ROUNDS = 8
+LISTS = 256
+#lists scored per query
+PROBES = 8
+#matches must score above this; blank rows (deleted or emptied requests) score 0
+MIN_SCORE = 0.0
+
+#text of a request's attachments embedded with it, see apps.mail.extraction
+ATTACHMENT_CHARS = 4000
+
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+
+@lru_cache(maxsize=1 << 18)
+def token_slot(token, dim):
+    '''column and sign of a token, stable across processes unlike hash()'''
+    digest = hashlib.blake2b(token.encode('utf8'), digest_size=8).digest()
+    value = int.from_bytes(digest, 'little')
+    return value % dim, 1.0 if (value >> 63) else -1.0
+
+
+class HashingEmbedder(object):
+    '''
+    words and word pairs hashed into dim columns, log-scaled counts,
+    normalized. Needs nothing but numpy and gives the same vector for the
+    same text everywhere
+    '''
+    name = 'hashing'
+
+    def __init__(self, dim=DEFAULT_DIM):
+        self.dim = dim
+
+    def tokens(self, text):
+        words = TOKEN_RE.findall((text or '').lower())
+        return words + ['%s %s' % pair for pair in zip(words, words[1:])]
+
+    def embed(self, texts):
+        vectors = numpy.zeros((len(texts), self.dim), dtype=numpy.float32)
+        for row, text in enumerate(texts):
+            counts = {}
+            for token in self.tokens(text):
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                column, sign = token_slot(token, self.dim)
+                vectors[row, column] += sign * (1.0 + math.log(count))
+        return normalize(vectors)
+
+
+class SentenceTransformerEmbedder(object):
+    '''
+    a sentence-transformers model loaded from SIMILAR_REQUESTS_MODEL, a
+    local path, so nothing is downloaded at run time
+    '''
+    name = 'sentence-transformers'
+
+    def __init__(self, dim=None):
+        if SentenceTransformer is None:
+            raise ImportError('sentence-transformers is not installed')
+        path = getattr(settings, 'SIMILAR_REQUESTS_MODEL', '')
+        self.model = SentenceTransformer(path, device='cpu')
+        self.name = 'sentence-transformers:%s' % os.path.basename(path.rstrip('/'))
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, texts):
+        vectors = self.model.encode(list(texts), batch_size=64, convert_to_numpy=True)
+        return normalize(vectors.astype(numpy.float32))
+
+
+def normalize(vectors):
+    norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def get_embedder():
+    path = getattr(settings, 'SIMILAR_REQUESTS_EMBEDDER', '')
+    embedder_class = import_string(path) if path else HashingEmbedder
+    return embedder_class(getattr(settings, 'SIMILAR_REQUESTS_DIM', DEFAULT_DIM))
+
+
+def train_centroids(vectors, lists, seed=0):
+    '''spherical k-means on a sample of the rows'''
+    rng = numpy.random.RandomState(seed)
+    picked = numpy.sort(rng.choice(len(vectors), min(len(vectors), TRAIN_SAMPLE), replace=False))
+    sample = numpy.asarray(vectors[picked])
+    centroids = sample[rng.choice(len(sample), lists, replace=False)]
+    for _ in range(TRAIN_ROUNDS):
+        assigned = numpy.argmax(numpy.dot(sample, centroids.T), axis=1)
+        sums = numpy.zeros_like(centroids)
+        numpy.add.at(sums, assigned, sample)
+        #a list nobody joined keeps its old centroid
+        empty = ~sums.any(axis=1)
+        sums[empty] = centroids[empty]
+        centroids = normalize(sums)
+    return centroids
+
+
+def nearest_lists(vectors, centroids):
+    assigned = numpy.empty(len(vectors), dtype=numpy.int32)
+    for start in range(0, len(vectors), SEARCH_SLICE):
+        chunk = numpy.asarray(vectors[start:start + SEARCH_SLICE])
+        assigned[start:start + len(chunk)] = numpy.argmax(numpy.dot(chunk, centroids.T), axis=1)
+    return assigned
+
+
+class LoadedIndex(object):
+    '''
+    one mapping of the files with the columns copied out and the masks and
+    inverted lists a query needs precomputed
+    '''
+
+    def __init__(self, path, meta, dim):
+        count = meta['count']
+        self.key = (count, meta['generation'])
+        self.vectors = numpy.memmap(os.path.join(path, 'vectors.f32'), dtype=numpy.float32, mode='r',
+                                    shape=(count, dim))
+        rows = numpy.memmap(os.path.join(path, 'rows.dat'), dtype=ROW_DTYPE, mode='r', shape=(count,))
+        self.ids = numpy.array(rows['id'])
+        self.author = numpy.array(rows['author'])
+        self.status = numpy.array(rows['status'])
+        #the last row of every id is its current one
+        unique, first = numpy.unique(self.ids[::-1], return_index=True)
+        current = numpy.zeros(count, dtype=bool)
+        current[count - 1 - first] = True
+        self.current = current & ~numpy.isin(self.status, [s.encode('ascii') for s in SKIPPED_STATUSES])
+        self.public = self.current & (numpy.array(rows['private']) == 0)
+        self.centroids = None
+        if meta.get('lists'):
+            self.centroids = numpy.fromfile(os.path.join(path, 'centroids.f32'), dtype=numpy.float32)\
+                .reshape(meta['lists'], dim)
+            lists = numpy.array(rows['list'])
+            #row numbers grouped by list, ascending within each
+            self.order = numpy.argsort(lists, kind='stable')
+            self.bounds = numpy.searchsorted(lists[self.order], numpy.arange(meta['lists'] + 1))
+
+    def candidates(self, vector, probes):
+        '''row numbers in the probes lists nearest the query, None for every row'''
+        if self.centroids is None or probes >= len(self.centroids):
+            return None
+        nearest = numpy.argsort(-numpy.dot(self.centroids, vector))[:probes]
+        rows = numpy.concatenate([self.order[self.bounds[j]:self.bounds[j + 1]] for j in nearest])
+        rows.sort()
+        return rows
+
+    def scores(self, vector, rows):
+        if rows is not None:
+            return numpy.dot(self.vectors[rows], vector)
+        scores = numpy.empty(len(self.ids), dtype=numpy.float32)
+        for start in range(0, len(self.ids), SEARCH_SLICE):
+            numpy.dot(self.vectors[start:start + SEARCH_SLICE], vector, out=scores[start:start + SEARCH_SLICE])
+        return scores
+
+    def visible(self, rows, user_id, statuses, exclude):
+        pick = (lambda column: column) if rows is None else (lambda column: column[rows])
+        visible = pick(self.public)
+        if user_id is not None:
+            visible = visible | (pick(self.current) & (pick(self.author) == user_id))
+        if statuses:
+            visible = visible & numpy.isin(pick(self.status), [s.encode('ascii') for s in statuses])
+        if exclude:
+            visible = visible & ~numpy.isin(pick(self.ids), list(exclude))
+        return visible
+
+
+class VectorIndex(object):
+    '''
+    vectors.f32 and rows.dat grow by appending; meta.json says how many rows
+    are complete, so readers never see a half written append. One writer
+    at a time, see writing()
+
+    Past TRAIN_AT rows the vectors are clustered into LISTS lists and a
+    query only scores the rows of the PROBES lists nearest to it, a few
+    percent of the index, probing wider when that finds fewer than k
+    '''
+
+    def __init__(self, path, dim, embedder_name):
+        self.path = path
+        self.dim = dim
+        self.embedder_name = embedder_name
+        self.lock = threading.Lock()
+        self.loaded = None
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def read_meta(self, check=True):
+        try:
+            with open(self.file('meta.json')) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return {'count': 0, 'generation': 0, 'lists': 0, 'dim': self.dim, 'embedder': self.embedder_name,
+                    'watermark': None}
+        if check and (meta['dim'] != self.dim or meta['embedder'] != self.embedder_name):
+            raise ValueError('index at %s was built with %s/%s, rebuild it for %s/%s' % (
+                self.path, meta['embedder'], meta['dim'], self.embedder_name, self.dim))
+        return meta
+
+    def write_meta(self, meta):
+        tmp = self.file('meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.file('meta.json'))
+
+    @contextmanager
+    def writing(self, check=True):
+        '''exclusive across processes, appends from two indexers would interleave'''
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with open(self.file('write.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield self.read_meta(check)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def truncate(self, meta):
+        '''drop whatever an interrupted append left past the last complete row'''
+        for name, size in (('vectors.f32', self.dim * 4), ('rows.dat', numpy.dtype(ROW_DTYPE).itemsize)):
+            if os.path.exists(self.file(name)):
+                with open(self.file(name), 'r+b') as f:
+                    f.truncate(meta['count'] * size)
+
+    def centroids(self, meta):
+        if not meta.get('lists'):
+            return None
+        return numpy.fromfile(self.file('centroids.f32'), dtype=numpy.float32).reshape(meta['lists'], self.dim)
+
+    def append(self, meta, vectors, rows):
+        '''call inside writing(), with the meta it gave'''
+        self.truncate(meta)
+        vectors = numpy.ascontiguousarray(vectors, dtype=numpy.float32)
+        rows = numpy.array([row + (-1,) for row in rows], dtype=ROW_DTYPE)
+        centroids = self.centroids(meta)
+        if centroids is not None:
+            rows['list'] = nearest_lists(vectors, centroids)
+        with open(self.file('vectors.f32'), 'ab') as f:
+            f.write(vectors.tobytes())
+        with open(self.file('rows.dat'), 'ab') as f:
+            f.write(rows.tobytes())
+        meta['count'] += len(rows)
+        if not meta.get('lists') and meta['count'] >= TRAIN_AT:
+            self.train(meta)
+        self.write_meta(meta)
+
+    def train(self, meta):
+        '''cluster the vectors into lists and file every row under one, inside writing()'''
+        lists = min(LISTS, meta['count'] // 64) or 1
+        vectors = numpy.memmap(self.file('vectors.f32'), dtype=numpy.float32, mode='r',
+                               shape=(meta['count'], self.dim))
+        centroids = train_centroids(vectors, lists)
+        centroids.astype(numpy.float32).tofile(self.file('centroids.f32'))
+        rows = numpy.memmap(self.file('rows.dat'), dtype=ROW_DTYPE, mode='r+', shape=(meta['count'],))
+        rows['list'] = nearest_lists(vectors, centroids)
+        rows.flush()
+        del rows
+        meta['lists'] = lists
+        meta['generation'] += 1
+
+    def load(self):
+        '''the current LoadedIndex, remapped only when meta.json changed'''
+        meta = self.read_meta()
+        with self.lock:
+            if self.loaded is None or self.loaded.key != (meta['count'], meta['generation']):
+                self.loaded = LoadedIndex(self.path, meta, self.dim) if meta['count'] else None
+            return self.loaded
+
+    def search(self, vector, k=5, user_id=None, statuses=None, exclude=()):
+        '''
+        [(request id, score, status)] best first, among current rows that
+        are public or belong to user_id and score above MIN_SCORE
+        '''
+        loaded = self.load()
+        if loaded is None or k <= 0:
+            return []
+        probes = PROBES
+        while True:
+            rows = loaded.candidates(vector, probes)
+            scores = loaded.scores(vector, rows)
+            visible = loaded.visible(rows, user_id, statuses, exclude) & (scores > MIN_SCORE)
+            if rows is None or visible.sum() >= k:
+                break
+            probes *= 4
+        scores[~visible] = -numpy.inf
+        k = min(k, int(visible.sum()))
+        if not k:
+            return []
+        top = numpy.argpartition(-scores, k - 1)[:k]
+        top = top[numpy.argsort(-scores[top])]
+        numbers = top if rows is None else rows[top]
+        return [(int(loaded.ids[i]), float(scores[j]), loaded.status[i].decode('ascii'))
+                for i, j in zip(numbers, top)]
+
+    def clear(self):
+        '''start over, e.g. after changing the embedder'''
+        with self.writing(check=False) as meta:
+            for name in ('vectors.f32', 'rows.dat', 'centroids.f32'):
+                if os.path.exists(self.file(name)):
+                    os.remove(self.file(name))
+            self.write_meta({'count': 0, 'generation': meta.get('generation', 0) + 1, 'lists': 0,
+                             'dim': self.dim, 'embedder': self.embedder_name, 'watermark': None})
+
+    def compact(self):
+        '''rewrite the files with current rows only and cluster them again'''
+        with self.writing() as meta:
+            loaded = self.load()
+            if loaded is None:
+                return 0
+            rows = numpy.memmap(self.file('rows.dat'), dtype=ROW_DTYPE, mode='r', shape=(meta['count'],))
+            keep = numpy.nonzero(loaded.current)[0]
+            for name, data in (('vectors.f32', loaded.vectors[keep]), ('rows.dat', rows[keep])):
+                with open(self.file(name + '.tmp'), 'wb') as f:
+                    f.write(numpy.ascontiguousarray(data).tobytes())
+            os.replace(self.file('vectors.f32.tmp'), self.file('vectors.f32'))
+            os.replace(self.file('rows.dat.tmp'), self.file('rows.dat'))
+            dropped = meta['count'] - len(keep)
+            meta['count'] = len(keep)
+            meta['lists'] = 0
+            if meta['count'] >= TRAIN_AT:
+                self.train(meta)
+            #processes that mapped the old files remap even if the count matches
+            meta['generation'] += 1
+            self.write_meta(meta)
+            return dropped
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    '''the process-wide index, None without numpy'''
+    global _index
+    if not HAS_NUMPY:
+        return None
+    with _index_lock:
+        if _index is None:
+            embedder = get_embedder()
+            path = getattr(settings, 'SIMILAR_REQUESTS_PATH',
+                           os.path.join(settings.SITE_ROOT, 'var', 'similar_requests'))
+            _index = VectorIndex(path, embedder.dim, embedder.name)
+            _index.embedder = embedder
+        return _index
+
+
+def request_text(request):
+    return ('%s\n\n%s' % (request.title, request.free_edit_body)).strip()
+
+
+def index_requests(queryset=None, batch_size=1000, index=None):
+    '''
+    embed and append requests changed since the last run, or those in
+    queryset. Returns how many were appended
+    '''
+    from apps.mail.extraction import requests_with_text_since
+    from apps.requests.models import Request
+    index = index or get_index()
+    if index is None:
+        return 0
+    appended = 0
+    with index.writing() as meta:
+        #taken first so text extracted during the run is picked up next time
+        started = timezone.now().isoformat()
+        if queryset is None:
+            queryset = Request.objects.all()
+            if meta.get('watermark'):
+                #ties with the watermark are indexed again rather than missed, as are
+                #requests whose attachments were read since the last run
+                text_since = meta.get('text_watermark') or meta['watermark']
+                queryset = queryset.filter(Q(date_updated__gte=meta['watermark']) |
+                                           Q(id__in=requests_with_text_since(text_since)))
+            meta['text_watermark'] = started
+        if not meta['count']:
+            queryset = queryset.exclude(status__in=SKIPPED_STATUSES).exclude(free_edit_body='')
+        queryset = queryset.order_by('date_updated', 'id')
+        watermark = meta.get('watermark')
+        fields = ('id', 'title', 'free_edit_body', 'author_id', 'status', 'private', 'date_updated')
+        batch = []
+        for request in queryset.only(*fields).iterator():
+            batch.append(request)
+            if len(batch) >= batch_size:
+                appended += append_batch(index, meta, batch)
+                watermark = batch[-1].date_updated.isoformat()
+                batch = []
+        if batch:
+            appended += append_batch(index, meta, batch)
+            watermark = batch[-1].date_updated.isoformat()
+        #a request picked up for its attachments may sort before the watermark
+        if watermark and (not meta.get('watermark') or watermark > meta['watermark']):
+            meta['watermark'] = watermark
+        index.write_meta(meta)
+    return appended
+
+
+def append_batch(index, meta, requests):
+    '''
+    requests deleted or emptied since they were indexed get a blank row,
+    which replaces the old one and is never returned
+    '''
+    from apps.mail.extraction import request_attachment_texts
+    attached = request_attachment_texts([request.id for request in requests], ATTACHMENT_CHARS)
+    vectors = index.embedder.embed([
+        '' if request.status in SKIPPED_STATUSES else request.free_edit_body and
+        ('%s\n\n%s' % (request_text(request), attached.get(request.id, ''))).strip()
+        for request in requests
+    ])
+    rows = [(request.id, request.author_id, request.status.encode('ascii'), 1 if request.private else 0)
+            for request in requests]
+    index.append(meta, vectors, rows)
+    return len(rows)
+
+
+def similar_requests(text, user=None, k=5, statuses=None, exclude=()):
+    '''
+    [{'id', 'score', 'status'}] for the k indexed requests most like text
+    that user may see, best first; empty when there's no index yet
+    '''
+    index = get_index()
+    if index is None or not (text or '').strip():
+        return []
+    try:
+        vector = index.embedder.embed([text])[0]
+        results = index.search(vector, k=k, user_id=user.pk if user is not None else None,
+                               statuses=statuses, exclude=exclude)
+    except ValueError as e:
+        logger.error('similar requests unavailable: %s' % e)
+        return []
+    return [{'id': pk, 'score': round(score, 4), 'status': status} for pk, score, status in results]
+
+
+def visible_requests(matches, user=None):
+    '''
+    {id: Request} for the matches user may still see. the index is only
+    as fresh as its last run, so requests made private or deleted since
+    then are dropped here against the current rows
+    '''
+    from apps.requests.models import Request
+    visible = Q(private=False)
+    if user is not None and user.pk is not None:
+        visible |= Q(author_id=user.pk)
+    queryset = Request.objects.filter(visible).exclude(status__in=SKIPPED_STATUSES)
+    return queryset.in_bulk([match['id'] for match in matches])
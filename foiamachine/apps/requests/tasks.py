@@ -0,0 +1,15 @@
+"""
+Background request upkeep
+"""
+
+from celery import shared_task
+
+
+@shared_task
+def index_similar_requests():
+    """
+    Add requests changed since the last run to the similar request index,
+    see apps.requests.similar
+    """
+    from .similar import index_requests
+    return index_requests()
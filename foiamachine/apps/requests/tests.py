@@ -2,6 +2,7 @@ from apps.core.user_test_base import UserTestBase
 from apps.requests.models import Request
 from apps.agency.models import Agency
 from apps.contacts.models import Contact
+from apps.government.models import Government
 from datetime import datetime
 from django.utils import timezone
 import json
@@ -47,3 +48,288 @@ class RequestSending(UserTestBase):
         self.request.due_date = None
         self.request.save()
         self.assertEqual(self.request.get_due_date, est.localize(datetime(2014, 1, 23)))
+
+
+class SummaryExports(UserTestBase):
+
+    def setUp(self):
+        super(SummaryExports, self).setUp()
+        from apps.mail.models import MailBox
+        self.create_request('yoko')
+        self.create_agency()
+        self.create_contact()
+        self.request.agency = self.agency
+        self.request.contacts = [self.contact]
+        self.request.save()
+        MailBox.objects.get_or_create(usr=self.usertwo)
+
+    def test_csv_export(self):
+        from apps.core.exports import get_writer
+        from apps.requests.exports import RequestSummaryExport, AgencySummaryExport
+        data = b''.join(get_writer(RequestSummaryExport(chunk_size=1), 'csv').stream()).decode('utf-8')
+        lines = data.strip().splitlines()
+        self.assertEqual(lines[0].split(',')[:2], ['id', 'agency_id'])
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith('%s,%s,' % (self.request.id, self.agency.id)))
+
+        data = b''.join(get_writer(AgencySummaryExport(), 'csv').stream()).decode('utf-8')
+        self.assertTrue(data.strip().splitlines()[1].endswith(',1'))
+
+    def test_jsonl_export(self):
+        from apps.core.exports import get_writer
+        from apps.requests.exports import ContactSummaryExport
+        data = b''.join(get_writer(ContactSummaryExport(), 'jsonl').stream()).decode('utf-8')
+        rows = [json.loads(line) for line in data.strip().splitlines()]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['id'], self.contact.id)
+        self.assertEqual(rows[0]['agency_id'], self.agency.id)
+
+    def test_export_download(self):
+        self.get_credentials_other('yoko')
+        resp = self.api_client.client.get('/requests/stats/export/governments/')
+        self.assertEqual(resp.status_code, 403)
+        self.get_credentials()
+        resp = self.api_client.client.get('/requests/stats/export/governments/?format=jsonl')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(b''.join(resp.streaming_content).splitlines()), Government.objects.count())
+
+
+class BulkRequestActions(UserTestBase):
+
+    def create_requests(self, count, username='john'):
+        self.get_credentials_other(username)
+        for i in range(count):
+            self.api_client.post('/api/v1/request/', format='json', data={
+                'contacts': [], 'free_edit_body': "<p>bulk %s</p>" % i, 'private': True, 'title': "bulk %s %s" % (username, i)})
+        return list(Request.objects.filter(title__startswith="bulk %s" % username).values_list('id', flat=True))
+
+    def bulk(self, data, username='john'):
+        self.get_credentials_other(username)
+        return self.api_client.post('/api/v1/request/bulk/', format='json', data=data)
+
+    def public_ids(self):
+        return set(Request.objects.for_group_a('public').values_list('id', flat=True))
+
+    def test_privacy_matches_save(self):
+        ids = self.create_requests(3)
+        resp = self.bulk({'action': 'public', 'request_ids': ids})
+        self.assertValidJSONResponse(resp)
+        self.assertEqual(json.loads(resp.content)['changed'], 3)
+        self.assertEqual(self.public_ids(), set(ids))
+        self.assertEqual(Request.objects.filter(id__in=ids, private=False).count(), 3)
+
+        #already public, nothing to do
+        self.assertEqual(json.loads(self.bulk({'action': 'public', 'request_ids': ids}).content)['changed'], 0)
+
+        #a single save going back to private agrees with the bulk path
+        req = Request.objects.get(id=ids[0])
+        req.private = True
+        req.save()
+        self.bulk({'action': 'private', 'request_ids': ids[1:]})
+        self.assertEqual(self.public_ids(), set())
+
+    def test_status_and_delete(self):
+        ids = self.create_requests(2)
+        self.bulk({'action': 'status', 'status': 'F', 'request_ids': ids})
+        self.assertEqual(Request.objects.filter(id__in=ids, status='F', date_fulfilled__isnull=False).count(), 2)
+        self.bulk({'action': 'status', 'status': 'S', 'request_ids': ids})
+        self.assertEqual(Request.objects.filter(id__in=ids, status='S', date_fulfilled__isnull=True).count(), 2)
+        self.assertHttpBadRequest(self.bulk({'action': 'status', 'status': 'nope', 'request_ids': ids}))
+
+        self.get_credentials()
+        self.api_client.client.post('/requests/my/', {'action': 'Delete', 'requests_to_modify': ids})
+        self.assertEqual(Request.objects.filter(id__in=ids, status='X').count(), 2)
+
+    def test_forbidden_changes_nothing(self):
+        mine = self.create_requests(2)
+        theirs = self.create_requests(1, username='yoko')
+        self.assertHttpForbidden(self.bulk({'action': 'public', 'request_ids': mine + theirs}))
+        self.assertEqual(Request.objects.filter(id__in=mine + theirs, private=False).count(), 0)
+        self.assertEqual(self.public_ids(), set())
+
+
+class KeysetPagination(UserTestBase):
+
+    def create_requests(self, count):
+        self.get_credentials()
+        for i in range(count):
+            self.api_client.post('/api/v1/request/', format='json', data={
+                'contacts': [], 'free_edit_body': "<p>page %s</p>" % i, 'private': True, 'title': "page %s" % i})
+        return Request.objects.filter(author=self.user)
+
+    def walk(self, paginator):
+        seen, page = [], paginator.page()
+        while True:
+            seen.extend(r.pk for r in page)
+            if not page.has_next():
+                return seen, page
+            page = paginator.page(after=page.next_cursor)
+
+    def test_pages_cover_everything_once(self):
+        from apps.core.pagination import KeysetPaginator
+        queryset = self.create_requests(7).order_by('-date_added', '-id')
+        expected = list(queryset.values_list('id', flat=True))
+        seen, last = self.walk(KeysetPaginator(queryset, 3, count_limit=5))
+        self.assertEqual(seen, expected)
+        self.assertEqual((last.count, last.count_exact), (5, False))
+
+        #and back again
+        previous = KeysetPaginator(queryset, 3).page(before=last.previous_cursor)
+        self.assertEqual([r.pk for r in previous], expected[3:6])
+
+    def test_nullable_keys(self):
+        from apps.core.pagination import KeysetPaginator
+        queryset = self.create_requests(5)
+        Request.objects.filter(id__in=list(queryset.values_list('id', flat=True))[:2]).update(due_date=timezone.now())
+        for ordering in (('due_date',), ('-due_date',)):
+            ordered = KeysetPaginator(queryset, 2, ordering=ordering)
+            seen, _ = self.walk(ordered)
+            self.assertEqual(seen, [r.pk for r in ordered.ordered()])
+
+    def test_api_cursor_links(self):
+        self.create_requests(5)
+        resp = self.api_client.get('/api/v1/request/', format='json', data={'limit': 2})
+        self.assertValidJSONResponse(resp)
+        data = json.loads(resp.content)
+        seen = [obj['id'] for obj in data['objects']]
+        while data['meta']['next']:
+            data = json.loads(self.api_client.get(data['meta']['next'], format='json').content)
+            seen.extend(obj['id'] for obj in data['objects'])
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+        self.assertEqual(data['meta']['total_count'], 5)
+
+    def test_show_all_is_a_download(self):
+        self.create_requests(3)
+        resp = self.api_client.client.get('/requests/my/', {'show': 'all'})
+        self.assertEqual(resp['Content-Type'], 'text/csv')
+        self.assertEqual(len(b''.join(resp.streaming_content).splitlines()), 4)
+
+    def test_parquet_without_pyarrow_is_a_bad_request(self):
+        from unittest import mock
+        self.create_requests(1)
+        with mock.patch('apps.core.exports.HAS_PYARROW', False):
+            resp = self.api_client.client.get('/requests/my/', {'show': 'all', 'format': 'parquet'})
+        self.assertEqual(resp.status_code, 400)
+
+
+class IndexAudit(UserTestBase):
+
+    def test_canonical_queries_use_indexes(self):
+        from django.core.management import call_command
+        from io import StringIO
+        out = StringIO()
+        call_command('audit_indexes', '--report-only', stdout=out)
+        report = out.getvalue()
+        for label in ('overdue requests', 'sunsetting requests', 'request by thread lookup', 'message by message id'):
+            self.assertIn('ok   %s' % label, report)
+
+
+class SimilarRequests(UserTestBase):
+
+    def setUp(self):
+        super(SimilarRequests, self).setUp()
+        from apps.requests import similar
+        import tempfile
+        self.similar = similar
+        self.directory = tempfile.mkdtemp()
+        self.settings_override = self.settings(SIMILAR_REQUESTS_PATH=self.directory)
+        self.settings_override.enable()
+        similar._index = None
+
+    def tearDown(self):
+        import shutil
+        self.settings_override.disable()
+        self.similar._index = None
+        shutil.rmtree(self.directory)
+        super(SimilarRequests, self).tearDown()
+
+    def add(self, title, body, status='F', private=False, author=None):
+        return Request.objects.create(author=author or self.usertwo, title=title, free_edit_body=body,
+                                      status=status, private=private)
+
+    def test_finds_visible_requests_by_outcome(self):
+        force = self.add('Use of force', 'All use of force reports filed by police officers in 2019')
+        self.add('Stadium', 'Emails between the mayor and the stadium developer', status='D')
+        hidden = self.add('Force, private', 'Use of force reports filed by police officers in 2018', private=True)
+        self.add('Draft', 'Use of force reports by police officers', status='I')
+        self.assertEqual(self.similar.index_requests(), 3)
+
+        found = self.similar.similar_requests('police use of force reports', user=self.user, k=3)
+        self.assertEqual(found[0]['id'], force.id)
+        self.assertNotIn(hidden.id, [match['id'] for match in found])
+        own = self.similar.similar_requests('police use of force reports', user=self.usertwo, k=2)
+        self.assertEqual(set(match['id'] for match in own), set([force.id, hidden.id]))
+        denied = self.similar.similar_requests('stadium developer emails', user=self.user, statuses=['D'])
+        self.assertEqual([match['status'] for match in denied], ['D'])
+
+    def test_changes_are_appended_and_compacted(self):
+        request = self.add('Budget', 'Budget memos from the finance department')
+        self.similar.index_requests()
+        request.free_edit_body = 'Parking ticket revenue by month'
+        request.status = 'X'
+        request.save()
+        self.similar.index_requests()
+        self.assertEqual(self.similar.similar_requests('budget memos finance', user=self.user), [])
+        self.assertTrue(self.similar.get_index().compact() >= 1)
+        self.assertEqual(self.similar.similar_requests('budget memos finance', user=self.user), [])
+
+    def test_suggestions_follow_current_privacy(self):
+        force = self.add('Use of force', 'All use of force reports filed by police officers in 2019')
+        self.similar.index_requests()
+        matches = self.similar.similar_requests('police use of force reports', user=self.user, k=1)
+        self.assertEqual(list(self.similar.visible_requests(matches, self.user)), [force.id])
+        Request.objects.filter(pk=force.pk).update(private=True)
+        self.assertEqual(self.similar.visible_requests(matches, self.user), {})
+        self.assertEqual(list(self.similar.visible_requests(matches, self.usertwo)), [force.id])
+        Request.objects.filter(pk=force.pk).update(status='X')
+        self.assertEqual(self.similar.visible_requests(matches, self.usertwo), {})
+
+    def test_emptied_requests_are_not_returned(self):
+        request = self.add('Budget', 'Budget memos from the finance department', status='S')
+        self.similar.index_requests()
+        self.assertEqual(self.similar.similar_requests('budget memos finance', user=self.user)[0]['id'], request.id)
+        request.free_edit_body = ''
+        request.save()
+        self.similar.index_requests()
+        self.assertEqual(self.similar.similar_requests('budget memos finance', user=self.user), [])
+
+    def test_attachment_text_is_embedded(self):
+        from django.core.files.base import ContentFile
+        from apps.mail.attachment import Attachment
+        from apps.mail.extraction import extract_attachments
+        from apps.mail.models import MailMessage
+        request = self.add('Contracts', 'Contracts signed with city vendors')
+        self.similar.index_requests()
+        query = 'towing company impound lot invoices'
+        before = self.similar.similar_requests(query, user=self.user, k=1)
+        before = before[0]['score'] if before else 0.0
+        with self.settings(USE_S3=False):
+            atch = Attachment.objects.store(self.usertwo, 'towing.txt',
+                                            ContentFile(b'Invoices from the towing company for impound lot fees'))
+            message = MailMessage.objects.create(email_from='agency@example.com', subject='records',
+                                                 body='attached', request=request)
+            message.attachments.add(atch)
+            extract_attachments([atch], workers=0)
+            self.similar.index_requests()
+            found = self.similar.similar_requests(query, user=self.user, k=1)
+            atch.delete()
+        self.assertEqual(found[0]['id'], request.id)
+        self.assertTrue(found[0]['score'] > before)
+
+    def test_clusters_keep_results_exact_enough(self):
+        import numpy
+        index = self.similar.VectorIndex(self.directory, 32, 'test')
+        rng = numpy.random.RandomState(0)
+        vectors = self.similar.normalize(rng.randn(3000, 32).astype(numpy.float32))
+        with index.writing() as meta:
+            index.append(meta, vectors, [(i, 1, b'F', 0) for i in range(3000)])
+        self.assertEqual(index.read_meta()['lists'], 0)
+        self.similar.TRAIN_AT, saved = 2000, self.similar.TRAIN_AT
+        try:
+            self.assertEqual(index.compact(), 0)
+        finally:
+            self.similar.TRAIN_AT = saved
+        self.assertTrue(index.read_meta()['lists'] > 1)
+        found = index.search(vectors[42], k=1)
+        self.assertEqual(found[0][0], 42)
@@ -6,8 +6,8 @@ from django.views.generic import RedirectView
 from .views import UserRequestListView, RequestDetailView,\
     SingleGroupRequestListView, GroupRequestListView, RequestListViewPublic, request_add_support,\
     PUBLIC_FORMS, show_pubprivate_form, new_new_request,\
-    free_request_edit, send_request, disallow_sunset, send_limit, overall_stats,\
-    LinkUserRequestListView,LinkRequestDetailView
+    free_request_edit, send_request, disallow_sunset, send_limit, overall_stats, export_stats,\
+    LinkUserRequestListView,LinkRequestDetailView, similar_request_suggestions
 from .forms import PubPrivateForm, GovernmentForm
 
 urlpatterns = patterns('',
@@ -19,11 +19,13 @@ urlpatterns = patterns('',
     url(r'group/(?P<pk>.+)/$', login_required(SingleGroupRequestListView.as_view()), name="request_list_single_group"),
     url(r'public/$', RequestListViewPublic.as_view(), name="request_list_public"),
     url(r'new/$', new_new_request, name='request_new',),
+    url(r'similar/$', similar_request_suggestions, name='request_similar'),
     url(r'send/(?P<pk>.+)/$', send_request, name="send_request"),
     url(r'privacy/(?P<pk>.+)/$', disallow_sunset, name="private"),
     url(r'free-form/(?P<pk>.+)/$', free_request_edit, name='free_request_edit'),
     url(r'free-form/$', free_request_edit, name='free_request_edit'),
     url(r'stats/$', direct_to_template, {'template' : 'requests/stats.html'}, name="request_stats"),
+    url(r'stats/export/(?P<name>\w+)/$', export_stats, name="request_stats_export"),
     url(r'embed/$', direct_to_template, {'template' : 'requests/embed_generator.html'}, name="embed_generator"),
     url(r'add-support/(?P<pk>.+)/user/(?P<user_id>.+)$', request_add_support, name="request_add_support"),
     url(r'(?P<pk>.+)/$', RequestDetailView.as_view(), name="request_detail"),
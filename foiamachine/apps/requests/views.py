@@ -5,7 +5,7 @@ from django.http import Http404
 from django.contrib.auth.decorators import login_required
 from django.views.generic import ListView, DetailView
 from django.utils.decorators import method_decorator
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, HttpResponseBadRequest
 from django.contrib.auth.models import User, Group
 from django.template import RequestContext
 import django.template
@@ -15,12 +15,18 @@ from django.db.models import Q
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 from django.core.files.storage import DefaultStorage
+from django.core.urlresolvers import reverse
 from guardian.shortcuts import get_perms, assign_perm, remove_perm, get_groups_with_perms
 
 from apps.mail.views import setup_message_reassignment
 from apps.mail.models import MailBox, Attachment
 from apps.government.models import Government
 from apps.requests.models import Agency, Request, ViewableLink
+from apps.requests.actions import apply_bulk_action, BulkActionError
+from apps.requests.exports import SUMMARY_EXPORTS, RequestListExport
+from apps.requests.similar import similar_requests, visible_requests
+from apps.core.exports import WRITERS, export_response
+from apps.core.pagination import KeysetPaginationMixin
 from apps.contacts.models import Contact
 from apps.requests.forms import PubPrivateForm,\
     GovernmentForm, TopicAgencyForm, DatesForm,UpdateForm,\
@@ -35,6 +41,7 @@ from guardian.shortcuts import get_objects_for_group
 
 from datetime import datetime, timedelta
 from itertools import chain
+import json
 import pytz
 import re
 import logging
@@ -42,6 +49,9 @@ import logging
 logger = logging.getLogger('default')
 register = django.template.Library()
 
+MAX_PER_PAGE = 100
+MAX_SIMILAR = 20
+
 
 PUBLIC_FORMS = [
     ("pub-private", PubPrivateForm),
@@ -145,6 +155,21 @@ def overall_stats(request):
     
     return render_to_response('requests/overall_stats.json', context, context_instance=RequestContext(request))
 
+def export_stats(request, name):
+    '''
+    staff only download of one of the summary exports, streamed so large
+    tables don't have to fit in memory. ?format= is csv, jsonl or parquet
+    '''
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    fmt = request.GET.get('format', 'csv')
+    if name not in SUMMARY_EXPORTS or fmt not in WRITERS:
+        raise Http404
+    try:
+        return export_response(SUMMARY_EXPORTS[name](), fmt)
+    except ImportError as e:
+        return HttpResponseBadRequest(str(e))
+
 def disallow_sunset(request, pk=None, template='requests/request_detail.html'):
     context = {}
     if pk is not None:
@@ -192,6 +217,39 @@ def free_request_edit(request, pk=None, template='requests/free_edit.html'):
     return render_to_response(template, context, context_instance=RequestContext(request))
 
 
+@login_required
+def similar_request_suggestions(request):
+    '''
+    json list of earlier requests like ?q=, for the wizard: public ones and
+    the user's own, best match first. ?outcome=F,P keeps those statuses,
+    ?exclude= leaves out the request being edited
+    '''
+    try:
+        k = min(int(request.GET.get('k', 5)), MAX_SIMILAR)
+        exclude = [int(pk) for pk in request.GET.get('exclude', '').split(',') if pk]
+    except ValueError:
+        return HttpResponse(json.dumps({'error': 'k and exclude must be numbers'}), status=400,
+                            content_type='application/json')
+    statuses = [status for status in request.GET.get('outcome', '').split(',') if status]
+    matches = similar_requests(request.GET.get('q', ''), user=request.user, k=k,
+                               statuses=statuses or None, exclude=exclude)
+    requests = visible_requests(matches, request.user)
+    results = []
+    for match in matches:
+        obj = requests.get(match['id'])
+        if obj is None:
+            continue
+        results.append({
+            'id': obj.id,
+            'title': obj.title,
+            'status': obj.status,
+            'status_display': obj.get_status_display(),
+            'score': match['score'],
+            'url': reverse('request_detail', args=(obj.id,)),
+        })
+    return HttpResponse(json.dumps({'results': results}), content_type='application/json')
+
+
 @login_required
 def send_request(request, pk=None):
     obj = get_object_or_404(Request, id=pk)
@@ -217,7 +275,9 @@ def send_request(request, pk=None):
     return rdv(request=request, pk=pk)
 
 
-class RequestListView(ListView):
+class RequestListView(KeysetPaginationMixin, ListView):
+    # for lists that aren't sorted already, id always breaks ties
+    keyset_ordering = ('-date_added', '-id')
 
 
     def post(self, request, *args, **kwargs):
@@ -232,42 +292,34 @@ class RequestListView(ListView):
             return render_to_response('403.html', {}, context_instance=RequestContext(request))
             
         requests_to_modify = form.cleaned_data['requests_to_modify']
-        action = form.cleaned_data['action']
-
-
-        for obj in requests_to_modify:
-            can_edit = user.has_perm(Request.get_permission_name('edit'), obj)
-            if not can_edit:
-                # Chicanery? 
-                return render_to_response('403.html', {}, context_instance=RequestContext(request))
-
-            if action == "Make Public":
-                obj.private = False
-            elif action == "Make Private":
-                obj.private = True
-            elif action == "Delete":
-                obj.status = 'X'
-            else:
-                obj.status = form.cleaned_data['newstatus']
-                if obj.status != 'F' and obj.status != 'P':
-                    obj.date_fulfilled = None
-                elif obj.status == 'F' or obj.status == 'P':
-                    obj.date_fulfilled = datetime.now()
+        action = form.cleaned_data['action'] or 'Update'
 
-                #groups = form.cleaned_data['groups']
-            obj.save()
+        try:
+            if requests_to_modify:
+                apply_bulk_action(user, action, [obj.pk for obj in requests_to_modify], status=form.cleaned_data['newstatus'])
+        except BulkActionError:
+            # Chicanery? 
+            return render_to_response('403.html', {}, context_instance=RequestContext(request))
 
         # Now use the get handler to reapply the filters
         # and pagination
-        return self.get(request, *args, **kwargs)
+        return ListView.get(self, request, *args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        if request.GET.get('show') == 'all':
+            # everything at once is a download rather than one very long page
+            fmt = request.GET.get('format', 'csv')
+            try:
+                return export_response(RequestListExport(self.get_queryset()), fmt if fmt in WRITERS else 'csv')
+            except ImportError as e:
+                #parquet without pyarrow
+                return HttpResponseBadRequest(str(e))
+        return ListView.get(self, request, *args, **kwargs)
 
     def get_paginate_by(self, qset):
         default_per_page = 20
         try:
-            show_param = self.request.GET.get('show')
-            if show_param == 'all':
-                return None
-            return int(self.request.GET.get('show'))
+            return max(1, min(int(self.request.GET.get('show')), MAX_PER_PAGE))
         except:
             return default_per_page
 
@@ -310,8 +362,9 @@ class RequestListView(ListView):
 
         queries = self.request.GET.copy()
 
-        if 'page' in queries:
-            del queries['page']
+        for key in ('page', 'after', 'before'):
+            if key in queries:
+                del queries[key]
 
         context['show_create'] = False
 
@@ -388,7 +441,7 @@ class UserRequestListView(RequestListView):
         context['scope'] = "My"
         context['user_tags'] = UserProfile.objects.get(user=self.request.user).tags.all()
         try:
-            context['show_create'] = Request.objects.for_user(self.request.user).filter(author=self.request.user).count() <= 0
+            context['show_create'] = not Request.objects.for_user(self.request.user).filter(author=self.request.user).exists()
         except:
             context['show_create'] = False
         return context
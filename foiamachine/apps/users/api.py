@@ -2,6 +2,8 @@ from models import User, Group
 
 from apps.requests.models import Request
 from apps.users.models import UserProfile
+from apps.users.permissions import GroupListPermissions
+from apps.users.tagging import bulk_tag, BulkTagError
 from tastypie.exceptions import ImmediateHttpResponse
 from tastypie.http import HttpBadRequest, HttpForbidden
 from tastypie.resources import ModelResource, ALL, ALL_WITH_RELATIONS, patch_cache_control
@@ -16,6 +18,7 @@ from tastypie import fields
 
 
 from django.conf import settings
+from django.conf.urls.defaults import url
 import logging
 
 logger = logging.getLogger('default')
@@ -88,25 +91,41 @@ class GroupResource(ModelResource):
                 if settings.DEBUG:
                     excluded.append(user.username)
                 retval = Group.objects.all()
-            return retval
+            return retval.prefetch_related('user_set')
         except Exception as e:
             logger.info(e)
             return []
 
 
+    def obj_get_list(self, bundle, **kwargs):
+        #load permissions for every listed group up front instead of per bundle
+        objs = list(super(GroupResource, self).obj_get_list(bundle, **kwargs))
+        self.load_permissions(bundle.request, objs, bundle.request.GET.get("request_id", None))
+        return objs
+
+    def load_permissions(self, request, groups, request_id):
+        request._group_permissions = GroupListPermissions(request.user, groups, request_id)
+        return request._group_permissions
+
+    def get_permissions(self, bundle):
+        perms = getattr(bundle.request, '_group_permissions', None)
+        if perms is None or not perms.covers(bundle.obj, bundle.data['request_id']):
+            #detail views and groups created or updated in this request
+            perms = self.load_permissions(bundle.request, [bundle.obj], bundle.data['request_id'])
+        return perms
+
     def dehydrate(self, bundle):
         if 'request_id' not in bundle.data.keys():
             bundle.data['request_id'] = bundle.request.GET.get("request_id", None)
-        bundle.data['toggle_to_edit'] = bundle.request.user.has_perm(UserProfile.get_permission_name('edit'), bundle.obj)
+        perms = self.get_permissions(bundle)
+        edit_group = UserProfile.get_permission_name('edit')
+        bundle.data['can_edit'] = perms.user_has_perm(bundle.request.user, edit_group, bundle.obj)
+        bundle.data['toggle_to_edit'] = bundle.data['can_edit']
         if bundle.data['request_id']:
-            checker = ObjectPermissionChecker(bundle.obj)
-            bundle.data['toggle_to_edit'] = checker.has_perm(Request.get_permission_name('edit'), Request.objects.get(id=bundle.data['request_id']))
-        if not bundle.request.user.is_authenticated():
-            bundle.data['can_edit'] = False
-        bundle.data['can_edit'] = bundle.request.user.has_perm(UserProfile.get_permission_name('edit'), bundle.obj)
+            bundle.data['toggle_to_edit'] = perms.group_has_perm(bundle.obj, Request.get_permission_name('edit'))
         bundle.data['type'] = 'group'
         for usr in bundle.data['users']:
-            usr.data['toggle_to_edit'] = usr.obj.has_perm(UserProfile.get_permission_name('edit'), bundle.obj)
+            usr.data['toggle_to_edit'] = perms.user_has_perm(usr.obj, edit_group, bundle.obj)
         return bundle
 
     def hydrate(self, bundle):
@@ -266,16 +285,52 @@ class TagResource(ModelResource):
             bundle.data['request_id'] = bundle.request.GET.get("request_id", None)
 
         if bundle.request.user.is_authenticated():            
-            user = bundle.request.user
-            up = UserProfile.objects.get(user=user)
-            bundle.data['can_edit'] = (up.tags.filter(id=bundle.data['id']).count() > 0)
+            bundle.data['can_edit'] = bundle.obj.pk in self.get_user_tag_ids(bundle.request)
         else:
             bundle.data['can_edit'] = False
         return bundle
 
+    def get_user_tag_ids(self, request):
+        '''
+        ids of the tags in the user's profile, one query per api request rather than per tag
+        '''
+        tag_ids = getattr(request, '_user_tag_ids', None)
+        if tag_ids is None:
+            tag_ids = set(UserProfile.objects.filter(user=request.user, tags__isnull=False).values_list('tags__id', flat=True))
+            request._user_tag_ids = tag_ids
+        return tag_ids
+
     def hydrate(self, bundle):
         return bundle
 
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/bulk/$" % self._meta.resource_name, self.wrap_view('bulk_tag'), name="api_tag_bulk"),
+        ]
+
+    def run_bulk_tag(self, user, action, name, request_ids=(), tag_id=None, new_name=None, strict=False):
+        try:
+            return bulk_tag(user, action, name, request_ids, tag_id=tag_id, new_name=new_name, strict=strict)
+        except BulkTagError as e:
+            raise ImmediateHttpResponse(HttpForbidden(str(e)))
+
+    def bulk_tag(self, request, **kwargs):
+        '''
+        POST {"action": "associate"|"disassociate"|"rename", "name": ..., "request_ids": [...], "id": ...}
+        to tag/untag many requests in one call. Every request has to be
+        taggable by the user or nothing is changed. Returns what was done.
+        '''
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        if not request.user.is_authenticated():
+            return HttpForbidden("You need to be logged in to tag requests.")
+        data = self.deserialize(request, request.body, format=request.META.get('CONTENT_TYPE', 'application/json'))
+        if not data.get('action') or not data.get('name'):
+            return HttpBadRequest("action and name are required")
+        summary = self.run_bulk_tag(request.user, data['action'], data['name'], data.get('request_ids', []),
+            tag_id=data.get('id'), new_name=data.get('new_name'))
+        return self.create_response(request, summary)
+
     def obj_create(self, bundle, **kwargs):
         try:
             data = bundle.data
@@ -291,20 +346,11 @@ class TagResource(ModelResource):
                     bundle.data['data']['result'] = 'created'
                     bundle.obj = obj
                 if 'request_ids' in data.keys():
-                    requests = Request.objects.filter(id__in=data['request_ids'])
-                    for req in requests:
-                        can_edit = user.has_perm(Request.get_permission_name('view'), req)
-
-                        if not can_edit:
-                            logger.info("%s tried to add/edit/rename tags from request %s owned by %s" % (bundle.request.user, req, req.author))
-                            raise ImmediateHttpResponse(HttpForbidden("It appears you do not have permissions to add or remove tags here."))
+                    summary = self.run_bulk_tag(user, 'associate', data['name'], data['request_ids'])
                     bundle.data['data']['result'] = 'created'
-                    up.tags.add(data['name'])
-                    obj = up.tags.get(name=data['name'])
-                    bundle.obj = obj
-                    for req in requests:
-                        req.tags.add(data['name'])
-                    
+                    bundle.obj = up.tags.get(id=summary['tag_id'])
+        except ImmediateHttpResponse:
+            raise
         except Exception as e:
             logger.exception(e)
         return bundle
@@ -325,46 +371,14 @@ class TagResource(ModelResource):
         up = UserProfile.objects.get(user=user)
         bundle.obj = Group.objects.get(id=data['id'])
         if 'data' in data.keys():
-            if 'action' in data['data'].keys() and 'request_ids' in data.keys():
+            if data['data'].get('action') in ('associate', 'disassociate') and 'request_ids' in data.keys():
                 # For bulk tagging
-                requests = Request.objects.filter(id__in=data['request_ids'])
-                for req in requests:
-                    can_edit = user.has_perm(Request.get_permission_name('view'), req)
-
-                    if not can_edit:
-                        logger.info("%s tried to add/edit/rename tags from request %s owned by %s" % (bundle.request.user, req, req.author))
-                        raise ImmediateHttpResponse(HttpForbidden("It appears you do not have permissions to add or remove tags here."))
-
-                for req in requests:
-                    # OK, they have permission, now let's actually do it
-
-                    if data['data']['action'] == 'associate':
-                        obj = up.tags.get(id=data['id'])
-                        tags = req.tags.filter(name=data['name'])
-                        if tags:
-                            # Already tagged like that
-                            for tag in tags:
-                                if tag.id != obj.id:
-                                    # Already tagged by another user
-                                    raise ImmediateHttpResponse(HttpForbidden("A tag by this name is already associated with one of these requests by another user."))
-                        else:
-                            # Tag it now
-                            req.tags.add(obj)
-
-                    elif data['data']['action'] == 'disassociate':
-                        req.tags.remove(data['name'])
-
+                if data['data']['action'] == 'associate':
+                    #the tag being associated has to be one of the user's own
+                    data['name'] = up.tags.get(id=data['id']).name
+                self.run_bulk_tag(user, data['data']['action'], data['name'], data['request_ids'], strict=True)
                 bundle.obj = Tag.objects.get(id=data['id'])
 
-                        
-                        
-
-
-
-
-
-                    
-
             if 'request_id' in data.keys():
                 req = Request.objects.get(id=data['request_id'])
                 can_edit = user.has_perm(Request.get_permission_name('view'), req)
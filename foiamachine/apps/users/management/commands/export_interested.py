@@ -1,7 +1,7 @@
 from django.core.management.base import BaseCommand
 from apps.users.models import InterestedParty
 from datetime import datetime
-from apps.core.unicode_csv import UnicodeWriter
+from apps.core.csvio import CSVWriter
 import logging
 import csv
 
@@ -11,7 +11,7 @@ logger = logging.getLogger('default')
 class Command(BaseCommand):
 
     def handle(self, *args, **options):
-        writer = UnicodeWriter(open('interesed-parties-%s.csv' % datetime.now().date(), 'wb'))
+        writer = CSVWriter(open('interesed-parties-%s.csv' % datetime.now().date(), 'wb'))
         parties = InterestedParty.objects.all()
         if len(args) > 0:
             #whitelist file location
@@ -4,7 +4,7 @@ from apps.users.models import InterestedParty, ActivationKeyValue
 from django.template.loader import get_template
 from django.contrib.sites.models import Site
 from django.template import Context
-from apps.core.unicode_csv import UnicodeWriter
+from apps.core.csvio import CSVWriter
 
 from datetime import datetime
 import os
@@ -21,7 +21,7 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         current_site = Site.objects.get_current()
         parties = InterestedParty.objects.filter(activation_key=None)
-        writer = UnicodeWriter(open('whitelist-%s.csv' % datetime.now().date(), 'wb'))
+        writer = CSVWriter(open('whitelist-%s.csv' % datetime.now().date(), 'wb'))
         headers = ['email']
         writer.writerow(headers)
         interests = {}
@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand
 from apps.users.models import InterestedParty
-from apps.core.unicode_csv import UnicodeReader
+from apps.core.csvio import CSVReader
 from datetime import datetime
 import logging
 import csv
@@ -12,9 +12,9 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         fname = args[0]
-        reader = list(UnicodeReader(open(fname, 'rb')))
+        reader = CSVReader(fname, header=True)
         headers = ['name', 'email', 'activation_key', 'activated_on', 'interested_in']
-        for row in reader[1:]:
+        for row in reader:
             try:
                 ip = InterestedParty(first_name=row[0], last_name=row[1], email=row[2])
                 ip.save()
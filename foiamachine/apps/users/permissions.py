@@ -0,0 +1,95 @@
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from guardian.models import UserObjectPermission, GroupObjectPermission
+
+from apps.requests.models import Request
+
+
+def codename(perm):
+    return perm.split('.')[-1]
+
+
+class UserPermissionBatch(object):
+    '''
+    Answers user.has_perm(perm, obj) for a set of users and objects of one
+    model from two queries: permissions assigned to the users directly and
+    permissions they get through their groups. Same answers as guardian's
+    backend for active, authenticated users.
+    '''
+
+    def __init__(self, users, objs):
+        objs = list(objs)
+        self.perms = defaultdict(set)
+        self.users = dict((user.pk, user) for user in users if user is not None and user.pk is not None)
+        if not objs or not self.users:
+            return
+        content_type = ContentType.objects.get_for_model(objs[0])
+        object_pks = [str(obj.pk) for obj in objs]
+        direct = UserObjectPermission.objects.filter(user__in=list(self.users.keys()),
+            content_type=content_type, object_pk__in=object_pks)\
+            .values_list('user_id', 'object_pk', 'permission__codename')
+        via_groups = GroupObjectPermission.objects.filter(group__user__in=list(self.users.keys()),
+            content_type=content_type, object_pk__in=object_pks)\
+            .values_list('group__user', 'object_pk', 'permission__codename')
+        for rows in (direct, via_groups):
+            for user_id, object_pk, code in rows:
+                self.perms[(user_id, object_pk)].add(code)
+
+    def has_perm(self, user, perm, obj):
+        if user is None or not user.is_authenticated() or not user.is_active:
+            return False
+        if user.is_superuser:
+            return True
+        return codename(perm) in self.perms.get((user.pk, str(obj.pk)), ())
+
+
+class GroupPermissionBatch(object):
+    '''
+    ObjectPermissionChecker(group).has_perm(perm, obj) for many groups at
+    once, from a single query
+    '''
+
+    def __init__(self, groups, objs):
+        objs = list(objs)
+        groups = [group.pk for group in groups]
+        self.perms = defaultdict(set)
+        if not objs or not groups:
+            return
+        rows = GroupObjectPermission.objects.filter(group__in=groups,
+            content_type=ContentType.objects.get_for_model(objs[0]),
+            object_pk__in=[str(obj.pk) for obj in objs])\
+            .values_list('group_id', 'object_pk', 'permission__codename')
+        for group_id, object_pk, code in rows:
+            self.perms[(group_id, object_pk)].add(code)
+
+    def has_perm(self, group, perm, obj):
+        return codename(perm) in self.perms.get((group.pk, str(obj.pk)), ())
+
+
+class GroupListPermissions(object):
+    '''
+    everything GroupResource.dehydrate asks about a list of groups: the
+    requesting user's and every member's permissions on each group, and
+    each group's permissions on the request being shared (if any)
+    '''
+
+    def __init__(self, user, groups, request_id=None):
+        groups = list(groups)
+        self.group_ids = set(group.pk for group in groups)
+        self.request_id = str(request_id) if request_id else None
+        request_obj = Request.objects.filter(id=request_id).first() if request_id else None
+        self.request_obj = request_obj
+        members = dict((member.pk, member) for group in groups for member in group.user_set.all())
+        members[user.pk] = user
+        self.users = UserPermissionBatch(members.values(), groups)
+        self.groups = GroupPermissionBatch(groups, [request_obj]) if request_obj is not None else None
+
+    def covers(self, group, request_id=None):
+        return group.pk in self.group_ids and (str(request_id) if request_id else None) == self.request_id
+
+    def user_has_perm(self, user, perm, group):
+        return self.users.has_perm(user, perm, group)
+
+    def group_has_perm(self, group, perm):
+        return self.groups is not None and self.groups.has_perm(group, perm, self.request_obj)
@@ -0,0 +1,109 @@
+'''
+Tag many requests at once. Permissions are checked with one set based
+query and TaggedItem rows are written in bulk instead of a taggit round
+trip per request.
+'''
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from guardian.shortcuts import get_objects_for_user
+from taggit.models import Tag, TaggedItem
+
+from apps.requests.models import Request
+from apps.users.models import UserProfile
+
+import logging
+
+logger = logging.getLogger('default')
+
+BULK_TAG_ACTIONS = ('associate', 'disassociate', 'rename')
+
+
+class BulkTagError(Exception):
+    '''
+    raised when nothing was changed, the message is safe to show to the user
+    '''
+    def __init__(self, message, forbidden=None):
+        super(BulkTagError, self).__init__(message)
+        self.forbidden = forbidden or []
+
+
+def allowed_request_ids(user, request_ids):
+    '''
+    the subset of request_ids the user may tag, like calling
+    user.has_perm(view) on every request
+    '''
+    ids = set(int(rid) for rid in request_ids)
+    allowed = get_objects_for_user(user, Request.get_permissions_path('view'),
+        klass=Request.objects.filter(id__in=ids)).values_list('id', flat=True)
+    return set(allowed), ids
+
+
+def bulk_tag(user, action, name, request_ids=(), tag_id=None, new_name=None, strict=False):
+    '''
+    associate or disassociate the tag called name on every request in
+    request_ids, or rename one of the user's tags. All requests must be
+    taggable by the user or nothing changes. Requests that already have
+    another user's tag with the same name are skipped and listed as
+    conflicts, or with strict=True fail the whole call. Returns a summary dict.
+    '''
+    if action not in BULK_TAG_ACTIONS:
+        raise BulkTagError("Unknown tag action %s" % action)
+    up = UserProfile.objects.get(user=user)
+    if action == 'rename':
+        return rename_tag(up, tag_id, new_name or name)
+
+    allowed, ids = allowed_request_ids(user, request_ids)
+    forbidden = sorted(ids - allowed)
+    if forbidden:
+        logger.info("%s tried to add/edit/rename tags on requests %s" % (user, forbidden))
+        raise BulkTagError("It appears you do not have permissions to add or remove tags here.", forbidden)
+
+    content_type = ContentType.objects.get_for_model(Request)
+    summary = {'action': action, 'tag': name, 'requests': len(ids), 'changed': 0, 'unchanged': 0, 'conflicts': []}
+    with transaction.atomic():
+        if action == 'disassociate':
+            summary['changed'], _ = TaggedItem.objects.filter(tag__name=name,
+                content_type=content_type, object_id__in=ids).delete()
+            summary['unchanged'] = len(ids) - summary['changed']
+            return summary
+
+        up.tags.add(name)
+        tag = up.tags.get(name=name)
+        summary['tag_id'] = tag.id
+        tagged = TaggedItem.objects.filter(tag__name=name, content_type=content_type, object_id__in=ids)\
+            .values_list('object_id', 'tag_id')
+        already, conflicts = set(), set()
+        for object_id, other_tag_id in tagged:
+            if other_tag_id == tag.id:
+                already.add(object_id)
+            else:
+                #another user's tag with the same name
+                conflicts.add(object_id)
+        if conflicts and strict:
+            raise BulkTagError("A tag by this name is already associated with one of these requests by another user.")
+        TaggedItem.objects.bulk_create([
+            TaggedItem(tag=tag, content_type=content_type, object_id=rid)
+            for rid in sorted(ids - already - conflicts)])
+        summary['changed'] = len(ids - already - conflicts)
+        summary['unchanged'] = len(already)
+        summary['conflicts'] = sorted(conflicts)
+    return summary
+
+
+def rename_tag(up, tag_id, new_name):
+    '''
+    only the user who has the tag in their profile can rename it
+    '''
+    usertags = up.tags.all()
+    if not new_name:
+        raise BulkTagError("Tag must have a name")
+    if tag_id is None or not usertags.filter(id=tag_id).exists():
+        raise BulkTagError("It appears you do not have permissions to edit this tag.")
+    if usertags.filter(name=new_name).exclude(id=tag_id).exists():
+        raise BulkTagError("You already have a tag by this name.")
+    tag = Tag.objects.get(id=tag_id)
+    old_name = tag.name
+    tag.name = new_name
+    tag.save()
+    return {'action': 'rename', 'tag': new_name, 'tag_id': tag.id, 'renamed_from': old_name,
+            'requests': TaggedItem.objects.filter(tag=tag, content_type=ContentType.objects.get_for_model(Request)).count()}
@@ -211,3 +211,95 @@ class GroupPermissions(UserTestBase):
         requestjson = json.loads(resp.content).copy()
         self.assertEqual(len(requestjson['objects']), 0)
 
+
+
+class BatchedPermissions(UserTestBase):
+
+    def create_groups(self, count):
+        for i in range(count):
+            self.api_client.post('/api/v1/group/', format='json', data={'name': 'batch group %s' % i}, authentication=self.get_credentials())
+
+    def test_batch_matches_guardian(self):
+        from django.contrib.auth.models import Group
+        from guardian.shortcuts import assign_perm
+        from apps.users.permissions import UserPermissionBatch
+        self.create_groups(3)
+        groups = list(Group.objects.filter(name__startswith='batch group'))
+        #direct permission for usertwo, userthree gets it through a group it belongs to
+        assign_perm(UserProfile.get_permission_name('edit'), self.usertwo, groups[0])
+        groups[1].user_set.add(self.userthree)
+        assign_perm(UserProfile.get_permission_name('view'), groups[1], groups[2])
+
+        users = [self.user, self.usertwo, self.userthree]
+        batch = UserPermissionBatch(users, groups)
+        for user in users:
+            for group in groups:
+                for key in ('edit', 'view'):
+                    perm = UserProfile.get_permission_name(key)
+                    self.assertEqual(batch.has_perm(user, perm, group), user.has_perm(perm, group))
+
+    def test_group_list_queries_are_flat(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        self.create_groups(2)
+        self.get_credentials()
+        with CaptureQueriesContext(connection) as few:
+            resp = self.api_client.get('/api/v1/group/', format='json')
+        self.assertValidJSONResponse(resp)
+        listed = len(json.loads(resp.content)['objects'])
+        self.create_groups(6)
+        with CaptureQueriesContext(connection) as many:
+            resp = self.api_client.get('/api/v1/group/', format='json')
+        self.assertEqual(len(json.loads(resp.content)['objects']), listed + 6)
+        self.assertEqual(len(few), len(many))
+
+
+class BulkTagging(UserTestBase):
+
+    def create_requests(self, count, username='john'):
+        self.get_credentials_other(username)
+        for i in range(count):
+            self.api_client.post('/api/v1/request/', format='json', data={
+                'contacts': [], 'free_edit_body': "<p>bulk %s</p>" % i, 'private': True, 'title': "bulk %s %s" % (username, i)})
+        return list(Request.objects.filter(title__startswith="bulk %s" % username).values_list('id', flat=True))
+
+    def bulk(self, data, username='john'):
+        self.get_credentials_other(username)
+        return self.api_client.post('/api/v1/tag/bulk/', format='json', data=data)
+
+    def tagged(self, name, ids):
+        return Request.objects.filter(id__in=ids, tags__name=name).count()
+
+    def test_associate_is_idempotent(self):
+        ids = self.create_requests(5)
+        resp = self.bulk({'action': 'associate', 'name': 'phase1', 'request_ids': ids})
+        self.assertValidJSONResponse(resp)
+        summary = json.loads(resp.content)
+        self.assertEqual(summary['changed'], 5)
+        self.assertEqual(self.tagged('phase1', ids), 5)
+        self.assertEqual(UserProfile.objects.get(user=self.user).tags.filter(name='phase1').count(), 1)
+
+        summary = json.loads(self.bulk({'action': 'associate', 'name': 'phase1', 'request_ids': ids}).content)
+        self.assertEqual(summary['changed'], 0)
+        self.assertEqual(summary['unchanged'], 5)
+        self.assertEqual(self.tagged('phase1', ids), 5)
+
+    def test_forbidden_changes_nothing(self):
+        mine = self.create_requests(2)
+        theirs = self.create_requests(1, username=self.usertwo.username)
+        resp = self.bulk({'action': 'associate', 'name': 'phase1', 'request_ids': mine + theirs})
+        self.assertHttpForbidden(resp)
+        self.assertEqual(self.tagged('phase1', mine + theirs), 0)
+
+    def test_disassociate_and_rename(self):
+        ids = self.create_requests(3)
+        tag_id = json.loads(self.bulk({'action': 'associate', 'name': 'phase1', 'request_ids': ids}).content)['tag_id']
+        summary = json.loads(self.bulk({'action': 'disassociate', 'name': 'phase1', 'request_ids': ids[:2]}).content)
+        self.assertEqual(summary['changed'], 2)
+        self.assertEqual(self.tagged('phase1', ids), 1)
+
+        summary = json.loads(self.bulk({'action': 'rename', 'name': 'phase2', 'id': tag_id}).content)
+        self.assertEqual(summary['renamed_from'], 'phase1')
+        self.assertEqual(self.tagged('phase2', ids), 1)
+        #only the owner can rename
+        self.assertHttpForbidden(self.bulk({'action': 'rename', 'name': 'phase3', 'id': tag_id}, username=self.usertwo.username))
@@ -25,6 +25,22 @@ app.conf.beat_schedule = {
     },
     'analyze-new-responses': {
         'task': 'foiamachine.apps.agents.tasks.analyze_new_responses',
-        'schedule': crontab(hour='*/6'),  # Run every 6 hours
+        'schedule': crontab(minute='*/30'),  # Safety sweep, mail triggers analysis as it arrives
+    },
+    'requeue-stalled-agent-tasks': {
+        'task': 'foiamachine.apps.agents.tasks.requeue_stalled_agent_tasks',
+        'schedule': crontab(minute='*/15'),  # Tasks stuck past the processing timeout
+    },
+    'rollup-agent-usage': {
+        'task': 'foiamachine.apps.agents.tasks.rollup_agent_usage',
+        'schedule': crontab(minute='*/15'),  # Usage dashboard is this fresh
+    },
+    'index-similar-requests': {
+        'task': 'foiamachine.apps.requests.tasks.index_similar_requests',
+        'schedule': crontab(minute='*/10'),  # Only changed requests are embedded
+    },
+    'poll-mail': {
+        'task': 'foiamachine.apps.mail.tasks.poll_mail',
+        'schedule': crontab(minute='*/5'),  # Only new messages are downloaded
     },
 }
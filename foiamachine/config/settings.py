@@ -176,6 +176,30 @@ AGENT_CONFIG = {
     'MODEL': os.getenv('AGENT_MODEL', 'gpt-4-turbo-preview'),
     'TEMPERATURE': float(os.getenv('AGENT_TEMPERATURE', '0.7')),
     'MAX_TOKENS': 2000,
+    # OpenAI-compatible endpoint, e.g. a local mock or proxy
+    'API_BASE': os.getenv('AGENT_API_BASE', ''),
+    # concurrent LLM calls per engine run
+    'WORKERS': int(os.getenv('AGENT_WORKERS', '4')),
+    # prompts per call for endpoints that accept a list of prompts
+    'BATCH_SIZE': int(os.getenv('AGENT_BATCH_SIZE', '1')),
+    # 0 means no token-rate limit
+    'TOKENS_PER_MINUTE': int(os.getenv('AGENT_TOKENS_PER_MINUTE', '0')),
+    'TIMEOUT': float(os.getenv('AGENT_TIMEOUT', '60')),
+    # retries on rate limits, gateway errors and dropped connections
+    'RETRIES': int(os.getenv('AGENT_RETRIES', '2')),
+    'RETRY_BACKOFF': float(os.getenv('AGENT_RETRY_BACKOFF', '1')),
+    # USD per 1K (prompt, completion) tokens by model, added to the defaults in agents/usage.py
+    'PRICES': {},
+    # seconds a request's responses must be quiet before they are analyzed,
+    # and the longest a steady stream of them can hold the analysis back
+    'ANALYSIS_DEBOUNCE': int(os.getenv('AGENT_ANALYSIS_DEBOUNCE', '60')),
+    'ANALYSIS_MAX_DELAY': int(os.getenv('AGENT_ANALYSIS_MAX_DELAY', '600')),
+    # days of per-call records kept once they are rolled up
+    'CALL_LOG_DAYS': int(os.getenv('AGENT_CALL_LOG_DAYS', '30')),
+    # completions cache, empty turns it off
+    'CACHE_PATH': os.getenv('AGENT_CACHE_PATH', str(BASE_DIR / 'var' / 'llm_cache.sqlite3')),
+    'CACHE_TTL': int(os.getenv('AGENT_CACHE_TTL', str(7 * 24 * 60 * 60))),
+    'CACHE_MAX_ENTRIES': int(os.getenv('AGENT_CACHE_MAX_ENTRIES', '10000')),
 }
 
 # Application Settings
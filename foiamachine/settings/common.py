@@ -256,6 +256,8 @@ DOCUMENTS_PATH = os.path.join(MEDIA_ROOT, 'documents')
 MAILGUN_API = 'https://api.mailgun.net/v2'
 MAILGUN_KEY = env("MAILGUN_KEY", "")
 MAILGUN_POP = 'pop3.mailgun.org'
+MAILGUN_POP_PORT = int(env("MAILGUN_POP_PORT", 110))
+MAILGUN_POP_PASSWORD = env("MAILGUN_POP_PASSWORD", "")
 MG_POST_URL = env("MG_POST_URL", "")
 MG_DOMAIN = env("MG_DOMAIN", "")
 
@@ -300,6 +302,17 @@ BLEACH_STRIP_COMMENTS = True
 
 ATTACHMENT_SIZE_LIMIT = 1024 * 1024 * 2 #2M
 
+# Similar request suggestions, see apps.requests.similar. The embedder is a
+# dotted path, empty for the built-in hashing vectorizer
+SIMILAR_REQUESTS_PATH = env("SIMILAR_REQUESTS_PATH", os.path.join(SITE_ROOT, 'var', 'similar_requests'))
+SIMILAR_REQUESTS_EMBEDDER = env("SIMILAR_REQUESTS_EMBEDDER", "")
+SIMILAR_REQUESTS_MODEL = env("SIMILAR_REQUESTS_MODEL", "")
+SIMILAR_REQUESTS_DIM = 256
+
+# Attachment text, see apps.mail.extraction. The OCR backend for scanned
+# PDFs is a dotted path, e.g. apps.mail.extraction.TesseractOCR, empty for none
+ATTACHMENT_OCR = env("ATTACHMENT_OCR", "")
+
 
 try:
     from local import *